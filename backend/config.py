@@ -63,6 +63,17 @@ SMTP_EMAIL = os.environ.get('SMTP_EMAIL', '')
 SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD', '')
 
 
+# ====================================================================
+# WEBSOCKET CONFIG
+# ====================================================================
+WS_HEARTBEAT_INTERVAL_SECONDS = int(os.environ.get('WS_HEARTBEAT_INTERVAL_SECONDS', '30'))
+WS_HEARTBEAT_MAX_MISSED = int(os.environ.get('WS_HEARTBEAT_MAX_MISSED', '3'))
+WS_MAX_CONNECTIONS_PER_USER = int(os.environ.get('WS_MAX_CONNECTIONS_PER_USER', '5'))
+WS_MAX_CONNECTIONS_PER_WORKER = int(os.environ.get('WS_MAX_CONNECTIONS_PER_WORKER', '2000'))
+# Janela (ms) para agrupar notificações do mesmo utilizador num só envio (0 = desactivado)
+NOTIFICATION_COALESCE_WINDOW_MS = int(os.environ.get('NOTIFICATION_COALESCE_WINDOW_MS', '150'))
+
+
 # ====================================================================
 # TRELLO CONFIG (opcional - para integração futura)
 # ====================================================================
@@ -38,6 +38,15 @@ class UserRole:
         return role in [cls.ADMIN, cls.CEO, cls.DIRETOR]
 
 
+class EmailDigestMode:
+    """Frequência dos emails de notificação para staff."""
+    IMMEDIATE = "immediate"  # Um email por evento
+    HOURLY = "hourly"  # Resumo de hora a hora
+    DAILY = "daily"  # Resumo diário
+    
+    ALL = [IMMEDIATE, HOURLY, DAILY]
+
+
 class UserRegister(BaseModel):
     email: EmailStr
     password: str
@@ -60,6 +69,7 @@ class UserResponse(BaseModel):
     is_active: Optional[bool] = True
     created_at: Optional[str] = None
     onedrive_folder: Optional[str] = None
+    email_digest_mode: Optional[str] = EmailDigestMode.IMMEDIATE
 
 
 class TokenResponse(BaseModel):
@@ -85,3 +95,8 @@ class UserUpdate(BaseModel):
     company: Optional[str] = None  # Empresa do utilizador
     is_active: Optional[bool] = None
     onedrive_folder: Optional[str] = None
+    email_digest_mode: Optional[str] = None
+
+
+class NotificationPreferencesUpdate(BaseModel):
+    email_digest_mode: str  # immediate | hourly | daily
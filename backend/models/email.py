@@ -57,6 +57,37 @@ class EmailUpdate(BaseModel):
     status: Optional[EmailStatus] = None
 
 
+class EmailSummary(BaseModel):
+    """Resumo de email para listagens (sem o corpo)."""
+    id: str
+    process_id: str
+    client_name: Optional[str] = None
+    direction: EmailDirection
+    from_email: str
+    to_emails: List[str]
+    cc_emails: Optional[List[str]] = []
+    subject: str
+    preview: Optional[str] = ""
+    thread_key: Optional[str] = None
+    body_size: Optional[int] = None
+    html_size: Optional[int] = None
+    has_html: Optional[bool] = False
+    attachments: Optional[List[EmailAttachment]] = []
+    attachments_count: Optional[int] = 0
+    status: EmailStatus
+    sent_at: Optional[str] = None
+    created_at: str
+    created_by: Optional[str] = None
+    created_by_name: Optional[str] = None
+    notes: Optional[str] = None
+
+
+class EmailPage(BaseModel):
+    """Página de emails de um processo (paginação por cursor)."""
+    emails: List[EmailSummary]
+    next_cursor: Optional[str] = None
+
+
 class EmailResponse(BaseModel):
     """Resposta de email."""
     id: str
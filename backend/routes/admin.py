@@ -4,9 +4,12 @@ from typing import List, Optional
 from fastapi import APIRouter, Depends, HTTPException
 
 from database import db
-from models.auth import UserRole, UserCreate, UserUpdate, UserResponse
+from models.auth import UserRole, UserCreate, UserUpdate, UserResponse, EmailDigestMode
 from models.workflow import WorkflowStatusCreate, WorkflowStatusUpdate, WorkflowStatusResponse
 from services.auth import hash_password, require_roles
+from services.staff_directory import staff_directory
+from services.notification_inbox import notification_inbox
+from services.email_outbox import get_email_outbox_stats
 
 
 router = APIRouter(prefix="/admin", tags=["Admin"])
@@ -125,6 +128,7 @@ async def create_user(data: UserCreate, user: dict = Depends(require_roles([User
     }
     
     await db.users.insert_one(user_doc)
+    await staff_directory.refresh_user(user_id)
     
     # Associar automaticamente processos do Trello que têm este utilizador atribuído
     # Verifica se o nome do utilizador corresponde a algum membro atribuído no Trello
@@ -192,9 +196,17 @@ async def update_user(user_id: str, data: UserUpdate, user: dict = Depends(requi
         update_data["is_active"] = data.is_active
     if data.onedrive_folder is not None:
         update_data["onedrive_folder"] = data.onedrive_folder
+    if data.email_digest_mode is not None:
+        if data.email_digest_mode not in EmailDigestMode.ALL:
+            raise HTTPException(status_code=400, detail="Frequência de email inválida")
+        update_data["email_digest_mode"] = data.email_digest_mode
     
     if update_data:
         await db.users.update_one({"id": user_id}, {"$set": update_data})
+        await staff_directory.refresh_user(user_id)
+        if "role" in update_data or "is_active" in update_data:
+            # A audiência visível mudou: recalcular o contador de não lidas
+            await notification_inbox.reset_counters([user_id])
     
     updated = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0})
     return UserResponse(**updated)
@@ -208,6 +220,8 @@ async def delete_user(user_id: str, user: dict = Depends(require_roles([UserRole
     result = await db.users.delete_one({"id": user_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Utilizador não encontrado")
+    staff_directory.remove_user(user_id)
+    await notification_inbox.reset_counters([user_id])
     return {"message": "Utilizador eliminado"}
 
 
@@ -354,3 +368,11 @@ async def migrate_process_numbers(user: dict = Depends(require_roles([UserRole.A
     }
 
 
+# ============== OUTBOX DE EMAILS ==============
+
+@router.get("/email-outbox")
+async def get_email_outbox_status(user: dict = Depends(require_roles([UserRole.ADMIN]))):
+    """
+    Estado do outbox de emails (pendentes, enviados e falhados).
+    """
+    return await get_email_outbox_stats()
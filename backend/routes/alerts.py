@@ -9,10 +9,9 @@ Autor: CreditoIMO Development Team
 """
 
 from typing import List, Optional
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
 
 from database import db
-from models.auth import UserRole
 from services.auth import get_current_user
 from services.alerts import (
     get_process_alerts,
@@ -23,6 +22,7 @@ from services.alerts import (
     create_deed_reminder,
     ALERT_TYPES
 )
+from services.notification_inbox import notification_inbox, InvalidCursorError, NOTIFICATION_PAGE_MAX
 
 
 router = APIRouter(prefix="/alerts", tags=["Alerts"])
@@ -159,52 +159,68 @@ async def create_deed_reminder_endpoint(
 @router.get("/notifications")
 async def get_notifications(
     unread_only: bool = False,
+    limit: int = Query(50, ge=1, le=NOTIFICATION_PAGE_MAX),
+    cursor: Optional[str] = None,
     user: dict = Depends(get_current_user)
 ):
     """
-    Obter notificações do sistema.
-    
-    Regras de visibilidade:
-    - Admin, CEO, Diretor: vêem TODAS as notificações (incluindo novos registos)
-    - Outros: vêem apenas notificações dos seus processos
-    """
-    query = {}
-    
-    if unread_only:
-        query["read"] = False
-    
-    # Admin, CEO e Diretor vêem todas as notificações
-    if user["role"] not in [UserRole.ADMIN, UserRole.CEO, UserRole.DIRETOR]:
-        # Outros utilizadores vêem apenas notificações dos seus processos
-        # E NÃO vêem notificações de novos registos
-        processes = await db.processes.find({
-            "$or": [
-                {"assigned_consultor_id": user["id"]},
-                {"consultor_id": user["id"]},
-                {"assigned_mediador_id": user["id"]},
-                {"intermediario_id": user["id"]}
-            ]
-        }, {"id": 1, "_id": 0}).to_list(1000)
-        process_ids = [p["id"] for p in processes]
-        
-        # Excluir notificações de novos registos para utilizadores não-admin
-        query["$and"] = [
-            {"$or": [
-                {"process_id": {"$in": process_ids}},
-                {"process_id": None}  # Notificações sem processo específico
-            ]},
-            {"type": {"$ne": "new_registration"}}  # Excluir novos registos
-        ]
-    
-    notifications = await db.notifications.find(query, {"_id": 0}).sort("created_at", -1).to_list(100)
+    Obter notificações do sistema (paginação por cursor).
+    
+    Regras de visibilidade (audiência calculada na criação):
+    - Notificações pessoais: apenas o destinatário
+    - Novos registos e alertas gerais: Admin, CEO, Diretor e participantes do processo
+    
+    Para obter a página seguinte, enviar o `next_cursor` da resposta.
+    """
+    try:
+        page = await notification_inbox.list_for_user(user, unread_only, limit, cursor)
+    except InvalidCursorError:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
     
     return {
-        "notifications": notifications,
-        "total": len(notifications),
-        "unread": sum(1 for n in notifications if not n.get("read"))
+        "notifications": page["notifications"],
+        "total": len(page["notifications"]),
+        "unread": await notification_inbox.unread_count(user),
+        "next_cursor": page["next_cursor"]
     }
 
 
+@router.get("/notifications/unread-count")
+async def get_unread_notifications_count(user: dict = Depends(get_current_user)):
+    """
+    Obter o número de notificações por ler (contador por utilizador).
+    
+    Endpoint leve para polling do ícone de notificações.
+    """
+    return {"unread": await notification_inbox.unread_count(user)}
+
+
+@router.get("/notifications/archive")
+async def get_archived_notifications(
+    limit: int = Query(50, ge=1, le=NOTIFICATION_PAGE_MAX),
+    cursor: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    """
+    Obter notificações arquivadas (fora da janela de retenção activa).
+    """
+    try:
+        page = await notification_inbox.list_archive_for_user(user, limit, cursor)
+    except InvalidCursorError:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    
+    return page
+
+
+@router.put("/notifications/read-all")
+async def mark_all_notifications_read(user: dict = Depends(get_current_user)):
+    """
+    Marcar todas as notificações visíveis como lidas.
+    """
+    marked = await notification_inbox.mark_all_read(user)
+    return {"success": True, "marked": marked}
+
+
 @router.put("/notifications/{notification_id}/read")
 async def mark_notification_read(
     notification_id: str,
@@ -213,12 +229,7 @@ async def mark_notification_read(
     """
     Marcar notificação como lida.
     """
-    result = await db.notifications.update_one(
-        {"id": notification_id},
-        {"$set": {"read": True}}
-    )
-    
-    if result.modified_count == 0:
+    if not await notification_inbox.mark_read(notification_id, user):
         raise HTTPException(status_code=404, detail="Notificação não encontrada")
     
     return {"success": True}
@@ -1,14 +1,16 @@
 import uuid
 from datetime import datetime, timezone
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException
 
 from database import db
 from models.auth import (
-    UserRole, UserRegister, UserLogin, UserResponse, TokenResponse
+    UserRole, UserRegister, UserLogin, UserResponse, TokenResponse,
+    EmailDigestMode, NotificationPreferencesUpdate
 )
 from services.auth import (
     hash_password, verify_password, create_token, get_current_user
 )
+from services.staff_directory import staff_directory
 
 
 router = APIRouter(prefix="/auth", tags=["Auth"])
@@ -37,6 +39,7 @@ async def register(data: UserRegister):
     }
     
     await db.users.insert_one(user_doc)
+    await staff_directory.refresh_user(user_id)
     token = create_token(user_id, data.email, UserRole.CLIENTE)
     
     return TokenResponse(
@@ -96,7 +99,8 @@ async def get_me(user: dict = Depends(get_current_user)):
         "role": user["role"],
         "created_at": user["created_at"],
         "onedrive_folder": user.get("onedrive_folder"),
-        "is_active": user.get("is_active", True)
+        "is_active": user.get("is_active", True),
+        "email_digest_mode": user.get("email_digest_mode") or EmailDigestMode.IMMEDIATE
     }
     
     # Incluir informação de impersonate se presente
@@ -106,3 +110,21 @@ async def get_me(user: dict = Depends(get_current_user)):
         response["impersonated_by_name"] = user.get("impersonated_by_name")
     
     return response
+
+
+@router.put("/me/notification-preferences")
+async def update_notification_preferences(
+    data: NotificationPreferencesUpdate,
+    user: dict = Depends(get_current_user)
+):
+    """
+    Frequência dos emails de notificação: um por evento (immediate) ou
+    resumo por hora (hourly) ou por dia (daily).
+    """
+    if data.email_digest_mode not in EmailDigestMode.ALL:
+        raise HTTPException(status_code=400, detail="Frequência de email inválida")
+    
+    await db.users.update_one({"id": user["id"]}, {"$set": {"email_digest_mode": data.email_digest_mode}})
+    await staff_directory.refresh_user(user["id"])
+    
+    return {"email_digest_mode": data.email_digest_mode}
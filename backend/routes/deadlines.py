@@ -7,8 +7,10 @@ from database import db
 from models.auth import UserRole
 from models.deadline import DeadlineCreate, DeadlineUpdate, DeadlineResponse
 from services.auth import get_current_user, require_roles
-from services.email import send_email_notification
+from services.email_digest import send_staff_email
 from services.history import log_history
+from services.date_fields import to_utc_datetime
+from services.deadline_reminders import deadline_reminders
 
 
 router = APIRouter(prefix="/deadlines", tags=["Deadlines"])
@@ -46,6 +48,7 @@ async def create_deadline(data: DeadlineCreate, user: dict = Depends(get_current
         "title": data.title,
         "description": data.description,
         "due_date": data.due_date,
+        "due_at": to_utc_datetime(data.due_date),
         "priority": data.priority,
         "completed": False,
         "created_by": user["id"],
@@ -57,6 +60,7 @@ async def create_deadline(data: DeadlineCreate, user: dict = Depends(get_current
     }
     
     await db.deadlines.insert_one(deadline_doc)
+    deadline_reminders.schedule(deadline_doc)
     
     if data.process_id:
         await log_history(data.process_id, user, "Criou prazo", "deadline", None, data.title)
@@ -66,13 +70,14 @@ async def create_deadline(data: DeadlineCreate, user: dict = Depends(get_current
         if assigned_id != user["id"]:
             assigned_user = await db.users.find_one({"id": assigned_id}, {"_id": 0})
             if assigned_user:
-                await send_email_notification(
-                    assigned_user["email"],
+                await send_staff_email(
+                    assigned_user,
                     f"Novo Prazo Atribuído: {data.title}",
                     f"Foi-lhe atribuído um novo prazo por {user['name']}:\n\n"
                     f"Título: {data.title}\n"
                     f"Data limite: {data.due_date}\n"
-                    f"Prioridade: {data.priority}"
+                    f"Prioridade: {data.priority}",
+                    process_id=data.process_id
                 )
     
     return DeadlineResponse(**{k: v for k, v in deadline_doc.items() if k != "_id"})
@@ -294,6 +299,7 @@ async def update_deadline(deadline_id: str, data: DeadlineUpdate, user: dict = D
         update_data["description"] = data.description
     if data.due_date is not None:
         update_data["due_date"] = data.due_date
+        update_data["due_at"] = to_utc_datetime(data.due_date)
     if data.priority is not None:
         update_data["priority"] = data.priority
     if data.completed is not None:
@@ -309,6 +315,7 @@ async def update_deadline(deadline_id: str, data: DeadlineUpdate, user: dict = D
         await db.deadlines.update_one({"id": deadline_id}, {"$set": update_data})
     
     updated = await db.deadlines.find_one({"id": deadline_id}, {"_id": 0})
+    deadline_reminders.schedule(updated)
     return DeadlineResponse(**updated)
 
 
@@ -317,4 +324,5 @@ async def delete_deadline(deadline_id: str, user: dict = Depends(require_roles([
     result = await db.deadlines.delete_one({"id": deadline_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Prazo não encontrado")
+    deadline_reminders.cancel(deadline_id)
     return {"message": "Prazo eliminado"}
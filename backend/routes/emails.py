@@ -10,13 +10,23 @@ import logging
 from typing import Optional, List
 from datetime import datetime, timezone
 import uuid
+from urllib.parse import quote
 
 from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import Response
 
 from database import db
-from models.email import EmailCreate, EmailUpdate, EmailResponse, EmailDirection, EmailStatus
+from models.email import EmailCreate, EmailUpdate, EmailResponse, EmailPage, EmailDirection, EmailStatus
 from services.auth import get_current_user
-from services.email_service import sync_emails_for_process, send_email, test_email_connection, get_email_accounts
+from services.email_sync import sync_all_mailboxes
+from services.email_listener import email_listeners
+from services.email_store import (
+    EMAIL_PAGE_SIZE, EMAIL_PAGE_MAX, InvalidEmailCursorError,
+    list_process_emails, load_email_body, store_email, update_email_body, delete_email_bodies, thread_key
+)
+from services.email_service import (
+    sync_emails_for_process, send_email, test_email_connection, get_email_accounts, fetch_email_attachment
+)
 
 logger = logging.getLogger(__name__)
 
@@ -46,6 +56,28 @@ async def enrich_email(email: dict) -> dict:
     return email
 
 
+async def enrich_emails(emails: List[dict]) -> List[dict]:
+    """Adicionar nomes a uma página de emails (uma consulta por colecção)."""
+    process_ids = list({em["process_id"] for em in emails if em.get("process_id")})
+    user_ids = list({em["created_by"] for em in emails if em.get("created_by")})
+    
+    client_names = {
+        p["id"]: p.get("client_name", "")
+        async for p in db.processes.find({"id": {"$in": process_ids}}, {"_id": 0, "id": 1, "client_name": 1})
+    } if process_ids else {}
+    user_names = {
+        u["id"]: u.get("name", "")
+        async for u in db.users.find({"id": {"$in": user_ids}}, {"_id": 0, "id": 1, "name": 1})
+    } if user_ids else {}
+    
+    for em in emails:
+        if em.get("process_id") in client_names:
+            em["client_name"] = client_names[em["process_id"]]
+        if em.get("created_by") in user_names:
+            em["created_by_name"] = user_names[em["created_by"]]
+    return emails
+
+
 # ==== ROTAS ESPECÍFICAS (devem vir antes das genéricas) ====
 
 @router.get("/test-connection")
@@ -64,6 +96,19 @@ async def test_email_connections(
     return results
 
 
+@router.get("/listeners")
+async def get_email_listeners(
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Estado das sessões IMAP IDLE (emails em tempo real) nesta réplica.
+    """
+    if current_user["role"] not in ["admin", "ceo"]:
+        raise HTTPException(status_code=403, detail="Sem permissão")
+    
+    return {"is_leader": email_listeners.is_leader, "listeners": email_listeners.listeners}
+
+
 @router.get("/accounts")
 async def get_configured_accounts(
     current_user: dict = Depends(get_current_user)
@@ -83,28 +128,26 @@ async def get_configured_accounts(
     ]
 
 
-@router.get("/process/{process_id}", response_model=List[EmailResponse])
+@router.get("/process/{process_id}", response_model=EmailPage)
 async def get_process_emails(
     process_id: str,
     direction: Optional[EmailDirection] = Query(None, description="Filtrar por direção"),
+    limit: int = Query(EMAIL_PAGE_SIZE, ge=1, le=EMAIL_PAGE_MAX),
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     """
-    Listar emails de um processo.
-    """
-    query = {"process_id": process_id}
-    
-    if direction:
-        query["direction"] = direction.value
-    
-    emails = await db.emails.find(query, {"_id": 0}).sort("sent_at", -1).to_list(500)
+    Listar emails de um processo (resumos, dos mais recentes para os mais antigos).
     
-    enriched_emails = []
-    for email in emails:
-        enriched = await enrich_email(email)
-        enriched_emails.append(EmailResponse(**enriched))
+    O corpo de cada email é obtido em GET /emails/{id}. Para obter a
+    página seguinte, enviar o `next_cursor` da resposta.
+    """
+    try:
+        page = await list_process_emails(process_id, direction.value if direction else None, cursor, limit)
+    except InvalidEmailCursorError:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
     
-    return enriched_emails
+    return EmailPage(emails=await enrich_emails(page["emails"]), next_cursor=page["next_cursor"])
 
 
 @router.get("/stats/{process_id}")
@@ -139,18 +182,35 @@ async def get_email_stats(
     return stats
 
 
+@router.post("/sync")
+async def sync_all_emails(
+    days: int = Query(30, description="Limite da primeira leitura de cada caixa (dias)"),
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Sincronizar as caixas de email de todas as contas para todos os
+    processos activos (uma passagem por caixa).
+    """
+    if current_user["role"] not in ["admin", "ceo"]:
+        raise HTTPException(status_code=403, detail="Sem permissão")
+    
+    return await sync_all_mailboxes(days)
+
+
 @router.post("/sync/{process_id}")
 async def sync_process_emails(
     process_id: str,
-    days: int = Query(30, description="Sincronizar emails dos últimos X dias"),
+    days: int = Query(30, description="Sincronizar emails dos últimos X dias (só na primeira sincronização)"),
+    full: bool = Query(False, description="Ignorar checkpoints e reler as pastas"),
     current_user: dict = Depends(get_current_user)
 ):
     """
     Sincronizar emails de um processo.
     Busca emails das contas configuradas (Precision e Power) 
     relacionados com o email do cliente.
+    Incremental: só são lidos os emails novos desde a última sincronização.
     """
-    result = await sync_emails_for_process(process_id, days)
+    result = await sync_emails_for_process(process_id, days, full)
     return result
 
 
@@ -220,7 +280,7 @@ async def create_email_record(
         "notes": email_data.notes
     }
     
-    await db.emails.insert_one(email)
+    await store_email(email)
     logger.info(f"Email registado: {email_id} para processo {email_data.process_id}")
     
     enriched = await enrich_email(email)
@@ -238,10 +298,40 @@ async def get_email(
     if not email:
         raise HTTPException(status_code=404, detail="Email não encontrado")
     
+    email.update(await load_email_body(email))
     enriched = await enrich_email(email)
     return EmailResponse(**enriched)
 
 
+@router.get("/{email_id}/attachments/{index}")
+async def download_email_attachment(
+    email_id: str,
+    index: int,
+    current_user: dict = Depends(get_current_user)
+):
+    """Descarregar um anexo de um email sincronizado (lido do servidor IMAP a pedido)."""
+    email = await db.emails.find_one({"id": email_id}, {"_id": 0})
+    
+    if not email:
+        raise HTTPException(status_code=404, detail="Email não encontrado")
+    
+    try:
+        result = await fetch_email_attachment(email, index)
+    except Exception as e:
+        logger.error(f"Erro ao descarregar anexo {index} do email {email_id}: {e}")
+        raise HTTPException(status_code=502, detail="Erro ao obter o anexo do servidor de email")
+    
+    if result is None:
+        raise HTTPException(status_code=404, detail="Anexo não disponível")
+    
+    attachment, content = result
+    return Response(
+        content=content,
+        media_type=attachment.get("content_type") or "application/octet-stream",
+        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{quote(attachment['filename'])}"}
+    )
+
+
 @router.put("/{email_id}", response_model=EmailResponse)
 async def update_email(
     email_id: str,
@@ -255,19 +345,25 @@ async def update_email(
         raise HTTPException(status_code=404, detail="Email não encontrado")
     
     update_data = {}
+    if email_data.body is not None:
+        update_data.update(await update_email_body(email, email_data.body))
     if email_data.subject is not None:
         update_data["subject"] = email_data.subject
-    if email_data.body is not None:
-        update_data["body"] = email_data.body
+        update_data["thread_key"] = thread_key(email_data.subject)
     if email_data.notes is not None:
         update_data["notes"] = email_data.notes
     if email_data.status is not None:
         update_data["status"] = email_data.status.value
     
     if update_data:
-        await db.emails.update_one({"id": email_id}, {"$set": update_data})
+        update = {"$set": update_data}
+        if email_data.body is not None:
+            # Email ainda não migrado: o corpo passou para email_bodies
+            update["$unset"] = {"body": "", "body_html": ""}
+        await db.emails.update_one({"id": email_id}, update)
     
     updated_email = await db.emails.find_one({"id": email_id}, {"_id": 0})
+    updated_email.update(await load_email_body(updated_email))
     enriched = await enrich_email(updated_email)
     return EmailResponse(**enriched)
 
@@ -284,6 +380,7 @@ async def delete_email(
         raise HTTPException(status_code=404, detail="Email não encontrado")
     
     await db.emails.delete_one({"id": email_id})
+    await delete_email_bodies([email_id])
     logger.info(f"Email {email_id} eliminado por {current_user['name']}")
     
     return {"success": True, "message": "Email eliminado"}
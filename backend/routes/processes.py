@@ -44,6 +44,7 @@ from models.process import (
 )
 from services.auth import get_current_user, require_roles, require_staff
 from services.email import send_email_notification
+from services.email_digest import send_staff_email
 from services.history import log_history, log_data_changes
 from services.alerts import (
     get_process_alerts,
@@ -53,6 +54,8 @@ from services.alerts import (
     notify_cpcv_or_deed_document_check
 )
 from services.realtime_notifications import notify_process_status_change
+from services.staff_directory import staff_directory
+from services.date_fields import to_utc_datetime
 from services.trello import trello_service, status_to_trello_list, build_card_description
 
 logger = logging.getLogger(__name__)
@@ -216,15 +219,13 @@ async def create_process(data: ProcessCreate, user: dict = Depends(get_current_u
     await log_history(process_id, user, "Criou processo")
     
     # Notificar administradores e CEO
-    staff = await db.users.find(
-        {"role": {"$in": [UserRole.ADMIN, UserRole.CEO]}}, 
-        {"_id": 0}
-    ).to_list(100)
+    staff = await staff_directory.get_users_by_roles([UserRole.ADMIN, UserRole.CEO], active_only=False)
     for s in staff:
-        await send_email_notification(
-            s["email"],
+        await send_staff_email(
+            s,
             "Novo Processo Criado",
-            f"O cliente {user['name']} criou um novo processo de {data.process_type}."
+            f"O cliente {user['name']} criou um novo processo de {data.process_type}.",
+            process_id=process_id
         )
     
     return ProcessResponse(**{k: v for k, v in process_doc.items() if k != "_id"})
@@ -483,9 +484,13 @@ async def move_process_kanban(
     if new_status == "fase_bancaria" and old_status != "fase_bancaria":
         # Guardar data de aprovação se ainda não existir
         if not process.get("credit_data", {}).get("bank_approval_date"):
+            approval_date = datetime.now().strftime("%Y-%m-%d")
             await db.processes.update_one(
                 {"id": process_id},
-                {"$set": {"credit_data.bank_approval_date": datetime.now().strftime("%Y-%m-%d")}}
+                {"$set": {
+                    "credit_data.bank_approval_date": approval_date,
+                    "credit_data.bank_approval_at": to_utc_datetime(approval_date)
+                }}
             )
         # Notificar sobre o countdown
         updated_process = await db.processes.find_one({"id": process_id}, {"_id": 0})
@@ -639,6 +644,7 @@ async def update_process(process_id: str, data: ProcessUpdate, user: dict = Depe
         if data.credit_data and can_update_credit:
             await log_data_changes(process_id, user, process.get("credit_data"), data.credit_data.model_dump(), "dados de crédito")
             update_data["credit_data"] = data.credit_data.model_dump()
+            update_data["credit_data"]["bank_approval_at"] = to_utc_datetime(data.credit_data.bank_approval_date)
         
         # Atualizar email e telefone do cliente
         if data.client_email is not None:
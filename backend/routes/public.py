@@ -18,6 +18,7 @@ from models.auth import UserRole
 from models.process import PublicClientRegistration
 from services.email import send_registration_confirmation, send_new_client_notification
 from services.alerts import notify_new_client_registration
+from services.staff_directory import staff_directory
 
 
 router = APIRouter(prefix="/public", tags=["Public"])
@@ -151,7 +152,8 @@ async def public_client_registration(data: PublicClientRegistration):
     # =========================================
     await send_registration_confirmation(
         client_email=data.email,
-        client_name=data.name
+        client_name=data.name,
+        idempotency_key=f"registration:{process_id}"
     )
     
     # =========================================
@@ -162,10 +164,9 @@ async def public_client_registration(data: PublicClientRegistration):
     await notify_new_client_registration(process_doc, has_property)
     
     # Enviar emails para admins e CEOs
-    staff = await db.users.find(
-        {"role": {"$in": [UserRole.ADMIN, UserRole.CEO, UserRole.DIRETOR]}}, 
-        {"_id": 0}
-    ).to_list(100)
+    staff = await staff_directory.get_users_by_roles(
+        [UserRole.ADMIN, UserRole.CEO, UserRole.DIRETOR], active_only=False
+    )
     
     for member in staff:
         await send_new_client_notification(
@@ -174,7 +175,8 @@ async def public_client_registration(data: PublicClientRegistration):
             client_phone=data.phone,
             process_type=data.process_type,
             staff_email=member["email"],
-            staff_name=member["name"]
+            staff_name=member["name"],
+            idempotency_key=f"new_client:{process_id}:{member['email']}"
         )
     
     return {
@@ -15,7 +15,10 @@ from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel
 
 from database import db
-from services.auth import get_current_user
+from models.auth import UserRole
+from services.auth import get_current_user, require_roles
+from services.push_notifications import invalidate_push_subscriptions
+from services.push_queue import get_push_queue_stats
 
 logger = logging.getLogger(__name__)
 
@@ -70,6 +73,7 @@ async def subscribe_push(
                 }
             }
         )
+        invalidate_push_subscriptions(user_ids=[user_id, existing.get("user_id")])
         logger.info(f"Subscrição push atualizada para utilizador {user_id}")
         return {"success": True, "message": "Subscrição atualizada"}
     
@@ -86,6 +90,7 @@ async def subscribe_push(
     }
     
     await db.push_subscriptions.insert_one(sub_data)
+    invalidate_push_subscriptions(user_ids=[user_id])
     logger.info(f"Nova subscrição push criada para utilizador {user_id}")
     
     return {"success": True, "message": "Subscrição criada com sucesso"}
@@ -107,13 +112,16 @@ async def unsubscribe_push(
     })
     
     if result.deleted_count > 0:
+        invalidate_push_subscriptions(user_ids=[user_id])
         logger.info(f"Subscrição push removida para utilizador {user_id}")
         return {"success": True, "message": "Subscrição removida"}
     
     # Se não encontrou pelo user_id, tenta só pelo endpoint
-    result = await db.push_subscriptions.delete_one({
+    removed = await db.push_subscriptions.find_one_and_delete({
         "endpoint": subscription.endpoint
     })
+    if removed:
+        invalidate_push_subscriptions(user_ids=[removed.get("user_id")])
     
     return {"success": True, "message": "Subscrição removida"}
 
@@ -128,6 +136,7 @@ async def unsubscribe_all_push(
     user_id = current_user["id"]
     
     result = await db.push_subscriptions.delete_many({"user_id": user_id})
+    invalidate_push_subscriptions(user_ids=[user_id])
     
     logger.info(f"Removidas {result.deleted_count} subscrições push do utilizador {user_id}")
     
@@ -163,3 +172,13 @@ async def get_push_status(
             for sub in subscriptions
         ]
     }
+
+
+@router.get("/queue")
+async def get_push_queue_status(
+    user: dict = Depends(require_roles([UserRole.ADMIN]))
+):
+    """
+    Estado da fila de envio push (pendentes, em processamento e dead letters).
+    """
+    return await get_push_queue_stats()
@@ -16,7 +16,8 @@ from fastapi import APIRouter, Depends, HTTPException, Query
 from database import db
 from models.task import TaskCreate, TaskUpdate, TaskResponse
 from services.auth import get_current_user
-from services.realtime_notifications import send_realtime_notification
+from services.realtime_notifications import send_realtime_notification, send_bulk_realtime_notification
+from services.date_fields import to_utc_datetime
 
 logger = logging.getLogger(__name__)
 
@@ -105,6 +106,7 @@ async def create_task(
         "assigned_to": task_data.assigned_to,
         "process_id": task_data.process_id,
         "due_date": task_data.due_date,  # Data de vencimento (opcional)
+        "due_at": to_utc_datetime(task_data.due_date),  # Cópia BSON para as tarefas agendadas
         "created_by": current_user["id"],
         "completed": False,
         "completed_at": None,
@@ -125,16 +127,14 @@ async def create_task(
         except (ValueError, TypeError):
             pass
     
-    for user_id in task_data.assigned_to:
-        if user_id != current_user["id"]:  # Não notificar o criador
-            await send_realtime_notification(
-                user_id=user_id,
-                title="📋 Nova Tarefa Atribuída",
-                message=f"{current_user['name']} atribuiu-lhe uma tarefa: {title}{due_info}",
-                notification_type="task_assigned",
-                link=f"/tasks" if not task_data.process_id else f"/process/{task_data.process_id}",
-                process_id=task_data.process_id
-            )
+    await send_bulk_realtime_notification(
+        user_ids=[user_id for user_id in task_data.assigned_to if user_id != current_user["id"]],  # Não notificar o criador
+        title="📋 Nova Tarefa Atribuída",
+        message=f"{current_user['name']} atribuiu-lhe uma tarefa: {title}{due_info}",
+        notification_type="task_assigned",
+        link=f"/tasks" if not task_data.process_id else f"/process/{task_data.process_id}",
+        process_id=task_data.process_id
+    )
     
     # Retornar tarefa enriquecida
     enriched = await enrich_task(task)
@@ -249,16 +249,15 @@ async def update_task(
         update_data["assigned_to"] = task_data.assigned_to
         # Notificar novos utilizadores
         new_assignees = set(task_data.assigned_to) - set(task.get("assigned_to", []))
-        for user_id in new_assignees:
-            if user_id != current_user["id"]:
-                await send_realtime_notification(
-                    user_id=user_id,
-                    title="📋 Nova Tarefa Atribuída",
-                    message=f"{current_user['name']} atribuiu-lhe uma tarefa: {task['title']}",
-                    notification_type="task_assigned",
-                    link=f"/tasks" if not task.get("process_id") else f"/process/{task['process_id']}",
-                    process_id=task.get("process_id")
-                )
+        new_assignees.discard(current_user["id"])
+        await send_bulk_realtime_notification(
+            user_ids=list(new_assignees),
+            title="📋 Nova Tarefa Atribuída",
+            message=f"{current_user['name']} atribuiu-lhe uma tarefa: {task['title']}",
+            notification_type="task_assigned",
+            link=f"/tasks" if not task.get("process_id") else f"/process/{task['process_id']}",
+            process_id=task.get("process_id")
+        )
     
     await db.tasks.update_one({"id": task_id}, {"$set": update_data})
     
@@ -22,6 +22,9 @@ from services.trello import (
     build_card_description, parse_card_description,
     TRELLO_TO_STATUS
 )
+from services.email_store import delete_all_email_bodies
+from services.staff_directory import staff_directory
+from services.notification_inbox import notification_inbox
 
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/trello", tags=["Trello Integration"])
@@ -170,13 +173,16 @@ async def reset_and_sync_from_trello(
         
         del_emails = await db.emails.delete_many({})
         result["deleted"]["emails"] = del_emails.deleted_count
+        await delete_all_email_bodies()
         
         del_notifications = await db.notifications.delete_many({})
         result["deleted"]["notifications"] = del_notifications.deleted_count
+        await notification_inbox.reset_counters()
         
         # Apagar utilizadores não-admin
         del_users = await db.users.delete_many({"role": {"$ne": "admin"}})
         result["deleted"]["users"] = del_users.deleted_count
+        staff_directory.invalidate()
         
         logger.info(f"Dados apagados: {result['deleted']}")
         
@@ -9,10 +9,12 @@ Endpoints WebSocket para comunicação em tempo real.
 import logging
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Query
 from jose import JWTError, jwt
+from starlette.websockets import WebSocketState
 
 from config import JWT_SECRET, JWT_ALGORITHM
 from database import db
 from services.websocket_manager import manager, WSEventType, create_ws_message
+from services.notification_inbox import notification_inbox
 
 logger = logging.getLogger(__name__)
 
@@ -68,8 +70,9 @@ async def websocket_notifications(
     user_id = user["id"]
     
     try:
-        # Conectar
-        await manager.connect(websocket, user_id)
+        # Conectar (pode ser recusado se o worker estiver no limite de conexões)
+        if not await manager.connect(websocket, user_id, user.get("role")):
+            return
         
         # Enviar confirmação de conexão
         await websocket.send_json(create_ws_message(
@@ -97,6 +100,9 @@ async def websocket_notifications(
             try:
                 data = await websocket.receive_json()
                 
+                # Qualquer mensagem do cliente prova que a conexão está viva
+                manager.touch(websocket)
+                
                 # Processar diferentes tipos de mensagens do cliente
                 msg_type = data.get("type")
                 
@@ -107,14 +113,15 @@ async def websocket_notifications(
                         {"status": "pong"}
                     ))
                 
+                elif msg_type == "pong":
+                    # Resposta ao heartbeat do servidor (já registada em touch)
+                    pass
+                
                 elif msg_type == "mark_notification_read":
                     # Marcar notificação como lida via WebSocket
                     notification_id = data.get("notification_id")
                     if notification_id:
-                        await db.notifications.update_one(
-                            {"id": notification_id, "user_id": user_id},
-                            {"$set": {"read": True}}
-                        )
+                        await notification_inbox.mark_read(notification_id, user)
                         await websocket.send_json(create_ws_message(
                             WSEventType.NOTIFICATION_READ,
                             {"notification_id": notification_id}
@@ -122,16 +129,19 @@ async def websocket_notifications(
                 
                 elif msg_type == "mark_all_read":
                     # Marcar todas as notificações como lidas
-                    await db.notifications.update_many(
-                        {"user_id": user_id, "read": False},
-                        {"$set": {"read": True}}
-                    )
+                    await notification_inbox.mark_all_read(user)
                     await websocket.send_json(create_ws_message(
                         WSEventType.ALL_NOTIFICATIONS_READ,
                         {"status": "success"}
                     ))
-                
+            
+            except WebSocketDisconnect:
+                raise
             except Exception as e:
+                if websocket.application_state != WebSocketState.CONNECTED:
+                    # Fechado do lado do servidor (heartbeat expirado ou limite
+                    # por utilizador): receive_json passa a lançar RuntimeError
+                    raise WebSocketDisconnect(code=1000)
                 logger.error(f"Erro ao processar mensagem WebSocket: {e}")
                 # Continuar o loop mesmo com erros de mensagem
     
@@ -160,5 +170,12 @@ async def websocket_status():
     return {
         "total_connections": manager.get_total_connections(),
         "connected_users": len(manager.get_connected_users()),
-        "user_ids": manager.get_connected_users()
+        "user_ids": manager.get_connected_users(),
+        "users_by_role": manager.get_connections_by_role(),
+        "limits": {
+            "max_connections_per_user": manager.max_connections_per_user,
+            "max_connections_per_worker": manager.max_connections_per_worker,
+            "heartbeat_interval_seconds": manager.heartbeat_interval,
+            "heartbeat_max_missed": manager.max_missed_beats
+        }
     }
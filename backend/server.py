@@ -20,6 +20,20 @@ from routes.push_notifications import router as push_notifications_router
 from routes.tasks import router as tasks_router
 from routes.emails import router as emails_router
 from routes.trello import router as trello_router
+from services.websocket_manager import manager as ws_manager
+from services.realtime_notifications import flush_pending_notifications
+from services.push_notifications import push_sender
+from services.push_queue import push_queue_worker, PUSH_DEAD_LETTER_RETENTION_DAYS
+from services.email_outbox import email_outbox_worker, EMAIL_OUTBOX_RETENTION_DAYS
+from services.notification_inbox import (
+    notification_inbox, NOTIFICATION_ARCHIVE_GRACE_DAYS, NOTIFICATION_ARCHIVE_RETENTION_DAYS
+)
+from services.date_fields import run_date_fields_migration
+from services.deadline_reminders import deadline_reminders
+from services.email import smtp_transport, email_templates
+from services.imap_pool import imap_pools
+from services.email_listener import email_listeners
+from services.email_service import run_email_migrations
 
 
 # Configure logging
@@ -85,6 +99,30 @@ async def startup():
     await db.notifications.create_index("process_id")
     await db.notifications.create_index("created_at")
     await db.notifications.create_index([("user_id", 1), ("read", 1)])  # Index composto para queries
+    await db.notifications.create_index([("audience", 1), ("read", 1), ("created_at", -1), ("id", -1)])
+    # Notificações agendadas: a mesma chave só pode ser criada uma vez
+    await db.notifications.create_index(
+        "dedupe_key", unique=True, partialFilterExpression={"dedupe_key": {"$exists": True}}
+    )
+    await db.notification_counters.create_index("user_id", unique=True)
+    await db.migrations.create_index("id", unique=True)
+    await notification_inbox.run_migrations()
+    
+    # Retenção: TTL de segurança na colecção quente e TTL do arquivo
+    await db.notifications.create_index(
+        "archive_at", expireAfterSeconds=NOTIFICATION_ARCHIVE_GRACE_DAYS * 24 * 3600
+    )
+    await db.notifications_archive.create_index(
+        "archived_at", expireAfterSeconds=NOTIFICATION_ARCHIVE_RETENTION_DAYS * 24 * 3600
+    )
+    await db.notifications_archive.create_index([("audience", 1), ("created_at", -1), ("_id", -1)])
+    
+    # Datas BSON filtradas pelas tarefas agendadas (ver services/date_fields.py)
+    await db.processes.create_index("documents.expiry_at")
+    await db.processes.create_index("credit_data.bank_approval_at")
+    await db.tasks.create_index([("completed", 1), ("due_at", 1)])
+    await db.deadlines.create_index([("completed", 1), ("due_at", 1)])
+    await run_date_fields_migration(db)
     
     # Indexes para push subscriptions
     await db.push_subscriptions.create_index("id", unique=True)
@@ -92,6 +130,27 @@ async def startup():
     await db.push_subscriptions.create_index("endpoint", unique=True)
     await db.push_subscriptions.create_index([("user_id", 1), ("is_active", 1)])
     
+    # Indexes para a fila de push notifications
+    await db.push_queue.create_index("id", unique=True)
+    await db.push_queue.create_index([("status", 1), ("next_attempt_at", 1)])
+    await db.push_queue.create_index("lease_token", sparse=True)
+    await db.push_dead_letters.create_index(
+        "dead_at", expireAfterSeconds=PUSH_DEAD_LETTER_RETENTION_DAYS * 24 * 3600
+    )
+    
+    # Indexes para o outbox de emails (estado de entrega mantido durante a retenção)
+    await db.email_outbox.create_index("id", unique=True)
+    await db.email_outbox.create_index("idempotency_key", unique=True)
+    await db.email_outbox.create_index([("provider", 1), ("status", 1), ("next_attempt_at", 1)])
+    await db.email_outbox.create_index("lease_token", sparse=True)
+    await db.email_outbox.create_index(
+        "finished_at", expireAfterSeconds=EMAIL_OUTBOX_RETENTION_DAYS * 24 * 3600
+    )
+    
+    # Eventos à espera do resumo de email (services/email_digest.py)
+    await db.email_digest_events.create_index([("mode", 1), ("created_at", 1)])
+    await db.email_digest_events.create_index("id", unique=True)
+    
     # Indexes para tarefas
     await db.tasks.create_index("id", unique=True)
     await db.tasks.create_index("process_id")
@@ -102,8 +161,21 @@ async def startup():
     # Indexes para emails
     await db.emails.create_index("id", unique=True)
     await db.emails.create_index("process_id")
-    await db.emails.create_index([("process_id", 1), ("sent_at", -1)])
+    # Listagem por cursor (sent_at, id) e conversas de um processo
+    await db.emails.create_index([("process_id", 1), ("sent_at", -1), ("id", -1)])
+    await db.emails.create_index([("process_id", 1), ("thread_key", 1)])
     await db.emails.create_index("direction")
+    # Corpos comprimidos, lidos só quando o email é aberto (services/email_store.py)
+    await db.email_bodies.create_index("email_id", unique=True)
+    # Emails sincronizados: um por Message-ID (ou hash do conteúdo) em cada processo
+    await run_email_migrations(db)
+    await db.emails.create_index(
+        [("process_id", 1), ("dedupe_key", 1)],
+        unique=True, partialFilterExpression={"dedupe_key": {"$exists": True}}
+    )
+    
+    # Checkpoints da sincronização IMAP incremental
+    await db.email_sync_state.create_index([("account", 1), ("scope", 1), ("folder", 1)], unique=True)
     
     # Create default workflow statuses if none exist - 15 fases do Trello
     status_count = await db.workflow_statuses.count_documents({})
@@ -132,8 +204,33 @@ async def startup():
     user_count = await db.users.count_documents({})
     if user_count == 0:
         logger.warning("Nenhum utilizador encontrado! Execute 'python seed.py' para criar utilizadores iniciais.")
+    
+    # Heartbeat do servidor para conexões WebSocket
+    ws_manager.start_heartbeat()
+    
+    # Worker da fila de push notifications
+    push_queue_worker.start()
+    
+    # Templates de email compilados uma vez; worker do outbox de emails
+    email_templates.load()
+    email_outbox_worker.start()
+    
+    # Lembretes de prazos à hora certa (apenas na réplica líder)
+    deadline_reminders.start()
+    
+    # Emails em tempo real por IMAP IDLE (apenas na réplica líder)
+    email_listeners.start()
 
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await flush_pending_notifications()
+    await ws_manager.stop_heartbeat()
+    await push_queue_worker.stop()
+    await email_outbox_worker.stop()
+    await deadline_reminders.stop()
+    await email_listeners.stop()
+    await smtp_transport.close()
+    await imap_pools.close()
+    await push_sender.close()
     client.close()
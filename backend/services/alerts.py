@@ -20,7 +20,11 @@ from datetime import datetime, timezone, timedelta
 from typing import List, Optional, Dict, Any
 
 from database import db
-from services.email import send_email_notification
+from services.date_fields import to_utc_datetime
+from services.deadline_reminders import deadline_reminders
+from services.email_digest import send_staff_email
+from services.staff_directory import staff_directory
+from services.notification_inbox import notification_inbox, build_audience, STAFF_AUDIENCE_ROLES
 
 
 # ====================================================================
@@ -354,6 +358,7 @@ async def create_deed_reminder(process: dict, deed_date: str, user: dict) -> Opt
             "title": f"📋 Preparar Escritura - {process.get('client_name', 'Cliente')}",
             "description": f"Escritura agendada para {deed_datetime.strftime('%d/%m/%Y')}. Verificar se toda a documentação está pronta.",
             "due_date": reminder_date.strftime("%Y-%m-%d"),
+            "due_at": to_utc_datetime(reminder_date.strftime("%Y-%m-%d")),
             "priority": "high",
             "completed": False,
             "created_by": user["id"],
@@ -363,18 +368,18 @@ async def create_deed_reminder(process: dict, deed_date: str, user: dict) -> Opt
         }
         
         await db.deadlines.insert_one(deadline_doc)
+        deadline_reminders.schedule(deadline_doc)
         
         # Notificar utilizadores envolvidos
-        for user_id in assigned_users:
-            assigned_user = await db.users.find_one({"id": user_id}, {"_id": 0})
-            if assigned_user:
-                await send_email_notification(
-                    assigned_user["email"],
-                    f"Lembrete: Escritura em 15 dias - {process.get('client_name')}",
-                    f"A escritura do cliente {process.get('client_name')} está agendada para {deed_datetime.strftime('%d/%m/%Y')}.\n\n"
-                    f"Por favor, verifique se toda a documentação necessária está pronta.\n\n"
-                    f"Este lembrete foi criado automaticamente."
-                )
+        for assigned_user in await staff_directory.get_users(assigned_users):
+            await send_staff_email(
+                assigned_user,
+                f"Lembrete: Escritura em 15 dias - {process.get('client_name')}",
+                f"A escritura do cliente {process.get('client_name')} está agendada para {deed_datetime.strftime('%d/%m/%Y')}.\n\n"
+                f"Por favor, verifique se toda a documentação necessária está pronta.\n\n"
+                f"Este lembrete foi criado automaticamente.",
+                process_id=process["id"]
+            )
         
         return deadline_id
     except (ValueError, TypeError) as e:
@@ -395,10 +400,7 @@ async def notify_new_client_registration(process: dict, has_property: bool = Fal
         has_property: Se o cliente já tem imóvel (atribuir só intermediários)
     """
     # Buscar administradores e CEO
-    admins = await db.users.find({
-        "role": {"$in": ["admin", "ceo"]},
-        "is_active": True
-    }, {"_id": 0}).to_list(100)
+    admins = await staff_directory.get_users_by_roles(["admin", "ceo"])
     
     assignment_note = ""
     if has_property:
@@ -407,8 +409,8 @@ async def notify_new_client_registration(process: dict, has_property: bool = Fal
         assignment_note = "\n\nAtribuir consultor imobiliário e/ou intermediário de crédito conforme necessário."
     
     for admin in admins:
-        await send_email_notification(
-            admin["email"],
+        await send_staff_email(
+            admin,
             f"🆕 Novo Registo de Cliente: {process.get('client_name', 'Cliente')}",
             f"Um novo cliente registou-se no sistema:\n\n"
             f"Nome: {process.get('client_name')}\n"
@@ -416,7 +418,8 @@ async def notify_new_client_registration(process: dict, has_property: bool = Fal
             f"Telefone: {process.get('client_phone')}\n"
             f"Tipo: {process.get('process_type')}\n"
             f"{assignment_note}\n\n"
-            f"Por favor, aceda ao sistema para atribuir os responsáveis."
+            f"Por favor, aceda ao sistema para atribuir os responsáveis.",
+            process_id=process["id"]
         )
     
     # Criar notificação no sistema
@@ -428,10 +431,12 @@ async def notify_new_client_registration(process: dict, has_property: bool = Fal
         "has_property": has_property,
         "message": f"Novo registo: {process.get('client_name')}" + (" (Já tem imóvel)" if has_property else ""),
         "read": False,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        # Novos registos são visíveis apenas para a gestão
+        "audience": build_audience(roles=STAFF_AUDIENCE_ROLES)
     }
     
-    await db.notifications.insert_one(notification)
+    await notification_inbox.insert([notification])
 
 
 # ====================================================================
@@ -447,7 +452,7 @@ async def notify_cpcv_or_deed_document_check(process: dict, new_status: str):
         process: Dados do processo
         new_status: O novo estado do processo (cpcv, fase_escritura, escritura_agendada)
     """
-    from services.realtime_notifications import send_realtime_notification
+    from services.realtime_notifications import send_bulk_realtime_notification
     
     # Determinar mensagem baseada no estado
     status_messages = {
@@ -470,10 +475,7 @@ async def notify_cpcv_or_deed_document_check(process: dict, new_status: str):
         user_ids.add(process["intermediario_id"])
     
     # Adicionar CEO, Diretores e Administrativos
-    staff = await db.users.find({
-        "role": {"$in": ["ceo", "diretor", "admin"]},
-        "is_active": True
-    }, {"_id": 0, "id": 1, "email": 1, "name": 1}).to_list(100)
+    staff = await staff_directory.get_users_by_roles(["ceo", "diretor", "admin"])
     
     for s in staff:
         user_ids.add(s["id"])
@@ -487,29 +489,28 @@ async def notify_cpcv_or_deed_document_check(process: dict, new_status: str):
     # Enviar notificações
     client_name = process.get("client_name", "Cliente")
     
-    for user_id in user_ids:
-        # Notificação em tempo real (WebSocket + Push)
-        await send_realtime_notification(
-            user_id=user_id,
-            title=f"{title} - {client_name}",
-            message=f"{description}. Por favor, verifique se toda a documentação está em ordem.{missing_info}",
-            notification_type="document_verification",
-            link=f"/process/{process['id']}",
+    # Notificações em tempo real (WebSocket + Push), numa única escrita
+    await send_bulk_realtime_notification(
+        user_ids=list(user_ids),
+        title=f"{title} - {client_name}",
+        message=f"{description}. Por favor, verifique se toda a documentação está em ordem.{missing_info}",
+        notification_type="document_verification",
+        link=f"/process/{process['id']}",
+        process_id=process["id"]
+    )
+    
+    for user in await staff_directory.get_users(user_ids):
+        # Email (imediato ou no resumo, conforme a preferência)
+        await send_staff_email(
+            user,
+            f"{title} - {client_name}",
+            f"Olá {user['name']},\n\n"
+            f"{description} para o cliente {client_name}.\n\n"
+            f"Por favor, aceda ao sistema para verificar se toda a documentação está em ordem "
+            f"antes de prosseguir com o processo.{missing_info}\n\n"
+            f"Aceda ao processo: /process/{process['id']}",
             process_id=process["id"]
         )
-        
-        # Email
-        user = await db.users.find_one({"id": user_id}, {"_id": 0})
-        if user:
-            await send_email_notification(
-                user["email"],
-                f"{title} - {client_name}",
-                f"Olá {user['name']},\n\n"
-                f"{description} para o cliente {client_name}.\n\n"
-                f"Por favor, aceda ao sistema para verificar se toda a documentação está em ordem "
-                f"antes de prosseguir com o processo.{missing_info}\n\n"
-                f"Aceda ao processo: /process/{process['id']}"
-            )
 
 
 async def notify_pre_approval_countdown(process: dict):
@@ -537,17 +538,16 @@ async def notify_pre_approval_countdown(process: dict):
     
     user_ids = list(set(user_ids))
     
-    for user_id in user_ids:
-        user = await db.users.find_one({"id": user_id}, {"_id": 0})
-        if user:
-            await send_email_notification(
-                user["email"],
-                f"⏰ Alerta de Prazo: {process.get('client_name')}",
-                f"{countdown['message']}\n\n"
-                f"Cliente: {process.get('client_name')}\n"
-                f"{countdown.get('details', '')}\n\n"
-                f"Por favor, tome as medidas necessárias."
-            )
+    for user in await staff_directory.get_users(user_ids):
+        await send_staff_email(
+            user,
+            f"⏰ Alerta de Prazo: {process.get('client_name')}",
+            f"{countdown['message']}\n\n"
+            f"Cliente: {process.get('client_name')}\n"
+            f"{countdown.get('details', '')}\n\n"
+            f"Por favor, tome as medidas necessárias.",
+            process_id=process["id"]
+        )
 
 
 # ====================================================================
@@ -0,0 +1,125 @@
+"""
+====================================================================
+DATAS INDEXÁVEIS - CREDITOIMO
+====================================================================
+As datas introduzidas pelos utilizadores são guardadas como texto
+(YYYY-MM-DD ou ISO 8601, com ou sem fuso) e é nesse formato que a API
+as devolve. Para que as tarefas agendadas filtrem por intervalo no
+servidor, cada uma tem uma cópia em data BSON (UTC), indexada:
+
+- tasks.due_date                            -> tasks.due_at
+- processes.credit_data.bank_approval_date  -> credit_data.bank_approval_at
+- processes.documents[].expiry_date         -> documents[].expiry_at
+- deadlines.due_date                        -> deadlines.due_at
+
+As cópias são escritas junto com o campo original; os documentos
+antigos são migrados uma vez no arranque (marcador em `migrations`).
+====================================================================
+"""
+
+import logging
+from datetime import datetime, timezone
+from typing import Optional, Any
+
+logger = logging.getLogger(__name__)
+
+DATE_FIELDS_MIGRATION_ID = "scheduled_date_fields_v1"
+DEADLINE_DATES_MIGRATION_ID = "deadline_due_at_v1"
+
+
+def to_utc_datetime(value: Any) -> Optional[datetime]:
+    """
+    Converter uma data (texto ISO/YYYY-MM-DD ou datetime) para datetime UTC.
+    
+    Datas sem fuso são interpretadas como UTC, tal como no MongoDB.
+    
+    Returns:
+        datetime com fuso UTC, ou None se o valor não for uma data válida
+    """
+    if isinstance(value, datetime):
+        parsed = value
+    elif isinstance(value, str) and value.strip():
+        try:
+            parsed = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+        except ValueError:
+            return None
+    else:
+        return None
+    
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+
+def _to_date_expression(field: str) -> dict:
+    """Expressão de agregação: texto/data -> data BSON (null se inválido)."""
+    return {"$convert": {"input": field, "to": "date", "onError": None, "onNull": None}}
+
+
+async def backfill_date_fields(database) -> int:
+    """
+    Migração: preencher as cópias em data BSON dos documentos existentes.
+    
+    Returns:
+        Número de documentos actualizados
+    """
+    tasks = await database.tasks.update_many(
+        {"due_date": {"$type": "string"}, "due_at": {"$exists": False}},
+        [{"$set": {"due_at": _to_date_expression("$due_date")}}]
+    )
+    
+    approvals = await database.processes.update_many(
+        {
+            "credit_data.bank_approval_date": {"$type": "string"},
+            "credit_data.bank_approval_at": {"$exists": False}
+        },
+        [{"$set": {"credit_data.bank_approval_at": _to_date_expression("$credit_data.bank_approval_date")}}]
+    )
+    
+    documents = await database.processes.update_many(
+        {"documents": {"$elemMatch": {"expiry_date": {"$type": "string"}, "expiry_at": {"$exists": False}}}},
+        [{"$set": {"documents": {"$map": {
+            "input": "$documents",
+            "as": "doc",
+            "in": {"$mergeObjects": [
+                "$$doc",
+                {"expiry_at": _to_date_expression("$$doc.expiry_date")}
+            ]}
+        }}}}]
+    )
+    
+    updated = tasks.modified_count + approvals.modified_count + documents.modified_count
+    logger.info(f"Datas BSON preenchidas em {updated} documentos")
+    return updated
+
+
+async def backfill_deadline_dates(database) -> int:
+    """
+    Migração: preencher `due_at` dos prazos existentes.
+    
+    Returns:
+        Número de prazos actualizados
+    """
+    result = await database.deadlines.update_many(
+        {"due_date": {"$type": "string"}, "due_at": {"$exists": False}},
+        [{"$set": {"due_at": _to_date_expression("$due_date")}}]
+    )
+    
+    logger.info(f"Datas BSON preenchidas em {result.modified_count} prazos")
+    return result.modified_count
+
+
+async def run_date_fields_migration(database) -> int:
+    """Executar cada migração das datas uma única vez."""
+    updated = 0
+    for migration_id, migrate in [
+        (DATE_FIELDS_MIGRATION_ID, backfill_date_fields),
+        (DEADLINE_DATES_MIGRATION_ID, backfill_deadline_dates),
+    ]:
+        if await database.migrations.find_one({"id": migration_id}):
+            continue
+        
+        count = await migrate(database)
+        await database.migrations.insert_one({"id": migration_id, "updated": count})
+        updated += count
+    return updated
@@ -0,0 +1,348 @@
+"""
+====================================================================
+LEMBRETES DE PRAZOS - CREDITOIMO
+====================================================================
+Motor em processo que envia o lembrete "o evento começa em 30 minutos"
+(`notify_deadline_reminder`) à hora certa.
+
+Funcionamento:
+- Os prazos futuros são carregados numa heap ordenada pela hora do
+  lembrete; o motor dorme até ao próximo lembrete (sem polling)
+- As rotas de prazos actualizam a heap ao criar, editar e apagar
+- Só a réplica com o lease de líder envia lembretes; alterações feitas
+  noutras réplicas chegam por change stream (ou, sem replica set, por
+  recarregamento a cada DEADLINE_REMINDER_RESYNC_SECONDS)
+- O envio é reclamado no próprio prazo (`reminder_sent_for`): cada
+  lembrete sai uma vez, mesmo com troca de líder, e entradas obsoletas
+  (prazo apagado, concluído ou com nova data) são ignoradas
+
+Prazos só com data (YYYY-MM-DD) começam às DEADLINE_ALL_DAY_HOUR horas
+no fuso SCHEDULER_TIMEZONE.
+====================================================================
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+from datetime import datetime, date, timezone, timedelta
+from typing import Optional, List, Dict, Tuple
+from zoneinfo import ZoneInfo
+
+from pymongo.errors import OperationFailure
+
+from services.date_fields import to_utc_datetime
+from services.realtime_notifications import notify_deadline_reminder
+from services.scheduler import LeaderLease, SCHEDULER_LEASE_SECONDS, SCHEDULER_TIMEZONE
+
+logger = logging.getLogger(__name__)
+
+DEADLINE_REMINDER_MINUTES = int(os.environ.get("DEADLINE_REMINDER_MINUTES", "30"))
+DEADLINE_ALL_DAY_HOUR = int(os.environ.get("DEADLINE_ALL_DAY_HOUR", "9"))
+DEADLINE_REMINDER_RESYNC_SECONDS = int(os.environ.get("DEADLINE_REMINDER_RESYNC_SECONDS", "300"))
+
+# Erro do MongoDB quando não há replica set (sem change streams)
+CHANGE_STREAM_UNSUPPORTED = 40573
+
+PARTICIPANT_FIELDS = ("assigned_consultor_id", "assigned_mediador_id", "assigned_user_id")
+
+REMINDER_PROJECTION = {
+    "_id": 0, "id": 1, "title": 1, "due_date": 1, "completed": 1,
+    "assigned_user_ids": 1, "reminder_sent_for": 1,
+    **{field: 1 for field in PARTICIPANT_FIELDS}
+}
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def deadline_participants(deadline: dict) -> List[str]:
+    """Utilizadores atribuídos ao prazo (lista e campos legacy), sem duplicados."""
+    candidates = list(deadline.get("assigned_user_ids") or [])
+    candidates += [deadline.get(field) for field in PARTICIPANT_FIELDS]
+    return list(dict.fromkeys(user_id for user_id in candidates if user_id))
+
+
+def deadline_start(deadline: dict, tz: str = SCHEDULER_TIMEZONE) -> Optional[datetime]:
+    """Hora (UTC) de início do prazo, ou None se a data for inválida."""
+    due_date = deadline.get("due_date")
+    
+    if isinstance(due_date, str) and len(due_date.strip()) == 10:
+        try:
+            day = date.fromisoformat(due_date.strip())
+        except ValueError:
+            return None
+        return datetime(day.year, day.month, day.day, DEADLINE_ALL_DAY_HOUR, tzinfo=ZoneInfo(tz)).astimezone(timezone.utc)
+    
+    return to_utc_datetime(due_date)
+
+
+def reminder_at(deadline: dict, minutes_before: int = DEADLINE_REMINDER_MINUTES) -> Optional[datetime]:
+    """Hora do lembrete, ou None se não houver lembrete a enviar."""
+    if deadline.get("completed") or deadline.get("reminder_sent_for") == deadline.get("due_date"):
+        return None
+    
+    start = deadline_start(deadline)
+    if start is None or start <= _utcnow():
+        return None
+    return start - timedelta(minutes=minutes_before)
+
+
+class DeadlineReminderEngine:
+    """Heap de lembretes de prazos, activa apenas na réplica líder."""
+    
+    def __init__(
+        self,
+        database=None,
+        minutes_before: int = DEADLINE_REMINDER_MINUTES,
+        lease_seconds: int = SCHEDULER_LEASE_SECONDS,
+        resync_seconds: int = DEADLINE_REMINDER_RESYNC_SECONDS
+    ):
+        self._database = database
+        self.minutes_before = minutes_before
+        self.lease_seconds = lease_seconds
+        self.resync_seconds = resync_seconds
+        self.lease: Optional[LeaderLease] = None
+        
+        # (hora do lembrete, sequência, id do prazo); entradas obsoletas
+        # ficam na heap e são descartadas ao sair
+        self._heap: List[Tuple[datetime, int, str]] = []
+        self._pending: Dict[str, Tuple[datetime, dict]] = {}
+        self._sequence = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        
+        self._task: Optional[asyncio.Task] = None
+        self._workers: List[asyncio.Task] = []
+    
+    @property
+    def db(self):
+        if self._database is not None:
+            return self._database
+        from database import db
+        return db
+    
+    @property
+    def is_leader(self) -> bool:
+        return bool(self._workers)
+    
+    @property
+    def pending_count(self) -> int:
+        return len(self._pending)
+    
+    # ----------------------------------------------------------------
+    # Heap
+    # ----------------------------------------------------------------
+    
+    def _push(self, deadline: dict):
+        deadline_id = deadline.get("id")
+        if not deadline_id:
+            return
+        
+        remind_at = reminder_at(deadline, self.minutes_before)
+        if remind_at is None:
+            self._pending.pop(deadline_id, None)
+            return
+        
+        self._pending[deadline_id] = (remind_at, deadline)
+        heapq.heappush(self._heap, (remind_at, next(self._sequence), deadline_id))
+    
+    def _pop_due(self, now: datetime) -> List[dict]:
+        """Retirar da heap os lembretes com hora <= now (ignorando obsoletos)."""
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            remind_at, _, deadline_id = heapq.heappop(self._heap)
+            entry = self._pending.get(deadline_id)
+            if entry and entry[0] == remind_at:
+                del self._pending[deadline_id]
+                due.append(entry[1])
+        return due
+    
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+    
+    def schedule(self, deadline: dict):
+        """
+        (Re)agendar o lembrete de um prazo criado ou editado.
+        
+        Nas réplicas que não são líder não faz nada: o líder recebe a
+        alteração pelo change stream ou pelo recarregamento periódico.
+        """
+        if not self.is_leader:
+            return
+        self._push(deadline)
+        self._wake()
+    
+    def cancel(self, deadline_id: str):
+        """Retirar o lembrete de um prazo apagado."""
+        self._pending.pop(deadline_id, None)
+    
+    async def load(self):
+        """Reconstruir a heap com todos os prazos futuros por concluir."""
+        cursor = self.db.deadlines.find(
+            {"completed": {"$ne": True}, "due_at": {"$gte": _utcnow() - timedelta(days=1)}},
+            REMINDER_PROJECTION
+        )
+        
+        self._heap = []
+        self._pending = {}
+        async for deadline in cursor:
+            self._push(deadline)
+        
+        logger.info(f"Lembretes de prazos: {len(self._pending)} agendados")
+        self._wake()
+    
+    # ----------------------------------------------------------------
+    # Envio
+    # ----------------------------------------------------------------
+    
+    async def _fire(self, deadline: dict) -> bool:
+        """Reclamar e enviar um lembrete. Devolve True se foi enviado."""
+        now = _utcnow()
+        start = deadline_start(deadline)
+        if start is None or start <= now:
+            return False
+        
+        # Só envia se o prazo continua igual e ninguém o enviou ainda
+        claimed = await self.db.deadlines.update_one(
+            {
+                "id": deadline["id"],
+                "due_date": deadline.get("due_date"),
+                "completed": {"$ne": True},
+                "reminder_sent_for": {"$ne": deadline.get("due_date")}
+            },
+            {"$set": {"reminder_sent_for": deadline.get("due_date"), "reminder_sent_at": now}}
+        )
+        if claimed.modified_count == 0:
+            return False
+        
+        minutes_left = max(1, round((start - now).total_seconds() / 60))
+        await notify_deadline_reminder(
+            {**deadline, "participants": deadline_participants(deadline), "date": deadline.get("due_date")},
+            minutes_before=minutes_left
+        )
+        return True
+    
+    async def _timer_loop(self):
+        while True:
+            # Limpar antes de ler a heap: um schedule() feito durante os
+            # envios volta a acordar o ciclo
+            self._wakeup.clear()
+            
+            due = self._pop_due(_utcnow())
+            for deadline in due:
+                try:
+                    await self._fire(deadline)
+                except Exception as e:
+                    logger.error(f"Erro ao enviar lembrete do prazo {deadline.get('id')}: {e}")
+            if due:
+                continue
+            
+            timeout = (self._heap[0][0] - _utcnow()).total_seconds() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+    
+    # ----------------------------------------------------------------
+    # Sincronização entre réplicas
+    # ----------------------------------------------------------------
+    
+    async def _watch_changes(self):
+        pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace"]}}}]
+        async with self.db.deadlines.watch(pipeline, full_document="updateLookup") as stream:
+            # Carregar depois de abrir o stream: nenhuma alteração fica por ver
+            await self.load()
+            # Prazos apagados não precisam de evento: o envio deixa de ser reclamável
+            async for change in stream:
+                if change.get("fullDocument"):
+                    self._push(change["fullDocument"])
+                    self._wake()
+    
+    async def _reload(self):
+        try:
+            await self.load()
+        except Exception as e:
+            logger.error(f"Erro ao recarregar lembretes de prazos: {e}")
+    
+    async def _sync_loop(self):
+        while True:
+            try:
+                await self._watch_changes()
+            except OperationFailure as e:
+                if e.code == CHANGE_STREAM_UNSUPPORTED:
+                    logger.info("MongoDB sem change streams: lembretes recarregados periodicamente")
+                    while True:
+                        await self._reload()
+                        await asyncio.sleep(self.resync_seconds)
+                logger.error(f"Erro no change stream de prazos: {e}")
+            except Exception as e:
+                logger.error(f"Erro na sincronização de lembretes de prazos: {e}")
+            
+            # Stream indisponível: manter a heap actualizada até nova tentativa
+            await self._reload()
+            await asyncio.sleep(self.resync_seconds)
+    
+    # ----------------------------------------------------------------
+    # Ciclo de vida
+    # ----------------------------------------------------------------
+    
+    async def _stop_workers(self):
+        workers = self._workers
+        self._workers = []
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        self._heap = []
+        self._pending = {}
+    
+    async def _run(self):
+        while True:
+            try:
+                is_leader = await self.lease.acquire()
+            except Exception as e:
+                logger.error(f"Erro ao renovar lease dos lembretes de prazos: {e}")
+                is_leader = False
+            
+            if is_leader and not self._workers:
+                logger.info(f"Lembretes de prazos: esta réplica é líder ({self.lease.owner})")
+                self._wakeup = asyncio.Event()
+                self._workers = [
+                    asyncio.create_task(self._sync_loop()),
+                    asyncio.create_task(self._timer_loop())
+                ]
+            elif not is_leader and self._workers:
+                logger.warning("Lembretes de prazos: lease perdido, a parar")
+                await self._stop_workers()
+            
+            await asyncio.sleep(self.lease.ttl_seconds / 3)
+    
+    def start(self):
+        """Iniciar o motor em background (idempotente)."""
+        if self.lease is None:
+            self.lease = LeaderLease(self.db, "leader:deadline_reminders", self.lease_seconds)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Parar o motor e libertar o lease."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        
+        await self._stop_workers()
+        if self.lease is not None:
+            try:
+                await self.lease.release()
+            except Exception as e:
+                logger.error(f"Erro ao libertar lease dos lembretes de prazos: {e}")
+
+
+# Instância global do motor de lembretes
+deadline_reminders = DeadlineReminderEngine()
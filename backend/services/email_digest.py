@@ -0,0 +1,161 @@
+"""
+====================================================================
+RESUMOS DE NOTIFICAÇÕES POR EMAIL - CREDITOIMO
+====================================================================
+Emails de notificação para staff segundo a preferência de cada
+utilizador (`email_digest_mode`):
+
+- immediate: um email por evento (comportamento anterior)
+- hourly / daily: o evento fica em `email_digest_events` e as tarefas
+  agendadas enviam um único email de resumo por período
+  (ver SCHEDULED_JOBS em services/scheduled_tasks.py)
+
+Cada resumo tem uma chave de idempotência por utilizador, período e
+conjunto de eventos: se a tarefa repetir (falha a meio, troca de líder)
+o email não é duplicado, e eventos chegados depois de um envio no mesmo
+período seguem num novo resumo em vez de serem descartados.
+====================================================================
+"""
+
+import hashlib
+import logging
+import os
+import uuid
+from datetime import datetime, timezone
+from typing import Optional
+from zoneinfo import ZoneInfo
+
+from models.auth import EmailDigestMode
+from services.email import send_email_notification, email_templates, is_smtp_configured
+from services.scheduler import SCHEDULER_TIMEZONE
+
+logger = logging.getLogger(__name__)
+
+# Eventos listados em cada resumo (os restantes são apenas contados)
+EMAIL_DIGEST_MAX_EVENTS = int(os.environ.get("EMAIL_DIGEST_MAX_EVENTS", "50"))
+
+DIGEST_LABELS = {
+    EmailDigestMode.HOURLY: "Resumo horário",
+    EmailDigestMode.DAILY: "Resumo diário",
+}
+
+
+def digest_mode(user: dict) -> str:
+    """Preferência do utilizador (immediate se ausente ou inválida)."""
+    mode = user.get("email_digest_mode")
+    return mode if mode in EmailDigestMode.ALL else EmailDigestMode.IMMEDIATE
+
+
+def digest_period(mode: str, now: datetime, tz: str = SCHEDULER_TIMEZONE) -> str:
+    """Identificador do período do resumo (hora ou dia, no fuso local)."""
+    local = now.astimezone(ZoneInfo(tz))
+    return local.strftime("%Y-%m-%dT%H") if mode == EmailDigestMode.HOURLY else local.strftime("%Y-%m-%d")
+
+
+def _get_db(database):
+    if database is not None:
+        return database
+    from database import db
+    return db
+
+
+async def send_staff_email(
+    user: dict,
+    subject: str,
+    body: str,
+    process_id: Optional[str] = None,
+    database=None
+) -> bool:
+    """
+    Email de notificação para um membro do staff.
+    
+    Com resumo activo, o evento é guardado para o próximo resumo em vez
+    de gerar um email.
+    
+    Returns:
+        True se o email ficou no outbox ou o evento ficou guardado
+    """
+    if not user.get("email"):
+        return False
+    
+    mode = digest_mode(user)
+    if mode == EmailDigestMode.IMMEDIATE:
+        return await send_email_notification(user["email"], subject, body)
+    
+    await _get_db(database).email_digest_events.insert_one({
+        "id": str(uuid.uuid4()),
+        "user_id": user["id"],
+        "email": user["email"],
+        "name": user.get("name"),
+        "mode": mode,
+        "subject": subject,
+        "body": body,
+        "process_id": process_id,
+        "created_at": datetime.now(timezone.utc)
+    })
+    return True
+
+
+async def send_email_digests(mode: str, database=None, now: Optional[datetime] = None) -> int:
+    """
+    Enviar um resumo a cada utilizador com eventos pendentes no modo dado.
+    
+    Returns:
+        Número de resumos enviados
+    """
+    database = _get_db(database)
+    now = now or datetime.now(timezone.utc)
+    period = digest_period(mode, now)
+    tz = ZoneInfo(SCHEDULER_TIMEZONE)
+    
+    pending = await database.email_digest_events.aggregate([
+        {"$match": {"mode": mode, "created_at": {"$lte": now}}},
+        {"$sort": {"created_at": 1}},
+        {"$group": {
+            "_id": "$user_id",
+            "email": {"$last": "$email"},
+            "name": {"$last": "$name"},
+            "ids": {"$push": "$id"},
+            "events": {"$push": {"subject": "$subject", "body": "$body", "created_at": "$created_at"}}
+        }},
+        {"$set": {"events": {"$slice": ["$events", EMAIL_DIGEST_MAX_EVENTS]}}}
+    ]).to_list(None)
+    if not pending:
+        return 0
+    
+    contexts = []
+    for digest in pending:
+        events = [
+            {
+                **event,
+                "time": event["created_at"].replace(tzinfo=timezone.utc).astimezone(tz).strftime("%d/%m %H:%M")
+            }
+            for event in digest["events"]
+        ]
+        contexts.append({
+            "name": digest.get("name") or digest["email"],
+            "events": events,
+            "total": len(digest["ids"]),
+            "hidden": len(digest["ids"]) - len(events)
+        })
+    rendered = email_templates.render_many("staff_digest", contexts, period_label=DIGEST_LABELS[mode])
+    
+    sent = 0
+    for digest, email in zip(pending, rendered):
+        if is_smtp_configured():
+            events_hash = hashlib.sha256("\x1f".join(sorted(digest["ids"])).encode()).hexdigest()[:16]
+            queued = await send_email_notification(
+                digest["email"], *email,
+                idempotency_key=f"digest:{mode}:{digest['_id']}:{period}:{events_hash}"
+            )
+            if not queued:
+                # Fica para o próximo resumo
+                continue
+            sent += 1
+        else:
+            logger.warning(f"[EMAIL SIMULATED] {email.subject} para {digest['email']}")
+        
+        await database.email_digest_events.delete_many({"id": {"$in": digest["ids"]}})
+    
+    logger.info(f"Resumos de email ({mode}): {sent} enviados para {len(pending)} utilizadores")
+    return sent
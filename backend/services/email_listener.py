@@ -0,0 +1,372 @@
+"""
+====================================================================
+RECEPÇÃO DE EMAILS EM TEMPO REAL (IMAP IDLE) - CREDITOIMO
+====================================================================
+Escuta contínua das caixas de email: os emails aparecem no histórico
+dos processos segundos depois de chegarem, sem sincronização manual.
+
+Funcionamento:
+- Por conta (get_email_accounts) duas sessões IMAP dedicadas, em INBOX
+  e na pasta de enviados, em IDLE (RFC 2177): o servidor avisa quando
+  chega uma mensagem, sem polling
+- Cada aviso lê só as mensagens novas (checkpoints da sincronização das
+  caixas, âmbito "mailbox"), encaminha-as pelo índice de clientes
+  (services/email_sync.py), guarda-as e avisa a equipa atribuída ao
+  processo: notificação guardada (qualquer worker) e evento WebSocket
+  `email_received` para as ligações da réplica líder
+- O IDLE é renovado a cada EMAIL_IDLE_RENEW_SECONDS (os servidores
+  terminam sessões em IDLE há mais de 30 minutos); servidores sem IDLE
+  são consultados a cada EMAIL_IDLE_FALLBACK_SECONDS
+- Ligação perdida: nova tentativa com espera exponencial (de
+  EMAIL_LISTENER_BACKOFF_SECONDS até EMAIL_LISTENER_MAX_BACKOFF_SECONDS)
+- Só a réplica com o lease de líder escuta as caixas
+
+A sincronização nocturna das caixas continua a correr e apanha o que
+tiver escapado (p.ex. com a aplicação parada).
+====================================================================
+"""
+
+import asyncio
+import imaplib
+import itertools
+import logging
+import os
+import re
+import select
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Optional, List, Dict, Any
+
+from services.email_service import (
+    EmailAccount,
+    SENT_FOLDERS,
+    SyncCheckpoints,
+    connect_imap,
+    get_email_accounts,
+    list_folders,
+)
+from services.email_sync import MAILBOX_SCOPE, ClientIndex, read_folders, store_routed_emails
+from services.realtime_notifications import notify_new_emails
+from services.scheduler import LeaderLease, SCHEDULER_LEASE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+EMAIL_IDLE_ENABLED = os.environ.get("EMAIL_IDLE_ENABLED", "true").lower() == "true"
+EMAIL_IDLE_RENEW_SECONDS = int(os.environ.get("EMAIL_IDLE_RENEW_SECONDS", "600"))
+EMAIL_IDLE_FALLBACK_SECONDS = int(os.environ.get("EMAIL_IDLE_FALLBACK_SECONDS", "60"))
+EMAIL_LISTENER_BACKOFF_SECONDS = int(os.environ.get("EMAIL_LISTENER_BACKOFF_SECONDS", "5"))
+EMAIL_LISTENER_MAX_BACKOFF_SECONDS = int(os.environ.get("EMAIL_LISTENER_MAX_BACKOFF_SECONDS", "300"))
+# O índice de clientes é recarregado com esta idade (processos novos ou alterados)
+EMAIL_LISTENER_INDEX_SECONDS = int(os.environ.get("EMAIL_LISTENER_INDEX_SECONDS", "300"))
+# Limite da primeira leitura de uma pasta sem checkpoint
+EMAIL_LISTENER_SINCE_DAYS = int(os.environ.get("EMAIL_LISTENER_SINCE_DAYS", "30"))
+
+# Intervalo de verificação do pedido de paragem durante o IDLE
+IDLE_STOP_CHECK_SECONDS = 1
+
+_NEW_MAIL = re.compile(rb"^\* \d+ (EXISTS|RECENT)", re.IGNORECASE)
+_idle_tags = itertools.count(1)
+
+
+def _read_line(mail: imaplib.IMAP4) -> bytes:
+    line = mail.readline()
+    if not line:
+        raise imaplib.IMAP4.abort("ligação terminada pelo servidor")
+    if line.upper().startswith(b"* BYE"):
+        raise imaplib.IMAP4.abort(line.decode(errors="replace").strip())
+    return line
+
+
+def _data_waiting(mail: imaplib.IMAP4, timeout: float) -> bool:
+    sock = mail.socket()
+    # Dados já decifrados no TLS não são vistos pelo select
+    if getattr(sock, "pending", None) and sock.pending():
+        return True
+    ready, _, _ = select.select([sock], [], [], timeout)
+    return bool(ready)
+
+
+def idle_wait(mail: imaplib.IMAP4, timeout: float, stop: threading.Event) -> bool:
+    """
+    Esperar em IDLE por mensagens novas na pasta seleccionada (bloqueante).
+    
+    Termina quando o servidor anuncia mensagens (EXISTS), ao fim de
+    `timeout` segundos ou quando `stop` é activado.
+    
+    Returns:
+        True se o servidor anunciou mensagens novas
+    """
+    tag = f"IDLE{next(_idle_tags)}".encode()
+    mail.send(tag + b" IDLE\r\n")
+    line = _read_line(mail)
+    if not line.startswith(b"+"):
+        raise imaplib.IMAP4.error(f"IDLE recusado: {line.decode(errors='replace').strip()}")
+    
+    changed = False
+    deadline = time.monotonic() + timeout
+    while not changed and not stop.is_set():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        if _data_waiting(mail, min(remaining, IDLE_STOP_CHECK_SECONDS)):
+            changed = bool(_NEW_MAIL.match(_read_line(mail)))
+    
+    # Terminar o IDLE; avisos que tenham chegado entretanto também contam
+    mail.send(b"DONE\r\n")
+    while True:
+        line = _read_line(mail)
+        if line.startswith(tag + b" "):
+            if not line[len(tag) + 1:].upper().startswith(b"OK"):
+                raise imaplib.IMAP4.error(f"IDLE terminado com erro: {line.decode(errors='replace').strip()}")
+            return changed
+        changed = changed or bool(_NEW_MAIL.match(line))
+
+
+def wait_for_mail(mail: imaplib.IMAP4, timeout: float, stop: threading.Event) -> bool:
+    """IDLE se o servidor o suportar; caso contrário, espera e NOOP (bloqueante)."""
+    if "IDLE" in mail.capabilities:
+        return idle_wait(mail, timeout, stop)
+    
+    deadline = time.monotonic() + min(timeout, EMAIL_IDLE_FALLBACK_SECONDS)
+    while not stop.is_set() and time.monotonic() < deadline:
+        time.sleep(IDLE_STOP_CHECK_SECONDS)
+    mail.noop()
+    return True
+
+
+def _logout(mail: imaplib.IMAP4):
+    try:
+        mail.logout()
+    except Exception:
+        try:
+            mail.shutdown()
+        except Exception:
+            pass
+
+
+class EmailListenerEngine:
+    """Sessões IMAP IDLE de todas as contas, activas apenas na réplica líder."""
+    
+    def __init__(
+        self,
+        database=None,
+        lease_seconds: int = SCHEDULER_LEASE_SECONDS,
+        renew_seconds: int = EMAIL_IDLE_RENEW_SECONDS,
+        backoff_seconds: float = EMAIL_LISTENER_BACKOFF_SECONDS,
+        max_backoff_seconds: float = EMAIL_LISTENER_MAX_BACKOFF_SECONDS,
+        since_days: int = EMAIL_LISTENER_SINCE_DAYS
+    ):
+        self._database = database
+        self.lease_seconds = lease_seconds
+        self.renew_seconds = renew_seconds
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.since_days = since_days
+        self.lease: Optional[LeaderLease] = None
+        
+        self._index: Optional[ClientIndex] = None
+        self._index_loaded_at = 0.0
+        self._index_lock: Optional[asyncio.Lock] = None
+        
+        # Estado de cada sessão ("conta:INBOX" / "conta:sent")
+        self.listeners: Dict[str, Dict[str, Any]] = {}
+        
+        self._stopping = threading.Event()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._task: Optional[asyncio.Task] = None
+        self._workers: List[asyncio.Task] = []
+    
+    @property
+    def db(self):
+        if self._database is not None:
+            return self._database
+        from database import db
+        return db
+    
+    @property
+    def is_leader(self) -> bool:
+        return bool(self._workers)
+    
+    async def _blocking(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+    
+    # ----------------------------------------------------------------
+    # Leitura das mensagens novas
+    # ----------------------------------------------------------------
+    
+    async def client_index(self) -> ClientIndex:
+        """Índice de clientes partilhado pelas sessões (recarregado periodicamente)."""
+        async with self._index_lock:
+            if self._index is None or time.monotonic() - self._index_loaded_at > EMAIL_LISTENER_INDEX_SECONDS:
+                self._index = await ClientIndex.load(self.db)
+                self._index_loaded_at = time.monotonic()
+        return self._index
+    
+    async def ingest(self, account: EmailAccount, folder: str, mail: imaplib.IMAP4) -> int:
+        """
+        Guardar as mensagens novas da pasta e avisar a equipa dos processos.
+        
+        Returns:
+            Número de emails novos guardados
+        """
+        index = await self.client_index()
+        checkpoints = await SyncCheckpoints.load(account.name, MAILBOX_SCOPE, database=self.db)
+        routed, stats = await self._blocking(
+            read_folders, mail, account, index, checkpoints, {folder: set()}, self.since_days
+        )
+        stored = await store_routed_emails(routed, self.db)
+        await checkpoints.save()
+        
+        if stored:
+            cursor = self.db.processes.find(
+                {"id": {"$in": list(stored)}},
+                {"_id": 0, "id": 1, "client_name": 1, "consultor_id": 1, "assigned_consultor_id": 1,
+                 "mediador_id": 1, "assigned_mediador_id": 1}
+            )
+            async for process in cursor:
+                try:
+                    await notify_new_emails(process, stored[process["id"]])
+                except Exception as e:
+                    logger.error(f"Erro ao avisar emails novos do processo {process['id']}: {e}")
+        
+        new_count = sum(len(docs) for docs in stored.values())
+        if new_count:
+            logger.info(f"Emails em tempo real ({account.name}/{folder}): {new_count} novos em {len(stored)} processos")
+        return new_count
+    
+    # ----------------------------------------------------------------
+    # Sessões IDLE
+    # ----------------------------------------------------------------
+    
+    def _open_session(self, account: EmailAccount, sent: bool) -> tuple:
+        """Ligar e escolher a pasta a escutar (bloqueante)."""
+        mail = connect_imap(account)
+        if not sent:
+            return mail, "INBOX"
+        names = list_folders(mail)
+        return mail, next((f for f in SENT_FOLDERS if f in names), None)
+    
+    async def _listen(self, account: EmailAccount, sent: bool):
+        key = f"{account.name}:{'sent' if sent else 'INBOX'}"
+        status = self.listeners[key] = {
+            "connected": False, "folder": None, "connections": 0, "errors": 0,
+            "ingested": 0, "last_error": None, "connected_at": None
+        }
+        delay = self.backoff_seconds
+        
+        while not self._stopping.is_set():
+            mail = None
+            try:
+                mail, folder = await self._blocking(self._open_session, account, sent)
+                if folder is None:
+                    logger.info(f"Emails em tempo real: {account.name} sem pasta de enviados")
+                    return
+                status.update(connected=True, folder=folder, connected_at=datetime.now(timezone.utc).isoformat())
+                status["connections"] += 1
+                delay = self.backoff_seconds
+                
+                # O que chegou enquanto a sessão estava em baixo
+                status["ingested"] += await self.ingest(account, folder, mail)
+                while not self._stopping.is_set():
+                    await self._blocking(wait_for_mail, mail, self.renew_seconds, self._stopping)
+                    if self._stopping.is_set():
+                        break
+                    # Também na renovação do IDLE: apanha avisos que se tenham perdido
+                    status["ingested"] += await self.ingest(account, folder, mail)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                status.update(connected=False, last_error=str(e))
+                status["errors"] += 1
+                logger.warning(f"Emails em tempo real: sessão {key} perdida ({e}); nova tentativa em {delay}s")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_backoff_seconds)
+            finally:
+                status["connected"] = False
+                if mail is not None:
+                    await self._blocking(_logout, mail)
+    
+    async def _start_workers(self):
+        accounts = get_email_accounts()
+        if not accounts:
+            logger.info("Emails em tempo real: nenhuma conta de email configurada")
+            return
+        
+        self._stopping.clear()
+        self._index_lock = asyncio.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2 * len(accounts), thread_name_prefix="imap-idle")
+        self._workers = [
+            asyncio.create_task(self._listen(account, sent))
+            for account in accounts
+            for sent in (False, True)
+        ]
+    
+    async def _stop_workers(self):
+        workers = self._workers
+        self._workers = []
+        if not workers:
+            return
+        
+        # As sessões saem do IDLE no máximo em IDLE_STOP_CHECK_SECONDS
+        self._stopping.set()
+        _, pending = await asyncio.wait(workers, timeout=IDLE_STOP_CHECK_SECONDS * 3)
+        for worker in pending:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        
+        self._executor.shutdown(wait=False)
+        self._executor = None
+        self._index = None
+    
+    # ----------------------------------------------------------------
+    # Ciclo de vida
+    # ----------------------------------------------------------------
+    
+    async def _run(self):
+        while True:
+            try:
+                is_leader = await self.lease.acquire()
+            except Exception as e:
+                logger.error(f"Erro ao renovar lease dos emails em tempo real: {e}")
+                is_leader = False
+            
+            if is_leader and not self._workers:
+                logger.info(f"Emails em tempo real: esta réplica é líder ({self.lease.owner})")
+                await self._start_workers()
+            elif not is_leader and self._workers:
+                logger.warning("Emails em tempo real: lease perdido, a parar")
+                await self._stop_workers()
+            
+            await asyncio.sleep(self.lease.ttl_seconds / 3)
+    
+    def start(self):
+        """Iniciar a escuta em background (idempotente)."""
+        if not EMAIL_IDLE_ENABLED:
+            return
+        if self.lease is None:
+            self.lease = LeaderLease(self.db, "leader:email_listener", self.lease_seconds)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Parar as sessões e libertar o lease."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        
+        await self._stop_workers()
+        if self.lease is not None:
+            try:
+                await self.lease.release()
+            except Exception as e:
+                logger.error(f"Erro ao libertar lease dos emails em tempo real: {e}")
+
+
+# Instância global da escuta das caixas de email
+email_listeners = EmailListenerEngine()
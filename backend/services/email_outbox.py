@@ -0,0 +1,402 @@
+"""
+====================================================================
+OUTBOX DE EMAILS - CREDITOIMO
+====================================================================
+Emails transaccionais guardados na colecção `email_outbox` e enviados
+por um worker em background: o pedido HTTP não espera pelo servidor
+SMTP e um SMTP em baixo não perde emails.
+
+Funcionalidades:
+- Chave de idempotência indicada por quem envia: repetir o pedido (p.ex.
+  um duplo submit ou um retry do cliente) não gera um segundo envio; sem
+  chave, cada pedido é um email novo
+- Ritmo limitado por fornecedor (token bucket na colecção
+  `email_rate_limits`, partilhado entre réplicas): EMAIL_RATE_PER_MINUTE
+  por omissão, ou por servidor em EMAIL_PROVIDER_RATES
+  ("smtp.exemplo.pt=20,smtp.outro.pt=100")
+- Retry com backoff exponencial (com jitter) para falhas temporárias;
+  respostas 5xx do servidor SMTP são definitivas
+- Um envio sem confirmação (tempo esgotado depois de a mensagem seguir
+  para o servidor) não é repetido, para não duplicar o email
+- Estado de entrega guardado no próprio documento (sent/dead, tentativas,
+  último erro) durante EMAIL_OUTBOX_RETENTION_DAYS
+====================================================================
+"""
+
+import asyncio
+import logging
+import os
+import random
+import uuid
+from datetime import datetime, timezone, timedelta
+from typing import Optional, List, Dict, Tuple
+
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from database import db
+import services.email as email_service
+
+logger = logging.getLogger(__name__)
+
+# Configuração do outbox
+EMAIL_OUTBOX_BATCH_SIZE = int(os.environ.get("EMAIL_OUTBOX_BATCH_SIZE", "50"))
+EMAIL_OUTBOX_POLL_SECONDS = float(os.environ.get("EMAIL_OUTBOX_POLL_SECONDS", "5"))
+EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.environ.get("EMAIL_OUTBOX_MAX_ATTEMPTS", "8"))
+EMAIL_RETRY_BASE_SECONDS = float(os.environ.get("EMAIL_RETRY_BASE_SECONDS", "30"))
+EMAIL_RETRY_MAX_SECONDS = float(os.environ.get("EMAIL_RETRY_MAX_SECONDS", "3600"))
+EMAIL_OUTBOX_RETENTION_DAYS = int(os.environ.get("EMAIL_OUTBOX_RETENTION_DAYS", "30"))
+EMAIL_OUTBOX_LEASE_SECONDS = 600
+
+# Ritmo de envio por fornecedor (emails por minuto e rajada máxima)
+EMAIL_RATE_PER_MINUTE = float(os.environ.get("EMAIL_RATE_PER_MINUTE", "60"))
+EMAIL_RATE_BURST = int(os.environ.get("EMAIL_RATE_BURST", "10"))
+EMAIL_PROVIDER_RATES = os.environ.get("EMAIL_PROVIDER_RATES", "")
+
+
+class EmailJobStatus:
+    PENDING = "pending"
+    PROCESSING = "processing"
+    SENT = "sent"
+    DEAD = "dead"
+
+
+class EmailFailureReason:
+    MAX_ATTEMPTS = "max_attempts"
+    REJECTED = "rejected"
+    UNCONFIRMED = "unconfirmed"
+
+
+def parse_provider_rates(value: str) -> Dict[str, float]:
+    """Interpretar EMAIL_PROVIDER_RATES ("host=por_minuto,...")."""
+    rates = {}
+    for item in value.split(","):
+        host, _, rate = item.partition("=")
+        try:
+            rates[host.strip().lower()] = float(rate)
+        except ValueError:
+            continue
+    return rates
+
+
+def compute_email_retry_delay(attempts: int) -> float:
+    """Backoff exponencial com jitter (metade fixa, metade aleatória)."""
+    backoff = min(EMAIL_RETRY_MAX_SECONDS, EMAIL_RETRY_BASE_SECONDS * (2 ** max(0, attempts - 1)))
+    return backoff / 2 + random.uniform(0, backoff / 2)
+
+
+def is_permanent_failure(result: dict) -> bool:
+    """Resposta 5xx do servidor SMTP (destinatário ou mensagem recusados)."""
+    code = result.get("code")
+    return code is not None and 500 <= code < 600
+
+
+async def enqueue_email(
+    to_email: str,
+    subject: str,
+    body: str,
+    html_body: Optional[str] = None,
+    idempotency_key: Optional[str] = None,
+    provider: Optional[str] = None,
+    database=None
+) -> bool:
+    """
+    Guardar um email no outbox e acordar o worker.
+    
+    Args:
+        idempotency_key: Chave do envio (p.ex. "registration:<processo>");
+            sem chave não há deduplicação: dois pedidos iguais são dois emails
+        database: Base de dados (por omissão a da aplicação)
+    
+    Returns:
+        True se o email foi criado, False se a chave já existia
+    """
+    now = datetime.now(timezone.utc)
+    job_id = str(uuid.uuid4())
+    job = {
+        "id": job_id,
+        "idempotency_key": idempotency_key or f"auto:{job_id}",
+        "provider": (provider or email_service.SMTP_SERVER).lower(),
+        "to": to_email,
+        "subject": subject,
+        "body": body,
+        "html_body": html_body,
+        "status": EmailJobStatus.PENDING,
+        "attempts": 0,
+        "created_at": now,
+        "next_attempt_at": now,
+        "last_error": None,
+        "last_code": None
+    }
+    
+    try:
+        await (db if database is None else database).email_outbox.insert_one(job)
+    except DuplicateKeyError:
+        logger.warning(f"[EMAIL OUTBOX] Email repetido ignorado para {to_email} ({job['idempotency_key']})")
+        return False
+    
+    email_outbox_worker.wake()
+    return True
+
+
+class ProviderRateLimiter:
+    """
+    Token bucket por fornecedor, guardado em `email_rate_limits`.
+    
+    A reposição e a reserva são feitas numa só actualização atómica:
+    várias réplicas partilham o mesmo ritmo.
+    """
+    
+    def __init__(
+        self,
+        default_rate: float = EMAIL_RATE_PER_MINUTE,
+        burst: int = EMAIL_RATE_BURST,
+        rates: Optional[Dict[str, float]] = None
+    ):
+        self.default_rate = default_rate
+        self.burst = burst
+        self.rates = parse_provider_rates(EMAIL_PROVIDER_RATES) if rates is None else rates
+    
+    def rate_per_minute(self, provider: str) -> float:
+        return self.rates.get(provider, self.default_rate)
+    
+    async def acquire(self, provider: str, requested: int) -> Tuple[int, float]:
+        """
+        Reservar até `requested` envios.
+        
+        Returns:
+            (envios concedidos, segundos até haver novo token)
+        """
+        rate_per_second = self.rate_per_minute(provider) / 60
+        now = datetime.now(timezone.utc)
+        elapsed_ms = {"$max": [0, {"$subtract": [now, {"$ifNull": ["$updated_at", now]}]}]}
+        
+        bucket = await db.email_rate_limits.find_one_and_update(
+            {"_id": provider},
+            [
+                {"$set": {
+                    "tokens": {"$min": [
+                        self.burst,
+                        {"$add": [
+                            {"$ifNull": ["$tokens", self.burst]},
+                            {"$multiply": [elapsed_ms, rate_per_second / 1000]}
+                        ]}
+                    ]},
+                    "updated_at": now
+                }},
+                {"$set": {"granted": {"$max": [0, {"$min": [requested, {"$floor": "$tokens"}]}]}}},
+                {"$set": {"tokens": {"$subtract": ["$tokens", "$granted"]}}}
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        
+        granted = int(bucket["granted"])
+        wait = max(0.0, 1 - bucket["tokens"]) / rate_per_second if rate_per_second > 0 else EMAIL_OUTBOX_POLL_SECONDS
+        return granted, wait
+    
+    async def release(self, provider: str, tokens: int):
+        """Devolver envios reservados e não usados."""
+        if tokens > 0:
+            await db.email_rate_limits.update_one({"_id": provider}, {"$inc": {"tokens": tokens}})
+
+
+class EmailOutboxWorker:
+    """Worker que envia os emails do `email_outbox`."""
+    
+    def __init__(
+        self,
+        sender=None,
+        limiter: Optional[ProviderRateLimiter] = None,
+        batch_size: int = EMAIL_OUTBOX_BATCH_SIZE,
+        poll_interval: float = EMAIL_OUTBOX_POLL_SECONDS,
+        max_attempts: int = EMAIL_OUTBOX_MAX_ATTEMPTS
+    ):
+        self.sender = sender or self._deliver
+        self.limiter = limiter or ProviderRateLimiter()
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self._throttle_wait: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+    
+    @staticmethod
+    async def _deliver(job: dict) -> dict:
+        return await email_service.deliver_email(job["to"], job["subject"], job["body"], job.get("html_body"))
+    
+    @staticmethod
+    def _ready_filter(provider: str, now: datetime) -> dict:
+        """Emails prontos do fornecedor (inclui reservas expiradas de workers mortos)."""
+        return {"provider": provider, "$or": [
+            {"status": EmailJobStatus.PENDING, "next_attempt_at": {"$lte": now}},
+            {"status": EmailJobStatus.PROCESSING, "locked_until": {"$lt": now}}
+        ]}
+    
+    async def _claim(self, provider: str, limit: int, now: datetime) -> List[dict]:
+        """Reservar até `limit` emails prontos do fornecedor."""
+        ready = self._ready_filter(provider, now)
+        candidates = await db.email_outbox.find(ready, {"_id": 0, "id": 1}) \
+            .sort("next_attempt_at", 1).limit(limit).to_list(limit)
+        if not candidates:
+            return []
+        
+        lease_token = str(uuid.uuid4())
+        await db.email_outbox.update_many(
+            {"id": {"$in": [c["id"] for c in candidates]}, **ready},
+            {"$set": {
+                "status": EmailJobStatus.PROCESSING,
+                "lease_token": lease_token,
+                "locked_until": now + timedelta(seconds=EMAIL_OUTBOX_LEASE_SECONDS)
+            }}
+        )
+        
+        return await db.email_outbox.find({"lease_token": lease_token}, {"_id": 0}).to_list(limit)
+    
+    async def _send(self, jobs: List[dict], stats: Dict[str, int]):
+        """Enviar os emails reservados e guardar o resultado de cada um."""
+        results = await asyncio.gather(*(self.sender(job) for job in jobs))
+        now = datetime.now(timezone.utc)
+        updates = []
+        
+        for job, result in zip(jobs, results):
+            attempts = job["attempts"] + 1
+            fields = {"attempts": attempts, "last_error": result.get("error"), "last_code": result.get("code")}
+            
+            if result["ok"]:
+                fields.update(status=EmailJobStatus.SENT, sent_at=now, finished_at=now)
+                stats["sent"] += 1
+            elif result.get("unconfirmed"):
+                # Pode ter sido entregue: repetir arriscaria um email duplicado
+                fields.update(status=EmailJobStatus.DEAD, reason=EmailFailureReason.UNCONFIRMED, finished_at=now)
+                stats["dead"] += 1
+                logger.warning(f"[EMAIL OUTBOX] Envio para {job['to']} sem confirmação, não repetido: {result.get('error')}")
+            elif is_permanent_failure(result) or attempts >= self.max_attempts:
+                reason = EmailFailureReason.REJECTED if is_permanent_failure(result) else EmailFailureReason.MAX_ATTEMPTS
+                fields.update(status=EmailJobStatus.DEAD, reason=reason, finished_at=now)
+                stats["dead"] += 1
+            else:
+                fields.update(
+                    status=EmailJobStatus.PENDING,
+                    next_attempt_at=now + timedelta(seconds=compute_email_retry_delay(attempts))
+                )
+                stats["retried"] += 1
+            
+            updates.append(UpdateOne(
+                {"id": job["id"], "lease_token": job["lease_token"]},
+                {"$set": fields, "$unset": {"lease_token": "", "locked_until": ""}}
+            ))
+        
+        if updates:
+            await db.email_outbox.bulk_write(updates, ordered=False)
+    
+    async def drain_once(self) -> Dict[str, int]:
+        """
+        Processar um lote por fornecedor, dentro do ritmo permitido.
+        
+        Returns:
+            Contadores do lote (claimed, sent, retried, dead, throttled)
+        """
+        now = datetime.now(timezone.utc)
+        stats = {"claimed": 0, "sent": 0, "retried": 0, "dead": 0, "throttled": 0}
+        self._throttle_wait = None
+        
+        providers = await db.email_outbox.distinct("provider", {"status": {"$in": [
+            EmailJobStatus.PENDING, EmailJobStatus.PROCESSING
+        ]}})
+        
+        for provider in providers:
+            waiting = await db.email_outbox.count_documents(self._ready_filter(provider, now), limit=self.batch_size)
+            if not waiting:
+                continue
+            
+            granted, wait = await self.limiter.acquire(provider, waiting)
+            if granted < waiting:
+                stats["throttled"] += waiting - granted
+                self._throttle_wait = min(wait, self._throttle_wait or wait)
+            if not granted:
+                continue
+            
+            jobs = await self._claim(provider, granted, now)
+            await self.limiter.release(provider, granted - len(jobs))
+            stats["claimed"] += len(jobs)
+            await self._send(jobs, stats)
+        
+        if stats["claimed"] or stats["throttled"]:
+            logger.info(f"Outbox de emails: {stats}")
+        return stats
+    
+    async def drain(self) -> Dict[str, int]:
+        """Processar lotes até não haver emails prontos (ou o ritmo esgotar)."""
+        totals = {"claimed": 0, "sent": 0, "retried": 0, "dead": 0, "throttled": 0}
+        while True:
+            stats = await self.drain_once()
+            for key, value in stats.items():
+                totals[key] += value
+            if not stats["claimed"] or stats["throttled"]:
+                totals["throttled"] = stats["throttled"]
+                return totals
+    
+    def wake(self):
+        """Acordar o worker (chamado após enfileirar novos emails)."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+    
+    async def _run(self):
+        while True:
+            # Limpar antes de drenar: um wake() durante a drenagem não se perde
+            self._wakeup.clear()
+            try:
+                await self.drain()
+            except Exception as e:
+                logger.error(f"Erro ao drenar outbox de emails: {e}")
+            
+            # Ritmo esgotado: voltar quando houver novo token
+            timeout = self.poll_interval
+            if self._throttle_wait is not None:
+                timeout = min(timeout, max(self._throttle_wait, 0.1))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+    
+    def start(self):
+        """Iniciar o worker em background (idempotente)."""
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Parar o worker."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._wakeup = None
+
+
+async def get_email_outbox_stats() -> dict:
+    """Obter o estado do outbox (por estado e motivos de falha)."""
+    now = datetime.now(timezone.utc)
+    
+    statuses = await db.email_outbox.aggregate([
+        {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+    ]).to_list(None)
+    reasons = await db.email_outbox.aggregate([
+        {"$match": {"status": EmailJobStatus.DEAD}},
+        {"$group": {"_id": "$reason", "count": {"$sum": 1}}}
+    ]).to_list(None)
+    
+    return {
+        **{status: 0 for status in (EmailJobStatus.PENDING, EmailJobStatus.PROCESSING, EmailJobStatus.SENT, EmailJobStatus.DEAD)},
+        **{s["_id"]: s["count"] for s in statuses},
+        "ready": await db.email_outbox.count_documents({"status": EmailJobStatus.PENDING, "next_attempt_at": {"$lte": now}}),
+        "dead_reasons": {r["_id"]: r["count"] for r in reasons}
+    }
+
+
+# Instância global do worker
+email_outbox_worker = EmailOutboxWorker()
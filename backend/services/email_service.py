@@ -4,9 +4,22 @@ SERVIÇO DE EMAIL - CREDITOIMO
 ====================================================================
 Serviço para enviar e receber emails via SMTP/IMAP.
 Suporta dois servidores: Precision Crédito e Power Real Estate.
+
+Sincronização IMAP incremental: por conta, pasta e processo guarda-se
+o UIDVALIDITY e o último UID visto (colecção `email_sync_state`). Cada
+sincronização só pesquisa e descarrega os UIDs novos; se o UIDVALIDITY
+mudar (pasta recriada no servidor) ou os termos de pesquisa mudarem
+(novo email monitorizado), a pasta volta a ser lida de início.
+
+De cada mensagem candidata lêem-se primeiro só os cabeçalhos e o
+BODYSTRUCTURE; as partes de texto só são descarregadas para as que
+interessam e os anexos apenas quando são abertos. No histórico fica só
+o resumo de cada email; o corpo é guardado à parte, comprimido (ver
+services/email_store.py).
 ====================================================================
 """
 
+import asyncio
 import logging
 import os
 import email
@@ -15,21 +28,50 @@ import smtplib
 import ssl
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from email.header import decode_header
-from typing import Optional, List, Dict, Any
+from email.header import decode_header, make_header
+from typing import Optional, List, Dict, Any, Iterator, NamedTuple, Tuple
 from datetime import datetime, timezone, timedelta
+from itertools import takewhile
+import base64
+import hashlib
+import quopri
 import uuid
 import re
 
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
 from database import db
+from services.email_store import (
+    EMAIL_BODIES_MIGRATION_ID, compact_email, delete_email_bodies, move_email_bodies, save_email_bodies, store_email
+)
+from services.imap_pool import imap_pools, IMAP_CONNECTION_ERRORS
 
 logger = logging.getLogger(__name__)
 
+# Pastas de enviados (nomes habituais nos servidores das contas)
+SENT_FOLDERS = ["Sent", "INBOX.Sent", "Sent Items", "Enviados"]
+
+# UIDs por comando UID FETCH
+IMAP_FETCH_BATCH = int(os.environ.get("IMAP_FETCH_BATCH", "50"))
+
+# Cabeçalhos lidos na primeira fase (o conteúdo só é lido se a mensagem interessar)
+HEADER_FIELDS = ("FROM", "TO", "CC", "SUBJECT", "DATE", "MESSAGE-ID")
+HEADER_FETCH = f"(UID BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS ({' '.join(HEADER_FIELDS)})])"
+
+# Emails sincronizados: chave única (process_id, dedupe_key) e migração das chaves
+DUPLICATE_KEY_ERROR = 11000
+EMAIL_DEDUPE_MIGRATION_ID = "email_dedupe_key_v1"
+
+_OPEN, _CLOSE = object(), object()
+_FETCH_TOKEN = re.compile(rb'(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"\[]+(?:\[[^\]]*\](?:<[\d.]+>)?)?)')
+
 
 class EmailAccount:
     """Configuração de uma conta de email."""
     def __init__(self, name: str, imap_server: str, imap_port: int, 
-                 smtp_server: str, smtp_port: int, email: str, password: str):
+                 smtp_server: str, smtp_port: int, email: str, password: str,
+                 imap_ssl: bool = True):
         self.name = name
         self.imap_server = imap_server
         self.imap_port = imap_port
@@ -37,6 +79,7 @@ class EmailAccount:
         self.smtp_port = smtp_port
         self.email = email
         self.password = password
+        self.imap_ssl = imap_ssl
 
 
 # Configuração das contas de email
@@ -75,6 +118,11 @@ def decode_email_header(header: str) -> str:
     """Descodificar header de email."""
     if not header:
         return ""
+    try:
+        # Palavras codificadas consecutivas juntam-se sem espaço (RFC 2047)
+        return str(make_header(decode_header(header)))
+    except Exception:
+        pass
     decoded_parts = decode_header(header)
     result = []
     for content, charset in decoded_parts:
@@ -100,282 +148,685 @@ def extract_email_address(header: str) -> str:
     return header.strip().lower()
 
 
-def get_email_body(msg) -> tuple:
-    """Extrair corpo do email (texto e HTML)."""
-    body_text = ""
-    body_html = ""
+def connect_imap(account: EmailAccount) -> imaplib.IMAP4:
+    """
+    Abrir e autenticar uma ligação IMAP à conta, fora do pool (bloqueante).
     
-    if msg.is_multipart():
-        for part in msg.walk():
-            content_type = part.get_content_type()
-            content_disposition = str(part.get("Content-Disposition"))
-            
-            if "attachment" not in content_disposition:
-                try:
-                    payload = part.get_payload(decode=True)
-                    if payload:
-                        charset = part.get_content_charset() or 'utf-8'
-                        text = payload.decode(charset, errors='replace')
-                        if content_type == "text/plain":
-                            body_text = text
-                        elif content_type == "text/html":
-                            body_html = text
-                except Exception as e:
-                    logger.warning(f"Erro ao extrair corpo: {e}")
-    else:
+    A sincronização usa as sessões de imap_pools (services/imap_pool.py).
+    """
+    return imap_pools.get(account).connect()
+
+
+def quote_folder(folder: str) -> str:
+    """Nome da pasta entre aspas (nomes com espaços, p.ex. "Sent Items")."""
+    name = folder.strip('"').replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{name}"'
+
+
+def select_folder(mail: imaplib.IMAP4, folder: str) -> Optional[int]:
+    """
+    Seleccionar uma pasta só para leitura (as mensagens não ficam lidas).
+    
+    A pasta fica seleccionada na sessão: se já for a seleccionada, não
+    é enviado novo EXAMINE (as sessões do pool são reutilizadas).
+    
+    Returns:
+        UIDVALIDITY da pasta, ou None se a pasta não existir
+    """
+    selected = getattr(mail, "selected_folder", None)
+    if mail.state == "SELECTED" and selected and selected[0] == folder:
+        return selected[1]
+    
+    mail.selected_folder = None
+    result, _ = mail.select(quote_folder(folder), readonly=True)
+    if result != "OK":
+        return None
+    _, data = mail.response("UIDVALIDITY")
+    uidvalidity = int(data[0]) if data and data[0] else 0
+    mail.selected_folder = (folder, uidvalidity)
+    return uidvalidity
+
+
+def uid_search(mail: imaplib.IMAP4, criteria: str) -> List[int]:
+    """UID SEARCH na pasta seleccionada."""
+    result, data = mail.uid("SEARCH", None, criteria)
+    if result != "OK" or not data or not data[0]:
+        return []
+    return [int(uid) for uid in data[0].split()]
+
+
+def _fetch_tokens(data: list) -> list:
+    """Tokens de uma resposta FETCH do imaplib (literais já vêm separados)."""
+    tokens = []
+    for item in data:
+        text, literal = item if isinstance(item, tuple) else (item, None)
+        if not isinstance(text, bytes):
+            continue
+        if literal is not None:
+            text = re.sub(rb"\{\d+\}$", b"", text)
+        for match in _FETCH_TOKEN.finditer(text):
+            opening, closing, quoted, atom = match.groups()
+            if opening:
+                tokens.append(_OPEN)
+            elif closing:
+                tokens.append(_CLOSE)
+            elif quoted is not None:
+                tokens.append(re.sub(rb'\\(.)', rb"\1", quoted).decode("utf-8", errors="replace"))
+            else:
+                atom = atom.decode("utf-8", errors="replace")
+                tokens.append(None if atom.upper() == "NIL" else atom)
+        if literal is not None:
+            tokens.append(literal)
+    return tokens
+
+
+def _fetch_list(tokens: list, pos: int) -> Tuple[list, int]:
+    items = []
+    while pos < len(tokens) and tokens[pos] is not _CLOSE:
+        if tokens[pos] is _OPEN:
+            item, pos = _fetch_list(tokens, pos + 1)
+            items.append(item)
+        else:
+            items.append(tokens[pos])
+            pos += 1
+    return items, pos + 1
+
+
+def parse_fetch_response(data: list) -> List[Dict[str, Any]]:
+    """
+    Interpretar a resposta de um FETCH: um dicionário por mensagem com
+    os itens pedidos (p.ex. "UID", "BODYSTRUCTURE", "BODY[1]").
+    """
+    tokens = _fetch_tokens(data)
+    messages = []
+    pos = 0
+    while pos < len(tokens):
+        if tokens[pos] is _OPEN:
+            items, pos = _fetch_list(tokens, pos + 1)
+            messages.append({
+                str(items[i]).upper(): items[i + 1]
+                for i in range(0, len(items) - 1, 2)
+            })
+        else:
+            pos += 1
+    return messages
+
+
+def uid_fetch(mail: imaplib.IMAP4, uids: List[int], parts: str) -> Iterator[Dict[str, Any]]:
+    """UID FETCH em lotes de IMAP_FETCH_BATCH (ver parse_fetch_response)."""
+    for start in range(0, len(uids), IMAP_FETCH_BATCH):
+        batch = uids[start:start + IMAP_FETCH_BATCH]
+        result, data = mail.uid("FETCH", ",".join(str(uid) for uid in batch), parts)
+        if result != "OK":
+            logger.warning(f"UID FETCH falhou para {len(batch)} mensagens: {data}")
+            continue
+        for item in parse_fetch_response(data):
+            if item.get("UID"):
+                yield item
+
+
+class MessagePart(NamedTuple):
+    """Parte de uma mensagem, segundo o BODYSTRUCTURE."""
+    section: str
+    content_type: str
+    charset: Optional[str]
+    encoding: str
+    size: int
+    filename: Optional[str]
+    attachment: bool
+
+
+def _fetch_pairs(value) -> Dict[str, Any]:
+    """Lista de parâmetros IMAP ("CHARSET" "utf-8" ...) como dicionário."""
+    if not isinstance(value, list):
+        return {}
+    return {str(value[i]).lower(): value[i + 1] for i in range(0, len(value) - 1, 2)}
+
+
+def message_parts(structure: list, section: str = "") -> List[MessagePart]:
+    """Partes (folhas) de um BODYSTRUCTURE, com o número de secção de cada uma."""
+    if not structure:
+        return []
+    if isinstance(structure[0], list):
+        parts = []
+        for index, child in enumerate(takewhile(lambda p: isinstance(p, list), structure), start=1):
+            parts.extend(message_parts(child, f"{section}.{index}" if section else str(index)))
+        return parts
+    
+    maintype, subtype = str(structure[0]).lower(), str(structure[1]).lower()
+    params = _fetch_pairs(structure[2])
+    # Campos de extensão: depois de "lines" (texto) ou de envelope/body/lines (message/rfc822)
+    md5_index = 7 + {"text": 1, "message": 3 if subtype == "rfc822" else 0}.get(maintype, 0)
+    disposition = structure[md5_index + 1] if len(structure) > md5_index + 1 else None
+    disposition_type = str(disposition[0]).lower() if isinstance(disposition, list) and disposition else None
+    disposition_params = _fetch_pairs(disposition[1]) if disposition_type and len(disposition) > 1 else {}
+    
+    filename = disposition_params.get("filename") or params.get("name")
+    attachment = (
+        disposition_type == "attachment" or bool(filename)
+        or f"{maintype}/{subtype}" not in ("text/plain", "text/html")
+    )
+    return [MessagePart(
+        section=section or "1",
+        content_type=f"{maintype}/{subtype}",
+        charset=params.get("charset"),
+        encoding=str(structure[5] or "7bit").lower(),
+        size=int(structure[6] or 0),
+        filename=decode_email_header(filename) if filename else None,
+        attachment=attachment
+    )]
+
+
+def decode_part(content: bytes, encoding: str) -> bytes:
+    """Descodificar o Content-Transfer-Encoding de uma parte."""
+    if encoding == "base64":
+        return base64.b64decode(content)
+    if encoding == "quoted-printable":
+        return quopri.decodestring(content)
+    return content
+
+
+def part_text(part: MessagePart, content: bytes) -> str:
+    """Texto de uma parte text/plain ou text/html."""
+    payload = decode_part(content, part.encoding)
+    try:
+        return payload.decode(part.charset or "utf-8", errors="replace")
+    except LookupError:
+        return payload.decode("utf-8", errors="replace")
+
+
+class FetchedMessage(NamedTuple):
+    """Cabeçalhos e estrutura de uma mensagem (primeira fase do FETCH)."""
+    uid: int
+    headers: email.message.Message
+    parts: List[MessagePart]
+    
+    @property
+    def message_id(self) -> str:
+        return self.headers.get("Message-ID", "")
+    
+    @property
+    def text_parts(self) -> List[MessagePart]:
+        return [p for p in self.parts if not p.attachment]
+    
+    @property
+    def attachments(self) -> List[MessagePart]:
+        return [p for p in self.parts if p.attachment]
+
+
+def fetch_headers(mail: imaplib.IMAP4, uids: List[int]) -> List[FetchedMessage]:
+    """
+    Primeira fase: só os cabeçalhos usados na sincronização e o
+    BODYSTRUCTURE (o conteúdo e os anexos não são descarregados).
+    """
+    messages = []
+    for item in uid_fetch(mail, uids, HEADER_FETCH):
+        header = next((v for k, v in item.items() if k.startswith("BODY[HEADER")), None) or b""
+        if isinstance(header, str):
+            header = header.encode()
+        structure = item.get("BODYSTRUCTURE")
+        messages.append(FetchedMessage(
+            uid=int(item["UID"]),
+            headers=email.message_from_bytes(header),
+            parts=message_parts(structure) if isinstance(structure, list) else []
+        ))
+    return messages
+
+
+def fetch_bodies(mail: imaplib.IMAP4, messages: List[FetchedMessage]) -> Dict[int, Tuple[str, str]]:
+    """
+    Segunda fase: as partes de texto (text/plain e text/html) das
+    mensagens dadas; os anexos nunca são descarregados aqui.
+    
+    Returns:
+        (texto, html) por UID
+    """
+    bodies = {message.uid: ("", "") for message in messages}
+    
+    # Mensagens com as mesmas secções de texto partilham o mesmo UID FETCH
+    groups: Dict[tuple, Dict[int, FetchedMessage]] = {}
+    for message in messages:
+        sections = tuple(p.section for p in message.text_parts)
+        if sections:
+            groups.setdefault(sections, {})[message.uid] = message
+    
+    for sections, by_uid in groups.items():
+        items = " ".join(f"BODY.PEEK[{section}]" for section in sections)
+        for item in uid_fetch(mail, list(by_uid), f"(UID {items})"):
+            message = by_uid.get(int(item["UID"]))
+            if message is None:
+                continue
+            text, html = "", ""
+            for part in message.text_parts:
+                content = item.get(f"BODY[{part.section}]")
+                if isinstance(content, str):
+                    content = content.encode()
+                if not content:
+                    continue
+                if part.content_type == "text/plain" and not text:
+                    text = part_text(part, content)
+                elif part.content_type == "text/html" and not html:
+                    html = part_text(part, content)
+            bodies[message.uid] = (text, html)
+    return bodies
+
+
+def attachment_metadata(message: FetchedMessage) -> List[Dict[str, Any]]:
+    """Anexos de uma mensagem (descarregados só a pedido, ver fetch_email_attachment)."""
+    return [
+        {
+            "filename": part.filename or f"anexo-{part.section}",
+            "size": part.size,
+            "content_type": part.content_type,
+            "section": part.section,
+            "encoding": part.encoding
+        }
+        for part in message.attachments
+    ]
+
+
+class FolderWindow(NamedTuple):
+    """Intervalo de UIDs novos de uma pasta nesta sincronização."""
+    uidvalidity: int
+    first_uid: int
+    last_uid: int
+    
+    @property
+    def initial(self) -> bool:
+        """Primeira leitura da pasta (sem checkpoint válido)."""
+        return self.first_uid == 1
+    
+    def search(self, mail: imaplib.IMAP4, criteria: str = "", since_date: Optional[str] = None) -> List[int]:
+        """
+        UIDs novos que satisfazem o critério.
+        
+        Args:
+            criteria: Critério IMAP adicional (p.ex. 'FROM "a@b.pt"')
+            since_date: Limite de data, só aplicado na primeira leitura
+        """
+        if self.last_uid < self.first_uid:
+            return []
+        terms = [f"UID {self.first_uid}:{self.last_uid}"]
+        if since_date and self.initial:
+            terms.append(f"SINCE {since_date}")
+        if criteria:
+            terms.append(criteria)
+        return [
+            uid for uid in uid_search(mail, f"({' '.join(terms)})")
+            if self.first_uid <= uid <= self.last_uid
+        ]
+
+
+class SyncCheckpoints:
+    """
+    Checkpoints da sincronização incremental de uma conta (colecção
+    email_sync_state): UIDVALIDITY e último UID visto por pasta e âmbito.
+    
+    O intervalo de cada pasta é fixado na primeira vez que é aberta (e
+    partilhado pelas pesquisas seguintes); os checkpoints só são gravados
+    no fim, e nunca para pastas em que a leitura falhou.
+    """
+    
+    def __init__(self, account: str, scope: Optional[str] = None,
+                 fingerprint: Optional[str] = None, states: Optional[dict] = None,
+                 database=None):
+        self.database = database if database is not None else db
+        self.account = account
+        self.scope = scope
+        self.fingerprint = fingerprint
+        self.states = states or {}
+        self.windows: Dict[str, FolderWindow] = {}
+        self.failed = set()
+    
+    @classmethod
+    async def load(cls, account: str, scope: str, fingerprint: Optional[str] = None,
+                   reset: bool = False, database=None) -> "SyncCheckpoints":
+        """
+        Ler os checkpoints de uma conta e âmbito.
+        
+        Checkpoints gravados com outros termos de pesquisa (fingerprint)
+        são ignorados; com reset=True todas as pastas são relidas.
+        """
+        database = database if database is not None else db
+        states = {}
+        if not reset:
+            async for state in database.email_sync_state.find({"account": account, "scope": scope}, {"_id": 0}):
+                if state.get("fingerprint") == fingerprint:
+                    states[state["folder"]] = state
+        return cls(account, scope, fingerprint, states, database)
+    
+    def open(self, mail: imaplib.IMAP4, folder: str) -> Optional[FolderWindow]:
+        """
+        Seleccionar a pasta e obter o intervalo de UIDs novos.
+        
+        Returns:
+            Intervalo de UIDs, ou None se a pasta não existir
+        """
+        uidvalidity = select_folder(mail, folder)
+        if uidvalidity is None:
+            return None
+        
+        window = self.windows.get(folder)
+        if window is not None and window.uidvalidity == uidvalidity:
+            return window
+        
+        first_uid = 1
+        state = self.states.get(folder)
+        if state and state["uidvalidity"] == uidvalidity:
+            first_uid = state["last_uid"] + 1
+        elif state:
+            logger.info(f"UIDVALIDITY de {folder} mudou em {self.account}: pasta relida de início")
+        
+        # `N:*` devolve sempre a última mensagem, mesmo com UID < N
+        uids = [uid for uid in uid_search(mail, f"UID {first_uid}:*") if uid >= first_uid]
+        window = FolderWindow(uidvalidity, first_uid, max(uids, default=first_uid - 1))
+        self.windows[folder] = window
+        return window
+    
+    def fail(self, folder: str):
+        """Marcar a pasta como não lida (o checkpoint não avança)."""
+        self.failed.add(folder)
+    
+    async def save(self):
+        """Gravar os checkpoints das pastas lidas com sucesso."""
+        if self.scope is None:
+            return
+        now = datetime.now(timezone.utc).isoformat()
+        for folder, window in self.windows.items():
+            if folder in self.failed:
+                continue
+            await self.database.email_sync_state.update_one(
+                {"account": self.account, "scope": self.scope, "folder": folder},
+                {"$set": {
+                    "uidvalidity": window.uidvalidity,
+                    "last_uid": window.last_uid,
+                    "fingerprint": self.fingerprint,
+                    "synced_at": now
+                }},
+                upsert=True
+            )
+
+
+def list_folders(mail: imaplib.IMAP4) -> List[str]:
+    """Nomes das pastas da conta, tal como o servidor os usa (ver decode_folder_name)."""
+    _, folders = mail.list()
+    names = []
+    for folder_info in folders or []:
+        if not isinstance(folder_info, bytes):
+            continue
+        folder_str = folder_info.decode('utf-8', errors='replace')
+        # Extrair nome da pasta (está entre aspas ou após o último espaço)
+        if '"' in folder_str:
+            names.append(folder_str.split('"')[-2])
+        else:
+            names.append(folder_str.split(' ')[-1])
+    return names
+
+
+def decode_folder_name(name: str) -> str:
+    """Nome de pasta em UTF-7 modificado (RFC 3501), p.ex. "N&APo-mero" -> "Número"."""
+    def decode(match):
+        chunk = match.group(1)
+        if not chunk:
+            return "&"
+        chunk = chunk.replace(",", "/")
+        return base64.b64decode(chunk + "=" * (-len(chunk) % 4)).decode("utf-16-be", errors="replace")
+    return re.sub(r"&([^-]*)-", decode, name)
+
+
+def monitored_addresses(process: dict) -> List[str]:
+    """
+    Endereços de email associados a um processo:
+    - Email do cliente
+    - Email do proprietário do imóvel
+    - Emails adicionais monitorizados
+    """
+    emails_to_monitor = []
+    
+    # Email principal do cliente
+    client_email = process.get("client_email")
+    if client_email:
+        # Limpar emails com formatação markdown do Trello
+        clean_email = client_email
+        if "[" in clean_email and "]" in clean_email:
+            match = re.search(r'[\w\.-]+@[\w\.-]+', clean_email)
+            if match:
+                clean_email = match.group()
+        emails_to_monitor.append(clean_email)
+    
+    # Email do proprietário do imóvel (muito importante para o match)
+    real_estate_data = process.get("real_estate_data", {}) or {}
+    owner_email = real_estate_data.get("owner_email")
+    if owner_email:
+        emails_to_monitor.append(owner_email)
+    
+    # Emails adicionais monitorizados
+    monitored_emails = process.get("monitored_emails", [])
+    if monitored_emails:
+        emails_to_monitor.extend(monitored_emails)
+    
+    # Remover duplicados e limpar
+    return list(set([e.lower().strip() for e in emails_to_monitor if e and "@" in e]))
+
+
+def search_fingerprint(client_name: str, emails: List[str]) -> str:
+    """Identificador dos termos de pesquisa de um processo."""
+    terms = "\n".join([(client_name or "").strip().lower()] + sorted(emails))
+    return hashlib.sha256(terms.encode()).hexdigest()[:16]
+
+
+def imap_locator(account: EmailAccount, folder: str, window: "FolderWindow", uid: int) -> Dict[str, Any]:
+    """Localização da mensagem no servidor (para descarregar anexos a pedido)."""
+    return {"account": account.name, "folder": folder, "uidvalidity": window.uidvalidity, "uid": uid}
+
+
+def summarize_message(
+    message: FetchedMessage,
+    body: Tuple[str, str],
+    account: EmailAccount,
+    matched_by: str,
+    locator: Dict[str, Any]
+) -> Dict[str, Any]:
+    """Dados de um email encontrado pelo nome do cliente (ou pela caixa completa)."""
+    msg = message.headers
+    from_email = extract_email_address(msg.get("From", ""))
+    to_emails = [extract_email_address(e) for e in (msg.get("To", "")).split(",")]
+    cc_emails = [extract_email_address(e) for e in (msg.get("Cc", "")).split(",") if e]
+    subject = decode_email_header(msg.get("Subject", ""))
+    date_str = msg.get("Date", "")
+    body_text, body_html = body
+    
+    direction = "sent" if from_email.lower() == account.email.lower() else "received"
+    
+    email_date = None
+    if date_str:
         try:
-            payload = msg.get_payload(decode=True)
-            if payload:
-                charset = msg.get_content_charset() or 'utf-8'
-                body_text = payload.decode(charset, errors='replace')
-        except Exception as e:
-            logger.warning(f"Erro ao extrair corpo simples: {e}")
+            email_date = email.utils.parsedate_to_datetime(date_str)
+        except:
+            email_date = datetime.now()
     
-    return body_text, body_html
+    return {
+        "message_id": message.message_id,
+        "from_email": from_email,
+        "to_emails": to_emails,
+        "cc_emails": cc_emails,
+        "subject": subject,
+        "body": body_text or body_html or "",
+        "body_html": body_html or None,
+        "date": email_date.isoformat() if email_date else datetime.now().isoformat(),
+        "direction": direction,
+        "source": "imap_sync",
+        "account": account.name,
+        "matched_by": matched_by,
+        "attachments": attachment_metadata(message),
+        "imap": locator
+    }
+
+
+async def run_imap_search(
+    account: EmailAccount,
+    checkpoints: SyncCheckpoints,
+    folder: str,
+    search,
+    *args
+) -> List[Dict[str, Any]]:
+    """
+    Executar uma pesquisa numa sessão do pool da conta.
+    
+    Se a pesquisa falhar de vez (p.ex. servidor indisponível), nenhuma
+    das pastas abertas por ela avança o checkpoint.
+    """
+    opened = set(checkpoints.windows)
+    try:
+        return await imap_pools.get(account).run(search, account, checkpoints, folder, *args)
+    except Exception as e:
+        for name in {folder} | (set(checkpoints.windows) - opened):
+            checkpoints.fail(name)
+        logger.error(f"Erro ao pesquisar emails em {account.name} ({folder}): {e}")
+        return []
 
 
 async def fetch_emails_by_name(
     account: EmailAccount,
     client_name: str,
     since_days: int = 30,
-    folder: str = "INBOX"
+    folder: str = "INBOX",
+    checkpoints: Optional[SyncCheckpoints] = None,
+    include_client_folders: bool = True
 ) -> List[Dict[str, Any]]:
     """
     Buscar emails do cliente de duas formas:
     1. Por nome no assunto
     2. Em subpastas que correspondam ao nome do cliente
     
+    Só são lidas as mensagens posteriores aos checkpoints; `since_days`
+    limita apenas a primeira leitura de cada pasta. De cada candidata
+    lêem-se primeiro os cabeçalhos; o texto só das que interessam e os
+    anexos nunca (ver fetch_email_attachment).
+    
     Args:
         account: Configuração da conta
         client_name: Nome do cliente para buscar
         since_days: Buscar emails dos últimos X dias
         folder: Pasta IMAP base
+        checkpoints: Checkpoints da sincronização (sem eles, lê tudo)
+        include_client_folders: Procurar também nas subpastas do cliente
     
     Returns:
         Lista de emails encontrados
     """
-    emails_found = []
-    
     if not client_name or len(client_name) < 3:
-        return emails_found
+        return []
     
+    checkpoints = checkpoints or SyncCheckpoints(account.name)
+    return await run_imap_search(
+        account, checkpoints, folder, _fetch_emails_by_name, client_name, since_days, include_client_folders
+    )
+
+
+def _fetch_emails_by_name(
+    mail: imaplib.IMAP4,
+    account: EmailAccount,
+    checkpoints: SyncCheckpoints,
+    folder: str,
+    client_name: str,
+    since_days: int,
+    include_client_folders: bool
+) -> List[Dict[str, Any]]:
+    """Pesquisa de fetch_emails_by_name numa sessão IMAP (bloqueante)."""
+    emails_found = []
     search_name = client_name.strip()
     # Extrair partes do nome para matching de subpastas
     name_parts = [p.lower() for p in search_name.split() if len(p) >= 3]
     
-    try:
-        context = ssl.create_default_context()
-        mail = imaplib.IMAP4_SSL(account.imap_server, account.imap_port, ssl_context=context)
-        mail.login(account.email, account.password)
-        
-        logger.info(f"Buscando emails para '{search_name}' em {account.name}")
-        
-        seen_ids = set()
-        since_date = (datetime.now() - timedelta(days=since_days)).strftime("%d-%b-%Y")
-        
-        # 1. Procurar em subpastas que correspondam ao nome do cliente
-        _, folders = mail.list()
-        matching_folders = []
-        
-        for folder_info in folders:
-            try:
-                folder_str = folder_info.decode('utf-8', errors='replace')
-                # Extrair nome da pasta (está entre aspas ou após o último /)
-                if '"' in folder_str:
-                    folder_name = folder_str.split('"')[-2]
-                else:
-                    folder_name = folder_str.split('/')[-1]
-                
-                folder_name_lower = folder_name.lower()
-                
-                # Verificar se alguma parte do nome está no nome da pasta
-                for part in name_parts:
-                    if part in folder_name_lower:
-                        # Extrair o nome completo da pasta para seleção
-                        if '"' in folder_str:
-                            full_folder = '"' + folder_str.split('"')[-2] + '"'
-                        else:
-                            parts = folder_str.split(' ')[-1]
-                            full_folder = parts
-                        matching_folders.append(full_folder)
-                        logger.info(f"Pasta encontrada para '{search_name}': {full_folder}")
-                        break
-            except Exception as e:
+    logger.info(f"Buscando emails para '{search_name}' em {account.name}")
+    
+    seen_ids = set()
+    since_date = (datetime.now() - timedelta(days=since_days)).strftime("%d-%b-%Y")
+    
+    def new_messages(uids: List[int]) -> List[FetchedMessage]:
+        """Cabeçalhos das mensagens ainda não vistas nesta pesquisa."""
+        messages = []
+        for message in fetch_headers(mail, uids):
+            if message.message_id in seen_ids:
                 continue
-        
-        # 2. Buscar emails nas pastas encontradas
-        for folder_name in matching_folders:
-            try:
-                result, _ = mail.select(folder_name)
-                if result != 'OK':
-                    continue
-                
-                _, message_numbers = mail.search(None, 'ALL')
-                
-                for num in message_numbers[0].split():
-                    try:
-                        _, msg_data = mail.fetch(num, "(RFC822)")
-                        email_body = msg_data[0][1]
-                        msg = email.message_from_bytes(email_body)
-                        
-                        msg_id = msg.get("Message-ID", "")
-                        if msg_id in seen_ids:
-                            continue
-                        seen_ids.add(msg_id)
-                        
-                        from_email = extract_email_address(msg.get("From", ""))
-                        to_emails = [extract_email_address(e) for e in (msg.get("To", "")).split(",")]
-                        subject = decode_email_header(msg.get("Subject", ""))
-                        date_str = msg.get("Date", "")
-                        body_text, body_html = get_email_body(msg)
-                        
-                        direction = "sent" if from_email.lower() == account.email.lower() else "received"
-                        
-                        email_date = None
-                        if date_str:
-                            try:
-                                email_date = email.utils.parsedate_to_datetime(date_str)
-                            except:
-                                email_date = datetime.now()
-                        
-                        emails_found.append({
-                            "message_id": msg_id,
-                            "from_email": from_email,
-                            "to_emails": to_emails,
-                            "subject": subject,
-                            "body": body_text or body_html or "",
-                            "date": email_date.isoformat() if email_date else datetime.now().isoformat(),
-                            "direction": direction,
-                            "source": "imap_sync",
-                            "account": account.name,
-                            "matched_by": "client_folder"
-                        })
-                        
-                    except Exception as e:
-                        logger.warning(f"Erro ao processar email: {e}")
-                        continue
-                        
-            except Exception as e:
-                logger.warning(f"Erro ao aceder pasta {folder_name}: {e}")
-        
-        # 3. Também buscar na INBOX por nome no assunto
+            seen_ids.add(message.message_id)
+            messages.append(message)
+        return messages
+    
+    # 1. Procurar em subpastas que correspondam ao nome do cliente
+    matching_folders = []
+    if include_client_folders:
+        for folder_name in list_folders(mail):
+            # Verificar se alguma parte do nome está no nome da pasta
+            if any(part in decode_folder_name(folder_name).lower() for part in name_parts):
+                matching_folders.append(folder_name)
+                logger.info(f"Pasta encontrada para '{search_name}': {folder_name}")
+    
+    # 2. Buscar emails novos nas pastas encontradas
+    for folder_name in matching_folders:
         try:
-            mail.select(folder)
-            _, message_numbers = mail.search(None, f'(SUBJECT "{search_name}" SINCE {since_date})')
+            window = checkpoints.open(mail, folder_name)
+            if window is None:
+                continue
             
-            for num in message_numbers[0].split():
-                try:
-                    _, msg_data = mail.fetch(num, "(RFC822)")
-                    email_body = msg_data[0][1]
-                    msg = email.message_from_bytes(email_body)
-                    
-                    msg_id = msg.get("Message-ID", "")
-                    if msg_id in seen_ids:
-                        continue
-                    seen_ids.add(msg_id)
-                    
-                    from_email = extract_email_address(msg.get("From", ""))
-                    to_emails = [extract_email_address(e) for e in (msg.get("To", "")).split(",")]
-                    subject = decode_email_header(msg.get("Subject", ""))
-                    date_str = msg.get("Date", "")
-                    body_text, body_html = get_email_body(msg)
-                    
-                    direction = "sent" if from_email.lower() == account.email.lower() else "received"
-                    
-                    email_date = None
-                    if date_str:
-                        try:
-                            email_date = email.utils.parsedate_to_datetime(date_str)
-                        except:
-                            email_date = datetime.now()
-                    
-                    emails_found.append({
-                        "message_id": msg_id,
-                        "from_email": from_email,
-                        "to_emails": to_emails,
-                        "subject": subject,
-                        "body": body_text or body_html or "",
-                        "date": email_date.isoformat() if email_date else datetime.now().isoformat(),
-                        "direction": direction,
-                        "source": "imap_sync",
-                        "account": account.name,
-                        "matched_by": "client_name_subject"
-                    })
-                    
-                except Exception as e:
-                    logger.warning(f"Erro ao processar email: {e}")
-                    continue
-                    
+            messages = new_messages(window.search(mail, "ALL"))
+            bodies = fetch_bodies(mail, messages)
+            for message in messages:
+                locator = imap_locator(account, folder_name, window, message.uid)
+                emails_found.append(summarize_message(message, bodies[message.uid], account, "client_folder", locator))
+        
+        except IMAP_CONNECTION_ERRORS:
+            raise
         except Exception as e:
-            logger.warning(f"Erro na busca por assunto: {e}")
+            checkpoints.fail(folder_name)
+            logger.warning(f"Erro ao aceder pasta {folder_name}: {e}")
+    
+    window = checkpoints.open(mail, folder)
+    if window is None:
+        return emails_found
+    
+    # 3. Também buscar na pasta base por nome no assunto
+    try:
+        messages = new_messages(window.search(mail, f'SUBJECT "{search_name}"', since_date))
+        bodies = fetch_bodies(mail, messages)
+        for message in messages:
+            locator = imap_locator(account, folder, window, message.uid)
+            emails_found.append(summarize_message(message, bodies[message.uid], account, "client_name_subject", locator))
+    
+    except IMAP_CONNECTION_ERRORS:
+        raise
+    except Exception as e:
+        checkpoints.fail(folder)
+        logger.warning(f"Erro na busca por assunto: {e}")
+    
+    # 4. Buscar por nome no CORPO do email (emails novos e filtrar localmente)
+    try:
+        # Limitar a 200 emails mais recentes para performance
+        uids = window.search(mail, since_date=since_date)[-200:]
+        messages = [m for m in fetch_headers(mail, uids) if m.message_id not in seen_ids]
+        bodies = fetch_bodies(mail, messages)
         
-        # 4. Buscar por nome no CORPO do email (emails recentes e filtrar localmente)
-        try:
-            mail.select(folder)
-            _, message_numbers = mail.search(None, f'(SINCE {since_date})')
+        for message in messages:
+            body_content = (bodies[message.uid][0] or bodies[message.uid][1]).lower()
             
-            # Limitar a 200 emails mais recentes para performance
-            nums = message_numbers[0].split()[-200:] if message_numbers[0] else []
+            # Verificar se o nome do cliente aparece no corpo
+            name_in_body = any(part in body_content for part in name_parts)
+            if not name_in_body:
+                continue
             
-            for num in nums:
-                try:
-                    _, msg_data = mail.fetch(num, "(RFC822)")
-                    email_body = msg_data[0][1]
-                    msg = email.message_from_bytes(email_body)
-                    
-                    msg_id = msg.get("Message-ID", "")
-                    if msg_id in seen_ids:
-                        continue
-                    
-                    body_text, body_html = get_email_body(msg)
-                    body_content = (body_text or body_html or "").lower()
-                    
-                    # Verificar se o nome do cliente aparece no corpo
-                    name_in_body = any(part in body_content for part in name_parts)
-                    if not name_in_body:
-                        continue
-                    
-                    seen_ids.add(msg_id)
-                    
-                    from_email = extract_email_address(msg.get("From", ""))
-                    to_emails = [extract_email_address(e) for e in (msg.get("To", "")).split(",")]
-                    subject = decode_email_header(msg.get("Subject", ""))
-                    date_str = msg.get("Date", "")
-                    
-                    direction = "sent" if from_email.lower() == account.email.lower() else "received"
-                    
-                    email_date = None
-                    if date_str:
-                        try:
-                            email_date = email.utils.parsedate_to_datetime(date_str)
-                        except:
-                            email_date = datetime.now()
-                    
-                    emails_found.append({
-                        "message_id": msg_id,
-                        "from_email": from_email,
-                        "to_emails": to_emails,
-                        "subject": subject,
-                        "body": body_text or body_html or "",
-                        "date": email_date.isoformat() if email_date else datetime.now().isoformat(),
-                        "direction": direction,
-                        "source": "imap_sync",
-                        "account": account.name,
-                        "matched_by": "client_name_body"
-                    })
-                    
-                except Exception as e:
-                    continue
-                    
-        except Exception as e:
-            logger.warning(f"Erro na busca por corpo: {e}")
-        
-        mail.logout()
-        logger.info(f"Encontrados {len(emails_found)} emails para '{search_name}' em {account.name}")
-        
+            seen_ids.add(message.message_id)
+            
+            locator = imap_locator(account, folder, window, message.uid)
+            emails_found.append(summarize_message(message, bodies[message.uid], account, "client_name_body", locator))
+    
+    except IMAP_CONNECTION_ERRORS:
+        raise
     except Exception as e:
-        logger.error(f"Erro ao buscar emails por nome em {account.name}: {e}")
+        checkpoints.fail(folder)
+        logger.warning(f"Erro na busca por corpo: {e}")
     
+    logger.info(f"Encontrados {len(emails_found)} emails para '{search_name}' em {account.name}")
     return emails_found
 
 
@@ -383,104 +834,321 @@ async def fetch_emails_from_account(
     account: EmailAccount,
     client_emails: List[str],
     since_days: int = 30,
-    folder: str = "INBOX"
+    folder: str = "INBOX",
+    checkpoints: Optional[SyncCheckpoints] = None
 ) -> List[Dict[str, Any]]:
     """
     Buscar emails de uma conta IMAP relacionados com clientes.
     
+    Só são lidas as mensagens posteriores aos checkpoints; `since_days`
+    limita apenas a primeira leitura da pasta. Os anexos não são
+    descarregados (ver fetch_email_attachment).
+    
     Args:
         account: Configuração da conta
         client_emails: Lista de emails de clientes para filtrar
         since_days: Buscar emails dos últimos X dias
         folder: Pasta IMAP (INBOX, Sent, etc.)
+        checkpoints: Checkpoints da sincronização (sem eles, lê tudo)
     
     Returns:
         Lista de emails encontrados
     """
+    checkpoints = checkpoints or SyncCheckpoints(account.name)
+    return await run_imap_search(account, checkpoints, folder, _fetch_emails_from_account, client_emails, since_days)
+
+
+def _fetch_emails_from_account(
+    mail: imaplib.IMAP4,
+    account: EmailAccount,
+    checkpoints: SyncCheckpoints,
+    folder: str,
+    client_emails: List[str],
+    since_days: int
+) -> List[Dict[str, Any]]:
+    """Pesquisa de fetch_emails_from_account numa sessão IMAP (bloqueante)."""
     emails_found = []
     
-    try:
-        # Conectar ao servidor IMAP
-        context = ssl.create_default_context()
-        mail = imaplib.IMAP4_SSL(account.imap_server, account.imap_port, ssl_context=context)
-        mail.login(account.email, account.password)
-        
-        logger.info(f"Conectado a {account.name} ({account.email})")
-        
-        # Selecionar pasta
-        mail.select(folder)
-        
-        # Calcular data de início
-        since_date = (datetime.now() - timedelta(days=since_days)).strftime("%d-%b-%Y")
+    # Selecionar pasta e obter o intervalo de UIDs novos
+    window = checkpoints.open(mail, folder)
+    if window is None:
+        return emails_found
+    
+    # Calcular data de início
+    since_date = (datetime.now() - timedelta(days=since_days)).strftime("%d-%b-%Y")
+    
+    # Buscar emails
+    for client_email in client_emails:
+        if not client_email:
+            continue
         
-        # Buscar emails
-        for client_email in client_emails:
-            if not client_email:
-                continue
-                
+        try:
             # Buscar emails de/para/cc este cliente
+            uids = set()
             for search_type in ["FROM", "TO", "CC"]:
+                uids.update(window.search(mail, f'{search_type} "{client_email}"', since_date))
+            
+            messages = fetch_headers(mail, sorted(uids))
+            bodies = fetch_bodies(mail, messages)
+            
+            for message in messages:
                 try:
-                    _, message_numbers = mail.search(None, f'({search_type} "{client_email}" SINCE {since_date})')
+                    msg = message.headers
+                    
+                    # Extrair informações
+                    from_email = extract_email_address(msg.get("From", ""))
+                    to_emails = [extract_email_address(e) for e in (msg.get("To", "")).split(",")]
+                    cc_emails = [extract_email_address(e) for e in (msg.get("Cc", "")).split(",") if e]
+                    subject = decode_email_header(msg.get("Subject", ""))
+                    date_str = msg.get("Date", "")
+                    body_text, body_html = bodies[message.uid]
+                    
+                    # Determinar direção
+                    direction = "received" if from_email == client_email else "sent"
+                    
+                    # Parsear data
+                    try:
+                        from email.utils import parsedate_to_datetime
+                        sent_at = parsedate_to_datetime(date_str).isoformat()
+                    except:
+                        sent_at = datetime.now(timezone.utc).isoformat()
+                    
+                    email_data = {
+                        "account": account.name,
+                        "direction": direction,
+                        "from_email": from_email,
+                        "to_emails": to_emails,
+                        "cc_emails": cc_emails,
+                        "subject": subject,
+                        "body": body_text or body_html,
+                        "body_html": body_html,
+                        "sent_at": sent_at,
+                        "client_email": client_email,
+                        "message_id": message.message_id,
+                        "attachments": attachment_metadata(message),
+                        "imap": imap_locator(account, folder, window, message.uid)
+                    }
                     
-                    for num in message_numbers[0].split():
-                        try:
-                            _, msg_data = mail.fetch(num, "(RFC822)")
-                            email_body = msg_data[0][1]
-                            msg = email.message_from_bytes(email_body)
-                            
-                            # Extrair informações
-                            from_email = extract_email_address(msg.get("From", ""))
-                            to_emails = [extract_email_address(e) for e in (msg.get("To", "")).split(",")]
-                            cc_emails = [extract_email_address(e) for e in (msg.get("Cc", "")).split(",") if e]
-                            subject = decode_email_header(msg.get("Subject", ""))
-                            date_str = msg.get("Date", "")
-                            body_text, body_html = get_email_body(msg)
-                            
-                            # Determinar direção
-                            direction = "received" if from_email == client_email else "sent"
-                            
-                            # Parsear data
-                            try:
-                                from email.utils import parsedate_to_datetime
-                                sent_at = parsedate_to_datetime(date_str).isoformat()
-                            except:
-                                sent_at = datetime.now(timezone.utc).isoformat()
-                            
-                            email_data = {
-                                "account": account.name,
-                                "direction": direction,
-                                "from_email": from_email,
-                                "to_emails": to_emails,
-                                "cc_emails": cc_emails,
-                                "subject": subject,
-                                "body": body_text or body_html,
-                                "body_html": body_html,
-                                "sent_at": sent_at,
-                                "client_email": client_email,
-                                "message_id": msg.get("Message-ID", "")
-                            }
-                            
-                            emails_found.append(email_data)
-                            
-                        except Exception as e:
-                            logger.warning(f"Erro ao processar email {num}: {e}")
-                            
+                    emails_found.append(email_data)
+                
                 except Exception as e:
-                    logger.warning(f"Erro na pesquisa {search_type} para {client_email}: {e}")
-        
-        mail.close()
-        mail.logout()
+                    logger.warning(f"Erro ao processar email {message.uid}: {e}")
         
-        logger.info(f"Encontrados {len(emails_found)} emails em {account.name}")
-        
-    except Exception as e:
-        logger.error(f"Erro ao conectar a {account.name}: {e}")
+        except IMAP_CONNECTION_ERRORS:
+            raise
+        except Exception as e:
+            checkpoints.fail(folder)
+            logger.warning(f"Erro na pesquisa por {client_email}: {e}")
     
+    logger.info(f"Encontrados {len(emails_found)} emails em {account.name}")
     return emails_found
 
 
-async def sync_emails_for_process(process_id: str, days: int = 30) -> Dict[str, Any]:
+async def fetch_email_attachment(email_doc: dict, index: int) -> Optional[Tuple[Dict[str, Any], bytes]]:
+    """
+    Descarregar um anexo de um email sincronizado (só a parte do anexo).
+    
+    Returns:
+        (metadados, conteúdo), ou None se o anexo já não estiver disponível
+        (conta removida ou pasta recriada no servidor)
+    """
+    locator = email_doc.get("imap")
+    attachments = email_doc.get("attachments") or []
+    if not locator or not 0 <= index < len(attachments) or not attachments[index].get("section"):
+        return None
+    
+    account = next((a for a in get_email_accounts() if a.name == locator["account"]), None)
+    if account is None:
+        return None
+    
+    attachment = attachments[index]
+    
+    def download(mail: imaplib.IMAP4) -> Optional[Tuple[Dict[str, Any], bytes]]:
+        if select_folder(mail, locator["folder"]) != locator["uidvalidity"]:
+            return None
+        for item in uid_fetch(mail, [locator["uid"]], f"(UID BODY.PEEK[{attachment['section']}])"):
+            content = item.get(f"BODY[{attachment['section']}]")
+            if isinstance(content, str):
+                content = content.encode()
+            if content:
+                return attachment, decode_part(content, attachment.get("encoding", "7bit"))
+        return None
+    
+    return await imap_pools.get(account).run(download)
+
+
+def normalize_message_id(message_id: Optional[str]) -> str:
+    """Message-ID sem <>, espaços nem maiúsculas no domínio (vazio se não houver)."""
+    value = "".join((message_id or "").split()).strip("<>")
+    local, at, domain = value.rpartition("@")
+    return f"{local}@{domain.lower()}" if at else value
+
+
+def email_dedupe_key(em: Dict[str, Any]) -> str:
+    """
+    Chave que identifica um email sincronizado dentro de um processo: o
+    Message-ID normalizado ou, sem ele, um hash do remetente,
+    destinatários, data e assunto.
+    """
+    message_id = normalize_message_id(em.get("message_id"))
+    if message_id:
+        return f"mid:{message_id}"
+    content = "\x1f".join([
+        (em.get("from_email") or "").lower(),
+        ",".join(sorted((e or "").lower() for e in em.get("to_emails") or [])),
+        em.get("date") or em.get("sent_at") or "",
+        em.get("subject") or ""
+    ])
+    return "sha256:" + hashlib.sha256(content.encode()).hexdigest()
+
+
+def synced_email_document(process_id: str, em: Dict[str, Any], created_at: str) -> Dict[str, Any]:
+    """Documento da colecção emails de um email sincronizado."""
+    email_id = str(uuid.uuid4())
+    return {
+        "id": email_id,
+        "process_id": process_id,
+        "dedupe_key": email_dedupe_key(em),
+        "message_id": normalize_message_id(em.get("message_id")) or None,
+        "direction": em["direction"],
+        "from_email": em["from_email"],
+        "to_emails": em["to_emails"],
+        "cc_emails": em.get("cc_emails", []),
+        "bcc_emails": [],
+        "subject": em["subject"],
+        "body": em["body"],
+        "body_html": em.get("body_html"),
+        "attachments": [
+            {**attachment, "url": f"/api/emails/{email_id}/attachments/{index}"}
+            for index, attachment in enumerate(em.get("attachments", []))
+        ],
+        "status": "sent",
+        # Usar date como sent_at
+        "sent_at": em.get("date") or em.get("sent_at"),
+        "created_at": created_at,
+        "created_by": None,
+        "notes": f"Sincronizado de {em.get('account', 'desconhecido')}",
+        "synced": True,
+        "account": em["account"],
+        "imap": em.get("imap")
+    }
+
+
+async def upsert_synced_emails(
+    items: List[Tuple[str, Dict[str, Any]]],
+    database=None
+) -> List[Dict[str, Any]]:
+    """
+    Guardar emails sincronizados numa só escrita (bulk_write de upserts
+    por processo e chave de deduplicação; os já existentes ficam como
+    estão). Os corpos vão para `email_bodies` (services/email_store.py).
+    
+    Args:
+        items: Pares (process_id, email) de toda a sincronização
+    
+    Returns:
+        Documentos de resumo dos emails novos
+    """
+    if not items:
+        return []
+    database = database if database is not None else db
+    created_at = datetime.now(timezone.utc).isoformat()
+    
+    documents, bodies = [], {}
+    for process_id, em in items:
+        summary, body = compact_email(synced_email_document(process_id, em, created_at))
+        documents.append(summary)
+        bodies[summary["id"]] = body
+    
+    # Corpos primeiro (o email só aparece no histórico com o corpo guardado);
+    # os dos emails que já existiam são removidos a seguir
+    await save_email_bodies(bodies, database)
+    
+    operations = [
+        UpdateOne(
+            {"process_id": doc["process_id"], "dedupe_key": doc["dedupe_key"]},
+            {"$setOnInsert": doc},
+            upsert=True
+        )
+        for doc in documents
+    ]
+    try:
+        result = await database.emails.bulk_write(operations, ordered=False)
+        upserted = result.upserted_ids
+    except BulkWriteError as e:
+        # Outra sincronização guardou o mesmo email ao mesmo tempo
+        if any(error["code"] != DUPLICATE_KEY_ERROR for error in e.details.get("writeErrors", [])):
+            raise
+        upserted = {entry["index"]: entry["_id"] for entry in e.details.get("upserted", [])}
+    
+    await delete_email_bodies(
+        [doc["id"] for index, doc in enumerate(documents) if index not in upserted], database
+    )
+    return [documents[index] for index in sorted(upserted)]
+
+
+async def store_synced_emails(process_id: str, emails: List[Dict[str, Any]], database=None) -> int:
+    """
+    Guardar no histórico de um processo os emails sincronizados.
+    
+    Returns:
+        Número de emails novos (os já existentes são ignorados)
+    """
+    return len(await upsert_synced_emails([(process_id, em) for em in emails], database))
+
+
+async def backfill_email_dedupe_keys(database) -> int:
+    """
+    Migração: chave de deduplicação dos emails sincronizados antes do
+    upsert por Message-ID (só o hash: o Message-ID não era guardado).
+    Duplicados antigos ficam sem chave, fora do índice único.
+    
+    Returns:
+        Número de emails actualizados
+    """
+    cursor = database.emails.find(
+        {"synced": True, "dedupe_key": {"$exists": False}},
+        {"_id": 0, "id": 1, "process_id": 1, "message_id": 1, "from_email": 1, "to_emails": 1, "sent_at": 1, "subject": 1}
+    )
+    
+    seen = set()
+    async for key in database.emails.find(
+        {"dedupe_key": {"$exists": True}}, {"_id": 0, "process_id": 1, "dedupe_key": 1}
+    ):
+        seen.add((key["process_id"], key["dedupe_key"]))
+    
+    operations = []
+    async for em in cursor:
+        key = email_dedupe_key(em)
+        if (em.get("process_id"), key) in seen:
+            continue
+        seen.add((em.get("process_id"), key))
+        operations.append(UpdateOne({"id": em["id"]}, {"$set": {"dedupe_key": key}}))
+    
+    if operations:
+        await database.emails.bulk_write(operations, ordered=False)
+    
+    logger.info(f"Chave de deduplicação calculada para {len(operations)} emails sincronizados")
+    return len(operations)
+
+
+async def run_email_migrations(database) -> int:
+    """Executar cada migração dos emails uma única vez."""
+    updated = 0
+    for migration_id, migrate in [
+        (EMAIL_DEDUPE_MIGRATION_ID, backfill_email_dedupe_keys),
+        (EMAIL_BODIES_MIGRATION_ID, move_email_bodies),
+    ]:
+        if await database.migrations.find_one({"id": migration_id}):
+            continue
+        
+        count = await migrate(database)
+        await database.migrations.insert_one({"id": migration_id, "updated": count})
+        updated += count
+    return updated
+
+
+async def sync_emails_for_process(process_id: str, days: int = 30, full: bool = False) -> Dict[str, Any]:
     """
     Sincronizar emails para um processo específico.
     Busca emails de ambas as contas relacionados com:
@@ -488,6 +1156,9 @@ async def sync_emails_for_process(process_id: str, days: int = 30) -> Dict[str,
     - Email do cliente
     - Email do proprietário do imóvel
     - Emails adicionais monitorizados
+    
+    A sincronização é incremental (checkpoints por conta e pasta): `days`
+    só limita a primeira leitura; com full=True tudo é relido.
     """
     # Obter processo
     process = await db.processes.find_one({"id": process_id}, {"_id": 0})
@@ -498,119 +1169,63 @@ async def sync_emails_for_process(process_id: str, days: int = 30) -> Dict[str,
     client_name = process.get("client_name", "")
     
     # Coletar todos os emails a monitorizar
-    emails_to_monitor = []
-    
-    # Email principal do cliente
-    client_email = process.get("client_email")
-    if client_email:
-        # Limpar emails com formatação markdown do Trello
-        clean_email = client_email
-        if "[" in clean_email and "]" in clean_email:
-            import re
-            match = re.search(r'[\w\.-]+@[\w\.-]+', clean_email)
-            if match:
-                clean_email = match.group()
-        emails_to_monitor.append(clean_email)
-    
-    # Email do proprietário do imóvel (muito importante para o match)
-    real_estate_data = process.get("real_estate_data", {}) or {}
-    owner_email = real_estate_data.get("owner_email")
-    if owner_email:
-        emails_to_monitor.append(owner_email)
-    
-    # Emails adicionais monitorizados
-    monitored_emails = process.get("monitored_emails", [])
-    if monitored_emails:
-        emails_to_monitor.extend(monitored_emails)
-    
-    # Remover duplicados e limpar
-    emails_to_monitor = list(set([e.lower().strip() for e in emails_to_monitor if e and "@" in e]))
+    emails_to_monitor = monitored_addresses(process)
     
     accounts = get_email_accounts()
     if not accounts:
         return {"success": False, "error": "Nenhuma conta de email configurada"}
     
-    all_emails = []
+    fingerprint = search_fingerprint(client_name, emails_to_monitor)
     
-    # Buscar emails de todas as contas
-    for account in accounts:
+    async def sync_account(account: EmailAccount) -> Tuple[List[Dict[str, Any]], SyncCheckpoints]:
+        checkpoints = await SyncCheckpoints.load(account.name, process_id, fingerprint, reset=full)
+        found = []
+        
         # 1. Buscar por NOME DO CLIENTE no assunto (principal)
         if client_name:
-            inbox_by_name = await fetch_emails_by_name(account, client_name, days, "INBOX")
-            all_emails.extend(inbox_by_name)
+            inbox_by_name = await fetch_emails_by_name(account, client_name, days, "INBOX", checkpoints)
+            found.extend(inbox_by_name)
             
-            # Tentar buscar nos enviados por nome
-            for sent_folder in ["Sent", "INBOX.Sent", "Sent Items", "Enviados"]:
-                try:
-                    sent_by_name = await fetch_emails_by_name(account, client_name, days, sent_folder)
-                    all_emails.extend(sent_by_name)
+            # Tentar buscar nos enviados por nome (primeira pasta que existir)
+            for sent_folder in SENT_FOLDERS:
+                sent_by_name = await fetch_emails_by_name(
+                    account, client_name, days, sent_folder, checkpoints, include_client_folders=False
+                )
+                found.extend(sent_by_name)
+                if sent_folder in checkpoints.windows or sent_folder in checkpoints.failed:
                     break
-                except:
-                    continue
         
         # 2. Buscar por endereço de email (se houver emails monitorizados)
         if emails_to_monitor:
             inbox_emails = await fetch_emails_from_account(
-                account, emails_to_monitor, days, "INBOX"
+                account, emails_to_monitor, days, "INBOX", checkpoints
             )
-            all_emails.extend(inbox_emails)
+            found.extend(inbox_emails)
             
-            for sent_folder in ["Sent", "INBOX.Sent", "Sent Items", "Enviados"]:
-                try:
-                    sent_emails = await fetch_emails_from_account(
-                        account, emails_to_monitor, days, sent_folder
-                    )
-                    all_emails.extend(sent_emails)
+            for sent_folder in SENT_FOLDERS:
+                sent_emails = await fetch_emails_from_account(
+                    account, emails_to_monitor, days, sent_folder, checkpoints
+                )
+                found.extend(sent_emails)
+                if sent_folder in checkpoints.windows or sent_folder in checkpoints.failed:
                     break
-                except:
-                    continue
+        
+        return found, checkpoints
     
-    # Remover duplicados por Message-ID
-    seen_ids = set()
-    unique_emails = []
-    for em in all_emails:
-        msg_id = em.get("message_id", "")
-        if msg_id and msg_id in seen_ids:
-            continue
-        if msg_id:
-            seen_ids.add(msg_id)
-        unique_emails.append(em)
+    # Buscar emails de todas as contas (em paralelo, cada uma no seu pool IMAP)
+    results = await asyncio.gather(*(sync_account(account) for account in accounts))
+    all_emails = [em for found, _ in results for em in found]
+    account_checkpoints = [checkpoints for _, checkpoints in results]
+    
+    # Remover duplicados (Message-ID normalizado ou hash do conteúdo)
+    unique_emails = list({email_dedupe_key(em): em for em in all_emails}.values())
     
     # Guardar na base de dados
-    new_count = 0
-    for em in unique_emails:
-        # Verificar se já existe (usar date como sent_at)
-        sent_at = em.get("date") or em.get("sent_at")
-        existing = await db.emails.find_one({
-            "process_id": process_id,
-            "subject": em["subject"],
-            "sent_at": sent_at,
-            "from_email": em["from_email"]
-        })
-        
-        if not existing:
-            email_doc = {
-                "id": str(uuid.uuid4()),
-                "process_id": process_id,
-                "direction": em["direction"],
-                "from_email": em["from_email"],
-                "to_emails": em["to_emails"],
-                "cc_emails": [],
-                "bcc_emails": [],
-                "subject": em["subject"],
-                "body": em["body"],
-                "body_html": em.get("body_html"),
-                "attachments": [],
-                "status": "sent",
-                "sent_at": sent_at,
-                "created_at": datetime.now(timezone.utc).isoformat(),
-                "created_by": None,
-                "notes": f"Sincronizado de {em.get('account', 'desconhecido')}",
-                "synced": True,
-                "account": em["account"]
-            }
-            await db.emails.insert_one(email_doc)
-            new_count += 1
+    new_count = await store_synced_emails(process_id, unique_emails)
+    
+    # Só depois de guardados os emails é que os checkpoints avançam
+    for checkpoints in account_checkpoints:
+        await checkpoints.save()
     
     logger.info(f"Sincronizados {new_count} novos emails para processo {process_id}")
     
@@ -704,10 +1319,10 @@ async def send_email(
                 "synced": False,
                 "account": account.name
             }
-            await db.emails.insert_one(email_doc)
+            await store_email(email_doc)
         
         return {"success": True, "account": account.name}
-        
+    
     except Exception as e:
         logger.error(f"Erro ao enviar email via {account.name}: {e}")
         return {"success": False, "error": str(e)}
@@ -727,10 +1342,7 @@ async def test_email_connection(account_name: str = None) -> Dict[str, Any]:
         
         # Testar IMAP
         try:
-            context = ssl.create_default_context()
-            mail = imaplib.IMAP4_SSL(account.imap_server, account.imap_port, ssl_context=context)
-            mail.login(account.email, account.password)
-            mail.logout()
+            await imap_pools.get(account).run(lambda mail: mail.noop())
             result["imap"] = True
         except Exception as e:
             result["error"] = f"IMAP: {str(e)}"
@@ -0,0 +1,356 @@
+"""
+====================================================================
+ARMAZENAMENTO DOS EMAILS - CREDITOIMO
+====================================================================
+Documentos compactos na colecção `emails` e corpos guardados à parte.
+
+Funcionalidades:
+- O documento principal de cada email guarda só o resumo usado nas
+  listagens: pré-visualização do texto (sem a cadeia de respostas
+  citadas), chave da conversa (assunto sem "Re:"/"Fwd:"), tamanhos do
+  corpo e metadados dos anexos
+- O corpo em texto e em HTML é comprimido (zlib) e guardado na colecção
+  `email_bodies`; acima de EMAIL_BODY_GRIDFS_BYTES comprimidos vai para
+  o GridFS (bucket `email_bodies`)
+- O corpo só é lido quando o email é aberto (GET /emails/{id})
+- Listagem de um processo em páginas por cursor (sent_at, id)
+
+Uso:
+    summary = await store_email(email_doc)
+    page = await list_process_emails(process_id, cursor=cursor)
+    body = await load_email_body(summary)
+====================================================================
+"""
+
+import base64
+import binascii
+import hashlib
+import html
+import json
+import logging
+import os
+import re
+import zlib
+from typing import Optional, List, Dict, Any, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from pymongo import ReplaceOne, UpdateOne
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+EMAIL_PREVIEW_CHARS = int(os.environ.get("EMAIL_PREVIEW_CHARS", "200"))
+EMAIL_BODY_GRIDFS_BYTES = int(os.environ.get("EMAIL_BODY_GRIDFS_BYTES", str(1024 * 1024)))
+EMAIL_BODY_COMPRESSION_LEVEL = int(os.environ.get("EMAIL_BODY_COMPRESSION_LEVEL", "6"))
+EMAIL_PAGE_SIZE = int(os.environ.get("EMAIL_PAGE_SIZE", "50"))
+EMAIL_PAGE_MAX = int(os.environ.get("EMAIL_PAGE_MAX", "200"))
+EMAIL_MIGRATION_BATCH_SIZE = int(os.environ.get("EMAIL_MIGRATION_BATCH_SIZE", "200"))
+
+EMAIL_BODIES_BUCKET = "email_bodies"
+EMAIL_BODIES_MIGRATION_ID = "email_bodies_v1"
+
+# Campos do resumo calculados a partir do corpo
+SUMMARY_FIELDS = ("preview", "thread_key", "body_size", "html_size", "has_html", "attachments_count")
+
+# Prefixos de resposta e reencaminhamento (PT, EN, DE, FR)
+_SUBJECT_PREFIX = re.compile(r"^\s*(?:(?:re|res|fw|fwd|enc|tr|aw|wg|rv)\s*(?:\[\d+\])?\s*:\s*)+", re.IGNORECASE)
+# Início da mensagem citada numa resposta
+_QUOTE_HEADER = re.compile(
+    r"^\s*(?:on\s.+\swrote:|em\s.+\sescreveu:|-{2,}\s*(?:original message|mensagem original|forwarded message"
+    r"|mensagem encaminhada)\s*-{2,}|_{10,}|(?:from|de):\s.+@.+)\s*$",
+    re.IGNORECASE
+)
+_HTML_HIDDEN = re.compile(r"<(style|script|head|blockquote)\b.*?</\1\s*>", re.IGNORECASE | re.DOTALL)
+_HTML_TAG = re.compile(r"<[^>]+>")
+
+
+class InvalidEmailCursorError(ValueError):
+    """Cursor de paginação inválido."""
+
+
+# ====================================================================
+# RESUMO
+# ====================================================================
+
+def thread_key(subject: Optional[str]) -> str:
+    """Chave da conversa: hash do assunto sem prefixos de resposta, em minúsculas."""
+    normalized = " ".join(_SUBJECT_PREFIX.sub("", subject or "").split()).casefold()
+    return hashlib.sha1(normalized.encode()).hexdigest()
+
+
+def html_to_text(body_html: str) -> str:
+    """Texto visível de um corpo HTML (sem estilos, scripts nem citações)."""
+    text = _HTML_HIDDEN.sub(" ", body_html)
+    text = re.sub(r"<(br|/p|/div|/tr|/li)\b[^>]*>", "\n", text, flags=re.IGNORECASE)
+    return html.unescape(_HTML_TAG.sub(" ", text))
+
+
+def email_preview(body: Optional[str], body_html: Optional[str] = None, length: int = EMAIL_PREVIEW_CHARS) -> str:
+    """Início do texto do email, sem a mensagem citada e com os espaços normalizados."""
+    text = body if (body or "").strip() else html_to_text(body_html or "")
+    
+    lines = []
+    for line in text.splitlines():
+        if _QUOTE_HEADER.match(line):
+            break
+        if not line.lstrip().startswith(">"):
+            lines.append(line)
+    
+    preview = " ".join(" ".join(lines).split())
+    if len(preview) > length:
+        preview = preview[:length].rstrip() + "…"
+    return preview
+
+
+def compact_email(email: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Optional[str]]]:
+    """
+    Separar o corpo de um documento de email.
+    
+    Returns:
+        (documento de resumo para a colecção emails, {"body", "body_html"})
+    """
+    summary = dict(email)
+    body = summary.pop("body", None) or ""
+    body_html = summary.pop("body_html", None)
+    
+    summary.update({
+        "preview": email_preview(body, body_html),
+        "thread_key": thread_key(summary.get("subject")),
+        "body_size": len(body.encode()),
+        "html_size": len(body_html.encode()) if body_html else 0,
+        "has_html": bool(body_html),
+        "attachments_count": len(summary.get("attachments") or [])
+    })
+    return summary, {"body": body, "body_html": body_html}
+
+
+# ====================================================================
+# CORPOS
+# ====================================================================
+
+def _bucket(database) -> AsyncIOMotorGridFSBucket:
+    return AsyncIOMotorGridFSBucket(database, bucket_name=EMAIL_BODIES_BUCKET)
+
+
+async def save_email_bodies(bodies: Dict[str, Dict[str, Optional[str]]], database=None):
+    """
+    Comprimir e guardar os corpos de vários emails (substituindo os
+    anteriores).
+    
+    Args:
+        bodies: {email_id: {"body", "body_html"}}
+    """
+    if not bodies:
+        return
+    database = database if database is not None else db
+    
+    previous_files = {
+        doc["email_id"]: doc["file_id"]
+        async for doc in database.email_bodies.find(
+            {"email_id": {"$in": list(bodies)}, "file_id": {"$exists": True}},
+            {"_id": 0, "email_id": 1, "file_id": 1}
+        )
+    }
+    
+    operations = []
+    for email_id, content in bodies.items():
+        payload = zlib.compress(
+            json.dumps({"body": content.get("body") or "", "body_html": content.get("body_html")}).encode(),
+            EMAIL_BODY_COMPRESSION_LEVEL
+        )
+        document = {"email_id": email_id, "compression": "zlib", "size": len(payload)}
+        if len(payload) > EMAIL_BODY_GRIDFS_BYTES:
+            document["file_id"] = await _bucket(database).upload_from_stream(
+                email_id, payload, metadata={"email_id": email_id}
+            )
+        else:
+            document["data"] = payload
+        operations.append(ReplaceOne({"email_id": email_id}, document, upsert=True))
+    
+    await database.email_bodies.bulk_write(operations, ordered=False)
+    
+    for file_id in previous_files.values():
+        await _delete_file(database, file_id)
+
+
+async def load_email_body(email: Dict[str, Any], database=None) -> Dict[str, Optional[str]]:
+    """
+    Corpo de um email: {"body", "body_html"} (vazio se não houver).
+    
+    Emails ainda não migrados têm o corpo no próprio documento.
+    """
+    if "body" in email:
+        return {"body": email.get("body") or "", "body_html": email.get("body_html")}
+    database = database if database is not None else db
+    
+    document = await database.email_bodies.find_one({"email_id": email["id"]}, {"_id": 0})
+    if not document:
+        return {"body": "", "body_html": None}
+    
+    if "file_id" in document:
+        stream = await _bucket(database).open_download_stream(document["file_id"])
+        payload = await stream.read()
+    else:
+        payload = document["data"]
+    return json.loads(zlib.decompress(payload))
+
+
+async def _delete_file(database, file_id):
+    try:
+        await _bucket(database).delete(file_id)
+    except Exception as e:
+        logger.warning(f"Erro ao eliminar corpo de email {file_id} do GridFS: {e}")
+
+
+async def delete_email_bodies(email_ids: List[str], database=None):
+    """Eliminar os corpos guardados de vários emails."""
+    if not email_ids:
+        return
+    database = database if database is not None else db
+    
+    async for document in database.email_bodies.find(
+        {"email_id": {"$in": email_ids}, "file_id": {"$exists": True}}, {"_id": 0, "file_id": 1}
+    ):
+        await _delete_file(database, document["file_id"])
+    await database.email_bodies.delete_many({"email_id": {"$in": email_ids}})
+
+
+async def delete_all_email_bodies(database=None):
+    """Eliminar todos os corpos guardados (incluindo os do GridFS)."""
+    database = database if database is not None else db
+    await database.email_bodies.delete_many({})
+    await database[f"{EMAIL_BODIES_BUCKET}.files"].delete_many({})
+    await database[f"{EMAIL_BODIES_BUCKET}.chunks"].delete_many({})
+
+
+async def store_email(email: Dict[str, Any], database=None) -> Dict[str, Any]:
+    """
+    Guardar um email novo: corpo em `email_bodies` e resumo em `emails`.
+    
+    Returns:
+        Documento de resumo guardado
+    """
+    database = database if database is not None else db
+    summary, body = compact_email(email)
+    
+    # O corpo primeiro: um email listado tem sempre o corpo disponível
+    await save_email_bodies({summary["id"]: body}, database)
+    await database.emails.insert_one(summary)
+    summary.pop("_id", None)
+    return summary
+
+
+async def update_email_body(email: Dict[str, Any], body: str, database=None) -> Dict[str, Any]:
+    """
+    Substituir o texto de um email (o HTML mantém-se).
+    
+    Returns:
+        Campos de resumo a actualizar no documento principal
+    """
+    current = await load_email_body(email, database)
+    summary, content = compact_email({**email, "body": body, "body_html": current.get("body_html")})
+    await save_email_bodies({email["id"]: content}, database)
+    return {field: summary[field] for field in SUMMARY_FIELDS}
+
+
+# ====================================================================
+# LISTAGEM
+# ====================================================================
+
+def encode_cursor(email: Dict[str, Any]) -> str:
+    raw = json.dumps([email.get("sent_at"), email["id"]])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        sent_at, email_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError, TypeError) as e:
+        raise InvalidEmailCursorError(str(e))
+    return sent_at, email_id
+
+
+async def list_process_emails(
+    process_id: str,
+    direction: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = EMAIL_PAGE_SIZE,
+    database=None
+) -> Dict[str, Any]:
+    """
+    Resumos dos emails de um processo, dos mais recentes para os mais
+    antigos (índice process_id, sent_at, id).
+    
+    Returns:
+        emails e next_cursor (None na última página)
+    """
+    database = database if database is not None else db
+    limit = max(1, min(limit, EMAIL_PAGE_MAX))
+    
+    query: Dict[str, Any] = {"process_id": process_id}
+    if direction:
+        query["direction"] = direction
+    
+    if cursor:
+        sent_at, email_id = decode_cursor(cursor)
+        if sent_at is None:
+            query["sent_at"] = None
+            query["id"] = {"$lt": email_id}
+        else:
+            # Os emails sem data ficam no fim da ordenação descendente
+            query["$or"] = [
+                {"sent_at": {"$lt": sent_at}},
+                {"sent_at": sent_at, "id": {"$lt": email_id}},
+                {"sent_at": None}
+            ]
+    
+    emails = await database.emails.find(query, {"_id": 0, "body": 0, "body_html": 0}) \
+        .sort([("sent_at", -1), ("id", -1)]) \
+        .limit(limit + 1) \
+        .to_list(limit + 1)
+    
+    next_cursor = None
+    if len(emails) > limit:
+        emails = emails[:limit]
+        next_cursor = encode_cursor(emails[-1])
+    
+    return {"emails": emails, "next_cursor": next_cursor}
+
+
+# ====================================================================
+# MIGRAÇÃO
+# ====================================================================
+
+async def move_email_bodies(database) -> int:
+    """
+    Migração: tirar o corpo dos documentos de email antigos para
+    `email_bodies` e acrescentar o resumo, em lotes.
+    
+    Returns:
+        Número de emails compactados
+    """
+    moved = 0
+    while True:
+        batch = await database.emails.find(
+            {"$or": [{"body": {"$exists": True}}, {"body_html": {"$exists": True}}]}, {"_id": 0}
+        ).limit(EMAIL_MIGRATION_BATCH_SIZE).to_list(EMAIL_MIGRATION_BATCH_SIZE)
+        if not batch:
+            break
+        
+        bodies = {}
+        operations = []
+        for email in batch:
+            summary, body = compact_email(email)
+            bodies[email["id"]] = body
+            operations.append(UpdateOne(
+                {"id": email["id"]},
+                {"$set": {field: summary[field] for field in SUMMARY_FIELDS}, "$unset": {"body": "", "body_html": ""}}
+            ))
+        
+        await save_email_bodies(bodies, database)
+        await database.emails.bulk_write(operations, ordered=False)
+        moved += len(batch)
+    
+    logger.info(f"Corpo de {moved} emails movido para email_bodies")
+    return moved
@@ -0,0 +1,401 @@
+"""
+====================================================================
+SINCRONIZAÇÃO DAS CAIXAS DE EMAIL - CREDITOIMO
+====================================================================
+Sincronização de cada caixa de email numa única passagem para todos os
+processos activos, em vez de uma pesquisa IMAP por processo:
+
+1. Índice em memória dos processos activos (ClientIndex): endereços
+   monitorizados (cliente, proprietário do imóvel, emails adicionais)
+   e um autómato Aho–Corasick sobre os nomes dos clientes
+2. Por conta: INBOX, a pasta de enviados e as subpastas com o nome de
+   um cliente, a partir dos checkpoints da caixa (âmbito "mailbox")
+3. Cada mensagem nova é lida uma vez (cabeçalhos primeiro) e
+   encaminhada para os processos a que corresponde
+
+A sincronização por processo (POST /emails/sync/{process_id}) continua
+disponível para recuperar o histórico de um cliente acabado de criar.
+====================================================================
+"""
+
+import asyncio
+import imaplib
+import logging
+import os
+import unicodedata
+from collections import deque
+from datetime import datetime, timedelta
+from typing import List, Dict, Any, Iterable, Iterator, Set, Tuple
+
+from services.email_service import (
+    EmailAccount,
+    FetchedMessage,
+    SENT_FOLDERS,
+    SyncCheckpoints,
+    decode_email_header,
+    decode_folder_name,
+    extract_email_address,
+    fetch_bodies,
+    fetch_headers,
+    get_email_accounts,
+    imap_locator,
+    list_folders,
+    monitored_addresses,
+    summarize_message,
+    upsert_synced_emails,
+)
+from services.imap_pool import imap_pools, IMAP_CONNECTION_ERRORS
+
+logger = logging.getLogger(__name__)
+
+# Âmbito dos checkpoints da sincronização da caixa completa
+MAILBOX_SCOPE = "mailbox"
+
+# Estados de processos que já não são sincronizados
+INACTIVE_STATUSES = ["concluidos", "desistencias"]
+
+# Mensagens lidas de cada vez (limita a memória em caixas grandes)
+EMAIL_SYNC_CHUNK = int(os.environ.get("EMAIL_SYNC_CHUNK", "500"))
+
+# Procurar nomes de clientes também no texto das mensagens
+EMAIL_SYNC_MATCH_BODY = os.environ.get("EMAIL_SYNC_MATCH_BODY", "true").lower() == "true"
+
+# Nomes de cliente mais curtos não são procurados (demasiados falsos positivos)
+MIN_CLIENT_NAME_LENGTH = 3
+
+
+def normalize_text(text: str) -> str:
+    """Minúsculas, sem acentos e com espaços simples (para comparar nomes)."""
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return " ".join(stripped.lower().split())
+
+
+class AhoCorasick:
+    """
+    Autómato de Aho–Corasick: encontra as ocorrências de todos os
+    padrões numa só passagem pelo texto, qualquer que seja o número de
+    padrões.
+    """
+    
+    def __init__(self):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        # Padrões que terminam em cada estado (próprios e herdados pelas ligações de falha)
+        self._patterns: List[List[Tuple[int, Any]]] = [[]]
+        self._output: List[List[Tuple[int, Any]]] = [[]]
+        self._count = 0
+        self._built = True
+    
+    def __len__(self) -> int:
+        return self._count
+    
+    def add(self, pattern: str, value: Any):
+        """Acrescentar um padrão (o autómato é reconstruído na próxima pesquisa)."""
+        state = 0
+        for char in pattern:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._patterns.append([])
+            state = next_state
+        self._patterns[state].append((len(pattern), value))
+        self._count += 1
+        self._built = False
+    
+    def build(self):
+        """Calcular as ligações de falha (percurso em largura do trie)."""
+        self._output = [list(patterns) for patterns in self._patterns]
+        queue = deque()
+        for state in self._goto[0].values():
+            self._fail[state] = 0
+            queue.append(state)
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[next_state] = self._goto[fallback].get(char, 0)
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+        self._built = True
+    
+    def find(self, text: str) -> Iterator[Tuple[int, int, Any]]:
+        """Ocorrências no texto: (início, fim exclusivo, valor)."""
+        if not self._built:
+            self.build()
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            for length, value in self._output[state]:
+                yield position + 1 - length, position + 1, value
+
+
+class ClientIndex:
+    """Endereços e nomes de clientes dos processos activos."""
+    
+    def __init__(self):
+        self.addresses: Dict[str, Set[str]] = {}
+        self.names = AhoCorasick()
+        self.processes = 0
+    
+    def add_process(self, process: dict):
+        self.processes += 1
+        for address in monitored_addresses(process):
+            self.addresses.setdefault(address, set()).add(process["id"])
+        name = normalize_text(process.get("client_name", ""))
+        if len(name) >= MIN_CLIENT_NAME_LENGTH:
+            self.names.add(name, process["id"])
+    
+    @classmethod
+    async def load(cls, database) -> "ClientIndex":
+        """Índice de todos os processos activos."""
+        index = cls()
+        cursor = database.processes.find(
+            {"status": {"$nin": INACTIVE_STATUSES}},
+            {"_id": 0, "id": 1, "client_name": 1, "client_email": 1, "real_estate_data.owner_email": 1, "monitored_emails": 1}
+        )
+        async for process in cursor:
+            index.add_process(process)
+        index.names.build()
+        return index
+    
+    def match_addresses(self, addresses: Iterable[str]) -> Set[str]:
+        """Processos que monitorizam algum dos endereços."""
+        matched = set()
+        for address in addresses:
+            matched |= self.addresses.get(address, set())
+        return matched
+    
+    def match_names(self, text: str) -> Set[str]:
+        """Processos cujo nome de cliente aparece no texto (palavras completas)."""
+        text = normalize_text(text)
+        matched = set()
+        for start, end, process_id in self.names.find(text):
+            before = text[start - 1] if start > 0 else " "
+            after = text[end] if end < len(text) else " "
+            if not before.isalnum() and not after.isalnum():
+                matched.add(process_id)
+        return matched
+
+
+def message_addresses(message: FetchedMessage) -> List[str]:
+    headers = message.headers
+    return [
+        extract_email_address(address)
+        for field in ("From", "To", "Cc")
+        for address in (headers.get(field, "") or "").split(",")
+        if address.strip()
+    ]
+
+
+def route_messages(
+    index: ClientIndex,
+    messages: List[FetchedMessage],
+    folder_processes: Set[str]
+) -> Tuple[Dict[int, Dict[str, str]], List[FetchedMessage]]:
+    """
+    Encaminhar mensagens pelos cabeçalhos (por ordem de prioridade: pasta
+    do cliente, endereço, nome no assunto).
+    
+    Returns:
+        ({uid: {process_id: matched_by}}, mensagens sem correspondência)
+    """
+    routes = {}
+    unmatched = []
+    for message in messages:
+        matches = {}
+        for process_id in folder_processes:
+            matches.setdefault(process_id, "client_folder")
+        for process_id in index.match_addresses(message_addresses(message)):
+            matches.setdefault(process_id, "address")
+        for process_id in index.match_names(decode_email_header(message.headers.get("Subject", ""))):
+            matches.setdefault(process_id, "client_name_subject")
+        if matches:
+            routes[message.uid] = matches
+        else:
+            unmatched.append(message)
+    return routes, unmatched
+
+
+def chunked(items: List[int], size: int) -> Iterator[List[int]]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+async def sync_mailbox(
+    account: EmailAccount,
+    index: ClientIndex,
+    since_days: int = 30,
+    database=None
+) -> Tuple[Dict[str, List[Dict[str, Any]]], SyncCheckpoints, Dict[str, int]]:
+    """
+    Ler as mensagens novas de uma conta e encaminhá-las para os processos
+    (numa sessão do pool IMAP da conta, fora do event loop).
+    
+    Returns:
+        (emails por processo, checkpoints por gravar, estatísticas)
+    """
+    checkpoints = await SyncCheckpoints.load(account.name, MAILBOX_SCOPE, database=database)
+    routed, stats = await imap_pools.get(account).run(_read_mailbox, account, index, checkpoints, since_days)
+    return routed, checkpoints, stats
+
+
+def _read_mailbox(
+    mail: imaplib.IMAP4,
+    account: EmailAccount,
+    index: ClientIndex,
+    checkpoints: SyncCheckpoints,
+    since_days: int
+) -> Tuple[Dict[str, List[Dict[str, Any]]], Dict[str, int]]:
+    """Leitura de sync_mailbox numa sessão IMAP (bloqueante; repetível do início)."""
+    names = list_folders(mail)
+    sent_folder = next((f for f in SENT_FOLDERS if f in names), None)
+    
+    # Pasta -> processos cujas mensagens estão todas nessa pasta
+    folders: Dict[str, Set[str]] = {"INBOX": set()}
+    if sent_folder:
+        folders[sent_folder] = set()
+    for name in names:
+        if name not in folders:
+            processes = index.match_names(decode_folder_name(name).replace("/", " ").replace(".", " "))
+            if processes:
+                folders[name] = processes
+    
+    return read_folders(mail, account, index, checkpoints, folders, since_days)
+
+
+def read_folders(
+    mail: imaplib.IMAP4,
+    account: EmailAccount,
+    index: ClientIndex,
+    checkpoints: SyncCheckpoints,
+    folders: Dict[str, Set[str]],
+    since_days: int
+) -> Tuple[Dict[str, List[Dict[str, Any]]], Dict[str, int]]:
+    """
+    Ler as mensagens novas das pastas e encaminhá-las (bloqueante).
+    
+    Args:
+        folders: Pasta -> processos a que pertencem todas as suas mensagens
+            (vazio para INBOX e enviados, encaminhados pelo índice)
+    
+    Returns:
+        (emails por processo, estatísticas)
+    """
+    routed: Dict[str, List[Dict[str, Any]]] = {}
+    stats = {"folders": 0, "scanned": 0, "matched": 0}
+    since_date = (datetime.now() - timedelta(days=since_days)).strftime("%d-%b-%Y")
+    
+    for folder, folder_processes in folders.items():
+        try:
+            window = checkpoints.open(mail, folder)
+            if window is None:
+                continue
+            stats["folders"] += 1
+            # Pastas de clientes são lidas por inteiro; INBOX e enviados desde `since_days`
+            uids = window.search(mail, "ALL", None if folder_processes else since_date)
+            
+            for chunk in chunked(uids, EMAIL_SYNC_CHUNK):
+                messages = fetch_headers(mail, chunk)
+                stats["scanned"] += len(messages)
+                routes, unmatched = route_messages(index, messages, folder_processes)
+                
+                candidates = unmatched if EMAIL_SYNC_MATCH_BODY and len(index.names) else []
+                bodies = fetch_bodies(mail, [m for m in messages if m.uid in routes] + candidates)
+                for message in candidates:
+                    text, html = bodies[message.uid]
+                    processes = index.match_names(text or html)
+                    if processes:
+                        routes[message.uid] = {process_id: "client_name_body" for process_id in processes}
+                
+                for message in messages:
+                    matches = routes.get(message.uid)
+                    if not matches:
+                        continue
+                    stats["matched"] += 1
+                    locator = imap_locator(account, folder, window, message.uid)
+                    for process_id, matched_by in matches.items():
+                        email_data = summarize_message(message, bodies[message.uid], account, matched_by, locator)
+                        routed.setdefault(process_id, []).append(email_data)
+        except IMAP_CONNECTION_ERRORS:
+            raise
+        except Exception as e:
+            checkpoints.fail(folder)
+            logger.warning(f"Erro ao sincronizar pasta {folder} de {account.name}: {e}")
+    
+    return routed, stats
+
+
+async def store_routed_emails(
+    routed: Dict[str, List[Dict[str, Any]]],
+    database=None
+) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Guardar os emails encaminhados numa só escrita (uma vez por email em
+    cada processo).
+    
+    Returns:
+        Documentos novos por processo
+    """
+    new_docs = await upsert_synced_emails(
+        [(process_id, em) for process_id, emails in routed.items() for em in emails], database
+    )
+    stored = {}
+    for doc in new_docs:
+        stored.setdefault(doc["process_id"], []).append(doc)
+    return stored
+
+
+async def sync_all_mailboxes(since_days: int = 30, database=None) -> Dict[str, Any]:
+    """
+    Sincronizar todas as contas configuradas para todos os processos activos.
+    
+    Args:
+        since_days: Limite da primeira leitura de INBOX e enviados
+        database: Base de dados (por omissão a da aplicação)
+    """
+    if database is None:
+        from database import db as database
+    
+    accounts = get_email_accounts()
+    if not accounts:
+        return {"success": False, "error": "Nenhuma conta de email configurada"}
+    
+    index = await ClientIndex.load(database)
+    result = {"success": True, "processes": index.processes, "accounts": {}, "new_imported": 0}
+    
+    # As contas são lidas em paralelo (cada uma no seu pool IMAP)
+    readings = await asyncio.gather(
+        *(sync_mailbox(account, index, since_days, database) for account in accounts),
+        return_exceptions=True
+    )
+    
+    for account, reading in zip(accounts, readings):
+        if isinstance(reading, Exception):
+            logger.error(f"Erro ao sincronizar a caixa {account.name}: {reading}")
+            result["accounts"][account.name] = {"error": str(reading)}
+            continue
+        routed, checkpoints, stats = reading
+        
+        stored = await store_routed_emails(routed, database)
+        new_count = sum(len(docs) for docs in stored.values())
+        
+        # Só depois de guardados os emails é que os checkpoints avançam
+        await checkpoints.save()
+        
+        stats["new_imported"] = new_count
+        result["accounts"][account.name] = stats
+        result["new_imported"] += new_count
+        logger.info(
+            f"Caixa {account.name}: {stats['scanned']} mensagens lidas, {stats['matched']} encaminhadas, "
+            f"{new_count} emails novos em {len(routed)} processos"
+        )
+    
+    return result
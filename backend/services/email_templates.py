@@ -0,0 +1,102 @@
+"""
+====================================================================
+TEMPLATES DE EMAIL - CREDITOIMO
+====================================================================
+Templates Jinja2 dos emails (backend/templates/email), compilados uma
+vez no arranque e reutilizados em todos os envios.
+
+Cada email tem:
+- `<nome>.html`: estende `layout.html` (estilos, cabeçalho e rodapé
+  comuns) e usa os blocos partilhados de `macros.html`
+- `<nome>.txt`: versão em texto simples
+- Assunto: em EMAIL_SUBJECTS (também é um template)
+
+A renderização é pura (só depende do contexto) e pode ser feita em lote:
+    rendered = email_templates.render_many("monthly_document_reminder", contexts, year=2026)
+====================================================================
+"""
+
+from pathlib import Path
+from typing import Optional, List, Dict, Iterable, NamedTuple
+
+from jinja2 import Environment, FileSystemLoader, StrictUndefined, select_autoescape
+
+TEMPLATES_DIR = Path(__file__).resolve().parent.parent / "templates" / "email"
+
+# Emails disponíveis e respectivos assuntos
+EMAIL_SUBJECTS = {
+    "registration_confirmation": "✅ Recebemos o seu pedido - Power Real Estate & Precision",
+    "documents_checklist": "📋 Lista de Documentos Necessários - Crédito Habitação",
+    "credit_approved": "🎉 Parabéns! O seu Crédito foi Aprovado!",
+    "new_client": "🆕 Novo Cliente: {{ client_name }}",
+    "status_update": "📋 Atualização do seu Processo - {{ new_status }}",
+    "monthly_document_reminder": "Documentação Mensal - {{ month_name }} {{ year }}",
+    "staff_digest": "📬 {{ period_label }}: {{ total }} {{ 'notificação' if total == 1 else 'notificações' }}",
+}
+
+
+class RenderedEmail(NamedTuple):
+    subject: str
+    text: str
+    html: str
+
+
+class EmailTemplateRenderer:
+    """Templates de email compilados (assunto, texto e HTML por email)."""
+    
+    def __init__(self, directory: Path = TEMPLATES_DIR, globals: Optional[dict] = None):
+        # Só o HTML é escapado; o texto simples e os assuntos ficam tal como estão.
+        # Sem auto_reload: depois de compilado, um template nunca volta ao disco
+        self.env = Environment(
+            loader=FileSystemLoader(str(directory)),
+            autoescape=select_autoescape(enabled_extensions=("html",), default_for_string=False),
+            undefined=StrictUndefined,
+            trim_blocks=True,
+            lstrip_blocks=True,
+            auto_reload=False
+        )
+        self.env.globals.update(globals or {})
+        self._compiled: Dict[str, tuple] = {}
+    
+    def load(self):
+        """Compilar todos os templates (chamado no arranque; idempotente)."""
+        for name in EMAIL_SUBJECTS:
+            self._templates(name)
+    
+    def _templates(self, name: str) -> tuple:
+        compiled = self._compiled.get(name)
+        if compiled is None:
+            if name not in EMAIL_SUBJECTS:
+                raise KeyError(f"Template de email desconhecido: {name}")
+            compiled = (
+                self.env.from_string(EMAIL_SUBJECTS[name]),
+                self.env.get_template(f"{name}.txt"),
+                self.env.get_template(f"{name}.html")
+            )
+            self._compiled[name] = compiled
+        return compiled
+    
+    @staticmethod
+    def _render(templates: tuple, context: dict) -> RenderedEmail:
+        subject, text, html = templates
+        return RenderedEmail(
+            subject=subject.render(context),
+            text=text.render(context),
+            html=html.render(context)
+        )
+    
+    def render(self, name: str, /, **context) -> RenderedEmail:
+        """Renderizar um email."""
+        return self._render(self._templates(name), context)
+    
+    def render_many(self, name: str, contexts: Iterable[dict], /, **shared) -> List[RenderedEmail]:
+        """
+        Renderizar o mesmo email para vários destinatários.
+        
+        Args:
+            name: Nome do email
+            contexts: Contexto de cada destinatário
+            shared: Contexto comum a todos (p.ex. mês e ano)
+        """
+        templates = self._templates(name)
+        return [self._render(templates, {**shared, **context}) for context in contexts]
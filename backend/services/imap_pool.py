@@ -0,0 +1,220 @@
+"""
+====================================================================
+POOL DE SESSÕES IMAP - CREDITOIMO
+====================================================================
+Sessões IMAP autenticadas reutilizadas entre sincronizações.
+
+Funcionalidades:
+- Cada sessão é aberta e autenticada uma vez (TLS + LOGIN) e serve
+  muitas operações; a pasta seleccionada mantém-se entre operações
+  (ver select_folder em services/email_service.py)
+- O imaplib é bloqueante: as operações correm num executor próprio de
+  cada conta, fora do event loop, com no máximo IMAP_POOL_SIZE sessões
+  em simultâneo; contas diferentes sincronizam em paralelo
+- Sessões paradas há mais de IMAP_IDLE_CHECK_SECONDS são verificadas
+  (NOOP) antes de reutilizar; uma sessão caída é reaberta e a operação
+  repetida uma vez
+- Tempo máximo por operação (IMAP_OPERATION_TIMEOUT_SECONDS)
+
+Uso:
+    pool = imap_pools.get(account)
+    uids = await pool.run(lambda mail: uid_search(mail, "ALL"))
+====================================================================
+"""
+
+import asyncio
+import imaplib
+import logging
+import os
+import ssl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Dict, Callable, Any
+
+logger = logging.getLogger(__name__)
+
+IMAP_POOL_SIZE = int(os.environ.get("IMAP_POOL_SIZE", "2"))
+IMAP_IDLE_CHECK_SECONDS = int(os.environ.get("IMAP_IDLE_CHECK_SECONDS", "30"))
+IMAP_TIMEOUT_SECONDS = int(os.environ.get("IMAP_TIMEOUT_SECONDS", "30"))
+IMAP_OPERATION_TIMEOUT_SECONDS = int(os.environ.get("IMAP_OPERATION_TIMEOUT_SECONDS", "600"))
+
+# Erros que indicam uma sessão inutilizável (reabrir e repetir)
+IMAP_CONNECTION_ERRORS = (imaplib.IMAP4.abort, ConnectionError, TimeoutError, OSError)
+
+
+class _Session:
+    """Sessão IMAP autenticada e respectiva utilização."""
+    
+    def __init__(self, mail: imaplib.IMAP4):
+        self.mail = mail
+        self.last_used = time.monotonic()
+
+
+class IMAPPool:
+    """Pool de sessões IMAP de uma conta."""
+    
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        username: str,
+        password: str,
+        size: int = IMAP_POOL_SIZE,
+        use_ssl: bool = True,
+        timeout: float = IMAP_TIMEOUT_SECONDS,
+        operation_timeout: float = IMAP_OPERATION_TIMEOUT_SECONDS
+    ):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.size = size
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.operation_timeout = operation_timeout
+        
+        self._idle: List[_Session] = []
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.stats = {"connections": 0, "operations": 0, "reconnects": 0}
+    
+    # ----------------------------------------------------------------
+    # Sessões (executadas no executor)
+    # ----------------------------------------------------------------
+    
+    def connect(self) -> imaplib.IMAP4:
+        """Abrir e autenticar uma sessão nova (fora do pool)."""
+        if self.use_ssl:
+            mail = imaplib.IMAP4_SSL(
+                self.host, self.port, ssl_context=ssl.create_default_context(), timeout=self.timeout
+            )
+        else:
+            mail = imaplib.IMAP4(self.host, self.port, timeout=self.timeout)
+        try:
+            mail.login(self.username, self.password)
+        except Exception:
+            mail.shutdown()
+            raise
+        with self._lock:
+            self.stats["connections"] += 1
+        return mail
+    
+    def _acquire(self) -> _Session:
+        while True:
+            with self._lock:
+                session = self._idle.pop() if self._idle else None
+            if session is None:
+                return _Session(self.connect())
+            
+            if time.monotonic() - session.last_used < IMAP_IDLE_CHECK_SECONDS:
+                return session
+            try:
+                if session.mail.noop()[0] == "OK":
+                    return session
+            except Exception:
+                pass
+            self._discard(session)
+    
+    def _release(self, session: _Session):
+        session.last_used = time.monotonic()
+        with self._lock:
+            self._idle.append(session)
+    
+    @staticmethod
+    def _discard(session: _Session):
+        try:
+            session.mail.logout()
+        except Exception:
+            try:
+                session.mail.shutdown()
+            except Exception:
+                pass
+    
+    def _run_sync(self, operation: Callable, args: tuple):
+        for attempt in (1, 2):
+            session = self._acquire()
+            try:
+                result = operation(session.mail, *args)
+            except IMAP_CONNECTION_ERRORS:
+                self._discard(session)
+                if attempt == 2:
+                    raise
+                with self._lock:
+                    self.stats["reconnects"] += 1
+                continue
+            except Exception:
+                # Erro da operação (p.ex. resposta NO): a sessão continua válida
+                self._release(session)
+                raise
+            
+            self._release(session)
+            return result
+    
+    def _close_sync(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for session in idle:
+            self._discard(session)
+    
+    # ----------------------------------------------------------------
+    # API assíncrona
+    # ----------------------------------------------------------------
+    
+    async def run(self, operation: Callable, *args) -> Any:
+        """
+        Executar `operation(mail, *args)` numa sessão do pool, fora do event loop.
+        
+        A operação é repetida uma vez numa sessão nova se a ligação cair
+        (deve por isso poder ser repetida do início).
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="imap-pool")
+        
+        self.stats["operations"] += 1
+        return await asyncio.wait_for(
+            asyncio.get_running_loop().run_in_executor(self._executor, self._run_sync, operation, args),
+            timeout=self.operation_timeout
+        )
+    
+    async def close(self):
+        """Terminar as sessões abertas e o executor."""
+        if self._executor is None:
+            return
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._close_sync)
+        self._executor.shutdown(wait=False)
+        self._executor = None
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+class IMAPPools:
+    """Um pool por conta de email (criado na primeira utilização)."""
+    
+    def __init__(self):
+        self._pools: Dict[tuple, IMAPPool] = {}
+    
+    def get(self, account) -> IMAPPool:
+        """Pool da conta (EmailAccount de services/email_service.py)."""
+        key = (account.name, account.imap_server, account.imap_port, account.email)
+        pool = self._pools.get(key)
+        if pool is None:
+            pool = IMAPPool(
+                account.imap_server, account.imap_port, account.email, account.password,
+                use_ssl=account.imap_ssl
+            )
+            self._pools[key] = pool
+        return pool
+    
+    async def close(self):
+        """Fechar todos os pools (no encerramento da aplicação)."""
+        pools, self._pools = list(self._pools.values()), {}
+        for pool in pools:
+            await pool.close()
+
+
+imap_pools = IMAPPools()
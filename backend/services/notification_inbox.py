@@ -0,0 +1,549 @@
+"""
+====================================================================
+CAIXA DE NOTIFICAÇÕES - CREDITOIMO
+====================================================================
+Escrita e leitura das notificações do sistema com audiência
+pré-calculada.
+
+Cada notificação guarda em `audience` os destinatários que a podem ver,
+como tokens `user:<id>` e `role:<role>`. A listagem é uma única query
+sobre o índice (audience, read, created_at, id) com paginação por cursor
+(keyset), sem consultar os processos do utilizador.
+
+O número de notificações por ler de cada utilizador é mantido em
+`notification_counters` e actualizado incrementalmente nas escritas e
+leituras. Contadores em falta são recalculados no primeiro acesso, a
+partir de um marcador a zero criado antes da contagem (as escritas
+concorrentes somam-se a ele e obrigam a contar de novo); os
+dos utilizadores com notificações por ler arquivadas são descartados
+no fim do arquivo, e a tarefa diária de arquivo descarta-os todos
+(remoções pelo TTL não passam pelos contadores).
+
+Retenção em dois níveis:
+- `notifications` (quente): cada notificação tem `archive_at` (data BSON),
+  NOTIFICATION_UNREAD_RETENTION_DAYS após a criação, antecipado para
+  NOTIFICATION_READ_RETENTION_DAYS após ser lida
+- `notifications_archive` (frio): formato compacto, consultado apenas a
+  pedido e removido por TTL após NOTIFICATION_ARCHIVE_RETENTION_DAYS
+
+A passagem para o arquivo é feita em lotes pelas tarefas agendadas. Um
+índice TTL em `archive_at` (com NOTIFICATION_ARCHIVE_GRACE_DAYS de folga)
+garante que a colecção quente não cresce se o arquivo não correr.
+====================================================================
+"""
+
+import asyncio
+import base64
+import binascii
+import json
+import logging
+import os
+import uuid
+from collections import Counter
+from datetime import datetime, timezone, timedelta
+from typing import Optional, List, Iterable
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from services.staff_directory import staff_directory
+
+logger = logging.getLogger(__name__)
+
+# Roles que recebem as notificações gerais (novos registos, alertas de processo sem destinatário)
+STAFF_AUDIENCE_ROLES = ["admin", "ceo", "diretor"]
+
+# Campos do processo com utilizadores atribuídos
+PROCESS_PARTICIPANT_FIELDS = ["assigned_consultor_id", "consultor_id", "assigned_mediador_id", "intermediario_id"]
+
+NOTIFICATION_PAGE_MAX = 100
+NOTIFICATION_COUNTER_INIT_ATTEMPTS = 3
+AUDIENCE_MIGRATION_ID = "notification_audience_v1"
+ARCHIVE_AT_MIGRATION_ID = "notification_archive_at_v1"
+
+# Retenção
+NOTIFICATION_READ_RETENTION_DAYS = int(os.environ.get("NOTIFICATION_READ_RETENTION_DAYS", "30"))
+NOTIFICATION_UNREAD_RETENTION_DAYS = int(os.environ.get("NOTIFICATION_UNREAD_RETENTION_DAYS", "90"))
+NOTIFICATION_ARCHIVE_GRACE_DAYS = int(os.environ.get("NOTIFICATION_ARCHIVE_GRACE_DAYS", "7"))
+NOTIFICATION_ARCHIVE_RETENTION_DAYS = int(os.environ.get("NOTIFICATION_ARCHIVE_RETENTION_DAYS", "365"))
+NOTIFICATION_ARCHIVE_BATCH_SIZE = int(os.environ.get("NOTIFICATION_ARCHIVE_BATCH_SIZE", "500"))
+NOTIFICATION_ARCHIVE_BATCH_PAUSE_SECONDS = 0.2
+
+# Campos mantidos no arquivo (os restantes e os valores nulos são descartados)
+ARCHIVE_FIELDS = ["audience", "type", "title", "message", "link", "process_id", "client_name", "read", "created_at"]
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+class InvalidCursorError(ValueError):
+    """Cursor de paginação inválido."""
+
+
+def user_audience(user_id: str) -> str:
+    return f"user:{user_id}"
+
+
+def role_audience(role: str) -> str:
+    return f"role:{role}"
+
+
+def build_audience(user_ids: Iterable[str] = (), roles: Iterable[str] = ()) -> List[str]:
+    """Construir a audiência de uma notificação a partir de utilizadores e roles."""
+    tokens = [user_audience(user_id) for user_id in user_ids if user_id]
+    tokens += [role_audience(role) for role in roles if role]
+    return list(dict.fromkeys(tokens))
+
+
+def process_participants(process: dict) -> List[str]:
+    """Utilizadores atribuídos a um processo."""
+    return list(dict.fromkeys(process[field] for field in PROCESS_PARTICIPANT_FIELDS if process.get(field)))
+
+
+def viewer_audience(user: dict) -> List[str]:
+    """Tokens de audiência que um utilizador pode ver."""
+    return build_audience([user["id"]], [user.get("role")])
+
+
+def encode_cursor(notification: dict) -> str:
+    raw = json.dumps([notification["created_at"], notification["id"]])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def read_archive_at(now: Optional[datetime] = None) -> datetime:
+    """Data de passagem ao arquivo de uma notificação lida agora."""
+    return (now or datetime.now(timezone.utc)) + timedelta(days=NOTIFICATION_READ_RETENTION_DAYS)
+
+
+def compact_for_archive(notification: dict, archived_at: datetime) -> dict:
+    """Documento compacto para `notifications_archive` (o id passa a `_id`)."""
+    document = {"_id": notification["id"]}
+    document.update({
+        field: notification[field]
+        for field in ARCHIVE_FIELDS
+        if notification.get(field) is not None
+    })
+    document["archived_at"] = archived_at
+    return document
+
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        created_at, notification_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError, TypeError) as e:
+        raise InvalidCursorError(str(e))
+    return created_at, notification_id
+
+
+class NotificationInbox:
+    """Escrita, listagem e contagem de notificações por audiência."""
+    
+    def __init__(self, database=None, directory=None):
+        self._database = database
+        self.directory = directory or staff_directory
+    
+    @property
+    def db(self):
+        if self._database is not None:
+            return self._database
+        from database import db
+        return db
+    
+    async def _expand_audience(self, audience: Iterable[str]) -> List[str]:
+        """Converter tokens de audiência em IDs de utilizadores (roles via directório)."""
+        user_ids = []
+        roles = []
+        for token in audience:
+            kind, _, value = token.partition(":")
+            if kind == "user":
+                user_ids.append(value)
+            elif kind == "role":
+                roles.append(value)
+        
+        if roles:
+            user_ids += [user["id"] for user in await self.directory.get_users_by_roles(roles)]
+        return list(dict.fromkeys(user_ids))
+    
+    async def _adjust_counters(self, notifications: Iterable[dict], delta: int):
+        """Somar `delta` ao contador de cada utilizador da audiência das notificações."""
+        totals = Counter()
+        for notification in notifications:
+            for user_id in await self._expand_audience(notification.get("audience", ())):
+                totals[user_id] += delta
+        
+        if not totals:
+            return
+        
+        # Sem upsert: contadores ainda não criados são calculados no primeiro
+        # acesso; `changes` assinala a escrita a um contador em inicialização
+        await self.db.notification_counters.bulk_write(
+            [UpdateOne({"user_id": user_id}, {"$inc": {"unread": n, "changes": 1}}) for user_id, n in totals.items()],
+            ordered=False
+        )
+    
+    async def insert(self, notifications: List[dict], ignore_duplicates: bool = False) -> int:
+        """
+        Guardar notificações (cada uma com `audience`) e actualizar os contadores.
+        
+        Os documentos recebidos não são alterados; as cópias guardadas levam
+        a data `archive_at` de retenção.
+        
+        Args:
+            ignore_duplicates: ignorar notificações rejeitadas pelo índice
+                único de `dedupe_key` (já enviadas anteriormente)
+        
+        Returns:
+            Número de notificações guardadas
+        """
+        if not notifications:
+            return 0
+        
+        now = datetime.now(timezone.utc)
+        documents = [
+            {
+                **notification,
+                "archive_at": read_archive_at(now) if notification.get("read")
+                else now + timedelta(days=NOTIFICATION_UNREAD_RETENTION_DAYS)
+            }
+            for notification in notifications
+        ]
+        
+        rejected = set()
+        if len(documents) == 1 and not ignore_duplicates:
+            await self.db.notifications.insert_one(documents[0])
+        else:
+            try:
+                await self.db.notifications.insert_many(documents, ordered=False)
+            except BulkWriteError as e:
+                errors = e.details.get("writeErrors", [])
+                if not ignore_duplicates or any(error["code"] != DUPLICATE_KEY_ERROR for error in errors):
+                    raise
+                rejected = {error["index"] for error in errors}
+        
+        inserted = [n for i, n in enumerate(notifications) if i not in rejected]
+        await self._adjust_counters([n for n in inserted if not n.get("read")], 1)
+        return len(inserted)
+    
+    async def list_for_user(
+        self,
+        user: dict,
+        unread_only: bool = False,
+        limit: int = 50,
+        cursor: Optional[str] = None
+    ) -> dict:
+        """
+        Listar as notificações visíveis para o utilizador, das mais recentes
+        para as mais antigas.
+        
+        Returns:
+            notifications e next_cursor (None na última página)
+        """
+        limit = max(1, min(limit, NOTIFICATION_PAGE_MAX))
+        
+        # `read` como $in mantém a igualdade no prefixo do índice: o servidor
+        # junta os intervalos já ordenados em vez de ordenar em memória
+        query = {
+            "audience": {"$in": viewer_audience(user)},
+            "read": False if unread_only else {"$in": [False, True]}
+        }
+        
+        if cursor:
+            created_at, notification_id = decode_cursor(cursor)
+            query["$or"] = [
+                {"created_at": {"$lt": created_at}},
+                {"created_at": created_at, "id": {"$lt": notification_id}}
+            ]
+        
+        notifications = await self.db.notifications.find(query, {"_id": 0, "audience": 0}) \
+            .sort([("created_at", -1), ("id", -1)]) \
+            .limit(limit + 1) \
+            .to_list(limit + 1)
+        
+        next_cursor = None
+        if len(notifications) > limit:
+            notifications = notifications[:limit]
+            next_cursor = encode_cursor(notifications[-1])
+        
+        return {"notifications": notifications, "next_cursor": next_cursor}
+    
+    async def count_unread(self, user: dict) -> int:
+        """Contar as notificações por ler directamente no índice."""
+        return await self.db.notifications.count_documents({
+            "audience": {"$in": viewer_audience(user)},
+            "read": False
+        })
+    
+    async def unread_count(self, user: dict) -> int:
+        """
+        Número de notificações por ler (contador mantido incrementalmente).
+        
+        Um contador em falta é criado como marcador a zero antes de contar,
+        para as escritas concorrentes não se perderem; a contagem só é
+        guardada se nenhuma escrita tocar no marcador entretanto (senão
+        conta-se de novo, até NOTIFICATION_COUNTER_INIT_ATTEMPTS vezes).
+        """
+        counter = await self.db.notification_counters.find_one({"user_id": user["id"]}, {"_id": 0})
+        if counter is not None and not counter.get("initializing"):
+            return max(0, counter["unread"])
+        
+        for _ in range(NOTIFICATION_COUNTER_INIT_ATTEMPTS):
+            token = str(uuid.uuid4())
+            try:
+                await self.db.notification_counters.update_one(
+                    {"user_id": user["id"], "initializing": True},
+                    {"$set": {"unread": 0, "changes": 0, "initializing": True, "init_token": token}},
+                    upsert=True
+                )
+            except DuplicateKeyError:
+                # Outro pedido acabou de inicializar o contador
+                counter = await self.db.notification_counters.find_one({"user_id": user["id"]}, {"_id": 0})
+                return max(0, counter["unread"])
+            
+            unread = await self.count_unread(user)
+            result = await self.db.notification_counters.update_one(
+                {"user_id": user["id"], "init_token": token, "changes": 0},
+                {"$set": {"unread": unread}, "$unset": {"initializing": "", "init_token": "", "changes": ""}}
+            )
+            if result.modified_count:
+                return unread
+        
+        # Escritas contínuas: devolver a contagem e inicializar no próximo acesso
+        return unread
+    
+    async def mark_read(self, notification_id: str, user: dict) -> bool:
+        """
+        Marcar uma notificação visível para o utilizador como lida.
+        
+        Returns:
+            False se a notificação não existir ou não for visível
+        """
+        audience = viewer_audience(user)
+        notification = await self.db.notifications.find_one_and_update(
+            {"id": notification_id, "audience": {"$in": audience}, "read": False},
+            {"$set": {"read": True}, "$min": {"archive_at": read_archive_at()}},
+            projection={"_id": 0, "audience": 1}
+        )
+        
+        if notification is None:
+            return await self.db.notifications.count_documents(
+                {"id": notification_id, "audience": {"$in": audience}}, limit=1
+            ) > 0
+        
+        await self._adjust_counters([notification], -1)
+        return True
+    
+    async def mark_all_read(self, user: dict) -> int:
+        """
+        Marcar como lidas todas as notificações visíveis para o utilizador.
+        
+        Returns:
+            Número de notificações marcadas
+        """
+        unread = await self.db.notifications.find(
+            {"audience": {"$in": viewer_audience(user)}, "read": False},
+            {"_id": 0, "id": 1, "audience": 1}
+        ).to_list(None)
+        
+        if not unread:
+            return 0
+        
+        await self.db.notifications.update_many(
+            {"id": {"$in": [n["id"] for n in unread]}, "read": False},
+            {"$set": {"read": True}, "$min": {"archive_at": read_archive_at()}}
+        )
+        await self._adjust_counters(unread, -1)
+        
+        return len(unread)
+    
+    async def reset_counters(self, user_ids: Optional[Iterable[str]] = None):
+        """
+        Descartar contadores (recalculados no próximo acesso), p.ex. após
+        mudança de role ou remoção em massa de notificações.
+        """
+        if user_ids is None:
+            await self.db.notification_counters.delete_many({})
+        else:
+            await self.db.notification_counters.delete_many({"user_id": {"$in": list(user_ids)}})
+    
+    async def archive_expired(
+        self,
+        batch_size: int = NOTIFICATION_ARCHIVE_BATCH_SIZE,
+        pause: float = NOTIFICATION_ARCHIVE_BATCH_PAUSE_SECONDS
+    ) -> int:
+        """
+        Mover para o arquivo, em lotes, as notificações cujo `archive_at` passou.
+        
+        Cada lote é copiado para `notifications_archive` e só depois removido
+        da colecção quente, pelo que uma interrupção a meio é retomada sem
+        perdas. A pausa entre lotes evita picos de I/O.
+        
+        Os contadores não são decrementados lote a lote (uma notificação lida
+        entre a leitura do lote e a remoção já foi descontada em mark_read):
+        os dos utilizadores afectados são recalculados no fim.
+        
+        Returns:
+            Número de notificações arquivadas
+        """
+        archived = 0
+        affected = set()
+        
+        while True:
+            now = datetime.now(timezone.utc)
+            batch = await self.db.notifications.find(
+                {"archive_at": {"$lte": now}}, {"_id": 0}
+            ).sort("archive_at", 1).limit(batch_size).to_list(batch_size)
+            
+            if not batch:
+                break
+            
+            try:
+                await self.db.notifications_archive.insert_many(
+                    [compact_for_archive(n, now) for n in batch], ordered=False
+                )
+            except BulkWriteError as e:
+                # Documentos já copiados numa execução interrompida
+                if any(error["code"] != DUPLICATE_KEY_ERROR for error in e.details.get("writeErrors", [])):
+                    raise
+            
+            await self.db.notifications.delete_many({"id": {"$in": [n["id"] for n in batch]}})
+            for notification in batch:
+                if not notification.get("read"):
+                    affected.update(await self._expand_audience(notification.get("audience", ())))
+            archived += len(batch)
+            
+            if len(batch) < batch_size:
+                break
+            await asyncio.sleep(pause)
+        
+        if affected:
+            await self.reset_counters(affected)
+        if archived:
+            logger.info(f"Notificações arquivadas: {archived}")
+        return archived
+    
+    async def list_archive_for_user(
+        self,
+        user: dict,
+        limit: int = 50,
+        cursor: Optional[str] = None
+    ) -> dict:
+        """
+        Listar notificações arquivadas visíveis para o utilizador (a pedido).
+        
+        Returns:
+            notifications e next_cursor (None na última página)
+        """
+        limit = max(1, min(limit, NOTIFICATION_PAGE_MAX))
+        query = {"audience": {"$in": viewer_audience(user)}}
+        
+        if cursor:
+            created_at, notification_id = decode_cursor(cursor)
+            query["$or"] = [
+                {"created_at": {"$lt": created_at}},
+                {"created_at": created_at, "_id": {"$lt": notification_id}}
+            ]
+        
+        documents = await self.db.notifications_archive.find(query, {"audience": 0}) \
+            .sort([("created_at", -1), ("_id", -1)]) \
+            .limit(limit + 1) \
+            .to_list(limit + 1)
+        
+        notifications = [{"id": doc.pop("_id"), **doc} for doc in documents]
+        
+        next_cursor = None
+        if len(notifications) > limit:
+            notifications = notifications[:limit]
+            next_cursor = encode_cursor(notifications[-1])
+        
+        return {"notifications": notifications, "next_cursor": next_cursor}
+    
+    async def _run_migration(self, migration_id: str, migrate) -> int:
+        """Executar uma migração uma única vez (marcador em `migrations`)."""
+        if await self.db.migrations.find_one({"id": migration_id}):
+            return 0
+        
+        updated = await migrate()
+        await self.db.migrations.insert_one({"id": migration_id, "updated": updated})
+        return updated
+    
+    async def run_migrations(self):
+        """Migrar notificações criadas antes da audiência e da retenção por data."""
+        await self._run_migration(AUDIENCE_MIGRATION_ID, self.backfill_audience)
+        await self._run_migration(ARCHIVE_AT_MIGRATION_ID, self.backfill_archive_at)
+    
+    async def backfill_audience(self) -> int:
+        """
+        Migração: calcular a audiência das notificações criadas antes deste
+        modelo.
+        
+        Returns:
+            Número de notificações actualizadas
+        """
+        missing = {"audience": {"$exists": False}}
+        
+        # Notificações pessoais: audiência é o próprio destinatário
+        result = await self.db.notifications.update_many(
+            {**missing, "user_id": {"$nin": [None, ""]}},
+            [{"$set": {"audience": [{"$concat": ["user:", "$user_id"]}]}}]
+        )
+        updated = result.modified_count
+        
+        # Notificações gerais: staff e, quando associadas a processo, os seus participantes
+        shared = await self.db.notifications.find(
+            missing, {"_id": 0, "id": 1, "process_id": 1, "type": 1}
+        ).to_list(None)
+        
+        process_ids = list({n["process_id"] for n in shared if n.get("process_id")})
+        processes = {}
+        if process_ids:
+            projection = {"_id": 0, "id": 1, **{field: 1 for field in PROCESS_PARTICIPANT_FIELDS}}
+            async for process in self.db.processes.find({"id": {"$in": process_ids}}, projection):
+                processes[process["id"]] = process
+        
+        operations = []
+        for notification in shared:
+            participants = []
+            process = processes.get(notification.get("process_id"))
+            if process and notification.get("type") != "new_registration":
+                participants = process_participants(process)
+            
+            operations.append(UpdateOne(
+                {"id": notification["id"]},
+                {"$set": {"audience": build_audience(participants, STAFF_AUDIENCE_ROLES)}}
+            ))
+        
+        if operations:
+            await self.db.notifications.bulk_write(operations, ordered=False)
+            updated += len(operations)
+        
+        await self.reset_counters()
+        
+        logger.info(f"Audiência calculada para {updated} notificações antigas")
+        return updated
+    
+    async def backfill_archive_at(self) -> int:
+        """
+        Migração: calcular `archive_at` (data BSON) das notificações antigas
+        a partir de `created_at` (texto ISO) e do estado de leitura.
+        
+        Returns:
+            Número de notificações actualizadas
+        """
+        day_ms = 24 * 3600 * 1000
+        result = await self.db.notifications.update_many(
+            {"archive_at": {"$exists": False}},
+            [{"$set": {"archive_at": {"$add": [
+                {"$dateFromString": {"dateString": "$created_at", "onError": "$$NOW", "onNull": "$$NOW"}},
+                {"$cond": [
+                    {"$eq": ["$read", True]},
+                    NOTIFICATION_READ_RETENTION_DAYS * day_ms,
+                    NOTIFICATION_UNREAD_RETENTION_DAYS * day_ms
+                ]}
+            ]}}}]
+        )
+        
+        logger.info(f"Data de arquivo calculada para {result.modified_count} notificações antigas")
+        return result.modified_count
+
+
+# Instância global da caixa de notificações
+notification_inbox = NotificationInbox()
@@ -3,16 +3,33 @@
 SERVIÇO DE PUSH NOTIFICATIONS - CREDITOIMO
 ====================================================================
 Serviço para enviar notificações push via Web Push API com VAPID.
+
+Os envios são assíncronos: a cifra do payload (ECE aes128gcm) e a
+assinatura VAPID correm fora do event loop e os pedidos HTTP usam um
+cliente httpx partilhado, com concorrência limitada entre subscrições
+e utilizadores. As entregas passam pela fila persistente de
+`services/push_queue.py` (retry, backoff e dead-letter).
+
+Caches em memória:
+- Headers VAPID assinados, por origem do serviço push, durante a validade do JWT
+- Subscrições activas por utilizador, invalidadas pelas rotas de subscrição
 ====================================================================
 """
 
+import asyncio
 import logging
 import json
 import os
-from typing import Optional, List
+import threading
+import time
+from functools import lru_cache
+from typing import Optional, List, Dict, Tuple, Iterable
 from datetime import datetime, timezone
+from urllib.parse import urlparse
 
-from pywebpush import webpush, WebPushException
+import httpx
+from py_vapid import Vapid
+from pywebpush import WebPusher
 
 from database import db
 
@@ -23,23 +40,238 @@ VAPID_PRIVATE_KEY = os.environ.get("VAPID_PRIVATE_KEY", "")
 VAPID_PUBLIC_KEY = os.environ.get("VAPID_PUBLIC_KEY", "")
 VAPID_MAILTO = os.environ.get("VAPID_MAILTO", "mailto:admin@creditoimo.pt")
 
+# Configuração do envio
+PUSH_MAX_CONCURRENCY = int(os.environ.get("PUSH_MAX_CONCURRENCY", "100"))
+PUSH_REQUEST_TIMEOUT_SECONDS = float(os.environ.get("PUSH_REQUEST_TIMEOUT_SECONDS", "10"))
+PUSH_TTL_SECONDS = int(os.environ.get("PUSH_TTL_SECONDS", str(24 * 60 * 60)))
+VAPID_TOKEN_VALIDITY_SECONDS = 12 * 60 * 60
+# Renovar o JWT VAPID quando faltar menos do que isto para expirar
+VAPID_TOKEN_REFRESH_MARGIN_SECONDS = 60 * 60
+# Validade máxima da cache de subscrições (protege contra alterações feitas por outras réplicas)
+PUSH_SUBSCRIPTION_CACHE_SECONDS = int(os.environ.get("PUSH_SUBSCRIPTION_CACHE_SECONDS", "300"))
+
+# Cache de headers VAPID: origem -> (headers, expira_em)
+_vapid_headers_cache: Dict[str, Tuple[Dict[str, str], float]] = {}
+_vapid_headers_lock = threading.Lock()
+
+# Cache de subscrições: user_id -> (subscrições, carregado_em)
+_subscriptions_cache: Dict[str, Tuple[List[dict], float]] = {}
+
 
 def is_vapid_configured() -> bool:
     """Verificar se as chaves VAPID estão configuradas."""
     return bool(VAPID_PRIVATE_KEY and VAPID_PUBLIC_KEY)
 
 
+@lru_cache(maxsize=4)
+def _get_vapid_signer(private_key: str) -> Vapid:
+    """Carregar a chave VAPID privada (uma vez por chave)."""
+    return Vapid.from_string(private_key=private_key)
+
+
+def _get_vapid_headers(endpoint: str) -> Dict[str, str]:
+    """
+    Obter os headers VAPID para a origem do serviço push do endpoint.
+    
+    O JWT é assinado uma vez por origem e reutilizado até perto de expirar.
+    """
+    url = urlparse(endpoint)
+    audience = f"{url.scheme}://{url.netloc}"
+    now = time.time()
+    
+    cached = _vapid_headers_cache.get(audience)
+    if cached and cached[1] - now > VAPID_TOKEN_REFRESH_MARGIN_SECONDS:
+        return cached[0]
+    
+    with _vapid_headers_lock:
+        cached = _vapid_headers_cache.get(audience)
+        if cached and cached[1] - now > VAPID_TOKEN_REFRESH_MARGIN_SECONDS:
+            return cached[0]
+        
+        expires_at = int(now) + VAPID_TOKEN_VALIDITY_SECONDS
+        claims = {"sub": VAPID_MAILTO, "aud": audience, "exp": expires_at}
+        headers = _get_vapid_signer(VAPID_PRIVATE_KEY).sign(claims)
+        _vapid_headers_cache[audience] = (headers, expires_at)
+        return headers
+
+
+def _prepare_push_request(subscription: dict, payload: str, ttl: int) -> Tuple[str, bytes, Dict[str, str]]:
+    """
+    Cifrar o payload e construir os headers de um pedido Web Push.
+    
+    Operação CPU-bound (ECDH + AES-GCM + ECDSA): executar fora do event loop.
+    """
+    endpoint = subscription["endpoint"]
+    pusher = WebPusher({"endpoint": endpoint, "keys": subscription["keys"]})
+    encoded = pusher.encode(payload.encode("utf8"), "aes128gcm")
+    
+    headers = {
+        "Content-Encoding": "aes128gcm",
+        "Content-Type": "application/octet-stream",
+        "TTL": str(ttl)
+    }
+    headers.update(_get_vapid_headers(endpoint))
+    
+    return endpoint, encoded["body"], headers
+
+
+class WebPushSender:
+    """
+    Motor de envio Web Push assíncrono.
+    
+    Partilha um cliente HTTP com pool de conexões e um semáforo global que
+    limita o número de envios em simultâneo.
+    """
+    
+    def __init__(
+        self,
+        max_concurrency: int = PUSH_MAX_CONCURRENCY,
+        timeout: float = PUSH_REQUEST_TIMEOUT_SECONDS,
+        transport: Optional[httpx.AsyncBaseTransport] = None
+    ):
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self._transport = transport
+        self._client: Optional[httpx.AsyncClient] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+    
+    def _ensure_client(self) -> httpx.AsyncClient:
+        """Criar o cliente HTTP e o semáforo no event loop actual."""
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_concurrency,
+                    max_keepalive_connections=self.max_concurrency
+                ),
+                transport=self._transport
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._loop = loop
+        return self._client
+    
+    async def close(self):
+        """Fechar o cliente HTTP."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
+    async def send(self, subscription: dict, payload: str, ttl: int = PUSH_TTL_SECONDS) -> dict:
+        """
+        Enviar um payload para uma subscrição.
+        
+        Returns:
+            Resultado do envio, incluindo o código HTTP e a latência do endpoint
+        """
+        client = self._ensure_client()
+        endpoint = subscription.get("endpoint", "")
+        
+        async with self._semaphore:
+            started = time.perf_counter()
+            try:
+                url, body, headers = await asyncio.to_thread(_prepare_push_request, subscription, payload, ttl)
+                response = await client.post(url, content=body, headers=headers)
+            except Exception as e:
+                return {
+                    "endpoint": endpoint,
+                    "success": False,
+                    "status_code": None,
+                    "error": str(e),
+                    "latency_ms": round((time.perf_counter() - started) * 1000, 1)
+                }
+            latency_ms = round((time.perf_counter() - started) * 1000, 1)
+        
+        logger.debug(f"Push {response.status_code} em {latency_ms} ms para {endpoint[:50]}...")
+        
+        return {
+            "endpoint": endpoint,
+            "success": 200 <= response.status_code < 300,
+            "status_code": response.status_code,
+            "retry_after": response.headers.get("Retry-After"),
+            "latency_ms": latency_ms
+        }
+    
+    async def send_many(self, subscriptions: List[dict], payload: str, ttl: int = PUSH_TTL_SECONDS) -> List[dict]:
+        """Enviar o mesmo payload para várias subscrições em paralelo."""
+        return list(await asyncio.gather(*(self.send(sub, payload, ttl) for sub in subscriptions)))
+
+
+# Instância global do motor de envio
+push_sender = WebPushSender()
+
+
+def _get_cached_subscriptions(user_id: str) -> Optional[List[dict]]:
+    cached = _subscriptions_cache.get(user_id)
+    if cached and time.monotonic() - cached[1] < PUSH_SUBSCRIPTION_CACHE_SECONDS:
+        return cached[0]
+    return None
+
+
 async def get_user_push_subscriptions(user_id: str) -> List[dict]:
     """
-    Obter todas as subscrições push activas de um utilizador.
+    Obter todas as subscrições push activas de um utilizador (com cache).
     """
+    subscriptions = _get_cached_subscriptions(user_id)
+    if subscriptions is not None:
+        return subscriptions
+    
     subscriptions = await db.push_subscriptions.find(
-        {"user_id": user_id, "is_active": True}
+        {"user_id": user_id, "is_active": True},
+        {"_id": 0}
     ).to_list(10)
     
+    _subscriptions_cache[user_id] = (subscriptions, time.monotonic())
     return subscriptions
 
 
+async def prefetch_push_subscriptions(user_ids: Iterable[str]):
+    """
+    Carregar para a cache, numa única query, as subscrições dos utilizadores
+    que ainda não estão em cache (usado antes de envios em massa).
+    """
+    missing = [user_id for user_id in set(user_ids) if _get_cached_subscriptions(user_id) is None]
+    if not missing:
+        return
+    
+    subscriptions = await db.push_subscriptions.find(
+        {"user_id": {"$in": missing}, "is_active": True},
+        {"_id": 0}
+    ).to_list(None)
+    
+    by_user: Dict[str, List[dict]] = {user_id: [] for user_id in missing}
+    for sub in subscriptions:
+        by_user[sub["user_id"]].append(sub)
+    
+    loaded_at = time.monotonic()
+    for user_id, user_subscriptions in by_user.items():
+        _subscriptions_cache[user_id] = (user_subscriptions, loaded_at)
+
+
+def invalidate_push_subscriptions(user_ids: Optional[Iterable[str]] = None, endpoints: Optional[Iterable[str]] = None):
+    """
+    Invalidar a cache de subscrições.
+    
+    Args:
+        user_ids: Utilizadores a invalidar
+        endpoints: Invalidar os utilizadores que têm estes endpoints em cache
+        (sem argumentos, limpa toda a cache)
+    """
+    if user_ids is None and endpoints is None:
+        _subscriptions_cache.clear()
+        return
+    
+    for user_id in user_ids or ():
+        _subscriptions_cache.pop(user_id, None)
+    
+    if endpoints:
+        endpoints = set(endpoints)
+        for user_id, (subscriptions, _) in list(_subscriptions_cache.items()):
+            if any(sub["endpoint"] in endpoints for sub in subscriptions):
+                _subscriptions_cache.pop(user_id, None)
+
+
 async def send_push_notification(
     user_id: str,
     title: str,
@@ -48,11 +280,15 @@ async def send_push_notification(
     badge: Optional[str] = "/logo192.png",
     tag: Optional[str] = None,
     url: Optional[str] = "/",
-    data: Optional[dict] = None
+    data: Optional[dict] = None,
+    ttl: int = PUSH_TTL_SECONDS
 ) -> dict:
     """
     Enviar notificação push para um utilizador via Web Push API.
     
+    As entregas (uma por subscrição) são guardadas na fila `push_queue`
+    e enviadas pelo worker em background.
+    
     Args:
         user_id: ID do utilizador
         title: Título da notificação
@@ -62,6 +298,7 @@ async def send_push_notification(
         tag: Tag para agrupar notificações
         url: URL para abrir ao clicar
         data: Dados adicionais
+        ttl: Tempo (segundos) durante o qual a notificação é válida
     
     Returns:
         Resultado do envio
@@ -88,55 +325,16 @@ async def send_push_notification(
         }
     })
     
-    sent_count = 0
-    failed_subscriptions = []
+    # A entrega é feita pelo worker da fila persistente (retry/backoff/dead-letter)
+    from services.push_queue import enqueue_push_deliveries
     
-    for sub in subscriptions:
-        try:
-            subscription_info = {
-                "endpoint": sub["endpoint"],
-                "keys": sub["keys"]
-            }
-            
-            webpush(
-                subscription_info=subscription_info,
-                data=payload,
-                vapid_private_key=VAPID_PRIVATE_KEY,
-                vapid_claims={"sub": VAPID_MAILTO}
-            )
-            
-            sent_count += 1
-            logger.info(f"Push notification enviada para {user_id}")
-            
-        except WebPushException as e:
-            logger.error(f"Erro ao enviar push para {user_id}: {e}")
-            
-            # Se a subscrição expirou ou é inválida, marcar como inativa
-            if e.response and e.response.status_code in [404, 410]:
-                failed_subscriptions.append(sub["endpoint"])
-                logger.info(f"Subscrição expirada marcada para remoção: {sub['endpoint'][:50]}...")
-        
-        except ValueError as e:
-            # Erro de deserialização da chave VAPID - log e continuar
-            logger.error(f"Erro de chave VAPID para {user_id}: {e}")
-            
-        except Exception as e:
-            # Qualquer outro erro - log e continuar
-            logger.error(f"Erro inesperado ao enviar push para {user_id}: {e}")
-    
-    # Desativar subscrições inválidas
-    if failed_subscriptions:
-        await db.push_subscriptions.update_many(
-            {"endpoint": {"$in": failed_subscriptions}},
-            {"$set": {"is_active": False, "deactivated_at": datetime.now(timezone.utc).isoformat()}}
-        )
-        logger.info(f"Desativadas {len(failed_subscriptions)} subscrições inválidas")
+    queued_count = await enqueue_push_deliveries(user_id, subscriptions, payload, ttl=ttl)
+    logger.info(f"Push notification para {user_id} colocada na fila ({queued_count} subscrições)")
     
     return {
-        "success": sent_count > 0,
-        "sent_count": sent_count,
-        "total_subscriptions": len(subscriptions),
-        "failed_count": len(failed_subscriptions)
+        "success": queued_count > 0,
+        "queued_count": queued_count,
+        "total_subscriptions": len(subscriptions)
     }
 
 
@@ -148,6 +346,9 @@ async def send_push_to_multiple_users(
 ) -> dict:
     """
     Enviar notificação push para múltiplos utilizadores.
+    
+    Os utilizadores são processados em paralelo; as entregas seguem para a
+    fila persistente, onde o envio HTTP é limitado pelo semáforo do `push_sender`.
     """
     results = {
         "total": len(user_ids),
@@ -156,9 +357,18 @@ async def send_push_to_multiple_users(
         "failed": 0
     }
     
-    for user_id in user_ids:
-        result = await send_push_notification(user_id, title, body, **kwargs)
-        if result.get("success"):
+    await prefetch_push_subscriptions(user_ids)
+    
+    user_results = await asyncio.gather(
+        *(send_push_notification(user_id, title, body, **kwargs) for user_id in user_ids),
+        return_exceptions=True
+    )
+    
+    for user_id, result in zip(user_ids, user_results):
+        if isinstance(result, Exception):
+            logger.error(f"Erro inesperado ao enviar push para {user_id}: {result}")
+            results["failed"] += 1
+        elif result.get("success"):
             results["sent"] += 1
         elif result.get("reason") == "no_subscriptions":
             results["no_subscriptions"] += 1
@@ -197,6 +407,22 @@ async def broadcast_push_notification(
     return await send_push_to_multiple_users(user_ids, title, body, **kwargs)
 
 
+async def deactivate_subscriptions(endpoints: List[str]) -> int:
+    """
+    Desactivar, numa única operação, subscrições rejeitadas pelo serviço push.
+    """
+    if not endpoints:
+        return 0
+    
+    result = await db.push_subscriptions.update_many(
+        {"endpoint": {"$in": list(set(endpoints))}, "is_active": True},
+        {"$set": {"is_active": False, "deactivated_at": datetime.now(timezone.utc).isoformat()}}
+    )
+    invalidate_push_subscriptions(endpoints=endpoints)
+    logger.info(f"Desativadas {result.modified_count} subscrições inválidas")
+    return result.modified_count
+
+
 async def cleanup_expired_subscriptions():
     """
     Remover subscrições expiradas.
@@ -213,6 +439,7 @@ async def cleanup_expired_subscriptions():
     )
     
     if result.modified_count > 0:
+        invalidate_push_subscriptions()
         logger.info(f"Desactivadas {result.modified_count} subscrições push expiradas")
     
     return result.modified_count
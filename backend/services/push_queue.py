@@ -0,0 +1,381 @@
+"""
+====================================================================
+FILA PERSISTENTE DE PUSH NOTIFICATIONS - CREDITOIMO
+====================================================================
+Entregas Web Push guardadas na colecção `push_queue` e drenadas por um
+worker em background.
+
+Funcionalidades:
+- Uma entrega por subscrição, guardada antes do envio
+- Retry com backoff exponencial (com jitter) que respeita `Retry-After`
+- Dead-letter (`push_dead_letters`) para mensagens com TTL expirado,
+  demasiadas tentativas ou rejeitadas pelo serviço push
+- Desactivação em lote das subscrições inválidas (404/410)
+- Latência de cada envio guardada no resultado da entrega (retry ou
+  dead-letter) e resumida por worker (últimos PUSH_LATENCY_SAMPLES
+  envios) em GET /notifications/push/queue
+====================================================================
+"""
+
+import asyncio
+import logging
+import os
+import random
+import uuid
+from collections import deque
+from datetime import datetime, timezone, timedelta
+from email.utils import parsedate_to_datetime
+from typing import Optional, List, Dict
+
+from pymongo import UpdateOne
+
+from database import db
+from services.push_notifications import push_sender, deactivate_subscriptions, PUSH_TTL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Configuração da fila
+PUSH_QUEUE_BATCH_SIZE = int(os.environ.get("PUSH_QUEUE_BATCH_SIZE", "200"))
+PUSH_QUEUE_POLL_SECONDS = float(os.environ.get("PUSH_QUEUE_POLL_SECONDS", "5"))
+PUSH_QUEUE_MAX_ATTEMPTS = int(os.environ.get("PUSH_QUEUE_MAX_ATTEMPTS", "8"))
+PUSH_RETRY_BASE_SECONDS = float(os.environ.get("PUSH_RETRY_BASE_SECONDS", "2"))
+PUSH_RETRY_MAX_SECONDS = float(os.environ.get("PUSH_RETRY_MAX_SECONDS", "900"))
+PUSH_QUEUE_LEASE_SECONDS = 120
+PUSH_LATENCY_SAMPLES = int(os.environ.get("PUSH_LATENCY_SAMPLES", "1000"))
+PUSH_DEAD_LETTER_RETENTION_DAYS = 30
+
+# Códigos HTTP do serviço push
+RETRYABLE_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+GONE_STATUS_CODES = {404, 410}
+
+
+class PushJobStatus:
+    PENDING = "pending"
+    PROCESSING = "processing"
+
+
+class DeadLetterReason:
+    TTL_EXPIRED = "ttl_expired"
+    MAX_ATTEMPTS = "max_attempts"
+    SUBSCRIPTION_GONE = "subscription_gone"
+    REJECTED = "rejected"
+
+
+def _as_utc(value: datetime) -> datetime:
+    """O Motor devolve datas sem timezone (UTC); normalizar para comparação."""
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+def parse_retry_after(value: Optional[str], now: Optional[datetime] = None) -> Optional[float]:
+    """
+    Interpretar o header `Retry-After` (segundos ou data HTTP).
+    
+    Returns:
+        Segundos a aguardar ou None se o header estiver ausente/inválido
+    """
+    if not value:
+        return None
+    
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    
+    now = now or datetime.now(timezone.utc)
+    return max(0.0, (_as_utc(retry_at) - now).total_seconds())
+
+
+def compute_retry_delay(attempts: int, retry_after: Optional[float] = None) -> float:
+    """
+    Calcular o intervalo até à próxima tentativa.
+    
+    Backoff exponencial com jitter (metade fixa, metade aleatória), limitado
+    a PUSH_RETRY_MAX_SECONDS. Nunca é inferior ao `Retry-After` do serviço.
+    """
+    backoff = min(PUSH_RETRY_MAX_SECONDS, PUSH_RETRY_BASE_SECONDS * (2 ** max(0, attempts - 1)))
+    delay = backoff / 2 + random.uniform(0, backoff / 2)
+    
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    
+    return delay
+
+
+async def enqueue_push_deliveries(
+    user_id: str,
+    subscriptions: List[dict],
+    payload: str,
+    ttl: int = PUSH_TTL_SECONDS
+) -> int:
+    """
+    Guardar na fila uma entrega por subscrição e acordar o worker.
+    
+    Returns:
+        Número de entregas colocadas na fila
+    """
+    if not subscriptions:
+        return 0
+    
+    now = datetime.now(timezone.utc)
+    jobs = [
+        {
+            "id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "endpoint": sub["endpoint"],
+            "keys": sub["keys"],
+            "payload": payload,
+            "ttl_seconds": ttl,
+            "status": PushJobStatus.PENDING,
+            "attempts": 0,
+            "created_at": now,
+            "next_attempt_at": now,
+            "expires_at": now + timedelta(seconds=ttl),
+            "last_status_code": None,
+            "last_error": None
+        }
+        for sub in subscriptions
+    ]
+    
+    await db.push_queue.insert_many(jobs)
+    push_queue_worker.wake()
+    
+    return len(jobs)
+
+
+class PushQueueWorker:
+    """Worker que drena a fila `push_queue`."""
+    
+    def __init__(
+        self,
+        sender=None,
+        batch_size: int = PUSH_QUEUE_BATCH_SIZE,
+        poll_interval: float = PUSH_QUEUE_POLL_SECONDS,
+        max_attempts: int = PUSH_QUEUE_MAX_ATTEMPTS
+    ):
+        self.sender = sender or push_sender
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._latencies: deque = deque(maxlen=PUSH_LATENCY_SAMPLES)
+    
+    def latency_summary(self) -> dict:
+        """Latência dos últimos envios deste worker (ms)."""
+        samples = sorted(self._latencies)
+        if not samples:
+            return {"samples": 0, "avg": None, "p95": None, "max": None}
+        return {
+            "samples": len(samples),
+            "avg": round(sum(samples) / len(samples), 1),
+            "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+            "max": samples[-1]
+        }
+    
+    async def _claim_batch(self) -> List[dict]:
+        """Reservar um lote de entregas prontas (inclui reservas expiradas de workers mortos)."""
+        now = datetime.now(timezone.utc)
+        ready = {"$or": [
+            {"status": PushJobStatus.PENDING, "next_attempt_at": {"$lte": now}},
+            {"status": PushJobStatus.PROCESSING, "locked_until": {"$lt": now}}
+        ]}
+        
+        candidates = await db.push_queue.find(ready, {"_id": 0, "id": 1}) \
+            .sort("next_attempt_at", 1).to_list(self.batch_size)
+        if not candidates:
+            return []
+        
+        lease_token = str(uuid.uuid4())
+        await db.push_queue.update_many(
+            {"id": {"$in": [c["id"] for c in candidates]}, **ready},
+            {"$set": {
+                "status": PushJobStatus.PROCESSING,
+                "lease_token": lease_token,
+                "locked_until": now + timedelta(seconds=PUSH_QUEUE_LEASE_SECONDS)
+            }}
+        )
+        
+        return await db.push_queue.find({"lease_token": lease_token}, {"_id": 0}).to_list(self.batch_size)
+    
+    async def drain_once(self) -> Dict[str, int]:
+        """
+        Processar um lote da fila.
+        
+        Returns:
+            Contadores do lote (claimed, sent, retried, dead)
+        """
+        jobs = await self._claim_batch()
+        stats = {"claimed": len(jobs), "sent": 0, "retried": 0, "dead": 0}
+        if not jobs:
+            return stats
+        
+        now = datetime.now(timezone.utc)
+        to_send = []
+        dead_letters = []
+        
+        # Mensagens cujo TTL expirou antes de nova tentativa não são enviadas
+        for job in jobs:
+            if job["attempts"] > 0 and _as_utc(job["expires_at"]) <= now:
+                dead_letters.append((job, DeadLetterReason.TTL_EXPIRED))
+            else:
+                to_send.append(job)
+        
+        results = await asyncio.gather(*(
+            self.sender.send(
+                job,
+                job["payload"],
+                ttl=max(0, int((_as_utc(job["expires_at"]) - now).total_seconds()))
+            )
+            for job in to_send
+        ))
+        
+        sent_ids = []
+        retries = []
+        gone_endpoints = []
+        
+        for job, result in zip(to_send, results):
+            status_code = result.get("status_code")
+            latency_ms = result.get("latency_ms")
+            attempts = job["attempts"] + 1
+            if latency_ms is not None:
+                self._latencies.append(latency_ms)
+            
+            if result["success"]:
+                sent_ids.append(job["id"])
+                continue
+            
+            job["attempts"] = attempts
+            job["last_status_code"] = status_code
+            job["last_error"] = result.get("error")
+            job["last_latency_ms"] = latency_ms
+            
+            if status_code in GONE_STATUS_CODES:
+                gone_endpoints.append(job["endpoint"])
+                dead_letters.append((job, DeadLetterReason.SUBSCRIPTION_GONE))
+                continue
+            
+            if status_code is not None and status_code not in RETRYABLE_STATUS_CODES:
+                dead_letters.append((job, DeadLetterReason.REJECTED))
+                continue
+            
+            retry_after = parse_retry_after(result.get("retry_after"), now)
+            next_attempt_at = now + timedelta(seconds=compute_retry_delay(attempts, retry_after))
+            
+            if attempts >= self.max_attempts:
+                dead_letters.append((job, DeadLetterReason.MAX_ATTEMPTS))
+            elif next_attempt_at >= _as_utc(job["expires_at"]):
+                dead_letters.append((job, DeadLetterReason.TTL_EXPIRED))
+            else:
+                retries.append(UpdateOne(
+                    {"id": job["id"], "lease_token": job["lease_token"]},
+                    {
+                        "$set": {
+                            "status": PushJobStatus.PENDING,
+                            "attempts": attempts,
+                            "next_attempt_at": next_attempt_at,
+                            "last_status_code": status_code,
+                            "last_error": result.get("error"),
+                            "last_latency_ms": latency_ms
+                        },
+                        "$unset": {"lease_token": "", "locked_until": ""}
+                    }
+                ))
+        
+        if sent_ids:
+            # Só as entregas ainda reservadas por este worker (lease não expirado)
+            await db.push_queue.delete_many({"id": {"$in": sent_ids}, "lease_token": jobs[0]["lease_token"]})
+        
+        if retries:
+            await db.push_queue.bulk_write(retries, ordered=False)
+        
+        if dead_letters:
+            await self._dead_letter(dead_letters, now)
+        
+        if gone_endpoints:
+            await deactivate_subscriptions(gone_endpoints)
+        
+        stats.update(sent=len(sent_ids), retried=len(retries), dead=len(dead_letters))
+        logger.info(f"Fila push: {stats}, latência {self.latency_summary()}")
+        return stats
+    
+    async def _dead_letter(self, dead_letters: List[tuple], now: datetime):
+        """Mover entregas falhadas definitivamente para `push_dead_letters`."""
+        documents = []
+        for job, reason in dead_letters:
+            document = {k: v for k, v in job.items() if k not in ("keys", "lease_token", "locked_until")}
+            document.update(status="dead", reason=reason, dead_at=now)
+            documents.append(document)
+        
+        await db.push_dead_letters.insert_many(documents)
+        await db.push_queue.delete_many({"id": {"$in": [job["id"] for job, _ in dead_letters]}})
+    
+    async def drain(self) -> Dict[str, int]:
+        """Processar lotes até não haver entregas prontas."""
+        totals = {"claimed": 0, "sent": 0, "retried": 0, "dead": 0}
+        while True:
+            stats = await self.drain_once()
+            for key, value in stats.items():
+                totals[key] += value
+            if stats["claimed"] < self.batch_size:
+                return totals
+    
+    def wake(self):
+        """Acordar o worker (chamado após enfileirar novas entregas)."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+    
+    async def _run(self):
+        while True:
+            # Limpar antes de drenar: um wake() durante a drenagem não se perde
+            self._wakeup.clear()
+            try:
+                await self.drain()
+            except Exception as e:
+                logger.error(f"Erro ao drenar fila push: {e}")
+            
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+    
+    def start(self):
+        """Iniciar o worker em background (idempotente)."""
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Parar o worker."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._wakeup = None
+
+
+async def get_push_queue_stats() -> dict:
+    """Obter o estado da fila push, dos dead letters e a latência dos envios deste worker."""
+    now = datetime.now(timezone.utc)
+    
+    reasons = await db.push_dead_letters.aggregate([
+        {"$group": {"_id": "$reason", "count": {"$sum": 1}}}
+    ]).to_list(None)
+    
+    return {
+        "pending": await db.push_queue.count_documents({"status": PushJobStatus.PENDING}),
+        "ready": await db.push_queue.count_documents({"status": PushJobStatus.PENDING, "next_attempt_at": {"$lte": now}}),
+        "processing": await db.push_queue.count_documents({"status": PushJobStatus.PROCESSING}),
+        "dead_letters": {r["_id"]: r["count"] for r in reasons},
+        "latency_ms": push_queue_worker.latency_summary()
+    }
+
+
+# Instância global do worker
+push_queue_worker = PushQueueWorker()
@@ -3,20 +3,157 @@
 SERVIÇO DE NOTIFICAÇÕES EM TEMPO REAL - CREDITOIMO
 ====================================================================
 Funções utilitárias para enviar notificações via WebSocket.
+
+Notificações emitidas para o mesmo utilizador dentro de uma janela curta
+(NOTIFICATION_COALESCE_WINDOW_MS) são agrupadas num único frame WebSocket
+ou numa única push notification com resumo.
 ====================================================================
 """
 
+import asyncio
 import logging
-from typing import Optional, List
+from typing import Optional, List, Dict, Callable, Awaitable
 from datetime import datetime, timezone
 import uuid
 
-from database import db
+from config import NOTIFICATION_COALESCE_WINDOW_MS
 from services.websocket_manager import manager, WSEventType, create_ws_message
 from services.push_notifications import send_push_notification
+from services.staff_directory import staff_directory
+from services.notification_inbox import notification_inbox, build_audience
 
 logger = logging.getLogger(__name__)
 
+# Número máximo de títulos listados no resumo de uma push agrupada
+PUSH_SUMMARY_MAX_LINES = 4
+
+
+class NotificationCoalescer:
+    """
+    Agrupa as notificações de cada utilizador emitidas dentro de uma janela.
+    
+    A primeira notificação de um utilizador abre a janela; as seguintes são
+    acumuladas e entregues em conjunto quando a janela fecha.
+    """
+    
+    def __init__(
+        self,
+        window_ms: int,
+        deliver: Callable[[str, List[dict]], Awaitable[None]]
+    ):
+        self.window = window_ms / 1000
+        self.deliver = deliver
+        self._pending: Dict[str, List[dict]] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+    
+    def _queue(self, user_id: str, notification: dict):
+        self._pending.setdefault(user_id, []).append(notification)
+        if user_id not in self._tasks:
+            self._tasks[user_id] = asyncio.create_task(self._flush_later(user_id))
+    
+    async def add(self, user_id: str, notification: dict):
+        """Acumular uma notificação (ou entregar já, se a janela for 0)."""
+        if self.window <= 0:
+            await self.deliver(user_id, [notification])
+            return
+        
+        self._queue(user_id, notification)
+    
+    async def add_many(self, notifications: List[dict]):
+        """Acumular notificações de vários destinatários (campo `user_id`) de uma só vez."""
+        if self.window <= 0:
+            await asyncio.gather(*(self.deliver(n["user_id"], [n]) for n in notifications))
+            return
+        
+        for notification in notifications:
+            self._queue(notification["user_id"], notification)
+    
+    async def _flush_later(self, user_id: str):
+        await asyncio.sleep(self.window)
+        self._tasks.pop(user_id, None)
+        await self.flush(user_id)
+    
+    async def flush(self, user_id: str):
+        """Entregar as notificações pendentes de um utilizador."""
+        notifications = self._pending.pop(user_id, None)
+        if not notifications:
+            return
+        
+        try:
+            await self.deliver(user_id, notifications)
+        except Exception as e:
+            logger.error(f"Erro ao entregar notificações agrupadas para {user_id}: {e}")
+    
+    async def flush_all(self):
+        """Entregar imediatamente tudo o que está pendente (ex.: no shutdown)."""
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
+        
+        for user_id in list(self._pending.keys()):
+            await self.flush(user_id)
+
+
+def _build_push_summary(notifications: List[dict]) -> dict:
+    """Construir título, corpo e URL de uma push que resume várias notificações."""
+    lines = [f"• {n.get('title') or n.get('message', '')}" for n in notifications[:PUSH_SUMMARY_MAX_LINES]]
+    remaining = len(notifications) - PUSH_SUMMARY_MAX_LINES
+    if remaining > 0:
+        lines.append(f"… e mais {remaining}")
+    
+    links = {n.get("link") for n in notifications}
+    process_ids = [n["process_id"] for n in notifications if n.get("process_id")]
+    
+    return {
+        "title": f"{len(notifications)} novas notificações",
+        "body": "\n".join(lines),
+        "url": links.pop() if len(links) == 1 and None not in links else "/",
+        "data": {"process_ids": list(dict.fromkeys(process_ids))} if process_ids else None
+    }
+
+
+async def deliver_notifications(user_id: str, notifications: List[dict]):
+    """
+    Entregar notificações a um utilizador: via WebSocket se estiver conectado,
+    caso contrário via push notification.
+    """
+    if manager.is_user_connected(user_id):
+        if len(notifications) == 1:
+            message = create_ws_message(WSEventType.NEW_NOTIFICATION, notifications[0])
+        else:
+            message = create_ws_message(
+                WSEventType.NOTIFICATION_BATCH,
+                {"notifications": notifications, "count": len(notifications)}
+            )
+        await manager.send_personal_message(message, user_id)
+        logger.info(f"{len(notifications)} notificação(ões) enviada(s) via WebSocket para {user_id}")
+        return
+    
+    logger.info(f"Utilizador {user_id} não conectado. Notificação guardada na DB.")
+    
+    # Enviar push notification quando o utilizador não está conectado via WebSocket
+    if len(notifications) == 1:
+        notification = notifications[0]
+        process_id = notification.get("process_id")
+        await send_push_notification(
+            user_id=user_id,
+            title=notification["title"],
+            body=notification["message"],
+            url=notification.get("link") or "/",
+            data={"process_id": process_id} if process_id else None
+        )
+    else:
+        await send_push_notification(user_id=user_id, **_build_push_summary(notifications))
+
+
+# Instância global do agrupador de notificações
+notification_coalescer = NotificationCoalescer(NOTIFICATION_COALESCE_WINDOW_MS, deliver_notifications)
+
+
+async def flush_pending_notifications():
+    """Entregar notificações ainda retidas na janela de agrupamento."""
+    await notification_coalescer.flush_all()
+
 
 async def send_realtime_notification(
     user_id: str,
@@ -30,6 +167,9 @@ async def send_realtime_notification(
     """
     Enviar notificação em tempo real para um utilizador.
     
+    A notificação é guardada de imediato; a entrega (WebSocket ou push) é
+    agrupada com outras do mesmo utilizador emitidas na mesma janela.
+    
     Args:
         user_id: ID do utilizador destinatário
         title: Título da notificação
@@ -56,31 +196,75 @@ async def send_realtime_notification(
     
     # Guardar na base de dados
     if save_to_db:
-        await db.notifications.insert_one({**notification, "_id": notification["id"]})
-        # Remover _id para resposta
-        notification.pop("_id", None)
+        await notification_inbox.insert([
+            {**notification, "_id": notification["id"], "audience": build_audience([user_id])}
+        ])
     
-    # Enviar via WebSocket se o utilizador estiver conectado
-    if manager.is_user_connected(user_id):
-        await manager.send_personal_message(
-            create_ws_message(WSEventType.NEW_NOTIFICATION, notification),
-            user_id
-        )
-        logger.info(f"Notificação enviada via WebSocket para {user_id}")
-    else:
-        logger.info(f"Utilizador {user_id} não conectado. Notificação guardada na DB.")
-        # Enviar push notification quando o utilizador não está conectado via WebSocket
-        await send_push_notification(
-            user_id=user_id,
-            title=title,
-            body=message,
-            url=link or "/",
-            data={"process_id": process_id} if process_id else None
-        )
+    # Enviar via WebSocket (ou push) após a janela de agrupamento
+    await notification_coalescer.add(user_id, notification)
     
     return notification
 
 
+async def send_bulk_realtime_notification(
+    user_ids: List[str],
+    title: str,
+    message: str,
+    notification_type: str = "info",
+    link: Optional[str] = None,
+    process_id: Optional[str] = None,
+    save_to_db: bool = True
+) -> List[dict]:
+    """
+    Enviar a mesma notificação em tempo real para vários utilizadores.
+    
+    Todas as notificações são guardadas com um único `insert_many` e
+    entregues ao agrupador num só lote.
+    
+    Args:
+        user_ids: IDs dos utilizadores destinatários (duplicados são ignorados)
+        title: Título da notificação
+        message: Mensagem da notificação
+        notification_type: Tipo (info, warning, error, success)
+        link: Link opcional para redireccionamento
+        process_id: ID do processo relacionado (opcional)
+        save_to_db: Se deve guardar na base de dados
+    
+    Returns:
+        Notificações criadas
+    """
+    user_ids = list(dict.fromkeys(user_id for user_id in user_ids if user_id))
+    if not user_ids:
+        return []
+    
+    created_at = datetime.now(timezone.utc).isoformat()
+    notifications = [
+        {
+            "id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "title": title,
+            "message": message,
+            "type": notification_type,
+            "link": link,
+            "process_id": process_id,
+            "read": False,
+            "created_at": created_at
+        }
+        for user_id in user_ids
+    ]
+    
+    # Guardar na base de dados (uma única escrita)
+    if save_to_db:
+        await notification_inbox.insert([
+            {**notification, "_id": notification["id"], "audience": build_audience([notification["user_id"]])}
+            for notification in notifications
+        ])
+    
+    await notification_coalescer.add_many(notifications)
+    
+    return notifications
+
+
 async def broadcast_notification(
     title: str,
     message: str,
@@ -106,29 +290,23 @@ async def broadcast_notification(
         Número de utilizadores notificados
     """
     exclude_users = exclude_users or []
-    count = 0
     
     # Obter utilizadores alvo
-    query = {"is_active": {"$ne": False}}
     if roles:
-        query["role"] = {"$in": roles}
-    
-    users = await db.users.find(query, {"id": 1, "_id": 0}).to_list(1000)
-    
-    for user in users:
-        user_id = user["id"]
-        if user_id not in exclude_users:
-            await send_realtime_notification(
-                user_id=user_id,
-                title=title,
-                message=message,
-                notification_type=notification_type,
-                link=link,
-                save_to_db=save_to_db
-            )
-            count += 1
-    
-    return count
+        users = await staff_directory.get_users_by_roles(roles)
+    else:
+        users = await staff_directory.get_all_users()
+    
+    notifications = await send_bulk_realtime_notification(
+        user_ids=[user["id"] for user in users if user["id"] not in exclude_users],
+        title=title,
+        message=message,
+        notification_type=notification_type,
+        link=link,
+        save_to_db=save_to_db
+    )
+    
+    return len(notifications)
 
 
 async def notify_process_update(
@@ -179,24 +357,20 @@ async def notify_process_update(
         users_to_notify.add(process["mediador_id"])
     
     # Também notificar admins e CEOs
-    admins = await db.users.find(
-        {"role": {"$in": ["admin", "ceo"]}, "is_active": {"$ne": False}},
-        {"id": 1, "_id": 0}
-    ).to_list(100)
+    admins = await staff_directory.get_users_by_roles(["admin", "ceo"])
     
     for admin in admins:
         users_to_notify.add(admin["id"])
     
     # Enviar notificações
-    for user_id in users_to_notify:
-        await send_realtime_notification(
-            user_id=user_id,
-            title=title,
-            message=message,
-            notification_type="info",
-            link=f"/processos/{process_id}",
-            process_id=process_id
-        )
+    await send_bulk_realtime_notification(
+        user_ids=list(users_to_notify),
+        title=title,
+        message=message,
+        notification_type="info",
+        link=f"/processos/{process_id}",
+        process_id=process_id
+    )
     
     # Broadcast evento WebSocket
     await manager.broadcast(create_ws_message(
@@ -228,15 +402,15 @@ async def notify_deadline_reminder(deadline: dict, minutes_before: int = 30):
     title = f"⏰ Lembrete: {deadline.get('title', 'Evento')}"
     message = f"O evento começa em {minutes_before} minutos"
     
+    await send_bulk_realtime_notification(
+        user_ids=participants,
+        title=title,
+        message=message,
+        notification_type="warning",
+        link="/admin?tab=calendar"
+    )
+    
     for user_id in participants:
-        await send_realtime_notification(
-            user_id=user_id,
-            title=title,
-            message=message,
-            notification_type="warning",
-            link="/admin?tab=calendar"
-        )
-        
         # Enviar evento específico via WebSocket
         if manager.is_user_connected(user_id):
             await manager.send_personal_message(
@@ -253,6 +427,67 @@ async def notify_deadline_reminder(deadline: dict, minutes_before: int = 30):
             )
 
 
+async def notify_new_emails(process: dict, emails: List[dict]):
+    """
+    Avisar a equipa atribuída ao processo de emails novos no histórico.
+    
+    A escuta corre só na réplica líder, que não vê os WebSockets dos outros
+    workers: o aviso é guardado como notificação (visível em qualquer
+    worker e entregue por push a quem não está ligado a este) e o evento
+    `email_received`, que actualiza o histórico aberto, segue para as
+    ligações deste worker.
+    
+    Args:
+        process: Dados do processo
+        emails: Documentos dos emails acabados de guardar
+    """
+    users_to_notify = {
+        process.get(field)
+        for field in ("consultor_id", "assigned_consultor_id", "mediador_id", "assigned_mediador_id")
+    }
+    users_to_notify.discard(None)
+    if not users_to_notify:
+        return
+    
+    client_name = process.get("client_name") or "Cliente"
+    if len(emails) == 1:
+        title = "📧 Novo email"
+        text = f"{client_name}: {emails[0].get('subject') or '(sem assunto)'}"
+    else:
+        title = f"📧 {len(emails)} novos emails"
+        text = f"Novos emails no processo de {client_name}"
+    await send_bulk_realtime_notification(
+        user_ids=list(users_to_notify),
+        title=title,
+        message=text,
+        notification_type="info",
+        link=f"/process/{process.get('id')}",
+        process_id=process.get("id")
+    )
+    
+    message = create_ws_message(
+        WSEventType.EMAIL_RECEIVED,
+        {
+            "process_id": process.get("id"),
+            "client_name": process.get("client_name"),
+            "count": len(emails),
+            "emails": [
+                {
+                    "id": em["id"],
+                    "subject": em.get("subject"),
+                    "from_email": em.get("from_email"),
+                    "direction": em.get("direction"),
+                    "sent_at": em.get("sent_at")
+                }
+                for em in emails
+            ]
+        }
+    )
+    for user_id in users_to_notify:
+        if manager.is_user_connected(user_id):
+            await manager.send_personal_message(message, user_id)
+
+
 async def notify_process_status_change(
     process: dict,
     old_status: str,
@@ -291,10 +526,7 @@ async def notify_process_status_change(
         users_to_notify.add(process["assigned_mediador_id"])
     
     # Também notificar admins, CEOs e diretores
-    admins = await db.users.find(
-        {"role": {"$in": ["admin", "ceo", "diretor"]}, "is_active": {"$ne": False}},
-        {"id": 1, "_id": 0}
-    ).to_list(100)
+    admins = await staff_directory.get_users_by_roles(["admin", "ceo", "diretor"])
     
     for admin in admins:
         users_to_notify.add(admin["id"])
@@ -303,15 +535,14 @@ async def notify_process_status_change(
     users_to_notify.discard(changed_by.get("id"))
     
     # Enviar notificações
-    for user_id in users_to_notify:
-        await send_realtime_notification(
-            user_id=user_id,
-            title="📋 Processo Atualizado",
-            message=message,
-            notification_type="process_status_change",
-            link=f"/process/{process_id}",
-            process_id=process_id,
-            save_to_db=True
-        )
+    await send_bulk_realtime_notification(
+        user_ids=list(users_to_notify),
+        title="📋 Processo Atualizado",
+        message=message,
+        notification_type="process_status_change",
+        link=f"/process/{process_id}",
+        process_id=process_id,
+        save_to_db=True
+    )
     
     logger.info(f"Notificação de mudança de estado enviada para {len(users_to_notify)} utilizadores")
@@ -7,17 +7,20 @@ Sistema de tarefas agendadas para execução diária.
 Tarefas incluídas:
 - Verificação de documentos a expirar
 - Verificação de prazos a aproximar-se
-- Limpeza de notificações antigas
+- Arquivo de notificações antigas
 - Geração de alertas automáticos
+- Resumos de notificações por email (horário e diário)
 
 Uso:
-    # Executar manualmente
+    # Executar manualmente (todas as tarefas, uma vez)
     python -m services.scheduled_tasks
     
     # Ou via cron (Linux) - executar diariamente às 8h:
     0 8 * * * cd /app/backend && python -m services.scheduled_tasks
     
-    # Ou iniciar como processo em background:
+    # Ou iniciar como processo em background, com cadência própria por
+    # tarefa (ver SCHEDULED_JOBS). Pode correr em várias réplicas: só a
+    # que detém o lease de líder executa as tarefas.
     python -m services.scheduled_tasks --daemon
 ====================================================================
 """
@@ -38,6 +41,16 @@ load_dotenv(ROOT_DIR / '.env')
 
 from motor.motor_asyncio import AsyncIOMotorClient
 
+from services.staff_directory import StaffDirectory
+from services.scheduler import JobScheduler
+from services.email import email_templates, is_smtp_configured
+from services.email_outbox import enqueue_email
+from services.email_digest import send_email_digests
+from services.email_sync import sync_all_mailboxes
+from models.auth import EmailDigestMode
+from services.notification_inbox import NotificationInbox, build_audience
+from services.date_fields import to_utc_datetime, run_date_fields_migration
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -45,6 +58,31 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Cadência de cada tarefa no modo daemon (cron no fuso SCHEDULER_TIMEZONE)
+# (nome, método, cron, intervalo em segundos, jitter em segundos)
+SCHEDULED_JOBS = [
+    ("expiring_documents", "check_expiring_documents", "0 8 * * *", None, 300),
+    ("upcoming_deadlines", "check_upcoming_deadlines", None, 3600, 60),
+    ("tasks_due_soon", "check_tasks_due_soon", "0 8,14 * * *", None, 300),
+    ("pre_approval_countdown", "check_pre_approval_countdown", "0 8 * * *", None, 300),
+    ("clients_waiting", "check_clients_waiting_too_long", "0 9 * * 1-5", None, 300),
+    ("monthly_document_reminder", "run_monthly_document_reminder", "0 9 1 * *", None, 600),
+    ("archive_notifications", "archive_old_notifications", "30 3 * * *", None, 600),
+    ("email_digest_hourly", "send_hourly_email_digests", "0 * * * *", None, 60),
+    ("email_digest_daily", "send_daily_email_digests", "0 18 * * *", None, 300),
+    ("email_mailbox_sync", "sync_email_mailboxes", "0 2 * * *", None, 600),
+]
+
+
+def dedupe_key(job: str, entity_id, user_id: str, bucket) -> str:
+    """
+    Chave determinística de uma notificação agendada.
+    
+    O `bucket` define a janela em que o alerta só pode sair uma vez
+    (p.ex. o dia, a data do prazo ou o patamar de dias em falta).
+    """
+    return f"{job}:{entity_id}:{user_id}:{bucket}"
+
 
 class ScheduledTasksService:
     """Serviço de tarefas agendadas."""
@@ -54,12 +92,19 @@ class ScheduledTasksService:
         self.db_name = os.environ.get('DB_NAME', 'test_database')
         self.client = None
         self.db = None
+        self.staff_directory = None
+        self.notification_inbox = None
     
     async def connect(self):
         """Conectar à base de dados."""
         self.client = AsyncIOMotorClient(self.mongo_url)
         self.db = self.client[self.db_name]
+        self.staff_directory = StaffDirectory(self.db)
+        self.notification_inbox = NotificationInbox(self.db, self.staff_directory)
         logger.info(f"Conectado à base de dados: {self.db_name}")
+        
+        # As verificações filtram pelas datas BSON (ver services/date_fields.py)
+        await run_date_fields_migration(self.db)
     
     async def disconnect(self):
         """Desconectar da base de dados."""
@@ -67,18 +112,25 @@ class ScheduledTasksService:
             self.client.close()
             logger.info("Desconectado da base de dados")
     
-    async def create_notification(
+    def build_notification(
         self,
         user_id: str,
         message: str,
         notification_type: str,
+        dedupe_key: str,
         process_id: str = None,
         client_name: str = None,
         link: str = None
-    ):
-        """Criar uma notificação na base de dados."""
-        notification = {
+    ) -> dict:
+        """
+        Preparar uma notificação agendada.
+        
+        A `dedupe_key` (índice único) garante que a mesma notificação não é
+        criada duas vezes, mesmo que a tarefa corra novamente.
+        """
+        return {
             "id": str(uuid.uuid4()),
+            "dedupe_key": dedupe_key,
             "user_id": user_id,
             "message": message,
             "type": notification_type,
@@ -86,11 +138,21 @@ class ScheduledTasksService:
             "client_name": client_name,
             "link": link,
             "read": False,
-            "created_at": datetime.now(timezone.utc).isoformat()
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "audience": build_audience([user_id])
         }
+    
+    async def create_notifications(self, notifications: List[dict]) -> int:
+        """
+        Guardar notificações num único insert, ignorando as que já existem
+        (mesma `dedupe_key`).
         
-        await self.db.notifications.insert_one(notification)
-        return notification
+        Returns:
+            Número de notificações novas
+        """
+        if not notifications:
+            return 0
+        return await self.notification_inbox.insert(notifications, ignore_duplicates=True)
     
     async def check_expiring_documents(self) -> int:
         """
@@ -102,57 +164,52 @@ class ScheduledTasksService:
         today = datetime.now(timezone.utc)
         warning_date = today + timedelta(days=7)
         
-        # Buscar processos com documentos
-        processes = await self.db.processes.find(
-            {"documents": {"$exists": True, "$ne": []}},
-            {"_id": 0}
-        ).to_list(1000)
+        # Apenas os processos (e, dentro deles, os documentos) a expirar na
+        # janela - índice em documents.expiry_at
+        in_window = {"$gte": today, "$lte": warning_date}
+        pipeline = [
+            {"$match": {"documents": {"$elemMatch": {"expiry_at": in_window}}}},
+            {"$project": {
+                "_id": 0, "id": 1, "client_name": 1, "consultor_id": 1, "mediador_id": 1,
+                "documents": {"$filter": {
+                    "input": "$documents",
+                    "as": "doc",
+                    "cond": {"$and": [
+                        {"$gte": ["$$doc.expiry_at", today]},
+                        {"$lte": ["$$doc.expiry_at", warning_date]}
+                    ]}
+                }}
+            }}
+        ]
         
-        notifications_created = 0
+        notifications = []
+        bucket = today.date().isoformat()
         
-        for process in processes:
-            documents = process.get("documents", [])
+        async for process in self.db.processes.aggregate(pipeline):
+            # Notificar consultor e mediador
+            users_to_notify = []
+            if process.get("consultor_id"):
+                users_to_notify.append(process["consultor_id"])
+            if process.get("mediador_id"):
+                users_to_notify.append(process["mediador_id"])
             
-            for doc in documents:
-                expiry_date_str = doc.get("expiry_date")
-                if not expiry_date_str:
-                    continue
+            for doc in process["documents"]:
+                days_until = (to_utc_datetime(doc["expiry_at"]) - today).days
+                document_key = f"{process.get('id')}/{doc.get('id') or doc.get('name')}"
                 
-                try:
-                    expiry_date = datetime.fromisoformat(expiry_date_str.replace('Z', '+00:00'))
-                except:
-                    continue
-                
-                # Verificar se expira nos próximos 7 dias
-                if today <= expiry_date <= warning_date:
-                    days_until = (expiry_date - today).days
-                    
-                    # Notificar consultor e mediador
-                    users_to_notify = []
-                    if process.get("consultor_id"):
-                        users_to_notify.append(process["consultor_id"])
-                    if process.get("mediador_id"):
-                        users_to_notify.append(process["mediador_id"])
-                    
-                    for user_id in users_to_notify:
-                        # Verificar se já existe notificação similar recente
-                        existing = await self.db.notifications.find_one({
-                            "user_id": user_id,
-                            "process_id": process.get("id"),
-                            "type": "document_expiry",
-                            "created_at": {"$gte": (today - timedelta(days=1)).isoformat()}
-                        })
-                        
-                        if not existing:
-                            await self.create_notification(
-                                user_id=user_id,
-                                message=f"Documento '{doc.get('name', 'Sem nome')}' expira em {days_until} dias",
-                                notification_type="document_expiry",
-                                process_id=process.get("id"),
-                                client_name=process.get("client_name"),
-                                link=f"/process/{process.get('id')}"
-                            )
-                            notifications_created += 1
+                for user_id in users_to_notify:
+                    # Um alerta por documento, utilizador e dia
+                    notifications.append(self.build_notification(
+                        user_id=user_id,
+                        message=f"Documento '{doc.get('name', 'Sem nome')}' expira em {days_until} dias",
+                        notification_type="document_expiry",
+                        dedupe_key=dedupe_key("document_expiry", document_key, user_id, bucket),
+                        process_id=process.get("id"),
+                        client_name=process.get("client_name"),
+                        link=f"/process/{process.get('id')}"
+                    ))
+        
+        notifications_created = await self.create_notifications(notifications)
         
         logger.info(f"Documentos a expirar: {notifications_created} notificações criadas")
         return notifications_created
@@ -175,29 +232,23 @@ class ScheduledTasksService:
             }
         }, {"_id": 0}).to_list(500)
         
-        notifications_created = 0
+        notifications = []
         
         for deadline in deadlines:
             participants = deadline.get("participants", [])
             
             for user_id in participants:
-                # Verificar se já existe notificação similar
-                existing = await self.db.notifications.find_one({
-                    "user_id": user_id,
-                    "type": "deadline_reminder",
-                    "message": {"$regex": deadline.get("title", "")},
-                    "created_at": {"$gte": (today - timedelta(hours=12)).isoformat()}
-                })
-                
-                if not existing:
-                    await self.create_notification(
-                        user_id=user_id,
-                        message=f"Lembrete: {deadline.get('title', 'Evento')} - amanhã",
-                        notification_type="deadline_reminder",
-                        process_id=deadline.get("process_id"),
-                        link="/admin?tab=calendar"
-                    )
-                    notifications_created += 1
+                # Um lembrete por prazo e utilizador
+                notifications.append(self.build_notification(
+                    user_id=user_id,
+                    message=f"Lembrete: {deadline.get('title', 'Evento')} - amanhã",
+                    notification_type="deadline_reminder",
+                    dedupe_key=dedupe_key("deadline_reminder", deadline.get("id"), user_id, deadline.get("date")),
+                    process_id=deadline.get("process_id"),
+                    link="/admin?tab=calendar"
+                ))
+        
+        notifications_created = await self.create_notifications(notifications)
         
         logger.info(f"Prazos próximos: {notifications_created} notificações criadas")
         return notifications_created
@@ -216,26 +267,20 @@ class ScheduledTasksService:
         logger.info("A verificar tarefas com prazo próximo...")
         
         today = datetime.now(timezone.utc)
+        start_of_today = today.replace(hour=0, minute=0, second=0, microsecond=0)
         
-        # Buscar tarefas não concluídas com due_date
-        tasks = await self.db.tasks.find({
+        # Apenas tarefas em atraso ou a vencer nos próximos 3 dias
+        # (índice em completed + due_at)
+        tasks = self.db.tasks.find({
             "completed": False,
-            "due_date": {"$exists": True, "$ne": None}
-        }, {"_id": 0}).to_list(500)
+            "due_at": {"$lt": start_of_today + timedelta(days=4)}
+        }, {"_id": 0, "id": 1, "title": 1, "process_id": 1, "assigned_to": 1, "due_at": 1})
         
-        notifications_created = 0
+        notifications = []
+        bucket = today.date().isoformat()
         
-        for task in tasks:
-            due_date_str = task.get("due_date")
-            if not due_date_str:
-                continue
-            
-            try:
-                due_date = datetime.fromisoformat(due_date_str.replace('Z', '+00:00'))
-            except (ValueError, TypeError):
-                continue
-            
-            days_until_due = (due_date.date() - today.date()).days
+        async for task in tasks:
+            days_until_due = (to_utc_datetime(task["due_at"]).date() - today.date()).days
             
             # Definir mensagem baseada nos dias
             if days_until_due < 0:
@@ -259,26 +304,20 @@ class ScheduledTasksService:
                 continue
             
             # Notificar todos os utilizadores atribuídos
+            link = f"/process/{task['process_id']}" if task.get("process_id") else "/staff?tab=tasks"
+            
             for user_id in task.get("assigned_to", []):
-                # Verificar se já existe notificação similar nas últimas 12 horas
-                existing = await self.db.notifications.find_one({
-                    "user_id": user_id,
-                    "type": notification_type,
-                    "message": {"$regex": task.get("id", "")},
-                    "created_at": {"$gte": (today - timedelta(hours=12)).isoformat()}
-                })
-                
-                if not existing:
-                    link = f"/process/{task['process_id']}" if task.get("process_id") else "/staff?tab=tasks"
-                    
-                    await self.create_notification(
-                        user_id=user_id,
-                        message=message,
-                        notification_type=notification_type,
-                        process_id=task.get("process_id"),
-                        link=link
-                    )
-                    notifications_created += 1
+                # Um alerta por tarefa, utilizador e dia
+                notifications.append(self.build_notification(
+                    user_id=user_id,
+                    message=message,
+                    notification_type=notification_type,
+                    dedupe_key=dedupe_key(notification_type, task.get("id"), user_id, bucket),
+                    process_id=task.get("process_id"),
+                    link=link
+                ))
+        
+        notifications_created = await self.create_notifications(notifications)
         
         logger.info(f"Tarefas com prazo próximo: {notifications_created} notificações criadas")
         return notifications_created
@@ -287,34 +326,38 @@ class ScheduledTasksService:
         """
         Verificar processos com pré-aprovação a expirar (90 dias).
         Alertar quando faltam 30, 15, 7 e 3 dias.
+        
+        Cada patamar é alertado uma vez, mesmo que a tarefa não tenha corrido
+        no dia exacto (p.ex. faltam 14 dias e o alerta dos 15 ainda não saiu).
         """
         logger.info("A verificar countdowns de pré-aprovação...")
         
         today = datetime.now(timezone.utc)
         alert_days = [30, 15, 7, 3]
         
-        # Buscar processos com data de pré-aprovação
-        processes = await self.db.processes.find({
-            "credit_data.bank_approval_date": {"$exists": True, "$ne": None}
-        }, {"_id": 0}).to_list(1000)
+        # Apenas pré-aprovações que expiram dentro do maior patamar
+        # (0 <= dias restantes <= 30) - índice em credit_data.bank_approval_at
+        earliest_approval = today - timedelta(days=90)
+        processes = self.db.processes.find({
+            "credit_data.bank_approval_at": {
+                "$gte": earliest_approval,
+                "$lt": earliest_approval + timedelta(days=max(alert_days) + 1)
+            }
+        }, {"_id": 0, "id": 1, "client_name": 1, "consultor_id": 1, "mediador_id": 1, "credit_data.bank_approval_at": 1})
         
-        notifications_created = 0
+        notifications = []
         
-        for process in processes:
-            approval_date_str = process.get("credit_data", {}).get("bank_approval_date")
-            if not approval_date_str:
-                continue
-            
-            try:
-                approval_date = datetime.fromisoformat(approval_date_str.replace('Z', '+00:00'))
-            except:
-                continue
+        async for process in processes:
+            approval_date = to_utc_datetime(process["credit_data"]["bank_approval_at"])
             
             # Calcular dias restantes (90 dias desde aprovação)
             expiry_date = approval_date + timedelta(days=90)
             days_remaining = (expiry_date - today).days
             
-            if days_remaining in alert_days:
+            # Patamar mais próximo ainda não ultrapassado
+            threshold = next((d for d in sorted(alert_days) if 0 <= days_remaining <= d), None)
+            
+            if threshold is not None:
                 users_to_notify = []
                 if process.get("consultor_id"):
                     users_to_notify.append(process["consultor_id"])
@@ -322,42 +365,40 @@ class ScheduledTasksService:
                     users_to_notify.append(process["mediador_id"])
                 
                 for user_id in users_to_notify:
-                    existing = await self.db.notifications.find_one({
-                        "user_id": user_id,
-                        "process_id": process.get("id"),
-                        "type": "pre_approval_countdown",
-                        "created_at": {"$gte": (today - timedelta(days=1)).isoformat()}
-                    })
-                    
-                    if not existing:
-                        await self.create_notification(
-                            user_id=user_id,
-                            message=f"⏰ Pré-aprovação expira em {days_remaining} dias!",
-                            notification_type="pre_approval_countdown",
-                            process_id=process.get("id"),
-                            client_name=process.get("client_name"),
-                            link=f"/process/{process.get('id')}"
-                        )
-                        notifications_created += 1
+                    notifications.append(self.build_notification(
+                        user_id=user_id,
+                        message=f"⏰ Pré-aprovação expira em {days_remaining} dias!",
+                        notification_type="pre_approval_countdown",
+                        dedupe_key=dedupe_key(
+                            "pre_approval_countdown", process.get("id"), user_id,
+                            f"{expiry_date.date().isoformat()}/{threshold}"
+                        ),
+                        process_id=process.get("id"),
+                        client_name=process.get("client_name"),
+                        link=f"/process/{process.get('id')}"
+                    ))
+        
+        notifications_created = await self.create_notifications(notifications)
         
         logger.info(f"Countdown pré-aprovação: {notifications_created} notificações criadas")
         return notifications_created
     
-    async def cleanup_old_notifications(self, days: int = 30) -> int:
+    async def archive_old_notifications(self) -> int:
         """
-        Limpar notificações lidas com mais de X dias.
+        Mover para o arquivo, em lotes, as notificações fora da janela quente
+        (lidas há mais de 30 dias ou por ler há mais de 90, por defeito) e
+        recalcular os contadores de notificações por ler.
         """
-        logger.info(f"A limpar notificações com mais de {days} dias...")
+        logger.info("A arquivar notificações antigas...")
         
-        cutoff_date = (datetime.now(timezone.utc) - timedelta(days=days)).isoformat()
+        archived = await self.notification_inbox.archive_expired()
         
-        result = await self.db.notifications.delete_many({
-            "read": True,
-            "created_at": {"$lt": cutoff_date}
-        })
+        # Reconciliar os contadores: notificações removidas pelo TTL da
+        # colecção quente não passam por archive_expired
+        await self.notification_inbox.reset_counters()
         
-        logger.info(f"Notificações removidas: {result.deleted_count}")
-        return result.deleted_count
+        logger.info(f"Notificações arquivadas: {archived}")
+        return archived
     
     async def check_clients_waiting_too_long(self, days: int = 15) -> int:
         """
@@ -369,45 +410,39 @@ class ScheduledTasksService:
         today = datetime.now(timezone.utc)
         cutoff_date = (today - timedelta(days=days)).isoformat()
         
-        # Buscar processos em estado "clientes_espera" há muito tempo
-        processes = await self.db.processes.find({
+        # Contar processos em estado "clientes_espera" há muito tempo
+        waiting = await self.db.processes.count_documents({
             "status": "clientes_espera",
             "created_at": {"$lte": cutoff_date}
-        }, {"_id": 0}).to_list(500)
+        })
         
-        if not processes:
+        if not waiting:
             logger.info("Nenhum cliente em espera há muito tempo")
             return 0
         
         # Obter CEO e Diretores
-        managers = await self.db.users.find({
-            "role": {"$in": ["ceo", "diretor", "admin"]},
-            "is_active": {"$ne": False}
-        }, {"_id": 0, "id": 1, "name": 1}).to_list(50)
-        
-        notifications_created = 0
-        
-        for manager in managers:
-            # Verificar se já enviou notificação hoje
-            existing = await self.db.notifications.find_one({
-                "user_id": manager["id"],
-                "type": "clients_waiting",
-                "created_at": {"$gte": (today - timedelta(hours=24)).isoformat()}
-            })
-            
-            if not existing:
-                await self.create_notification(
-                    user_id=manager["id"],
-                    message=f"⚠️ {len(processes)} cliente(s) em espera há mais de {days} dias. Requer atenção!",
-                    notification_type="clients_waiting",
-                    link="/admin?tab=overview"
-                )
-                notifications_created += 1
-        
-        logger.info(f"Clientes em espera: {notifications_created} notificações criadas para {len(processes)} clientes")
+        managers = await self.staff_directory.get_users_by_roles(["ceo", "diretor", "admin"])
+        
+        # Um alerta por gestor e dia
+        notifications_created = await self.create_notifications([
+            self.build_notification(
+                user_id=manager["id"],
+                message=f"⚠️ {waiting} cliente(s) em espera há mais de {days} dias. Requer atenção!",
+                notification_type="clients_waiting",
+                dedupe_key=dedupe_key("clients_waiting", "all", manager["id"], today.date().isoformat()),
+                link="/admin?tab=overview"
+            )
+            for manager in managers
+        ])
+        
+        logger.info(f"Clientes em espera: {notifications_created} notificações criadas para {waiting} clientes")
         return notifications_created
     
-    async def send_monthly_document_reminder(self) -> int:
+    async def run_monthly_document_reminder(self) -> int:
+        """Lembrete mensal agendado (pode correr após o dia 1 em caso de atraso)."""
+        return await self.send_monthly_document_reminder(check_day=False)
+    
+    async def send_monthly_document_reminder(self, check_day: bool = True) -> int:
         """
         No 1º dia de cada mês, enviar alerta para consultores e intermediários
         para pedirem recibo e extrato de conta ao cliente.
@@ -416,7 +451,7 @@ class ScheduledTasksService:
         today = datetime.now(timezone.utc)
         
         # Verificar se é o 1º dia do mês
-        if today.day != 1:
+        if check_day and today.day != 1:
             logger.info("Não é o 1º dia do mês - ignorando alerta mensal")
             return 0
         
@@ -449,7 +484,9 @@ class ScheduledTasksService:
             "status": {"$in": active_statuses}
         }, {"_id": 0}).to_list(1000)
         
-        notifications_created = 0
+        notifications = []
+        email_recipients = []
+        month_bucket = f"{prev_year}-{prev_month:02d}"
         
         for process in processes:
             users_to_notify = []
@@ -469,114 +506,69 @@ class ScheduledTasksService:
             client_name = process.get("client_name", "Cliente")
             
             for user_id in set(users_to_notify):
-                await self.create_notification(
+                notifications.append(self.build_notification(
                     user_id=user_id,
                     message=f"📄 Pedir recibo de vencimento e extrato bancário de {prev_month_name} ao cliente {client_name}",
                     notification_type="monthly_document_reminder",
+                    dedupe_key=dedupe_key("monthly_document_reminder", process.get("id"), user_id, month_bucket),
                     process_id=process.get("id"),
                     client_name=client_name,
                     link=f"/process/{process.get('id')}"
-                )
-                notifications_created += 1
+                ))
             
-            # Enviar email ao cliente
-            client_email = process.get("client_email")
-            if client_email:
-                try:
-                    await self.send_monthly_reminder_email(
-                        to_email=client_email,
-                        client_name=client_name,
-                        month_name=prev_month_name,
-                        year=prev_year
-                    )
-                except Exception as e:
-                    logger.error(f"Erro ao enviar email para {client_email}: {e}")
-        
-        logger.info(f"Lembretes mensais: {notifications_created} notificações criadas")
+            # Email ao cliente (renderizado e colocado no outbox no fim)
+            if process.get("client_email"):
+                email_recipients.append({
+                    "to": process["client_email"], "client_name": client_name, "process_id": process.get("id")
+                })
+        
+        notifications_created = await self.create_notifications(notifications)
+        
+        emails_queued = await self.queue_monthly_reminder_emails(email_recipients, prev_month_name, prev_year, month_bucket)
+        
+        logger.info(
+            f"Lembretes mensais: {notifications_created} notificações criadas, "
+            f"{emails_queued}/{len(email_recipients)} emails no outbox"
+        )
         return notifications_created
     
-    async def send_monthly_reminder_email(
-        self, 
-        to_email: str, 
-        client_name: str, 
-        month_name: str, 
-        year: int
-    ):
-        """Enviar email ao cliente a pedir documentos mensais."""
-        import smtplib
-        from email.mime.text import MIMEText
-        from email.mime.multipart import MIMEMultipart
-        
-        smtp_server = os.environ.get('SMTP_SERVER')
-        smtp_port = int(os.environ.get('SMTP_PORT', 465))
-        smtp_email = os.environ.get('SMTP_EMAIL')
-        smtp_password = os.environ.get('SMTP_PASSWORD')
-        
-        if not all([smtp_server, smtp_email, smtp_password]):
-            logger.warning("SMTP não configurado - email não enviado")
-            return
-        
-        subject = f"Documentação Mensal - {month_name} {year}"
-        
-        html_content = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="UTF-8">
-            <style>
-                body {{ font-family: Arial, sans-serif; line-height: 1.6; color: #333; }}
-                .container {{ max-width: 600px; margin: 0 auto; padding: 20px; }}
-                .header {{ background: #1e3a5f; color: white; padding: 20px; text-align: center; }}
-                .content {{ padding: 20px; background: #f9f9f9; }}
-                .docs-list {{ background: white; padding: 15px; border-radius: 5px; margin: 15px 0; }}
-                .footer {{ text-align: center; padding: 20px; font-size: 12px; color: #666; }}
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <div class="header">
-                    <h1>Power Real Estate & Precision Crédito</h1>
-                </div>
-                <div class="content">
-                    <p>Exmo(a). Sr(a). <strong>{client_name}</strong>,</p>
-                    
-                    <p>Para manter o seu processo de crédito atualizado, solicitamos o envio dos seguintes documentos referentes ao mês de <strong>{month_name} de {year}</strong>:</p>
-                    
-                    <div class="docs-list">
-                        <h3>📄 Documentos Necessários:</h3>
-                        <ul>
-                            <li><strong>Recibo de Vencimento</strong> - Mês de {month_name}</li>
-                            <li><strong>Extrato Bancário</strong> - Mês de {month_name}</li>
-                        </ul>
-                    </div>
-                    
-                    <p>Por favor, envie estes documentos assim que possível para que possamos dar continuidade ao seu processo.</p>
-                    
-                    <p>Pode enviar os documentos em resposta a este email ou através do seu consultor/intermediário.</p>
-                    
-                    <p>Com os melhores cumprimentos,<br>
-                    <strong>Equipa Power Real Estate & Precision Crédito</strong></p>
-                </div>
-                <div class="footer">
-                    <p>Este email foi enviado automaticamente. Por favor não responda diretamente.</p>
-                    <p>Em caso de dúvidas, contacte o seu consultor ou intermediário.</p>
-                </div>
-            </div>
-        </body>
-        </html>
+    async def queue_monthly_reminder_emails(self, recipients: list, month_name: str, year: int, month_bucket: str) -> int:
         """
+        Colocar os emails do lembrete mensal no outbox (ritmo por fornecedor,
+        retry e estado de entrega ficam a cargo do worker). A chave por
+        processo e mês evita repetir o email se a tarefa voltar a correr.
         
-        msg = MIMEMultipart('alternative')
-        msg['Subject'] = subject
-        msg['From'] = smtp_email
-        msg['To'] = to_email
-        msg.attach(MIMEText(html_content, 'html'))
-        
-        with smtplib.SMTP_SSL(smtp_server, smtp_port) as server:
-            server.login(smtp_email, smtp_password)
-            server.sendmail(smtp_email, to_email, msg.as_string())
+        Returns:
+            Número de emails novos no outbox
+        """
+        if not recipients:
+            return 0
+        if not is_smtp_configured():
+            logger.warning(f"SMTP não configurado - {len(recipients)} emails não enviados")
+            return 0
         
-        logger.info(f"Email mensal enviado para {to_email}")
+        rendered = email_templates.render_many("monthly_document_reminder", recipients, month_name=month_name, year=year)
+        queued = 0
+        for recipient, email in zip(recipients, rendered):
+            queued += await enqueue_email(
+                recipient["to"], email.subject, email.text, email.html,
+                idempotency_key=f"monthly_reminder:{recipient['process_id']}:{month_bucket}",
+                database=self.db
+            )
+        return queued
+    
+    async def send_hourly_email_digests(self) -> int:
+        """Resumo horário de notificações para o staff que o escolheu."""
+        return await send_email_digests(EmailDigestMode.HOURLY, self.db)
+    
+    async def send_daily_email_digests(self) -> int:
+        """Resumo diário de notificações para o staff que o escolheu."""
+        return await send_email_digests(EmailDigestMode.DAILY, self.db)
+    
+    async def sync_email_mailboxes(self) -> int:
+        """Sincronização nocturna das caixas de email para todos os processos activos."""
+        result = await sync_all_mailboxes(database=self.db)
+        return result.get("new_imported", 0)
     
     async def run_all_tasks(self):
         """Executar todas as tarefas agendadas."""
@@ -595,7 +587,9 @@ class ScheduledTasksService:
             countdown_count = await self.check_pre_approval_countdown()
             waiting_count = await self.check_clients_waiting_too_long()
             monthly_count = await self.send_monthly_document_reminder()
-            cleanup_count = await self.cleanup_old_notifications()
+            archived_count = await self.archive_old_notifications()
+            digest_count = await self.send_hourly_email_digests() + await self.send_daily_email_digests()
+            synced_count = await self.sync_email_mailboxes()
             
             logger.info("=" * 50)
             logger.info("RESUMO DAS TAREFAS")
@@ -605,9 +599,11 @@ class ScheduledTasksService:
             logger.info(f"- Alertas de countdown: {countdown_count}")
             logger.info(f"- Alertas clientes em espera: {waiting_count}")
             logger.info(f"- Lembretes mensais: {monthly_count}")
-            logger.info(f"- Notificações limpas: {cleanup_count}")
+            logger.info(f"- Notificações arquivadas: {archived_count}")
+            logger.info(f"- Resumos de email: {digest_count}")
+            logger.info(f"- Emails sincronizados: {synced_count}")
             logger.info("=" * 50)
-            
+        
         except Exception as e:
             logger.error(f"Erro nas tarefas agendadas: {e}")
             raise
@@ -615,36 +611,50 @@ class ScheduledTasksService:
             await self.disconnect()
 
 
-async def run_daemon(interval_hours: int = 24):
+def build_scheduler(service: ScheduledTasksService) -> JobScheduler:
+    """Registar as tarefas de SCHEDULED_JOBS num agendador."""
+    scheduler = JobScheduler(service.db, name="scheduled_tasks")
+    
+    for name, method, cron, every, jitter in SCHEDULED_JOBS:
+        scheduler.add_job(name, getattr(service, method), cron=cron, every=every, jitter=jitter)
+    
+    return scheduler
+
+
+async def run_daemon():
     """
-    Executar tarefas em loop (modo daemon).
-    Por defeito, executa a cada 24 horas.
+    Executar tarefas em modo daemon, cada uma com a sua cadência.
+    
+    Tarefas em atraso (daemon parado ou sem líder) são executadas uma vez
+    ao arrancar. Tarefas independentes correm em concorrência.
     """
     service = ScheduledTasksService()
+    await service.connect()
     
-    while True:
-        try:
-            await service.run_all_tasks()
-        except Exception as e:
-            logger.error(f"Erro no daemon: {e}")
-        
-        # Aguardar próxima execução
-        next_run = datetime.now() + timedelta(hours=interval_hours)
-        logger.info(f"Próxima execução: {next_run.strftime('%Y-%m-%d %H:%M:%S')}")
-        await asyncio.sleep(interval_hours * 3600)
+    scheduler = build_scheduler(service)
+    await scheduler.ensure_indexes()
+    scheduler.start()
+    
+    for job in scheduler.jobs.values():
+        logger.info(f"Tarefa registada: {job.name} ({job.schedule!r})")
+    
+    try:
+        await scheduler.wait()
+    finally:
+        await scheduler.stop()
+        await service.disconnect()
 
 
 async def main():
     """Função principal."""
     parser = argparse.ArgumentParser(description='CreditoIMO - Tarefas Agendadas')
-    parser.add_argument('--daemon', action='store_true', help='Executar em modo daemon (loop contínuo)')
-    parser.add_argument('--interval', type=int, default=24, help='Intervalo em horas (para daemon)')
+    parser.add_argument('--daemon', action='store_true', help='Executar em modo daemon (agendador por tarefa)')
     
     args = parser.parse_args()
     
     if args.daemon:
         logger.info("Iniciando em modo daemon...")
-        await run_daemon(args.interval)
+        await run_daemon()
     else:
         service = ScheduledTasksService()
         await service.run_all_tasks()
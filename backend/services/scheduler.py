@@ -0,0 +1,429 @@
+"""
+====================================================================
+AGENDADOR DE TAREFAS - CREDITOIMO
+====================================================================
+Agendador em processo para tarefas periódicas, partilhado entre réplicas.
+
+Funcionalidades:
+- Cadência por tarefa: expressão cron (5 campos) ou intervalo fixo
+- Jitter aleatório por execução
+- Recuperação de execuções perdidas (catch-up) a partir do estado em MongoDB
+- Lease de líder em MongoDB: só uma réplica executa as tarefas
+- Tarefas independentes executadas em concorrência
+- Histórico de execuções e duração por tarefa (`scheduler_runs`)
+====================================================================
+"""
+
+import asyncio
+import logging
+import os
+import random
+import socket
+import time
+import uuid
+from datetime import datetime, timezone, timedelta
+from typing import Optional, Callable, Awaitable, Dict, List, Set
+from zoneinfo import ZoneInfo
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_TIMEZONE = os.environ.get("SCHEDULER_TIMEZONE", "Europe/Lisbon")
+SCHEDULER_LEASE_SECONDS = int(os.environ.get("SCHEDULER_LEASE_SECONDS", "60"))
+SCHEDULER_HISTORY_DAYS = int(os.environ.get("SCHEDULER_HISTORY_DAYS", "30"))
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _as_utc(value: datetime) -> datetime:
+    """O Motor devolve datas sem timezone (UTC); normalizar para comparação."""
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+# ====================================================================
+# CADÊNCIAS
+# ====================================================================
+
+class CronSchedule:
+    """
+    Expressão cron de 5 campos (minuto hora dia mês dia-da-semana).
+    
+    Suporta `*`, listas (`1,15`), intervalos (`1-5`) e passos (`*/15`).
+    Dia da semana: 0-6 com 0 = domingo (7 também é domingo). Como no cron,
+    quando dia do mês e dia da semana estão ambos restritos basta um coincidir.
+    """
+    
+    FIELD_RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+    
+    def __init__(self, expression: str, tz: str = SCHEDULER_TIMEZONE):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Expressão cron inválida: {expression!r}")
+        
+        self.expression = expression
+        self.tz = ZoneInfo(tz)
+        parsed = [self._parse_field(f, lo, hi) for f, (lo, hi) in zip(fields, self.FIELD_RANGES)]
+        self.minutes, self.hours, self.days, self.months, weekdays = parsed
+        self.weekdays = {d % 7 for d in weekdays}
+        self.day_restricted = fields[2] != "*"
+        self.weekday_restricted = fields[4] != "*"
+    
+    @staticmethod
+    def _parse_field(field: str, lo: int, hi: int) -> Set[int]:
+        values = set()
+        for part in field.split(","):
+            value_range, _, step = part.partition("/")
+            step = int(step) if step else 1
+            
+            if value_range == "*":
+                start, end = lo, hi
+            elif "-" in value_range:
+                start, end = (int(v) for v in value_range.split("-"))
+            else:
+                start = end = int(value_range)
+                if step > 1:
+                    end = hi
+            
+            if start < lo or end > hi or start > end or step < 1:
+                raise ValueError(f"Campo cron inválido: {field!r}")
+            values.update(range(start, end + 1, step))
+        return values
+    
+    def _day_matches(self, moment: datetime) -> bool:
+        day_ok = moment.day in self.days
+        # Python: segunda = 0; cron: domingo = 0
+        weekday_ok = (moment.weekday() + 1) % 7 in self.weekdays
+        
+        if self.day_restricted and self.weekday_restricted:
+            return day_ok or weekday_ok
+        return day_ok and weekday_ok
+    
+    def next_after(self, moment: datetime) -> datetime:
+        """Próxima data (UTC) estritamente posterior a `moment`."""
+        local = _as_utc(moment).astimezone(self.tz).replace(second=0, microsecond=0, tzinfo=None)
+        candidate = local + timedelta(minutes=1)
+        limit = candidate + timedelta(days=366 * 5)
+        
+        while candidate < limit:
+            if candidate.month not in self.months:
+                year, month = (candidate.year + 1, 1) if candidate.month == 12 else (candidate.year, candidate.month + 1)
+                candidate = candidate.replace(year=year, month=month, day=1, hour=0, minute=0)
+                continue
+            if not self._day_matches(candidate):
+                candidate = (candidate + timedelta(days=1)).replace(hour=0, minute=0)
+                continue
+            if candidate.hour not in self.hours:
+                candidate = (candidate + timedelta(hours=1)).replace(minute=0)
+                continue
+            if candidate.minute not in self.minutes:
+                candidate += timedelta(minutes=1)
+                continue
+            
+            return candidate.replace(tzinfo=self.tz).astimezone(timezone.utc)
+        
+        raise ValueError(f"Expressão cron sem ocorrências: {self.expression!r}")
+    
+    def __repr__(self):
+        return f"cron({self.expression})"
+
+
+class IntervalSchedule:
+    """Execução a cada N segundos."""
+    
+    def __init__(self, seconds: float):
+        if seconds <= 0:
+            raise ValueError("Intervalo tem de ser positivo")
+        self.seconds = seconds
+    
+    def next_after(self, moment: datetime) -> datetime:
+        return _as_utc(moment) + timedelta(seconds=self.seconds)
+    
+    def __repr__(self):
+        return f"every({self.seconds}s)"
+
+
+class ScheduledJob:
+    """Definição de uma tarefa agendada."""
+    
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[], Awaitable],
+        schedule,
+        jitter_seconds: float = 0,
+        catch_up: bool = True
+    ):
+        self.name = name
+        self.func = func
+        self.schedule = schedule
+        self.jitter_seconds = jitter_seconds
+        self.catch_up = catch_up
+
+
+# ====================================================================
+# LEASE DE LÍDER
+# ====================================================================
+
+class LeaderLease:
+    """
+    Lease com expiração guardado em `scheduler_leases`.
+    
+    Só o dono pode renovar; qualquer réplica pode adquirir um lease expirado.
+    """
+    
+    def __init__(self, database, name: str, ttl_seconds: int = SCHEDULER_LEASE_SECONDS, owner: Optional[str] = None):
+        self.db = database
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    
+    async def acquire(self) -> bool:
+        """Adquirir ou renovar o lease. Devolve True se esta réplica é a dona."""
+        now = _utcnow()
+        try:
+            lease = await self.db.scheduler_leases.find_one_and_update(
+                {"_id": self.name, "$or": [{"owner": self.owner}, {"expires_at": {"$lte": now}}]},
+                {"$set": {
+                    "owner": self.owner,
+                    "expires_at": now + timedelta(seconds=self.ttl_seconds),
+                    "renewed_at": now
+                }},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # O documento existe e pertence a outra réplica
+            return False
+        
+        return lease is not None and lease.get("owner") == self.owner
+    
+    async def release(self):
+        """Libertar o lease (se ainda for o dono)."""
+        await self.db.scheduler_leases.delete_one({"_id": self.name, "owner": self.owner})
+
+
+# ====================================================================
+# AGENDADOR
+# ====================================================================
+
+class JobScheduler:
+    """
+    Executa tarefas registadas segundo a sua cadência, apenas na réplica
+    que detém o lease de líder.
+    
+    O estado de cada tarefa (`scheduler_jobs`) guarda a próxima execução, pelo
+    que um novo líder (ou um reinício) retoma as execuções em atraso: cada
+    tarefa em atraso corre uma vez e volta à sua cadência normal.
+    """
+    
+    def __init__(self, database, name: str = "scheduler", lease_seconds: int = SCHEDULER_LEASE_SECONDS):
+        self.db = database
+        self.name = name
+        self.lease = LeaderLease(database, f"leader:{name}", lease_seconds)
+        self.jobs: Dict[str, ScheduledJob] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._job_tasks: Dict[str, asyncio.Task] = {}
+    
+    def add_job(
+        self,
+        name: str,
+        func: Callable[[], Awaitable],
+        cron: Optional[str] = None,
+        every: Optional[float] = None,
+        jitter: float = 0,
+        catch_up: bool = True
+    ) -> ScheduledJob:
+        """
+        Registar uma tarefa.
+        
+        Args:
+            name: Nome único da tarefa
+            func: Corrotina sem argumentos a executar
+            cron: Expressão cron (alternativa a `every`)
+            every: Intervalo em segundos (alternativa a `cron`)
+            jitter: Atraso aleatório máximo (segundos) por execução
+            catch_up: Executar uma vez ao arrancar se houver execuções perdidas
+        """
+        if (cron is None) == (every is None):
+            raise ValueError("Indicar exactamente um de `cron` ou `every`")
+        
+        schedule = CronSchedule(cron) if cron else IntervalSchedule(every)
+        job = ScheduledJob(name, func, schedule, jitter, catch_up)
+        self.jobs[name] = job
+        return job
+    
+    async def ensure_indexes(self):
+        await self.db.scheduler_runs.create_index([("job", 1), ("started_at", -1)])
+        await self.db.scheduler_runs.create_index(
+            "started_at", expireAfterSeconds=SCHEDULER_HISTORY_DAYS * 24 * 3600
+        )
+    
+    def _state_id(self, job: ScheduledJob) -> str:
+        return f"{self.name}:{job.name}"
+    
+    async def _next_run_at(self, job: ScheduledJob) -> datetime:
+        """Próxima execução a partir do estado persistido."""
+        now = _utcnow()
+        state = await self.db.scheduler_jobs.find_one({"_id": self._state_id(job)})
+        
+        if not state or not state.get("next_run_at"):
+            next_run_at = job.schedule.next_after(now)
+            await self.db.scheduler_jobs.update_one(
+                {"_id": self._state_id(job)},
+                {"$set": {"job": job.name, "next_run_at": next_run_at}},
+                upsert=True
+            )
+            return next_run_at
+        
+        next_run_at = _as_utc(state["next_run_at"])
+        if next_run_at <= now and not job.catch_up:
+            return job.schedule.next_after(now)
+        return next_run_at
+    
+    async def run_job(self, job: ScheduledJob, scheduled_for: Optional[datetime] = None) -> dict:
+        """Executar uma tarefa e registar a execução no histórico."""
+        started_at = _utcnow()
+        started = time.monotonic()
+        run = {
+            "id": str(uuid.uuid4()),
+            "scheduler": self.name,
+            "job": job.name,
+            "owner": self.lease.owner,
+            "scheduled_for": scheduled_for,
+            "started_at": started_at
+        }
+        
+        try:
+            result = await job.func()
+            run.update(status="success", result=result if isinstance(result, (int, float, str, dict)) else None)
+        except asyncio.CancelledError:
+            run.update(status="cancelled")
+            raise
+        except Exception as e:
+            logger.exception(f"Erro na tarefa agendada {job.name}")
+            run.update(status="error", error=str(e))
+        finally:
+            run.update(finished_at=_utcnow(), duration_ms=round((time.monotonic() - started) * 1000, 1))
+            await self._record_run(job, run)
+        
+        return run
+    
+    async def _record_run(self, job: ScheduledJob, run: dict):
+        next_run_at = job.schedule.next_after(_utcnow())
+        try:
+            await self.db.scheduler_runs.insert_one(dict(run))
+            await self.db.scheduler_jobs.update_one(
+                {"_id": self._state_id(job)},
+                {"$set": {
+                    "job": job.name,
+                    "next_run_at": next_run_at,
+                    "last_run_at": run["started_at"],
+                    "last_status": run["status"],
+                    "last_duration_ms": run["duration_ms"],
+                    "last_error": run.get("error")
+                }},
+                upsert=True
+            )
+        except Exception as e:
+            logger.error(f"Erro ao registar execução de {job.name}: {e}")
+        
+        logger.info(f"Tarefa {job.name}: {run['status']} em {run['duration_ms']} ms (próxima: {next_run_at.isoformat()})")
+    
+    async def _job_loop(self, job: ScheduledJob):
+        while True:
+            try:
+                next_run_at = await self._next_run_at(job)
+            except Exception as e:
+                logger.error(f"Erro ao ler estado da tarefa {job.name}: {e}")
+                await asyncio.sleep(self.lease.ttl_seconds)
+                continue
+            
+            delay = max(0.0, (next_run_at - _utcnow()).total_seconds())
+            if job.jitter_seconds:
+                delay += random.uniform(0, job.jitter_seconds)
+            await asyncio.sleep(delay)
+            
+            await self.run_job(job, scheduled_for=next_run_at)
+    
+    def _start_jobs(self):
+        for job in self.jobs.values():
+            task = self._job_tasks.get(job.name)
+            if task is None or task.done():
+                self._job_tasks[job.name] = asyncio.create_task(self._job_loop(job))
+    
+    async def _stop_jobs(self):
+        tasks = list(self._job_tasks.values())
+        self._job_tasks = {}
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    async def _run(self):
+        while True:
+            try:
+                is_leader = await self.lease.acquire()
+            except Exception as e:
+                logger.error(f"Erro ao renovar lease do agendador: {e}")
+                is_leader = False
+            
+            if is_leader and not self._job_tasks:
+                logger.info(f"Agendador {self.name}: esta réplica é líder ({self.lease.owner})")
+                self._start_jobs()
+            elif not is_leader and self._job_tasks:
+                logger.warning(f"Agendador {self.name}: lease perdido, a parar tarefas")
+                await self._stop_jobs()
+            
+            await asyncio.sleep(self.lease.ttl_seconds / 3)
+    
+    @property
+    def is_leader(self) -> bool:
+        return bool(self._job_tasks)
+    
+    def start(self):
+        """Iniciar o agendador em background (idempotente)."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Parar o agendador e libertar o lease."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        
+        await self._stop_jobs()
+        try:
+            await self.lease.release()
+        except Exception as e:
+            logger.error(f"Erro ao libertar lease do agendador: {e}")
+    
+    async def wait(self):
+        """Aguardar até o agendador ser parado."""
+        if self._task:
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+    
+    async def get_status(self) -> List[dict]:
+        """Estado persistido de cada tarefa registada."""
+        states = await self.db.scheduler_jobs.find(
+            {"_id": {"$in": [self._state_id(job) for job in self.jobs.values()]}}
+        ).to_list(None)
+        by_job = {state["job"]: state for state in states}
+        
+        return [
+            {
+                "job": job.name,
+                "schedule": repr(job.schedule),
+                **{k: v for k, v in by_job.get(job.name, {}).items() if k not in ("_id", "job")}
+            }
+            for job in self.jobs.values()
+        ]
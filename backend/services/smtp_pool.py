@@ -0,0 +1,312 @@
+"""
+====================================================================
+POOL DE LIGAÇÕES SMTP - CREDITOIMO
+====================================================================
+Envio de emails em lote reutilizando ligações SMTP autenticadas.
+
+Funcionalidades:
+- Cada ligação é aberta e autenticada uma vez e serve muitas mensagens
+  (até SMTP_MESSAGES_PER_CONNECTION por sessão)
+- O smtplib é bloqueante: os envios correm num executor próprio, fora do
+  event loop, com no máximo SMTP_POOL_SIZE ligações em simultâneo
+- Ligações paradas há mais de SMTP_IDLE_CHECK_SECONDS são verificadas
+  (NOOP) antes de reutilizar; uma ligação caída é reaberta e o envio
+  repetido uma vez
+- Tempo máximo por envio (SMTP_SEND_TIMEOUT_SECONDS), contado a partir
+  do momento em que uma ligação pega na mensagem (a espera pela vez não
+  conta): um servidor lento nunca prende quem espera pelo resultado
+- Um envio interrompido por tempo depois de a mensagem começar a seguir
+  para o servidor fica "unconfirmed" (pode ter sido entregue) e não é
+  repetido; interrompido antes (a ligar ou autenticar), a thread desiste
+  do envio e a falha pode ser repetida sem duplicar o email
+- Resultado por mensagem (destinatário, sucesso, erro e código SMTP)
+
+Uso:
+    async with smtp_pool_from_env() as pool:
+        results = await pool.send_many(messages)
+====================================================================
+"""
+
+import asyncio
+import logging
+import os
+import smtplib
+import ssl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.message import Message
+from functools import partial
+from email.utils import getaddresses
+from typing import Optional, List
+
+logger = logging.getLogger(__name__)
+
+SMTP_POOL_SIZE = int(os.environ.get("SMTP_POOL_SIZE", "4"))
+SMTP_MESSAGES_PER_CONNECTION = int(os.environ.get("SMTP_MESSAGES_PER_CONNECTION", "100"))
+SMTP_IDLE_CHECK_SECONDS = int(os.environ.get("SMTP_IDLE_CHECK_SECONDS", "30"))
+SMTP_TIMEOUT_SECONDS = int(os.environ.get("SMTP_TIMEOUT_SECONDS", "30"))
+SMTP_SEND_TIMEOUT_SECONDS = int(os.environ.get("SMTP_SEND_TIMEOUT_SECONDS", "60"))
+
+# Erros que indicam uma ligação inutilizável (reabrir e repetir)
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError)
+
+
+def smtp_error_code(error: Exception) -> Optional[int]:
+    """Código de resposta SMTP de um erro (None se não houve resposta do servidor)."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in error.recipients.values()]
+        return max(codes) if codes else None
+    return getattr(error, "smtp_code", None)
+
+
+class _Connection:
+    """Sessão SMTP autenticada e respectiva utilização."""
+    
+    def __init__(self, smtp: smtplib.SMTP):
+        self.smtp = smtp
+        self.sent = 0
+        self.last_used = time.monotonic()
+
+
+class _SendState:
+    """
+    Estado de um envio partilhado entre o event loop e a thread: a thread
+    só passa ao sendmail se o envio não tiver sido abandonado por tempo, e
+    o abandono só é seguro (repetível) se a mensagem ainda não seguiu.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.on_wire = False
+        self.cancelled = False
+    
+    def start(self) -> bool:
+        """Thread: marcar o início do sendmail (False se o envio foi abandonado)."""
+        with self._lock:
+            if self.cancelled and not self.on_wire:
+                return False
+            self.on_wire = True
+            return True
+    
+    def cancel(self) -> bool:
+        """Event loop: abandonar o envio; True se a mensagem pode já ter seguido."""
+        with self._lock:
+            self.cancelled = True
+            return self.on_wire
+
+
+class SendCancelled(Exception):
+    """Envio abandonado por tempo antes de a mensagem seguir para o servidor."""
+
+
+class SMTPPool:
+    """Pool de ligações SMTP para envios em lote."""
+    
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        username: str,
+        password: str,
+        size: int = SMTP_POOL_SIZE,
+        messages_per_connection: int = SMTP_MESSAGES_PER_CONNECTION,
+        use_ssl: Optional[bool] = None,
+        timeout: float = SMTP_TIMEOUT_SECONDS,
+        send_timeout: float = SMTP_SEND_TIMEOUT_SECONDS
+    ):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.size = size
+        self.messages_per_connection = messages_per_connection
+        # Porta 465: SSL implícito; outras portas: STARTTLS se disponível
+        self.use_ssl = port == 465 if use_ssl is None else use_ssl
+        self.timeout = timeout
+        self.send_timeout = send_timeout
+        
+        self._idle: List[_Connection] = []
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.stats = {"connections": 0, "sent": 0, "failed": 0}
+    
+    # ----------------------------------------------------------------
+    # Ligações (executadas no executor)
+    # ----------------------------------------------------------------
+    
+    def _connect(self) -> _Connection:
+        context = ssl.create_default_context()
+        if self.use_ssl:
+            smtp = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout, context=context)
+        else:
+            smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            smtp.ehlo()
+            if smtp.has_extn("starttls"):
+                smtp.starttls(context=context)
+                smtp.ehlo()
+        
+        try:
+            if self.username and self.password:
+                smtp.login(self.username, self.password)
+        except Exception:
+            smtp.close()
+            raise
+        
+        with self._lock:
+            self.stats["connections"] += 1
+        return _Connection(smtp)
+    
+    def _acquire(self) -> _Connection:
+        while True:
+            with self._lock:
+                connection = self._idle.pop() if self._idle else None
+            if connection is None:
+                return self._connect()
+            
+            if time.monotonic() - connection.last_used < SMTP_IDLE_CHECK_SECONDS:
+                return connection
+            try:
+                if connection.smtp.noop()[0] == 250:
+                    return connection
+            except Exception:
+                pass
+            self._discard(connection)
+    
+    def _release(self, connection: _Connection):
+        connection.last_used = time.monotonic()
+        if connection.sent >= self.messages_per_connection:
+            self._discard(connection)
+            return
+        with self._lock:
+            self._idle.append(connection)
+    
+    @staticmethod
+    def _discard(connection: _Connection):
+        try:
+            connection.smtp.quit()
+        except Exception:
+            connection.smtp.close()
+    
+    def _send_sync(self, message: Message, recipients: List[str], state: _SendState):
+        for attempt in (1, 2):
+            connection = self._acquire()
+            if not state.start():
+                # Tempo máximo esgotado a ligar: quem enviou já conta com um retry
+                self._release(connection)
+                raise SendCancelled()
+            try:
+                connection.smtp.sendmail(self.username, recipients, message.as_bytes())
+            except CONNECTION_ERRORS as e:
+                self._discard(connection)
+                # Sem resposta a meio do envio: a mensagem pode já ter sido aceite
+                if attempt == 2 or isinstance(e, TimeoutError):
+                    raise
+                continue
+            except smtplib.SMTPException:
+                # Erro da mensagem (p.ex. destinatário recusado): a sessão continua válida
+                try:
+                    connection.smtp.rset()
+                    self._release(connection)
+                except Exception:
+                    self._discard(connection)
+                raise
+            
+            connection.sent += 1
+            self._release(connection)
+            return
+    
+    def _close_sync(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            self._discard(connection)
+    
+    # ----------------------------------------------------------------
+    # API assíncrona
+    # ----------------------------------------------------------------
+    
+    async def send(self, message: Message, recipients: Optional[List[str]] = None) -> dict:
+        """
+        Enviar uma mensagem (o remetente por omissão é o utilizador SMTP).
+        
+        Args:
+            message: Mensagem completa (cabeçalhos incluídos)
+            recipients: Destinatários do envelope (por omissão, To e Cc)
+        
+        Returns:
+            {"to", "ok", "error", "code", "unconfirmed"} (code: resposta SMTP
+            do erro, se houver; unconfirmed: a mensagem pode ter sido entregue)
+        """
+        if not message["From"]:
+            message["From"] = self.username
+        if recipients is None:
+            recipients = [address for _, address in getaddresses(message.get_all("To", []) + message.get_all("Cc", []))]
+        result = {"to": ", ".join(recipients), "ok": False, "error": None, "code": None, "unconfirmed": False}
+        
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="smtp-pool")
+            self._slots = asyncio.Semaphore(self.size)
+        
+        # Só entra no executor quando há uma ligação livre, para o tempo
+        # máximo não incluir a espera atrás dos outros envios
+        slots = self._slots
+        await slots.acquire()
+        state = _SendState()
+        future = asyncio.get_running_loop().run_in_executor(self._executor, self._send_sync, message, recipients, state)
+        future.add_done_callback(partial(self._send_done, slots))
+        
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.send_timeout)
+            result["ok"] = True
+            self.stats["sent"] += 1
+        except Exception as e:
+            if future.done():
+                result["error"] = str(e) or e.__class__.__name__
+                result["code"] = smtp_error_code(e)
+                result["unconfirmed"] = isinstance(e, TimeoutError) and state.on_wire
+            else:
+                # A thread continua: ou desiste antes do sendmail, ou a
+                # mensagem já seguiu e o resultado fica por confirmar
+                result["error"] = f"Tempo de envio excedido ({self.send_timeout}s)"
+                result["unconfirmed"] = state.cancel()
+            self.stats["failed"] += 1
+            logger.error(f"[SMTP POOL] Erro ao enviar para {result['to']}: {result['error']}")
+        
+        return result
+    
+    @staticmethod
+    def _send_done(slots: asyncio.Semaphore, future: asyncio.Future):
+        # A ligação só fica livre quando a thread termina (mesmo depois do tempo máximo)
+        slots.release()
+        if not future.cancelled():
+            future.exception()
+    
+    async def send_many(self, messages: List[Message]) -> List[dict]:
+        """Enviar várias mensagens em concorrência (resultados pela mesma ordem)."""
+        return list(await asyncio.gather(*(self.send(message) for message in messages)))
+    
+    async def close(self):
+        """Terminar as sessões abertas e o executor."""
+        if self._executor is None:
+            return
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._close_sync)
+        self._executor.shutdown(wait=False)
+        self._executor = None
+        self._slots = None
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+def smtp_pool_from_env(**kwargs) -> Optional[SMTPPool]:
+    """Pool com a configuração SMTP da aplicação (None se não configurado)."""
+    from services.email import SMTP_SERVER, SMTP_PORT, SMTP_EMAIL, SMTP_PASSWORD, is_smtp_configured
+    
+    if not is_smtp_configured():
+        return None
+    return SMTPPool(SMTP_SERVER, SMTP_PORT, SMTP_EMAIL, SMTP_PASSWORD, **kwargs)
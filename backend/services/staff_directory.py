@@ -0,0 +1,152 @@
+"""
+====================================================================
+DIRECTÓRIO DE UTILIZADORES (STAFF) - CREDITOIMO
+====================================================================
+Cache em memória dos utilizadores, indexada por id e por role, usada
+para resolver destinatários de notificações e emails sem consultar a
+colecção `users` em cada evento.
+
+Funcionalidades:
+- Carregamento completo numa única query (id, email, nome, role, estado)
+- Índices por id e por role
+- Actualizado pelas rotas que escrevem utilizadores (refresh/remove)
+- Recarregado após STAFF_DIRECTORY_TTL_SECONDS, para apanhar escritas
+  feitas por outros processos
+====================================================================
+"""
+
+import asyncio
+import logging
+import os
+import time
+from typing import Optional, List, Dict, Set, Iterable
+
+logger = logging.getLogger(__name__)
+
+STAFF_DIRECTORY_TTL_SECONDS = int(os.environ.get("STAFF_DIRECTORY_TTL_SECONDS", "300"))
+
+# Campos mantidos em cache (nunca a password)
+DIRECTORY_PROJECTION = {"_id": 0, "id": 1, "email": 1, "name": 1, "role": 1, "is_active": 1, "email_digest_mode": 1}
+
+
+def _is_active(user: dict) -> bool:
+    """Utilizadores sem o campo `is_active` são considerados activos."""
+    return user.get("is_active") is not False
+
+
+class StaffDirectory:
+    """Directório de utilizadores com índices por id e por role."""
+    
+    def __init__(self, database=None, ttl_seconds: int = STAFF_DIRECTORY_TTL_SECONDS):
+        self._database = database
+        self.ttl_seconds = ttl_seconds
+        self._users: Dict[str, dict] = {}
+        self._by_role: Dict[str, Set[str]] = {}
+        self._loaded_at: Optional[float] = None
+        self._lock: Optional[asyncio.Lock] = None
+    
+    @property
+    def db(self):
+        if self._database is not None:
+            return self._database
+        from database import db
+        return db
+    
+    def _is_fresh(self) -> bool:
+        return self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl_seconds
+    
+    def _index(self, user: dict):
+        self._unindex(user["id"])
+        self._users[user["id"]] = user
+        self._by_role.setdefault(user.get("role"), set()).add(user["id"])
+    
+    def _unindex(self, user_id: str):
+        previous = self._users.pop(user_id, None)
+        if previous is not None:
+            role_users = self._by_role.get(previous.get("role"))
+            if role_users is not None:
+                role_users.discard(user_id)
+                if not role_users:
+                    del self._by_role[previous.get("role")]
+    
+    async def load(self):
+        """Carregar todos os utilizadores numa única query."""
+        users = await self.db.users.find({}, DIRECTORY_PROJECTION).to_list(None)
+        
+        self._users = {}
+        self._by_role = {}
+        for user in users:
+            if user.get("id"):
+                self._index(user)
+        self._loaded_at = time.monotonic()
+        
+        logger.debug(f"Directório de utilizadores carregado: {len(self._users)} utilizadores")
+    
+    async def _ensure_loaded(self):
+        if self._is_fresh():
+            return
+        
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        
+        async with self._lock:
+            # Outro pedido pode ter carregado enquanto se aguardava o lock
+            if not self._is_fresh():
+                await self.load()
+    
+    async def get_user(self, user_id: str) -> Optional[dict]:
+        """Obter um utilizador (id, email, name, role, is_active) por id."""
+        await self._ensure_loaded()
+        return self._users.get(user_id)
+    
+    async def get_users(self, user_ids: Iterable[str], active_only: bool = False) -> List[dict]:
+        """Obter vários utilizadores por id, ignorando ids desconhecidos."""
+        await self._ensure_loaded()
+        users = (self._users.get(user_id) for user_id in dict.fromkeys(user_ids) if user_id)
+        return [user for user in users if user and (not active_only or _is_active(user))]
+    
+    async def get_users_by_roles(self, roles: Iterable[str], active_only: bool = True) -> List[dict]:
+        """
+        Obter os utilizadores com qualquer um dos roles indicados.
+        
+        Args:
+            roles: Roles a incluir
+            active_only: Excluir utilizadores desactivados
+        """
+        await self._ensure_loaded()
+        
+        users = []
+        for role in dict.fromkeys(roles):
+            for user_id in self._by_role.get(role, ()):
+                user = self._users[user_id]
+                if not active_only or _is_active(user):
+                    users.append(user)
+        return users
+    
+    async def get_all_users(self, active_only: bool = True) -> List[dict]:
+        """Obter todos os utilizadores do directório."""
+        await self._ensure_loaded()
+        return [user for user in self._users.values() if not active_only or _is_active(user)]
+    
+    async def refresh_user(self, user_id: str):
+        """Reler um utilizador após escrita (criação ou actualização)."""
+        if self._loaded_at is None:
+            return
+        
+        user = await self.db.users.find_one({"id": user_id}, DIRECTORY_PROJECTION)
+        if user:
+            self._index(user)
+        else:
+            self._unindex(user_id)
+    
+    def remove_user(self, user_id: str):
+        """Remover um utilizador eliminado."""
+        self._unindex(user_id)
+    
+    def invalidate(self):
+        """Forçar recarregamento completo no próximo acesso."""
+        self._loaded_at = None
+
+
+# Instância global do directório
+staff_directory = StaffDirectory()
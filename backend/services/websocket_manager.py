@@ -8,62 +8,144 @@ Funcionalidades:
 - Gestão de conexões por utilizador
 - Broadcast de notificações
 - Reconexão automática
-- Heartbeat para manter conexões activas
+- Heartbeat do servidor com remoção de conexões inactivas
+- Limites de conexões por utilizador e por worker
+- Índices por utilizador e por papel (presença e broadcast por papel)
 ====================================================================
 """
 
+import asyncio
 import json
 import logging
-from typing import Dict, Set, Optional
+import time
+from typing import Dict, Set, Optional, List
 from fastapi import WebSocket
 from datetime import datetime, timezone
 
+from config import (
+    WS_HEARTBEAT_INTERVAL_SECONDS,
+    WS_HEARTBEAT_MAX_MISSED,
+    WS_MAX_CONNECTIONS_PER_USER,
+    WS_MAX_CONNECTIONS_PER_WORKER,
+)
+
 logger = logging.getLogger(__name__)
 
 
+# Códigos de fecho usados pelo servidor
+WS_CLOSE_HEARTBEAT_TIMEOUT = 4002
+WS_CLOSE_USER_LIMIT = 4008
+WS_CLOSE_WORKER_FULL = 1013
+
+
+class ConnectionInfo:
+    """Metadados de uma conexão WebSocket (estrutura compacta com __slots__)."""
+    
+    __slots__ = ("websocket", "user_id", "role", "connected_at", "missed_beats")
+    
+    def __init__(self, websocket: WebSocket, user_id: str, role: Optional[str] = None):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.role = role
+        self.connected_at = time.monotonic()
+        self.missed_beats = 0
+
+
 class ConnectionManager:
     """Gestor de conexões WebSocket."""
     
-    def __init__(self):
-        # Mapeamento de user_id para conjunto de conexões WebSocket
+    def __init__(
+        self,
+        heartbeat_interval: float = WS_HEARTBEAT_INTERVAL_SECONDS,
+        max_missed_beats: int = WS_HEARTBEAT_MAX_MISSED,
+        max_connections_per_user: int = WS_MAX_CONNECTIONS_PER_USER,
+        max_connections_per_worker: int = WS_MAX_CONNECTIONS_PER_WORKER
+    ):
+        # Índice por utilizador: user_id -> conjunto de conexões WebSocket
         self.active_connections: Dict[str, Set[WebSocket]] = {}
-        # Mapeamento de WebSocket para user_id
-        self.websocket_to_user: Dict[WebSocket, str] = {}
+        # Mapeamento de WebSocket para os metadados da conexão
+        self.websocket_to_user: Dict[WebSocket, ConnectionInfo] = {}
+        # Índice por papel: role -> conjunto de user_ids conectados
+        self.role_index: Dict[str, Set[str]] = {}
+        
+        self.heartbeat_interval = heartbeat_interval
+        self.max_missed_beats = max_missed_beats
+        self.max_connections_per_user = max_connections_per_user
+        self.max_connections_per_worker = max_connections_per_worker
+        self._heartbeat_task: Optional[asyncio.Task] = None
     
-    async def connect(self, websocket: WebSocket, user_id: str):
-        """Aceitar uma nova conexão WebSocket."""
+    async def connect(self, websocket: WebSocket, user_id: str, role: Optional[str] = None) -> bool:
+        """
+        Aceitar uma nova conexão WebSocket.
+        
+        Respeita os limites por worker (recusa a conexão) e por utilizador
+        (fecha a conexão mais antiga do utilizador).
+        
+        Returns:
+            True se a conexão foi aceite
+        """
+        if self.get_total_connections() >= self.max_connections_per_worker:
+            logger.warning(f"Limite de {self.max_connections_per_worker} conexões atingido. Conexão de {user_id} recusada.")
+            await websocket.close(code=WS_CLOSE_WORKER_FULL, reason="Servidor sem capacidade")
+            return False
+        
         await websocket.accept()
         
-        if user_id not in self.active_connections:
-            self.active_connections[user_id] = set()
+        existing = self.active_connections.get(user_id, set())
+        if len(existing) >= self.max_connections_per_user:
+            oldest = min(existing, key=lambda ws: self.websocket_to_user[ws].connected_at)
+            logger.info(f"Limite de conexões por utilizador atingido para {user_id}. A fechar a mais antiga.")
+            await self._close(oldest, WS_CLOSE_USER_LIMIT, "Limite de conexões por utilizador")
+            self.disconnect(oldest)
         
-        self.active_connections[user_id].add(websocket)
-        self.websocket_to_user[websocket] = user_id
+        self.active_connections.setdefault(user_id, set()).add(websocket)
+        self.websocket_to_user[websocket] = ConnectionInfo(websocket, user_id, role)
+        if role:
+            self.role_index.setdefault(role, set()).add(user_id)
         
         logger.info(f"WebSocket conectado para utilizador {user_id}. Total conexões: {self.get_total_connections()}")
+        return True
     
     def disconnect(self, websocket: WebSocket):
         """Remover uma conexão WebSocket."""
-        user_id = self.websocket_to_user.get(websocket)
+        info = self.websocket_to_user.pop(websocket, None)
+        if not info:
+            return
         
-        if user_id and user_id in self.active_connections:
-            self.active_connections[user_id].discard(websocket)
+        user_id = info.user_id
+        connections = self.active_connections.get(user_id)
+        if connections is not None:
+            connections.discard(websocket)
             
-            # Remover o set se estiver vazio
-            if not self.active_connections[user_id]:
+            # Remover o set se estiver vazio (e o utilizador do índice de papéis)
+            if not connections:
                 del self.active_connections[user_id]
-        
-        if websocket in self.websocket_to_user:
-            del self.websocket_to_user[websocket]
+                if info.role and info.role in self.role_index:
+                    self.role_index[info.role].discard(user_id)
+                    if not self.role_index[info.role]:
+                        del self.role_index[info.role]
         
         logger.info(f"WebSocket desconectado para utilizador {user_id}. Total conexões: {self.get_total_connections()}")
     
+    def touch(self, websocket: WebSocket):
+        """Registar actividade do cliente (reinicia a contagem de heartbeats falhados)."""
+        info = self.websocket_to_user.get(websocket)
+        if info:
+            info.missed_beats = 0
+    
+    async def _close(self, websocket: WebSocket, code: int, reason: str):
+        """Fechar uma conexão ignorando erros (a conexão pode já estar morta)."""
+        try:
+            await asyncio.wait_for(websocket.close(code=code, reason=reason), timeout=5)
+        except Exception:
+            pass
+    
     async def send_personal_message(self, message: dict, user_id: str):
         """Enviar mensagem para um utilizador específico."""
         if user_id in self.active_connections:
             disconnected = set()
             
-            for websocket in self.active_connections[user_id]:
+            for websocket in list(self.active_connections[user_id]):
                 try:
                     await websocket.send_json(message)
                 except Exception as e:
@@ -78,36 +160,105 @@ class ConnectionManager:
         """Enviar mensagem para todos os utilizadores conectados."""
         disconnected = []
         
-        for user_id, connections in self.active_connections.items():
-            if exclude_user and user_id == exclude_user:
+        for websocket, info in list(self.websocket_to_user.items()):
+            if exclude_user and info.user_id == exclude_user:
                 continue
             
-            for websocket in connections:
-                try:
-                    await websocket.send_json(message)
-                except Exception as e:
-                    logger.error(f"Erro no broadcast para {user_id}: {e}")
-                    disconnected.append(websocket)
+            try:
+                await websocket.send_json(message)
+            except Exception as e:
+                logger.error(f"Erro no broadcast para {info.user_id}: {e}")
+                disconnected.append(websocket)
         
         # Remover conexões que falharam
         for ws in disconnected:
             self.disconnect(ws)
     
-    async def broadcast_to_roles(self, message: dict, roles: list, users_data: dict):
-        """Enviar mensagem para utilizadores com papéis específicos."""
-        for user_id in self.active_connections.keys():
-            user_role = users_data.get(user_id, {}).get("role")
-            if user_role in roles:
-                await self.send_personal_message(message, user_id)
+    async def broadcast_to_roles(self, message: dict, roles: list, exclude_user: Optional[str] = None):
+        """Enviar mensagem para utilizadores conectados com papéis específicos."""
+        for user_id in self.get_connected_users_by_role(roles):
+            if exclude_user and user_id == exclude_user:
+                continue
+            await self.send_personal_message(message, user_id)
+    
+    async def run_heartbeat(self) -> int:
+        """
+        Executar um ciclo de heartbeat.
+        
+        Envia um ping a todas as conexões e remove as que falharam
+        `max_missed_beats` heartbeats consecutivos sem qualquer mensagem do cliente.
+        
+        Returns:
+            Número de conexões removidas
+        """
+        message = create_ws_message(WSEventType.HEARTBEAT, {"status": "ping"})
+        stale: List[WebSocket] = []
+        alive: List[WebSocket] = []
+        
+        for websocket, info in list(self.websocket_to_user.items()):
+            if info.missed_beats >= self.max_missed_beats:
+                stale.append(websocket)
+            else:
+                info.missed_beats += 1
+                alive.append(websocket)
+        
+        results = await asyncio.gather(
+            *(asyncio.wait_for(ws.send_json(message), timeout=self.heartbeat_interval) for ws in alive),
+            return_exceptions=True
+        )
+        stale.extend(ws for ws, result in zip(alive, results) if isinstance(result, BaseException))
+        
+        for websocket in stale:
+            await self._close(websocket, WS_CLOSE_HEARTBEAT_TIMEOUT, "Heartbeat expirado")
+            self.disconnect(websocket)
+        
+        if stale:
+            logger.info(f"Heartbeat: {len(stale)} conexões inactivas removidas")
+        return len(stale)
+    
+    async def _heartbeat_loop(self):
+        """Loop de heartbeat executado em background."""
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self.run_heartbeat()
+            except Exception as e:
+                logger.error(f"Erro no heartbeat WebSocket: {e}")
+    
+    def start_heartbeat(self):
+        """Iniciar a tarefa de heartbeat (idempotente)."""
+        if self._heartbeat_task is None or self._heartbeat_task.done():
+            self._heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+    
+    async def stop_heartbeat(self):
+        """Parar a tarefa de heartbeat."""
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
+            try:
+                await self._heartbeat_task
+            except asyncio.CancelledError:
+                pass
+            self._heartbeat_task = None
     
     def get_total_connections(self) -> int:
         """Obter número total de conexões activas."""
-        return sum(len(conns) for conns in self.active_connections.values())
+        return len(self.websocket_to_user)
     
     def get_connected_users(self) -> list:
         """Obter lista de utilizadores conectados."""
         return list(self.active_connections.keys())
     
+    def get_connected_users_by_role(self, roles: list) -> list:
+        """Obter utilizadores conectados com algum dos papéis indicados."""
+        users: Set[str] = set()
+        for role in roles:
+            users.update(self.role_index.get(role, ()))
+        return list(users)
+    
+    def get_connections_by_role(self) -> Dict[str, int]:
+        """Obter número de utilizadores conectados por papel."""
+        return {role: len(users) for role, users in self.role_index.items()}
+    
     def is_user_connected(self, user_id: str) -> bool:
         """Verificar se um utilizador está conectado."""
         return user_id in self.active_connections and len(self.active_connections[user_id]) > 0
@@ -121,6 +272,7 @@ manager = ConnectionManager()
 class WSEventType:
     # Notificações
     NEW_NOTIFICATION = "new_notification"
+    NOTIFICATION_BATCH = "notification_batch"
     NOTIFICATION_READ = "notification_read"
     ALL_NOTIFICATIONS_READ = "all_notifications_read"
     
@@ -139,6 +291,9 @@ class WSEventType:
     DEADLINE_UPDATED = "deadline_updated"
     DEADLINE_REMINDER = "deadline_reminder"
     
+    # Emails
+    EMAIL_RECEIVED = "email_received"
+    
     # Sistema
     HEARTBEAT = "heartbeat"
     CONNECTION_STATUS = "connection_status"
@@ -9,7 +9,18 @@ from pathlib import Path
 # Add backend to path
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
+import asyncio
+import base64
 import os
+import re
+import socket
+import socketserver
+import threading
+import time
+from datetime import datetime, timezone
+from email import message_from_bytes
+from email.message import EmailMessage
+from email.utils import format_datetime, make_msgid, parsedate_to_datetime
 import pytest
 import pytest_asyncio
 from httpx import AsyncClient
@@ -57,3 +68,429 @@ async def mediador_token(client):
     })
     assert response.status_code == 200, f"Mediador login failed: {response.text}"
     return response.json()["access_token"]
+
+
+class LocalSMTPServer:
+    """
+    Servidor SMTP mínimo (sem TLS) que regista sessões e mensagens.
+    
+    Destinatários começados por "reject" são recusados (550) e os
+    começados por "busy" recebem uma falha temporária (451); se
+    `drop_after` estiver definido, cada sessão é fechada pelo servidor
+    depois desse número de mensagens; `delay` atrasa a resposta a DATA
+    (servidor lento) e `connect_delay` a saudação inicial (ligação lenta).
+    """
+    
+    def __init__(self, drop_after: int = None, delay: float = 0, connect_delay: float = 0):
+        self.drop_after = drop_after
+        self.delay = delay
+        self.connect_delay = connect_delay
+        self.sessions = 0
+        self.logins = []
+        self.messages = []
+        self._server = None
+        self.port = None
+    
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+    
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+    
+    async def _handle(self, reader, writer):
+        self.sessions += 1
+        sent_in_session = 0
+        recipients = []
+        
+        def reply(line: str):
+            writer.write(f"{line}\r\n".encode())
+        
+        if self.connect_delay:
+            await asyncio.sleep(self.connect_delay)
+        reply("220 localhost ESMTP")
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode().strip()
+                verb = command.split(" ")[0].upper()
+                
+                if verb in ("EHLO", "HELO"):
+                    writer.write(b"250-localhost\r\n250 AUTH PLAIN\r\n")
+                elif verb == "AUTH":
+                    self.logins.append(base64.b64decode(command.split(" ")[2]).split(b"\0")[1].decode())
+                    reply("235 Authentication successful")
+                elif verb == "MAIL":
+                    recipients = []
+                    reply("250 OK")
+                elif verb == "RCPT":
+                    address = command.split(":", 1)[1].strip("<> ")
+                    if address.startswith("reject"):
+                        reply("550 Mailbox unavailable")
+                    elif address.startswith("busy"):
+                        reply("451 Try again later")
+                    else:
+                        recipients.append(address)
+                        reply("250 OK")
+                elif verb == "DATA":
+                    reply("354 End data with <CR><LF>.<CR><LF>")
+                    await writer.drain()
+                    data = []
+                    while (chunk := await reader.readline()) not in (b".\r\n", b""):
+                        data.append(chunk)
+                    if self.delay:
+                        await asyncio.sleep(self.delay)
+                    self.messages.append({"to": recipients, "data": b"".join(data)})
+                    sent_in_session += 1
+                    reply("250 Queued")
+                    if self.drop_after and sent_in_session >= self.drop_after:
+                        await writer.drain()
+                        break
+                elif verb in ("RSET", "NOOP"):
+                    reply("250 OK")
+                elif verb == "QUIT":
+                    reply("221 Bye")
+                    await writer.drain()
+                    break
+                else:
+                    reply("502 Command not implemented")
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+@pytest_asyncio.fixture
+async def smtp_server():
+    """Servidor SMTP local de substituição (porta livre em 127.0.0.1)."""
+    server = LocalSMTPServer()
+    await server.start()
+    yield server
+    await server.stop()
+
+
+class LocalIMAPServer:
+    """
+    Servidor IMAP mínimo (sem TLS) com pastas em memória, numa thread
+    (o cliente imaplib é bloqueante).
+    
+    Suporta o necessário para a sincronização: LOGIN, LIST,
+    SELECT/EXAMINE (com UIDVALIDITY), UID SEARCH (UID, ALL, SUBJECT,
+    FROM, TO, CC, SINCE), UID FETCH, IDLE (com EXISTS quando chega uma
+    mensagem à pasta seleccionada), NOOP e LOGOUT. Regista os comandos
+    recebidos (`commands`) e os bytes enviados em respostas FETCH
+    (`fetched_bytes`); `delay` atrasa cada resposta (servidor lento).
+    """
+    
+    def __init__(self, folders=("INBOX", "Sent")):
+        self.folders = {name: {"uidvalidity": 1, "next_uid": 1, "messages": []} for name in folders}
+        self.commands = []
+        self.logins = 0
+        self.fetched_bytes = 0
+        self.delay = 0
+        self.lock = threading.Lock()
+        self.sessions = []
+        self.port = None
+        self._server = None
+    
+    def add_folder(self, folder: str):
+        with self.lock:
+            self.folders.setdefault(folder, {"uidvalidity": 1, "next_uid": 1, "messages": []})
+    
+    def add_message(self, folder: str, sender: str, to: str, subject: str, body: str = "",
+                    cc: str = None, date: datetime = None, message_id: str = None,
+                    html: str = None, attachments: list = None) -> int:
+        """
+        Acrescentar uma mensagem à pasta; devolve o UID.
+        
+        `attachments`: lista de (nome, conteúdo em bytes), anexados como PDF.
+        """
+        msg = EmailMessage()
+        msg["From"] = sender
+        msg["To"] = to
+        if cc:
+            msg["Cc"] = cc
+        msg["Subject"] = subject
+        msg["Date"] = format_datetime(date or datetime.now(timezone.utc))
+        msg["Message-ID"] = message_id or make_msgid(domain="test.pt")
+        msg.set_content(body)
+        if html:
+            msg.add_alternative(html, subtype="html")
+        for filename, content in attachments or []:
+            msg.add_attachment(content, maintype="application", subtype="pdf", filename=filename)
+        with self.lock:
+            box = self.folders[folder]
+            uid = box["next_uid"]
+            box["next_uid"] += 1
+            raw = msg.as_bytes()
+            box["messages"].append({"uid": uid, "msg": msg, "raw": raw, "parsed": message_from_bytes(raw)})
+            # Sessões em IDLE na pasta são avisadas de imediato
+            for session in self.sessions:
+                if session["idle"] and session["selected"] == folder:
+                    try:
+                        session["wfile"].write(f"* {len(box['messages'])} EXISTS\r\n".encode())
+                        session["wfile"].flush()
+                    except OSError:
+                        pass
+        return uid
+    
+    def recreate_folder(self, folder: str):
+        """Recriar a pasta no servidor: novo UIDVALIDITY e UIDs renumerados."""
+        with self.lock:
+            box = self.folders[folder]
+            box["uidvalidity"] += 1
+            for uid, message in enumerate(box["messages"], start=1):
+                message["uid"] = uid
+            box["next_uid"] = len(box["messages"]) + 1
+            # Como num servidor real, as sessões com a pasta aberta são terminadas
+            dropped = [s for s in self.sessions if s["selected"] == folder]
+        for session in dropped:
+            self._disconnect(session)
+    
+    def drop_sessions(self):
+        """Terminar todas as ligações abertas (p.ex. reinício do servidor)."""
+        with self.lock:
+            sessions = list(self.sessions)
+        for session in sessions:
+            self._disconnect(session)
+    
+    @staticmethod
+    def _disconnect(session: dict):
+        try:
+            session["socket"].shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    
+    def fetch_commands(self) -> list:
+        return [c for c in self.commands if c.upper().startswith("UID FETCH")]
+    
+    def start(self):
+        owner = self
+        
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                session = {"socket": self.request, "wfile": self.wfile, "selected": None, "idle": False}
+                with owner.lock:
+                    owner.sessions.append(session)
+                try:
+                    owner._session(session, self.rfile, self.wfile)
+                except OSError:
+                    pass
+                finally:
+                    with owner.lock:
+                        owner.sessions.remove(session)
+        
+        self._server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+    
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+    
+    # ---- protocolo ----
+    
+    @staticmethod
+    def _tokens(text: str) -> list:
+        return [
+            t[1:-1].replace('\\"', '"') if t.startswith('"') else t
+            for t in re.findall(r'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()]+', text)
+        ]
+    
+    @staticmethod
+    def _uid_set(spec: str, uids: list) -> set:
+        highest = max(uids, default=0)
+        selected = set()
+        for part in spec.split(","):
+            bounds = [highest if b == "*" else int(b) for b in part.split(":")]
+            low, high = min(bounds), max(bounds)
+            selected.update(uid for uid in uids if low <= uid <= high)
+        return selected
+    
+    def _search(self, messages: list, criteria: str) -> list:
+        tokens = [t for t in self._tokens(criteria) if t not in ("(", ")")]
+        uids = [m["uid"] for m in messages]
+        matched = set(uids)
+        i = 0
+        while i < len(tokens):
+            key = tokens[i].upper()
+            if key == "ALL":
+                i += 1
+                continue
+            value = tokens[i + 1]
+            i += 2
+            if key == "UID":
+                matched &= self._uid_set(value, uids)
+            elif key == "SINCE":
+                since = datetime.strptime(value, "%d-%b-%Y").date()
+                matched &= {m["uid"] for m in messages if parsedate_to_datetime(m["msg"]["Date"]).date() >= since}
+            elif key in ("SUBJECT", "FROM", "TO", "CC"):
+                header = {"SUBJECT": "Subject", "FROM": "From", "TO": "To", "CC": "Cc"}[key]
+                matched &= {m["uid"] for m in messages if value.lower() in str(m["msg"].get(header, "")).lower()}
+            else:
+                raise ValueError(f"critério não suportado: {key}")
+        return sorted(matched)
+    
+    @staticmethod
+    def _quoted(value) -> str:
+        return "NIL" if value is None else '"' + str(value).replace('"', '\\"') + '"'
+    
+    def _bodystructure(self, part) -> str:
+        """BODYSTRUCTURE (RFC 3501) de uma parte da mensagem."""
+        if part.is_multipart():
+            children = "".join(self._bodystructure(p) for p in part.get_payload())
+            return f"({children} {self._quoted(part.get_content_subtype().upper())})"
+        params = part.get_params()[1:] if part.get_params() else []
+        params = "(" + " ".join(f"{self._quoted(k.upper())} {self._quoted(v)}" for k, v in params) + ")" if params else "NIL"
+        payload = part.get_payload().encode()
+        encoding = (part.get("Content-Transfer-Encoding") or "7bit").upper()
+        fields = [
+            self._quoted(part.get_content_maintype().upper()), self._quoted(part.get_content_subtype().upper()),
+            params, "NIL", "NIL", self._quoted(encoding), str(len(payload))
+        ]
+        if part.get_content_maintype() == "text":
+            fields.append(str(payload.count(b"\n")))
+        disposition = part.get_content_disposition()
+        if disposition:
+            filename = part.get_filename()
+            disposition_params = f"({self._quoted('FILENAME')} {self._quoted(filename)})" if filename else "NIL"
+            fields += ["NIL", f"({self._quoted(disposition.upper())} {disposition_params})"]
+        return "(" + " ".join(fields) + ")"
+    
+    @staticmethod
+    def _section(message, section: str):
+        part = message
+        for index in section.split("."):
+            if part.is_multipart():
+                part = part.get_payload()[int(index) - 1]
+        return part.get_payload().encode()
+    
+    def _fetch_item(self, message: dict, item: str) -> tuple:
+        """Nome e conteúdo de um item de FETCH."""
+        name = item.upper().replace("BODY.PEEK[", "BODY[")
+        if name in ("RFC822", "BODY[]"):
+            return name, message["raw"]
+        if name == "BODYSTRUCTURE":
+            return name, self._bodystructure(message["parsed"])
+        if name.startswith("BODY[HEADER.FIELDS"):
+            fields = name[name.index("(") + 1:name.index(")")].split()
+            lines = [f"{k}: {v}\r\n" for k, v in message["parsed"].items() if k.upper() in fields]
+            return name, ("".join(lines) + "\r\n").encode()
+        if name.startswith("BODY[") and name[5:-1].replace(".", "").isdigit():
+            return name, self._section(message["parsed"], name[5:-1])
+        raise ValueError(f"item FETCH não suportado: {item}")
+    
+    def _fetch(self, messages: list, spec: str, items: str, write):
+        items = items.strip()
+        if items.startswith("("):
+            items = items[1:-1]
+        wanted = re.findall(r'[A-Z0-9.]+(?:\[[^\]]*\](?:<[\d.]+>)?)?', items.upper())
+        selected = self._uid_set(spec, [m["uid"] for m in messages])
+        for seq, message in enumerate(messages, start=1):
+            if message["uid"] not in selected:
+                continue
+            parts = [f"UID {message['uid']}".encode()]
+            for item in wanted:
+                if item == "UID":
+                    continue
+                name, value = self._fetch_item(message, item)
+                if isinstance(value, bytes):
+                    self.fetched_bytes += len(value)
+                    parts.append(f"{name} {{{len(value)}}}\r\n".encode() + value)
+                else:
+                    parts.append(f"{name} {value}".encode())
+            write(f"* {seq} FETCH (".encode() + b" ".join(parts) + b")\r\n")
+    
+    def _session(self, session: dict, rfile, wfile):
+        selected = None
+        
+        def write(data: bytes):
+            wfile.write(data)
+        
+        def reply(line: str):
+            wfile.write(f"{line}\r\n".encode())
+        
+        reply("* OK [CAPABILITY IMAP4rev1 IDLE] localhost IMAP ready")
+        while True:
+            line = rfile.readline()
+            if not line:
+                return
+            tag, _, rest = line.decode().rstrip("\r\n").partition(" ")
+            verb, _, args = rest.partition(" ")
+            verb = verb.upper()
+            if self.delay:
+                time.sleep(self.delay)
+            if verb == "IDLE" and selected:
+                with self.lock:
+                    self.commands.append(rest)
+                    session["idle"] = True
+                    reply("+ idling")
+                    wfile.flush()
+                done = rfile.readline()
+                with self.lock:
+                    session["idle"] = False
+                    if not done:
+                        return
+                    reply(f"{tag} OK IDLE terminated")
+                    wfile.flush()
+                continue
+            with self.lock:
+                self.commands.append(rest)
+                if verb == "CAPABILITY":
+                    reply("* CAPABILITY IMAP4rev1 IDLE")
+                    reply(f"{tag} OK CAPABILITY completed")
+                elif verb == "LOGIN":
+                    self.logins += 1
+                    reply(f"{tag} OK LOGIN completed")
+                elif verb == "LIST":
+                    for name in self.folders:
+                        reply(f'* LIST (\\HasNoChildren) "/" "{name}"')
+                    reply(f"{tag} OK LIST completed")
+                elif verb in ("SELECT", "EXAMINE"):
+                    name = self._tokens(args)[0]
+                    box = self.folders.get(name)
+                    if box is None:
+                        selected = session["selected"] = None
+                        reply(f"{tag} NO Mailbox does not exist")
+                    else:
+                        selected = session["selected"] = name
+                        reply(f"* {len(box['messages'])} EXISTS")
+                        reply("* 0 RECENT")
+                        reply(f"* OK [UIDVALIDITY {box['uidvalidity']}] UIDs valid")
+                        reply(f"* OK [UIDNEXT {box['next_uid']}] Predicted next UID")
+                        mode = "READ-ONLY" if verb == "EXAMINE" else "READ-WRITE"
+                        reply(f"{tag} OK [{mode}] {verb} completed")
+                elif verb == "UID" and selected:
+                    command, _, criteria = args.partition(" ")
+                    messages = self.folders[selected]["messages"]
+                    if command.upper() == "SEARCH":
+                        uids = self._search(messages, criteria)
+                        reply("* SEARCH" + "".join(f" {uid}" for uid in uids))
+                    else:
+                        spec, _, items = criteria.partition(" ")
+                        self._fetch(messages, spec, items, write)
+                    reply(f"{tag} OK UID {command.upper()} completed")
+                elif verb in ("NOOP", "CLOSE"):
+                    if verb == "CLOSE":
+                        selected = session["selected"] = None
+                    reply(f"{tag} OK {verb} completed")
+                elif verb == "LOGOUT":
+                    reply("* BYE logging out")
+                    reply(f"{tag} OK LOGOUT completed")
+                    wfile.flush()
+                    return
+                else:
+                    reply(f"{tag} BAD command not supported")
+            wfile.flush()
+
+
+@pytest.fixture
+def imap_server():
+    """Servidor IMAP local de substituição (porta livre em 127.0.0.1)."""
+    server = LocalIMAPServer()
+    server.start()
+    yield server
+    server.stop()
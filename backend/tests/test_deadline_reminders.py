@@ -0,0 +1,177 @@
+"""
+Testes do motor de lembretes de prazos (services/deadline_reminders.py)
+"""
+import asyncio
+import uuid
+from datetime import datetime, timezone, timedelta
+
+import pytest
+import pytest_asyncio
+
+import services.deadline_reminders as reminders_module
+from services.deadline_reminders import (
+    DeadlineReminderEngine,
+    deadline_participants,
+    deadline_start,
+    reminder_at,
+)
+
+
+def starting_in(minutes: float, **fields) -> dict:
+    """Prazo (com hora) que começa daqui a `minutes` minutos."""
+    start = datetime.now(timezone.utc) + timedelta(minutes=minutes)
+    return {
+        "id": f"test-reminder-{uuid.uuid4().hex[:8]}",
+        "title": "Escritura",
+        "due_date": start.isoformat(),
+        "due_at": start,
+        "completed": False,
+        "assigned_user_ids": ["test-reminder-user"],
+        **fields
+    }
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """Lembretes enviados (substitui o envio real)."""
+    calls = []
+    
+    async def fake_notify(deadline, minutes_before=30):
+        calls.append((deadline["id"], deadline["participants"], minutes_before))
+    
+    monkeypatch.setattr(reminders_module, "notify_deadline_reminder", fake_notify)
+    return calls
+
+
+@pytest_asyncio.fixture
+async def reminders_db():
+    """Base de dados de teste (salta se o MongoDB não estiver disponível)."""
+    from database import db
+    
+    try:
+        await asyncio.wait_for(db.command("ping"), timeout=2)
+    except Exception:
+        pytest.skip("MongoDB não disponível")
+    
+    yield db
+    
+    await db.deadlines.delete_many({"id": {"$regex": "^test-reminder-"}})
+    await db.scheduler_leases.delete_many({"_id": {"$regex": "^test-"}})
+
+
+class TestReminderTimes:
+    """Hora de início, hora do lembrete e participantes."""
+    
+    def test_all_day_deadline_starts_at_configured_hour(self):
+        # Verão em Lisboa (UTC+1): 09:00 locais = 08:00 UTC
+        start = deadline_start({"due_date": "2026-07-01"}, tz="Europe/Lisbon")
+        assert start == datetime(2026, 7, 1, reminders_module.DEADLINE_ALL_DAY_HOUR - 1, tzinfo=timezone.utc)
+        
+        assert deadline_start({"due_date": "2026-07-01T15:00:00Z"}) == datetime(2026, 7, 1, 15, tzinfo=timezone.utc)
+        assert deadline_start({"due_date": "sem data"}) is None
+        print("✓ Início do prazo calculado")
+    
+    def test_no_reminder_when_done_sent_or_past(self):
+        deadline = starting_in(120)
+        assert reminder_at(deadline, 30) == deadline["due_at"] - timedelta(minutes=30)
+        
+        assert reminder_at({**deadline, "completed": True}) is None
+        assert reminder_at({**deadline, "reminder_sent_for": deadline["due_date"]}) is None
+        assert reminder_at(starting_in(-5)) is None
+        print("✓ Sem lembrete para prazos concluídos, enviados ou passados")
+    
+    def test_participants(self):
+        deadline = {"assigned_user_ids": ["a", "b"], "assigned_consultor_id": "a", "assigned_mediador_id": "c"}
+        assert deadline_participants(deadline) == ["a", "b", "c"]
+        print("✓ Participantes sem duplicados")
+
+
+class TestReminderHeap:
+    """Heap de lembretes: ordem, edição e cancelamento."""
+    
+    def test_pop_due_in_order_and_skip_stale(self):
+        engine = DeadlineReminderEngine(database=None, minutes_before=30)
+        first, second, moved, deleted = starting_in(40), starting_in(50), starting_in(45), starting_in(35)
+        for deadline in (first, second, moved, deleted):
+            engine._push(deadline)
+        
+        # Editado para mais tarde e apagado
+        engine._push({**moved, "due_date": (moved["due_at"] + timedelta(hours=3)).isoformat()})
+        engine.cancel(deleted["id"])
+        
+        due = engine._pop_due(datetime.now(timezone.utc) + timedelta(minutes=30))
+        assert [d["id"] for d in due] == [first["id"], second["id"]]
+        assert engine.pending_count == 1
+        print("✓ Lembretes retirados por ordem, sem entradas obsoletas")
+
+
+class TestReminderEngine:
+    """Envio à hora certa e coordenação entre réplicas."""
+    
+    @pytest.mark.asyncio
+    async def test_reminder_fires_when_due(self, reminders_db, sent):
+        deadline = starting_in(30 + 1 / 60)
+        await reminders_db.deadlines.insert_one(dict(deadline))
+        
+        engine = DeadlineReminderEngine(reminders_db, minutes_before=30, lease_seconds=3, resync_seconds=60)
+        engine.lease = reminders_module.LeaderLease(reminders_db, "test-deadline-reminders", 3)
+        engine.start()
+        try:
+            for _ in range(60):
+                if sent:
+                    break
+                await asyncio.sleep(0.1)
+        finally:
+            await engine.stop()
+        
+        assert sent == [(deadline["id"], ["test-reminder-user"], 30)]
+        stored = await reminders_db.deadlines.find_one({"id": deadline["id"]})
+        assert stored["reminder_sent_for"] == deadline["due_date"]
+        print("✓ Lembrete enviado à hora certa")
+    
+    @pytest.mark.asyncio
+    async def test_reminder_is_claimed_once(self, reminders_db, sent):
+        deadline = starting_in(10)
+        await reminders_db.deadlines.insert_one(dict(deadline))
+        
+        first = DeadlineReminderEngine(reminders_db)
+        second = DeadlineReminderEngine(reminders_db)
+        results = await asyncio.gather(first._fire(deadline), second._fire(deadline))
+        
+        assert sorted(results) == [False, True]
+        assert len(sent) == 1
+        
+        # Prazo alterado entretanto: a entrada antiga já não é enviada
+        await reminders_db.deadlines.update_one({"id": deadline["id"]}, {"$set": {"due_date": "2030-01-01"}})
+        assert not await first._fire({**deadline, "reminder_sent_for": None})
+        print("✓ Cada lembrete é enviado uma única vez")
+
+
+class TestDeedReminder:
+    """Lembrete de escritura criado pelos alertas (requer MongoDB)."""
+    
+    @pytest.mark.asyncio
+    async def test_deed_reminder_is_scheduled(self, reminders_db, monkeypatch):
+        from services import alerts
+        
+        scheduled = []
+        
+        async def fake_email(*args, **kwargs):
+            return True
+        
+        monkeypatch.setattr(alerts, "send_staff_email", fake_email)
+        monkeypatch.setattr(alerts.deadline_reminders, "schedule", scheduled.append)
+        
+        process = {"id": "test-reminder-deed", "client_name": "Rui Escritura", "consultor_id": "test-reminder-user"}
+        deed_date = (datetime.now(timezone.utc) + timedelta(days=30)).strftime("%Y-%m-%d")
+        try:
+            deadline_id = await alerts.create_deed_reminder(process, deed_date, {"id": "test-reminder-user"})
+            stored = await reminders_db.deadlines.find_one({"id": deadline_id}, {"_id": 0})
+        finally:
+            await reminders_db.deadlines.delete_many({"process_id": process["id"]})
+        
+        assert isinstance(stored["due_at"], datetime)
+        assert [d["id"] for d in scheduled] == [deadline_id]
+        # Carregado pelo motor (filtro em due_at)
+        assert reminder_at(stored) is not None
+        print("✓ Lembrete de escritura com due_at e agendado")
@@ -0,0 +1,123 @@
+"""
+Testes dos resumos de notificações por email (services/email_digest.py)
+"""
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+import pytest_asyncio
+
+import services.email_digest as digest_module
+from models.auth import EmailDigestMode
+from services.email_digest import digest_mode, digest_period, send_staff_email, send_email_digests
+
+
+def staff(user_id: str, mode: str = None) -> dict:
+    return {"id": f"test-digest-{user_id}", "email": f"{user_id}@test.pt", "name": user_id.title(), "email_digest_mode": mode}
+
+
+@pytest.fixture
+def outbox(monkeypatch):
+    """Emails colocados no outbox (substitui send_email_notification)."""
+    calls = []
+    
+    async def fake_send(to_email, subject, body, html_body=None, idempotency_key=None):
+        calls.append({"to": to_email, "subject": subject, "body": body, "html": html_body, "key": idempotency_key})
+        return True
+    
+    monkeypatch.setattr(digest_module, "send_email_notification", fake_send)
+    monkeypatch.setattr(digest_module, "is_smtp_configured", lambda: True)
+    return calls
+
+
+@pytest_asyncio.fixture
+async def digest_db():
+    """Base de dados de teste (salta se o MongoDB não estiver disponível)."""
+    from database import db
+    
+    try:
+        await asyncio.wait_for(db.command("ping"), timeout=2)
+    except Exception:
+        pytest.skip("MongoDB não disponível")
+    
+    yield db
+    await db.email_digest_events.delete_many({"user_id": {"$regex": "^test-digest-"}})
+
+
+class TestDigestPreference:
+    """Preferência e período do resumo."""
+    
+    def test_mode_defaults_to_immediate(self):
+        assert digest_mode({}) == EmailDigestMode.IMMEDIATE
+        assert digest_mode({"email_digest_mode": "semanal"}) == EmailDigestMode.IMMEDIATE
+        assert digest_mode({"email_digest_mode": "daily"}) == EmailDigestMode.DAILY
+        print("✓ Sem preferência: um email por evento")
+    
+    def test_period_in_local_time(self):
+        # 23:30 UTC no verão = 00:30 em Lisboa do dia seguinte
+        now = datetime(2026, 7, 1, 23, 30, tzinfo=timezone.utc)
+        assert digest_period(EmailDigestMode.HOURLY, now, tz="Europe/Lisbon") == "2026-07-02T00"
+        assert digest_period(EmailDigestMode.DAILY, now, tz="Europe/Lisbon") == "2026-07-02"
+        print("✓ Período do resumo no fuso local")
+
+
+class TestEmailDigests:
+    """Acumulação de eventos e envio do resumo (requer MongoDB)."""
+    
+    @pytest.mark.asyncio
+    async def test_immediate_user_gets_email_now(self, digest_db, outbox):
+        assert await send_staff_email(staff("rui"), "Novo Prazo", "Texto")
+        
+        assert [c["to"] for c in outbox] == ["rui@test.pt"]
+        assert await digest_db.email_digest_events.count_documents({"user_id": "test-digest-rui"}) == 0
+    
+    @pytest.mark.asyncio
+    async def test_events_are_summarised_once_per_user(self, digest_db, outbox):
+        ana, rui, eva = staff("ana", "hourly"), staff("rui", "hourly"), staff("eva", "daily")
+        for i in range(30):
+            await send_staff_email(ana, f"Mudança de fase {i}", "O processo mudou de fase", process_id="p1")
+        await send_staff_email(rui, "Novo Prazo", "Escritura")
+        await send_staff_email(eva, "Novo Prazo", "Escritura")
+        assert outbox == []
+        
+        assert await send_email_digests(EmailDigestMode.HOURLY, digest_db) == 2
+        
+        by_user = {c["to"]: c for c in outbox}
+        assert set(by_user) == {"ana@test.pt", "rui@test.pt"}
+        assert by_user["ana@test.pt"]["subject"] == "📬 Resumo horário: 30 notificações"
+        assert "Mudança de fase 29" in by_user["ana@test.pt"]["body"]
+        assert by_user["ana@test.pt"]["key"].startswith(f"digest:hourly:{ana['id']}:")
+        
+        # Os eventos enviados saem da colecção; o resumo diário fica à espera
+        assert await digest_db.email_digest_events.count_documents({"mode": "hourly"}) == 0
+        assert await digest_db.email_digest_events.count_documents({"mode": "daily"}) == 1
+        assert await send_email_digests(EmailDigestMode.HOURLY, digest_db) == 0
+        print("✓ 32 eventos → 2 emails de resumo horário")
+    
+    @pytest.mark.asyncio
+    async def test_late_events_get_a_new_digest_in_the_same_period(self, digest_db, outbox):
+        ana = staff("ana", "hourly")
+        now = datetime(2026, 5, 4, 10, 30, tzinfo=timezone.utc)
+        await send_staff_email(ana, "Novo Prazo", "Escritura")
+        await digest_db.email_digest_events.update_many({"user_id": ana["id"]}, {"$set": {"created_at": now}})
+        assert await send_email_digests(EmailDigestMode.HOURLY, digest_db, now=now) == 1
+        
+        # Evento chegado depois do envio, ainda no mesmo período
+        await send_staff_email(ana, "Documento Recebido", "Recibos")
+        await digest_db.email_digest_events.update_many({"user_id": ana["id"]}, {"$set": {"created_at": now}})
+        assert await send_email_digests(EmailDigestMode.HOURLY, digest_db, now=now) == 1
+        
+        assert len(outbox) == 2 and outbox[0]["key"] != outbox[1]["key"]
+        assert "Documento Recebido" in outbox[1]["body"]
+        print("✓ Eventos tardios seguem num novo resumo do mesmo período")
+    
+    @pytest.mark.asyncio
+    async def test_long_digest_is_capped(self, digest_db, outbox, monkeypatch):
+        monkeypatch.setattr(digest_module, "EMAIL_DIGEST_MAX_EVENTS", 5)
+        for i in range(8):
+            await send_staff_email(staff("ana", "daily"), f"Evento {i}", "Texto")
+        
+        assert await send_email_digests(EmailDigestMode.DAILY, digest_db) == 1
+        assert "Evento 4" in outbox[0]["body"] and "Evento 5" not in outbox[0]["body"]
+        assert "e mais 3 notificações" in outbox[0]["body"]
+        print("✓ Resumo longo: primeiros eventos listados, restantes contados")
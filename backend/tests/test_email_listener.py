@@ -0,0 +1,187 @@
+"""
+====================================================================
+TESTES DOS EMAILS EM TEMPO REAL (IMAP IDLE) - CREDITOIMO
+====================================================================
+IDLE contra o servidor IMAP local de substituição de conftest.py e
+escuta completa (encaminhamento, evento WebSocket e reconexão). Os
+testes da escuta requerem MongoDB.
+====================================================================
+"""
+
+import asyncio
+import threading
+import time
+import uuid
+
+import pytest
+import pytest_asyncio
+
+from services import email_listener as listener_module
+from services.email_listener import EmailListenerEngine, idle_wait
+from services.email_service import EmailAccount, connect_imap, select_folder
+from services.scheduler import LeaderLease
+from services.websocket_manager import manager, WSEventType
+
+CLIENT = "cliente@test.pt"
+
+
+def local_account(server, name: str = "precision") -> EmailAccount:
+    return EmailAccount(
+        name=name, imap_server="127.0.0.1", imap_port=server.port,
+        smtp_server="127.0.0.1", smtp_port=0,
+        email="geral@precision.pt", password="secret", imap_ssl=False
+    )
+
+
+async def wait_until(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condição não satisfeita a tempo"
+        await asyncio.sleep(0.05)
+
+
+class TestIdleWait:
+    """Comando IDLE (RFC 2177) numa sessão com a pasta seleccionada."""
+    
+    @pytest.mark.asyncio
+    async def test_new_message_ends_idle(self, imap_server):
+        mail = connect_imap(local_account(imap_server))
+        select_folder(mail, "INBOX")
+        loop = asyncio.get_running_loop()
+        
+        started = time.monotonic()
+        waiting = loop.run_in_executor(None, idle_wait, mail, 30, threading.Event())
+        await wait_until(lambda: any(c.upper().startswith("IDLE") for c in imap_server.commands))
+        imap_server.add_message("INBOX", CLIENT, "geral@precision.pt", "Documentos", "Em anexo")
+        
+        assert await waiting is True
+        assert time.monotonic() - started < 5
+        # A sessão continua utilizável depois do IDLE
+        assert mail.noop()[0] == "OK"
+        mail.logout()
+        print("✓ Mensagem nova termina o IDLE de imediato")
+    
+    @pytest.mark.asyncio
+    async def test_idle_ends_on_timeout_or_stop(self, imap_server):
+        mail = connect_imap(local_account(imap_server))
+        select_folder(mail, "INBOX")
+        loop = asyncio.get_running_loop()
+        
+        assert await loop.run_in_executor(None, idle_wait, mail, 0.3, threading.Event()) is False
+        
+        stop = threading.Event()
+        waiting = loop.run_in_executor(None, idle_wait, mail, 30, stop)
+        await asyncio.sleep(0.2)
+        stop.set()
+        assert await asyncio.wait_for(waiting, timeout=3) is False
+        assert mail.noop()[0] == "OK"
+        mail.logout()
+
+
+@pytest_asyncio.fixture
+async def listener_db():
+    """Processo de teste com consultor atribuído (salta sem MongoDB)."""
+    from database import db
+    
+    try:
+        await asyncio.wait_for(db.command("ping"), timeout=2)
+    except Exception:
+        pytest.skip("MongoDB não disponível")
+    
+    process_id = f"test-listener-{uuid.uuid4().hex[:8]}"
+    await db.processes.insert_one({
+        "id": process_id, "client_name": "Marta Escuta", "client_email": CLIENT,
+        "status": "fase_documental", "assigned_consultor_id": "test-listener-consultor"
+    })
+    
+    yield db, process_id
+    
+    await db.processes.delete_one({"id": process_id})
+    await db.emails.delete_many({"process_id": process_id})
+    await db.email_sync_state.delete_many({"scope": "mailbox"})
+    await db.scheduler_leases.delete_many({"_id": {"$regex": "^test-"}})
+    await db.notifications.delete_many({"process_id": process_id})
+    await db.notification_counters.delete_many({"user_id": "test-listener-consultor"})
+
+
+@pytest.fixture
+def ws_events(monkeypatch):
+    """Eventos `email_received` enviados (utilizadores todos ligados)."""
+    events = []
+    
+    async def fake_send(message, user_id):
+        if message["type"] == WSEventType.EMAIL_RECEIVED:
+            events.append((user_id, message))
+    
+    monkeypatch.setattr(manager, "is_user_connected", lambda user_id: True)
+    monkeypatch.setattr(manager, "send_personal_message", fake_send)
+    return events
+
+
+class TestEmailListener:
+    """Escuta das caixas: encaminhamento, evento e reconexão (requer MongoDB)."""
+    
+    @pytest.mark.asyncio
+    async def test_new_mail_reaches_process_and_staff(self, listener_db, imap_server, ws_events, monkeypatch):
+        db, process_id = listener_db
+        monkeypatch.setattr(listener_module, "get_email_accounts", lambda: [local_account(imap_server)])
+        # Já estava na caixa antes da escuta começar: lido na ligação
+        imap_server.add_message("INBOX", CLIENT, "geral@precision.pt", "Pedido inicial", "Olá")
+        
+        engine = EmailListenerEngine(db, lease_seconds=3, backoff_seconds=0.1)
+        engine.lease = LeaderLease(db, "test-email-listener", 3)
+        engine.start()
+        try:
+            await wait_until(lambda: len(ws_events) == 1)
+            await wait_until(lambda: any(c.upper().startswith("IDLE") for c in imap_server.commands))
+            
+            imap_server.add_message("INBOX", CLIENT, "geral@precision.pt", "Recibos de vencimento", "Em anexo")
+            imap_server.add_message("Sent", "geral@precision.pt", CLIENT, "Re: Recibos de vencimento", "Obrigado")
+            await wait_until(lambda: len(ws_events) == 3)
+        finally:
+            await engine.stop()
+        
+        subjects = {
+            em["subject"]
+            for _, message in ws_events
+            for em in message["data"]["emails"]
+        }
+        assert subjects == {"Pedido inicial", "Recibos de vencimento", "Re: Recibos de vencimento"}
+        user_id, message = ws_events[-1]
+        assert user_id == "test-listener-consultor"
+        assert message["type"] == WSEventType.EMAIL_RECEIVED
+        assert message["data"]["process_id"] == process_id
+        
+        assert await db.emails.count_documents({"process_id": process_id}) == 3
+        # Aviso guardado para quem está ligado a outro worker
+        notifications = await db.notifications.find(
+            {"process_id": process_id, "user_id": "test-listener-consultor"}, {"_id": 0}
+        ).to_list(None)
+        assert len(notifications) == 3 and notifications[0]["title"] == "📧 Novo email"
+        inbox = await db.email_sync_state.find_one({"account": "precision", "scope": "mailbox", "folder": "INBOX"})
+        assert inbox["last_uid"] == 2
+        print("✓ Email recebido em tempo real: guardado no processo e evento para o consultor")
+    
+    @pytest.mark.asyncio
+    async def test_listener_reconnects_after_drop(self, listener_db, imap_server, ws_events, monkeypatch):
+        db, process_id = listener_db
+        monkeypatch.setattr(listener_module, "get_email_accounts", lambda: [local_account(imap_server)])
+        
+        engine = EmailListenerEngine(db, lease_seconds=3, backoff_seconds=0.1)
+        engine.lease = LeaderLease(db, "test-email-listener", 3)
+        engine.start()
+        try:
+            await wait_until(lambda: engine.listeners.get("precision:INBOX", {}).get("connected"))
+            imap_server.drop_sessions()
+            # Chegou enquanto a sessão estava em baixo
+            imap_server.add_message("INBOX", CLIENT, "geral@precision.pt", "Durante a falha", "Texto")
+            
+            await wait_until(lambda: engine.listeners["precision:INBOX"]["connections"] >= 2)
+            await wait_until(lambda: len(ws_events) == 1)
+        finally:
+            await engine.stop()
+        
+        status = engine.listeners["precision:INBOX"]
+        assert status["errors"] >= 1 and status["ingested"] == 1
+        assert await db.emails.count_documents({"process_id": process_id, "subject": "Durante a falha"}) == 1
+        print("✓ Sessão IDLE perdida: religada e mensagens em falta recuperadas")
@@ -0,0 +1,175 @@
+"""
+====================================================================
+TESTES DO OUTBOX DE EMAILS - CREDITOIMO
+====================================================================
+Idempotência, resultado de entrega (enviado, recusado, retry) e ritmo
+por fornecedor, contra o servidor SMTP local de substituição de
+conftest.py. Os testes do outbox requerem MongoDB (MONGO_URL).
+====================================================================
+"""
+
+import asyncio
+import uuid
+from datetime import datetime, timezone, timedelta
+
+import pytest
+import pytest_asyncio
+
+from services import email as email_service
+from services.email_outbox import (
+    EmailOutboxWorker,
+    ProviderRateLimiter,
+    compute_email_retry_delay,
+    enqueue_email,
+    is_permanent_failure,
+    parse_provider_rates,
+    EMAIL_RETRY_BASE_SECONDS,
+    EMAIL_RETRY_MAX_SECONDS,
+)
+from services.smtp_pool import SMTPPool
+
+
+@pytest_asyncio.fixture
+async def outbox_db():
+    """Base de dados de teste (salta se o MongoDB não estiver disponível)."""
+    from database import db
+    
+    try:
+        await asyncio.wait_for(db.command("ping"), timeout=2)
+    except Exception:
+        pytest.skip("MongoDB não disponível")
+    
+    # Índice criado no arranque do servidor (server.py)
+    await db.email_outbox.create_index("idempotency_key", unique=True)
+    
+    yield db
+    
+    await db.email_outbox.delete_many({"provider": {"$regex": "^test-outbox-"}})
+    await db.email_rate_limits.delete_many({"_id": {"$regex": "^test-outbox-"}})
+
+
+@pytest.fixture
+def provider():
+    return f"test-outbox-{uuid.uuid4().hex[:8]}"
+
+
+@pytest.fixture
+def email_transport(smtp_server, monkeypatch):
+    """SMTP configurado e apontado para o servidor local."""
+    transport = SMTPPool("127.0.0.1", smtp_server.port, "sistema@test.pt", "secret", size=2, use_ssl=False)
+    monkeypatch.setattr(email_service, "smtp_transport", transport)
+    monkeypatch.setattr(email_service, "SMTP_SERVER", "127.0.0.1")
+    monkeypatch.setattr(email_service, "SMTP_EMAIL", "sistema@test.pt")
+    monkeypatch.setattr(email_service, "SMTP_PASSWORD", "secret")
+    return transport
+
+
+def fast_worker(**kwargs) -> EmailOutboxWorker:
+    return EmailOutboxWorker(limiter=ProviderRateLimiter(default_rate=6000, burst=100), **kwargs)
+
+
+class TestOutboxPolicy:
+    """Classificação de falhas e backoff."""
+    
+    def test_failure_classification_and_backoff(self):
+        assert is_permanent_failure({"ok": False, "code": 550})
+        assert not is_permanent_failure({"ok": False, "code": 451})
+        assert not is_permanent_failure({"ok": False, "code": None})
+        
+        assert EMAIL_RETRY_BASE_SECONDS / 2 <= compute_email_retry_delay(1) <= EMAIL_RETRY_BASE_SECONDS
+        assert compute_email_retry_delay(50) <= EMAIL_RETRY_MAX_SECONDS
+        assert parse_provider_rates("SMTP.A.pt=20, smtp.b.pt=100,invalido") == {"smtp.a.pt": 20, "smtp.b.pt": 100}
+        print("✓ 5xx definitivo, 4xx e erros de ligação com retry")
+
+
+class TestEmailOutbox:
+    """Outbox persistente contra o servidor SMTP local (requer MongoDB)."""
+    
+    @pytest.mark.asyncio
+    async def test_enqueue_is_idempotent(self, outbox_db, provider):
+        assert await enqueue_email("a@test.pt", "Registo", "Texto", idempotency_key=f"{provider}:1", provider=provider)
+        assert not await enqueue_email("a@test.pt", "Registo", "Texto", idempotency_key=f"{provider}:1", provider=provider)
+        
+        assert await outbox_db.email_outbox.count_documents({"provider": provider}) == 1
+        print("✓ Chave repetida não gera segundo email")
+    
+    @pytest.mark.asyncio
+    async def test_enqueue_without_key_is_not_deduplicated(self, outbox_db, provider):
+        # O mesmo lembrete duas vezes no mesmo dia são dois emails
+        assert await enqueue_email("a@test.pt", "Lembrete", "Texto", provider=provider)
+        assert await enqueue_email("a@test.pt", "Lembrete", "Texto", provider=provider)
+        
+        assert await outbox_db.email_outbox.count_documents({"provider": provider}) == 2
+        print("✓ Sem chave, pedidos iguais não são deduplicados")
+    
+    @pytest.mark.asyncio
+    async def test_delivery_outcomes(self, outbox_db, provider, smtp_server, email_transport):
+        for to in ("ok@test.pt", "reject@test.pt", "busy@test.pt"):
+            await enqueue_email(to, "Estado", "Texto", provider=provider)
+        
+        started = datetime.now(timezone.utc)
+        await fast_worker().drain()
+        jobs = {
+            job["to"]: job
+            async for job in outbox_db.email_outbox.find({"provider": provider}, {"_id": 0})
+        }
+        
+        assert jobs["ok@test.pt"]["status"] == "sent" and jobs["ok@test.pt"]["sent_at"]
+        assert jobs["reject@test.pt"]["status"] == "dead" and jobs["reject@test.pt"]["reason"] == "rejected"
+        assert jobs["reject@test.pt"]["last_code"] == 550
+        
+        retry = jobs["busy@test.pt"]
+        assert retry["status"] == "pending" and retry["attempts"] == 1 and retry["last_code"] == 451
+        next_attempt = retry["next_attempt_at"].replace(tzinfo=timezone.utc)
+        assert next_attempt >= started + timedelta(seconds=EMAIL_RETRY_BASE_SECONDS / 2)
+        assert [m["to"] for m in smtp_server.messages] == [["ok@test.pt"]]
+        print("✓ Enviado, recusado (dead) e falha temporária reagendada")
+    
+    @pytest.mark.asyncio
+    async def test_unconfirmed_send_is_not_retried(self, outbox_db, provider):
+        async def sender(job):
+            return {"to": job["to"], "ok": False, "error": "Tempo de envio excedido (60s)", "code": None, "unconfirmed": True}
+        
+        await enqueue_email("lento@test.pt", "Estado", "Texto", provider=provider)
+        stats = await fast_worker(sender=sender).drain()
+        
+        job = await outbox_db.email_outbox.find_one({"provider": provider}, {"_id": 0})
+        assert stats["dead"] == 1 and stats["retried"] == 0
+        assert job["status"] == "dead" and job["reason"] == "unconfirmed" and job["attempts"] == 1
+        print("✓ Envio sem confirmação não é repetido")
+    
+    @pytest.mark.asyncio
+    async def test_rate_limit_per_provider(self, outbox_db, provider):
+        sent = []
+        
+        async def sender(job):
+            sent.append(job["to"])
+            return {"to": job["to"], "ok": True, "error": None, "code": None}
+        
+        for i in range(5):
+            await enqueue_email(f"lote{i}@test.pt", "Estado", "Texto", provider=provider)
+        
+        # 60 por minuto, rajada de 2: dois envios agora, o próximo daqui a ~1s
+        worker = EmailOutboxWorker(sender=sender, limiter=ProviderRateLimiter(default_rate=60, burst=2))
+        stats = await worker.drain()
+        assert len(sent) == 2 and stats["throttled"] == 3
+        assert 0 < worker._throttle_wait <= 1
+        
+        await asyncio.sleep(1.1)
+        await worker.drain()
+        assert len(sent) == 3
+        print("✓ Ritmo de envio limitado por fornecedor")
+    
+    @pytest.mark.asyncio
+    async def test_notification_is_queued_not_sent_inline(self, outbox_db, smtp_server, email_transport):
+        to = f"fila-{uuid.uuid4().hex[:8]}@test.pt"
+        assert await email_service.send_email_notification(to, "Novo Processo", "Texto")
+        assert smtp_server.messages == []
+        
+        job = await outbox_db.email_outbox.find_one({"to": to})
+        assert job["status"] == "pending" and job["provider"] == "127.0.0.1"
+        
+        await outbox_db.email_outbox.update_one({"to": to}, {"$set": {"provider": "test-outbox-inline"}})
+        await fast_worker().drain()
+        assert [m["to"] for m in smtp_server.messages] == [[to]]
+        print("✓ send_email_notification fica no outbox e sai pelo worker")
@@ -0,0 +1,217 @@
+"""
+====================================================================
+TESTES DO ARMAZENAMENTO DOS EMAILS - CREDITOIMO
+====================================================================
+Resumo dos emails (pré-visualização, chave da conversa, tamanhos),
+corpos comprimidos em `email_bodies`, listagem por cursor e migração
+dos documentos antigos. Os testes da base de dados requerem MongoDB.
+====================================================================
+"""
+
+import asyncio
+import uuid
+
+import pytest
+import pytest_asyncio
+
+from services import email_store
+from services.email_service import store_synced_emails
+from services.email_store import (
+    compact_email, email_preview, thread_key, store_email, load_email_body,
+    delete_email_bodies, list_process_emails, move_email_bodies, InvalidEmailCursorError
+)
+
+
+def email_doc(process_id: str, i: int, sent_at=None, body: str = "Texto", body_html: str = None) -> dict:
+    return {
+        "id": f"{process_id}-{i:03d}",
+        "process_id": process_id,
+        "direction": "received",
+        "from_email": "cliente@test.pt",
+        "to_emails": ["geral@precision.pt"],
+        "subject": f"Documentos {i}",
+        "body": body,
+        "body_html": body_html,
+        "attachments": [],
+        "status": "sent",
+        "sent_at": sent_at if sent_at is not None else f"2026-01-01T10:{i:02d}:00+00:00",
+        "created_at": "2026-01-01T10:00:00+00:00"
+    }
+
+
+class TestEmailSummary:
+    """Resumo calculado a partir do corpo."""
+    
+    def test_preview_drops_quoted_reply(self):
+        body = (
+            "Bom dia,\n\nSeguem   os recibos.\n\n"
+            "Em 3 de jan. de 2026, às 10:00, Precision <geral@precision.pt> escreveu:\n"
+            "> Pode enviar os recibos?\n"
+        )
+        assert email_preview(body) == "Bom dia, Seguem os recibos."
+        assert email_preview("> citação\nResposta") == "Resposta"
+        print("✓ Pré-visualização sem a mensagem citada")
+    
+    def test_preview_from_html_and_truncated(self):
+        body_html = (
+            "<html><head><style>p {color: red}</style></head><body>"
+            "<p>Caro&nbsp;cliente,</p><div>segue a simulação.</div>"
+            "<blockquote>mensagem anterior</blockquote></body></html>"
+        )
+        assert email_preview("", body_html) == "Caro cliente, segue a simulação."
+        
+        preview = email_preview("palavra " * 100, length=20)
+        assert preview == "palavra palavra pala…"
+    
+    def test_thread_key_ignores_reply_prefixes(self):
+        key = thread_key("Recibos de vencimento")
+        assert thread_key("RE: Fwd:  recibos de  vencimento") == key
+        assert thread_key("Res: ENC: Recibos de vencimento") == key
+        assert thread_key("Re[2]: Recibos de vencimento") == key
+        assert thread_key("Recibos de junho") != key
+    
+    def test_compact_email_moves_body_out(self):
+        summary, body = compact_email(email_doc("p", 1, body="Olá " * 50, body_html="<p>Olá</p>"))
+        
+        assert "body" not in summary and "body_html" not in summary
+        assert body == {"body": "Olá " * 50, "body_html": "<p>Olá</p>"}
+        assert summary["body_size"] == len(("Olá " * 50).encode())
+        assert summary["html_size"] == len("<p>Olá</p>".encode()) and summary["has_html"] is True
+        assert summary["attachments_count"] == 0
+        assert summary["thread_key"] == thread_key("Documentos 1")
+
+
+@pytest_asyncio.fixture
+async def store_db():
+    """Base de dados de teste (salta se o MongoDB não estiver disponível)."""
+    from database import db
+    
+    try:
+        await asyncio.wait_for(db.command("ping"), timeout=2)
+    except Exception:
+        pytest.skip("MongoDB não disponível")
+    
+    process_id = f"test-store-{uuid.uuid4().hex[:8]}"
+    
+    yield db, process_id
+    
+    ids = [em["id"] async for em in db.emails.find({"process_id": process_id}, {"_id": 0, "id": 1})]
+    await delete_email_bodies(ids, db)
+    await db.emails.delete_many({"process_id": process_id})
+
+
+class TestEmailBodies:
+    """Corpos comprimidos fora do documento principal (requer MongoDB)."""
+    
+    @pytest.mark.asyncio
+    async def test_body_is_stored_compressed_apart(self, store_db):
+        db, process_id = store_db
+        newsletter = "<table><tr><td>Oferta especial de crédito habitação</td></tr></table>" * 2000
+        
+        summary = await store_email(email_doc(process_id, 1, body="Texto simples", body_html=newsletter), db)
+        
+        stored = await db.emails.find_one({"id": summary["id"]}, {"_id": 0})
+        assert "body" not in stored and "body_html" not in stored
+        assert stored["html_size"] == len(newsletter.encode())
+        
+        body_doc = await db.email_bodies.find_one({"email_id": summary["id"]})
+        assert body_doc["compression"] == "zlib"
+        assert body_doc["size"] < len(newsletter) / 20
+        
+        assert await load_email_body(stored, db) == {"body": "Texto simples", "body_html": newsletter}
+        print(f"✓ Corpo HTML de {len(newsletter)} bytes guardado em {body_doc['size']} bytes")
+    
+    @pytest.mark.asyncio
+    async def test_large_body_goes_to_gridfs(self, store_db, monkeypatch):
+        db, process_id = store_db
+        monkeypatch.setattr(email_store, "EMAIL_BODY_GRIDFS_BYTES", 10)
+        
+        summary = await store_email(email_doc(process_id, 1, body="Corpo guardado no GridFS"), db)
+        body_doc = await db.email_bodies.find_one({"email_id": summary["id"]})
+        assert "file_id" in body_doc and "data" not in body_doc
+        assert (await load_email_body(summary, db))["body"] == "Corpo guardado no GridFS"
+        
+        await delete_email_bodies([summary["id"]], db)
+        assert await db.email_bodies.count_documents({"email_id": summary["id"]}) == 0
+        assert await db[f"{email_store.EMAIL_BODIES_BUCKET}.files"].count_documents({"_id": body_doc["file_id"]}) == 0
+    
+    @pytest.mark.asyncio
+    async def test_resynced_emails_leave_no_orphan_bodies(self, store_db):
+        db, process_id = store_db
+        emails = [
+            {
+                "direction": "received", "from_email": "cliente@test.pt", "to_emails": ["geral@precision.pt"],
+                "subject": f"Documentos {i}", "body": f"Segue o documento {i}", "date": "2026-01-01T10:00:00+00:00",
+                "account": "precision", "message_id": f"<doc{i}@test.pt>"
+            }
+            for i in range(3)
+        ]
+        
+        assert await store_synced_emails(process_id, emails, db) == 3
+        assert await store_synced_emails(process_id, emails, db) == 0
+        
+        ids = [em["id"] async for em in db.emails.find({"process_id": process_id}, {"_id": 0, "id": 1})]
+        assert await db.email_bodies.count_documents({"email_id": {"$in": ids}}) == 3
+        stored = await db.emails.find_one({"process_id": process_id, "subject": "Documentos 2"}, {"_id": 0})
+        assert stored["preview"] == "Segue o documento 2"
+        assert (await load_email_body(stored, db))["body"] == "Segue o documento 2"
+
+
+class TestProcessEmailList:
+    """Listagem dos resumos por cursor (requer MongoDB)."""
+    
+    @pytest.mark.asyncio
+    async def test_cursor_pages_cover_every_email_once(self, store_db):
+        db, process_id = store_db
+        for i in range(7):
+            await store_email(email_doc(process_id, i), db)
+        # Emails sem data ficam no fim
+        for i in (7, 8):
+            doc = email_doc(process_id, i)
+            doc["sent_at"] = None
+            await store_email(doc, db)
+        
+        pages, cursor = [], None
+        while True:
+            page = await list_process_emails(process_id, cursor=cursor, limit=3, database=db)
+            pages.append(page["emails"])
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+        
+        ids = [em["id"] for page in pages for em in page]
+        assert len(pages) == 3
+        assert ids == [f"{process_id}-{i:03d}" for i in (6, 5, 4, 3, 2, 1, 0, 8, 7)]
+        assert all("body" not in em and em["preview"] == "Texto" for page in pages for em in page)
+        print("✓ 9 emails em 3 páginas por cursor, sem repetições nem corpos")
+    
+    @pytest.mark.asyncio
+    async def test_invalid_cursor_is_rejected(self, store_db):
+        db, process_id = store_db
+        with pytest.raises(InvalidEmailCursorError):
+            await list_process_emails(process_id, cursor="não-é-um-cursor", database=db)
+
+
+class TestEmailBodiesMigration:
+    """Migração dos emails guardados com o corpo no documento (requer MongoDB)."""
+    
+    @pytest.mark.asyncio
+    async def test_legacy_bodies_are_moved(self, store_db):
+        db, process_id = store_db
+        await db.emails.insert_many([
+            email_doc(process_id, i, body=f"Resposta {i}\n> citação", body_html=f"<p>Resposta {i}</p>")
+            for i in range(5)
+        ])
+        legacy = await db.emails.find_one({"id": f"{process_id}-000"}, {"_id": 0})
+        assert (await load_email_body(legacy, db))["body"] == "Resposta 0\n> citação"
+        
+        assert await move_email_bodies(db) >= 5
+        
+        migrated = await db.emails.find({"process_id": process_id}, {"_id": 0}).to_list(10)
+        assert all("body" not in em and "body_html" not in em for em in migrated)
+        assert {em["preview"] for em in migrated} == {f"Resposta {i}" for i in range(5)}
+        assert await load_email_body(migrated[0], db) == {
+            "body": f"{migrated[0]['subject'].replace('Documentos', 'Resposta')}\n> citação",
+            "body_html": f"<p>{migrated[0]['subject'].replace('Documentos', 'Resposta')}</p>"
+        }
+        print("✓ Corpos dos emails antigos movidos para email_bodies")
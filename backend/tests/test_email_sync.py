@@ -0,0 +1,455 @@
+"""
+====================================================================
+TESTES DA SINCRONIZAÇÃO IMAP INCREMENTAL - CREDITOIMO
+====================================================================
+Checkpoints por conta e pasta (UIDVALIDITY + último UID) e leitura
+em duas fases (cabeçalhos primeiro, texto só do que interessa, anexos
+a pedido) e sincronização de cada caixa numa só passagem para todos os
+processos (services/email_sync.py) contra o servidor IMAP local de substituição de conftest.py.
+Os testes da sincronização por processo requerem MongoDB (MONGO_URL).
+====================================================================
+"""
+
+import asyncio
+import uuid
+
+import pytest
+import pytest_asyncio
+
+from services import email_service
+from services.email_sync import AhoCorasick, ClientIndex, sync_all_mailboxes
+from services.email_service import (
+    EmailAccount,
+    FolderWindow,
+    SyncCheckpoints,
+    backfill_email_dedupe_keys,
+    decode_folder_name,
+    email_dedupe_key,
+    fetch_email_attachment,
+    fetch_emails_by_name,
+    fetch_emails_from_account,
+    message_parts,
+    normalize_message_id,
+    parse_fetch_response,
+    search_fingerprint,
+    store_synced_emails,
+    sync_emails_for_process,
+)
+
+CLIENT = "cliente@test.pt"
+
+# PDF digitalizado de ~400 KB (anexo típico dos emails de clientes)
+SCANNED_PDF = b"%PDF-1.4\n" + bytes(range(256)) * 1600
+
+
+def local_account(server, name: str = "precision") -> EmailAccount:
+    return EmailAccount(
+        name=name, imap_server="127.0.0.1", imap_port=server.port,
+        smtp_server="127.0.0.1", smtp_port=0,
+        email="geral@precision.pt", password="secret", imap_ssl=False
+    )
+
+
+def fill_inbox(server, count: int, start: int = 0):
+    for i in range(start, start + count):
+        server.add_message("INBOX", CLIENT, "geral@precision.pt", f"Documentos {i}", f"Segue o documento {i}")
+
+
+def fetched_uids(server) -> list:
+    """UIDs pedidos nos comandos UID FETCH."""
+    uids = []
+    for command in server.fetch_commands():
+        uids.extend(int(uid) for uid in command.split(" ")[2].split(","))
+    return uids
+
+
+@pytest_asyncio.fixture
+async def sync_db():
+    """Base de dados de teste (salta se o MongoDB não estiver disponível)."""
+    from database import db
+    
+    try:
+        await asyncio.wait_for(db.command("ping"), timeout=2)
+    except Exception:
+        pytest.skip("MongoDB não disponível")
+    
+    process_id = f"test-sync-{uuid.uuid4().hex[:8]}"
+    await db.processes.insert_one({"id": process_id, "client_name": "Ana Sofia Teixeira", "client_email": CLIENT})
+    
+    yield db, process_id
+    
+    await db.processes.delete_one({"id": process_id})
+    await db.emails.delete_many({"process_id": process_id})
+    await db.email_sync_state.delete_many({"scope": process_id})
+
+
+class TestFolderCheckpoints:
+    """Intervalo de UIDs novos por pasta."""
+    
+    @pytest.mark.asyncio
+    async def test_only_new_uids_are_fetched(self, imap_server):
+        fill_inbox(imap_server, 5)
+        account = local_account(imap_server)
+        
+        checkpoints = SyncCheckpoints(account.name)
+        found = await fetch_emails_from_account(account, [CLIENT], checkpoints=checkpoints)
+        assert len(found) == 5
+        assert checkpoints.windows["INBOX"] == FolderWindow(uidvalidity=1, first_uid=1, last_uid=5)
+        
+        # Segunda leitura a partir do checkpoint: só a mensagem nova
+        fill_inbox(imap_server, 1, start=5)
+        imap_server.commands.clear()
+        state = {"INBOX": {"folder": "INBOX", "uidvalidity": 1, "last_uid": 5}}
+        checkpoints = SyncCheckpoints(account.name, states=state)
+        found = await fetch_emails_from_account(account, [CLIENT], checkpoints=checkpoints)
+        
+        assert [e["subject"] for e in found] == ["Documentos 5"]
+        assert set(fetched_uids(imap_server)) == {6}
+        assert checkpoints.windows["INBOX"].last_uid == 6
+        print("✓ Só os UIDs posteriores ao checkpoint são descarregados")
+    
+    @pytest.mark.asyncio
+    async def test_no_new_mail_fetches_nothing(self, imap_server):
+        fill_inbox(imap_server, 3)
+        account = local_account(imap_server)
+        
+        state = {"INBOX": {"folder": "INBOX", "uidvalidity": 1, "last_uid": 3}}
+        checkpoints = SyncCheckpoints(account.name, states=state)
+        assert await fetch_emails_from_account(account, [CLIENT], checkpoints=checkpoints) == []
+        
+        # `3:*` devolve a última mensagem (UID 3), que não pode ser relida
+        assert checkpoints.windows["INBOX"] == FolderWindow(1, 4, 3)
+        assert imap_server.fetch_commands() == []
+    
+    @pytest.mark.asyncio
+    async def test_uidvalidity_change_resets_folder(self, imap_server):
+        fill_inbox(imap_server, 4)
+        imap_server.recreate_folder("INBOX")
+        account = local_account(imap_server)
+        
+        state = {"INBOX": {"folder": "INBOX", "uidvalidity": 1, "last_uid": 4}}
+        checkpoints = SyncCheckpoints(account.name, states=state)
+        found = await fetch_emails_from_account(account, [CLIENT], checkpoints=checkpoints)
+        
+        assert len(found) == 4
+        assert checkpoints.windows["INBOX"] == FolderWindow(uidvalidity=2, first_uid=1, last_uid=4)
+        print("✓ UIDVALIDITY diferente: pasta relida de início")
+    
+    @pytest.mark.asyncio
+    async def test_missing_folder_is_skipped(self, imap_server):
+        checkpoints = SyncCheckpoints("precision")
+        found = await fetch_emails_from_account(local_account(imap_server), [CLIENT], folder="Enviados", checkpoints=checkpoints)
+        
+        assert found == [] and checkpoints.windows == {}
+    
+    def test_fingerprint_follows_search_terms(self):
+        assert search_fingerprint("Ana", ["b@test.pt", "a@test.pt"]) == search_fingerprint(" ana ", ["a@test.pt", "b@test.pt"])
+        assert search_fingerprint("Ana", ["a@test.pt"]) != search_fingerprint("Ana", ["a@test.pt", "c@test.pt"])
+
+
+class TestHeaderFirstFetch:
+    """Cabeçalhos e BODYSTRUCTURE primeiro; texto só das mensagens relevantes."""
+    
+    def test_parse_fetch_response(self):
+        data = [
+            (b'1 (UID 7 BODY[HEADER.FIELDS (FROM SUBJECT)] {31}', b"From: a@test.pt\r\nSubject: Ol\xc3\xa1\r\n"),
+            b' BODYSTRUCTURE (("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "QUOTED-PRINTABLE" 120 4 NIL NIL NIL NIL)'
+            b'("APPLICATION" "PDF" NIL NIL NIL "BASE64" 540000 NIL ("ATTACHMENT" ("FILENAME" "IRS 2025.pdf")) NIL NIL) "MIXED"))',
+            b'2 (UID 9 BODYSTRUCTURE ("TEXT" "HTML" ("CHARSET" "iso-8859-1") NIL NIL "7BIT" 80 2 NIL NIL NIL NIL))'
+        ]
+        
+        first, second = parse_fetch_response(data)
+        assert first["UID"] == "7" and first["BODY[HEADER.FIELDS (FROM SUBJECT)]"].startswith(b"From:")
+        text, pdf = message_parts(first["BODYSTRUCTURE"])
+        assert (text.section, text.content_type, text.charset, text.attachment) == ("1", "text/plain", "utf-8", False)
+        assert (pdf.section, pdf.filename, pdf.size, pdf.attachment) == ("2", "IRS 2025.pdf", 540000, True)
+        
+        [html] = message_parts(second["BODYSTRUCTURE"])
+        assert (html.section, html.content_type, html.attachment) == ("1", "text/html", False)
+        print("✓ Resposta FETCH com literais e BODYSTRUCTURE interpretada")
+    
+    @pytest.mark.asyncio
+    async def test_attachments_are_not_downloaded(self, imap_server):
+        for i in range(5):
+            imap_server.add_message(
+                "INBOX", CLIENT, "geral@precision.pt", f"Documentos {i}", "Segue o relatório de avaliação",
+                html="<p>Segue o relatório de avaliação</p>", attachments=[(f"IRS {i}.pdf", SCANNED_PDF)]
+            )
+        mailbox_bytes = sum(len(m["raw"]) for m in imap_server.folders["INBOX"]["messages"])
+        
+        found = await fetch_emails_from_account(local_account(imap_server), [CLIENT])
+        
+        assert len(found) == 5
+        assert found[0]["body"].strip() == "Segue o relatório de avaliação"
+        assert "<p>Segue o relatório de avaliação</p>" in found[0]["body_html"]
+        assert found[0]["attachments"][0]["filename"] == "IRS 0.pdf"
+        assert found[0]["attachments"][0]["content_type"] == "application/pdf"
+        assert imap_server.fetched_bytes * 10 < mailbox_bytes
+        print(f"✓ {imap_server.fetched_bytes} bytes lidos de uma caixa com {mailbox_bytes}")
+    
+    @pytest.mark.asyncio
+    async def test_unrelated_messages_stay_at_headers(self, imap_server):
+        for i in range(10):
+            imap_server.add_message("INBOX", "outro@test.pt", "geral@precision.pt", f"Newsletter {i}",
+                                    "Novidades do mercado", attachments=[("catalogo.pdf", SCANNED_PDF)])
+        imap_server.add_message("INBOX", "banco@test.pt", "geral@precision.pt", "Avaliação",
+                                "Relatório da cliente Ana Teixeira")
+        
+        found = await fetch_emails_by_name(local_account(imap_server), "Ana Teixeira", include_client_folders=False)
+        
+        assert [e["matched_by"] for e in found] == ["client_name_body"]
+        # Pesquisa no corpo: só as partes de texto das candidatas, nunca os PDFs
+        assert imap_server.fetched_bytes < len(SCANNED_PDF) / 10
+    
+    @pytest.mark.asyncio
+    async def test_attachment_on_demand(self, imap_server, monkeypatch):
+        account = local_account(imap_server)
+        monkeypatch.setattr(email_service, "get_email_accounts", lambda: [account])
+        imap_server.add_message("INBOX", CLIENT, "geral@precision.pt", "IRS", "Em anexo",
+                                attachments=[("IRS 2025.pdf", SCANNED_PDF)])
+        [found] = await fetch_emails_from_account(account, [CLIENT])
+        
+        attachment, content = await fetch_email_attachment(found, 0)
+        assert attachment["filename"] == "IRS 2025.pdf" and content == SCANNED_PDF
+        
+        # Pasta recriada no servidor: o UID guardado já não é válido
+        imap_server.recreate_folder("INBOX")
+        assert await fetch_email_attachment(found, 0) is None
+        assert await fetch_email_attachment(found, 1) is None
+        print("✓ Anexo descarregado só quando é aberto")
+
+
+class TestIncrementalSync:
+    """Sincronização por processo com checkpoints gravados (requer MongoDB)."""
+    
+    @pytest.mark.asyncio
+    async def test_second_sync_reads_only_new_mail(self, sync_db, imap_server, monkeypatch):
+        db, process_id = sync_db
+        monkeypatch.setattr(email_service, "get_email_accounts", lambda: [local_account(imap_server)])
+        fill_inbox(imap_server, 20)
+        imap_server.add_message("Sent", "geral@precision.pt", CLIENT, "Re: Documentos", "Obrigado")
+        
+        first = await sync_emails_for_process(process_id)
+        assert first["new_imported"] == 21
+        state = await db.email_sync_state.find_one({"scope": process_id, "folder": "INBOX"})
+        assert state["uidvalidity"] == 1 and state["last_uid"] == 20
+        
+        fill_inbox(imap_server, 2, start=20)
+        imap_server.commands.clear()
+        second = await sync_emails_for_process(process_id)
+        
+        assert second["total_found"] == 2 and second["new_imported"] == 2
+        assert sorted(set(fetched_uids(imap_server))) == [21, 22]
+        assert await db.emails.count_documents({"process_id": process_id}) == 23
+        print("✓ 21 emails na primeira sincronização, 2 novos na segunda")
+    
+    @pytest.mark.asyncio
+    async def test_new_monitored_email_rereads_folders(self, sync_db, imap_server, monkeypatch):
+        db, process_id = sync_db
+        monkeypatch.setattr(email_service, "get_email_accounts", lambda: [local_account(imap_server)])
+        imap_server.add_message("INBOX", "banco@test.pt", "geral@precision.pt", "Avaliação", "Relatório")
+        
+        await sync_emails_for_process(process_id)
+        assert await db.emails.count_documents({"process_id": process_id}) == 0
+        
+        # Email antigo de um endereço acabado de monitorizar também é importado
+        await db.processes.update_one({"id": process_id}, {"$set": {"monitored_emails": ["banco@test.pt"]}})
+        result = await sync_emails_for_process(process_id)
+        assert result["new_imported"] == 1
+    
+    @pytest.mark.asyncio
+    async def test_full_sync_ignores_checkpoints(self, sync_db, imap_server, monkeypatch):
+        db, process_id = sync_db
+        monkeypatch.setattr(email_service, "get_email_accounts", lambda: [local_account(imap_server)])
+        fill_inbox(imap_server, 3)
+        
+        await sync_emails_for_process(process_id)
+        assert (await sync_emails_for_process(process_id))["total_found"] == 0
+        
+        result = await sync_emails_for_process(process_id, full=True)
+        assert result["total_found"] == 3 and result["new_imported"] == 0
+
+
+def synced_email(i: int, message_id: str = None) -> dict:
+    return {
+        "message_id": message_id if message_id is not None else f"<doc{i}@Test.PT>",
+        "from_email": CLIENT, "to_emails": ["geral@precision.pt"],
+        "subject": f"Documentos {i}", "body": "Em anexo", "date": f"2026-03-01T10:{i % 60:02d}:00+00:00",
+        "direction": "received", "account": "precision"
+    }
+
+
+class CountingDatabase:
+    """Base de dados que regista as operações feitas na colecção emails."""
+    
+    def __init__(self, database):
+        self._database = database
+        self.calls = []
+    
+    def __getattr__(self, name):
+        collection = getattr(self._database, name)
+        if name != "emails":
+            return collection
+        calls = self.calls
+        
+        class Collection:
+            def __getattr__(self, method):
+                calls.append(method)
+                return getattr(collection, method)
+        
+        return Collection()
+
+
+class TestSyncedEmailUpsert:
+    """Emails sincronizados guardados por upsert numa só escrita (requer MongoDB)."""
+    
+    def test_message_id_is_normalized(self):
+        assert normalize_message_id(" <ABC.123@Mail.Test.PT>\r\n") == "ABC.123@mail.test.pt"
+        assert normalize_message_id(None) == ""
+        assert email_dedupe_key(synced_email(1)) == email_dedupe_key(synced_email(1, "doc1@test.pt"))
+        # Sem Message-ID: hash do conteúdo
+        assert email_dedupe_key(synced_email(1, "")).startswith("sha256:")
+        assert email_dedupe_key(synced_email(1, "")) != email_dedupe_key(synced_email(2, ""))
+    
+    @pytest.mark.asyncio
+    async def test_initial_sync_is_one_bulk_write(self, sync_db):
+        db, process_id = sync_db
+        await db.emails.create_index(
+            [("process_id", 1), ("dedupe_key", 1)],
+            unique=True, partialFilterExpression={"dedupe_key": {"$exists": True}}
+        )
+        counting = CountingDatabase(db)
+        
+        assert await store_synced_emails(process_id, [synced_email(i) for i in range(500)], counting) == 500
+        assert counting.calls == ["bulk_write"]
+        
+        # Mesmo Message-ID noutro formato, e emails sem Message-ID repetidos
+        again = [synced_email(i, f"doc{i}@test.pt") for i in range(500)] + [synced_email(900, "")] * 2
+        assert await store_synced_emails(process_id, again, counting) == 1
+        assert counting.calls == ["bulk_write", "bulk_write"]
+        assert await db.emails.count_documents({"process_id": process_id}) == 501
+        print("✓ 500 emails numa escrita; reenvio sem duplicados")
+    
+    @pytest.mark.asyncio
+    async def test_legacy_emails_get_keys(self, sync_db):
+        db, process_id = sync_db
+        legacy = {
+            "process_id": process_id, "synced": True, "from_email": CLIENT, "to_emails": ["geral@precision.pt"],
+            "subject": "Documentos 7", "sent_at": synced_email(7)["date"]
+        }
+        await db.emails.insert_many([{**legacy, "id": f"{process_id}-a"}, {**legacy, "id": f"{process_id}-b"}])
+        
+        assert await backfill_email_dedupe_keys(db) >= 1
+        keys = [doc.get("dedupe_key") async for doc in db.emails.find({"process_id": process_id})]
+        assert keys.count(email_dedupe_key(synced_email(7, ""))) == 1 and keys.count(None) == 1
+        
+        # Email antigo sem Message-ID não volta a ser guardado
+        assert await store_synced_emails(process_id, [synced_email(7, "")], db) == 0
+
+
+class TestClientIndex:
+    """Índice de endereços e autómato de nomes de clientes."""
+    
+    def test_aho_corasick_finds_overlapping_patterns(self):
+        automaton = AhoCorasick()
+        for pattern in ("ana", "ana sofia", "sofia", "fia"):
+            automaton.add(pattern, pattern)
+        
+        found = sorted((start, value) for start, _, value in automaton.find("cliente ana sofia"))
+        assert found == [(8, "ana"), (8, "ana sofia"), (12, "sofia"), (14, "fia")]
+        
+        # Padrão acrescentado depois de uma pesquisa: autómato reconstruído
+        automaton.add("cliente", "cliente")
+        assert "cliente" in {value for _, _, value in automaton.find("cliente ana sofia")}
+    
+    def test_folder_names_are_decoded(self):
+        assert decode_folder_name("Clientes/Jo&AOM-o Gon&AOc-alves") == "Clientes/João Gonçalves"
+        assert decode_folder_name("Sent &- Enviados") == "Sent & Enviados"
+    
+    def test_names_match_whole_words_without_accents(self):
+        index = ClientIndex()
+        index.add_process({"id": "p1", "client_name": "João  Gonçalves", "client_email": "JOAO@test.pt"})
+        index.add_process({"id": "p2", "client_name": "Ana", "monitored_emails": ["joao@test.pt"]})
+        index.add_process({"id": "p3", "client_name": "Rui"})
+        
+        assert index.match_names("Re: Escritura joao goncalves (IRS)") == {"p1"}
+        assert index.match_names("Mariana Silva") == set()
+        assert index.match_names("Ana e Rui: avaliação") == {"p2", "p3"}
+        assert index.match_addresses(["joao@test.pt", "outro@test.pt"]) == {"p1", "p2"}
+        print("✓ Nomes por palavras completas, sem acentos; endereços partilhados")
+
+
+@pytest_asyncio.fixture
+async def mailbox_db():
+    """Processos de teste para a sincronização das caixas (requer MongoDB)."""
+    from database import db
+    
+    try:
+        await asyncio.wait_for(db.command("ping"), timeout=2)
+    except Exception:
+        pytest.skip("MongoDB não disponível")
+    
+    prefix = f"test-mailbox-{uuid.uuid4().hex[:6]}"
+    processes = [
+        {"id": f"{prefix}-{i}", "client_name": f"Cliente Número{i} Teste", "client_email": f"cliente{i}@test.pt", "status": "fase_documental"}
+        for i in range(50)
+    ]
+    processes.append({"id": f"{prefix}-fechado", "client_name": "Fechado Teste", "client_email": "fechado@test.pt", "status": "concluidos"})
+    await db.processes.insert_many([dict(p) for p in processes])
+    
+    yield db, prefix
+    
+    await db.processes.delete_many({"id": {"$regex": f"^{prefix}"}})
+    await db.emails.delete_many({"process_id": {"$regex": f"^{prefix}"}})
+    await db.email_sync_state.delete_many({"scope": "mailbox"})
+
+
+class TestMailboxSync:
+    """Uma passagem por caixa para todos os processos activos (requer MongoDB)."""
+    
+    @pytest.mark.asyncio
+    async def test_one_pass_routes_to_every_process(self, mailbox_db, imap_server, monkeypatch):
+        db, prefix = mailbox_db
+        monkeypatch.setattr(email_service, "get_email_accounts", lambda: [local_account(imap_server)])
+        monkeypatch.setattr("services.email_sync.get_email_accounts", lambda: [local_account(imap_server)])
+        
+        for i in range(50):
+            imap_server.add_message("INBOX", f"cliente{i}@test.pt", "geral@precision.pt", f"Documentos {i}", "Em anexo")
+        imap_server.add_message("Sent", "geral@precision.pt", "banco@test.pt", "Proposta Cliente Número7 Teste", "Segue")
+        imap_server.add_message("INBOX", "banco@test.pt", "geral@precision.pt", "Avaliação", "Relatório do cliente número8 teste.")
+        imap_server.add_message("INBOX", "fechado@test.pt", "geral@precision.pt", "Obrigado", "Processo fechado")
+        imap_server.add_message("INBOX", "spam@test.pt", "geral@precision.pt", "Promoção", "Nada a ver")
+        # Nome da pasta em UTF-7 modificado, como o servidor o devolve no LIST
+        imap_server.add_folder("Clientes/Cliente N&APo-mero9 Teste")
+        imap_server.add_message("Clientes/Cliente N&APo-mero9 Teste", "notario@test.pt", "geral@precision.pt", "Escritura", "Marcada")
+        
+        result = await sync_all_mailboxes()
+        
+        assert result["processes"] >= 50 and result["new_imported"] == 53
+        stats = result["accounts"]["precision"]
+        assert stats["scanned"] == 55 and stats["matched"] == 53 and stats["folders"] == 3
+        # Uma ligação e uma leitura de cada pasta para todos os processos
+        assert imap_server.logins == 1
+        assert len([c for c in imap_server.commands if c.upper().startswith("EXAMINE")]) == 3
+        
+        by_process = {}
+        async for doc in db.emails.find({"process_id": {"$regex": f"^{prefix}"}}, {"_id": 0}):
+            by_process.setdefault(doc["process_id"], []).append(doc["subject"])
+        assert len(by_process) == 50
+        assert sorted(by_process[f"{prefix}-7"]) == ["Documentos 7", "Proposta Cliente Número7 Teste"]
+        assert sorted(by_process[f"{prefix}-8"]) == ["Avaliação", "Documentos 8"]
+        assert sorted(by_process[f"{prefix}-9"]) == ["Documentos 9", "Escritura"]
+        assert f"{prefix}-fechado" not in by_process
+        print("✓ 55 mensagens lidas uma vez e encaminhadas para 50 processos")
+    
+    @pytest.mark.asyncio
+    async def test_next_pass_reads_only_new_mail(self, mailbox_db, imap_server, monkeypatch):
+        db, prefix = mailbox_db
+        monkeypatch.setattr("services.email_sync.get_email_accounts", lambda: [local_account(imap_server)])
+        imap_server.add_message("INBOX", "cliente1@test.pt", "geral@precision.pt", "Primeiro", "Texto")
+        
+        assert (await sync_all_mailboxes())["new_imported"] == 1
+        
+        imap_server.add_message("INBOX", "cliente2@test.pt", "geral@precision.pt", "Segundo", "Texto")
+        result = await sync_all_mailboxes()
+        assert result["new_imported"] == 1 and result["accounts"]["precision"]["scanned"] == 1
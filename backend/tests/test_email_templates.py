@@ -0,0 +1,115 @@
+"""
+====================================================================
+TESTES DOS TEMPLATES DE EMAIL - CREDITOIMO
+====================================================================
+Renderização dos templates Jinja2 (services/email_templates.py):
+conteúdo, escape do HTML, layout partilhado e benchmark de
+renderização em lote de todos os templates.
+====================================================================
+"""
+
+import time
+
+import pytest
+
+from services.email import email_templates, COMPANY_NAME, DEFAULT_DOCUMENTS
+from services.email_templates import EMAIL_SUBJECTS, EmailTemplateRenderer
+
+# Contexto de exemplo de cada template (um template novo tem de ser acrescentado aqui)
+SAMPLE_CONTEXTS = {
+    "registration_confirmation": {"client_name": "Ana Silva"},
+    "documents_checklist": {"client_name": "Ana Silva", "documents": DEFAULT_DOCUMENTS},
+    "credit_approved": {
+        "client_name": "Ana Silva", "bank_name": "BCP", "approved_amount": "180 000 €",
+        "interest_rate": "3,1%", "monthly_payment": "760 €"
+    },
+    "new_client": {
+        "client_name": "Ana Silva", "client_email": "ana@test.pt", "client_phone": "912345678",
+        "process_type": "credito", "staff_name": "Rui"
+    },
+    "status_update": {"client_name": "Ana Silva", "new_status": "Fase Bancária", "message": "Proposta enviada"},
+    "monthly_document_reminder": {"client_name": "Ana Silva", "month_name": "Março", "year": 2026},
+    "staff_digest": {
+        "name": "Ana Silva", "period_label": "Resumo diário", "total": 12, "hidden": 2,
+        "events": [{"subject": f"Novo Prazo {i}", "body": "Título: Escritura\nData limite: 2026-05-04", "time": "04/05 10:00"} for i in range(10)]
+    },
+}
+
+# Campo personalizado por destinatário no benchmark
+PERSONALIZED_FIELD = {"staff_digest": "name"}
+
+BENCHMARK_EMAILS = 500
+BENCHMARK_MAX_MS_PER_EMAIL = 5
+
+
+class TestEmailTemplates:
+    """Conteúdo, escape e layout partilhado."""
+    
+    def test_every_template_has_sample_context(self):
+        assert set(SAMPLE_CONTEXTS) == set(EMAIL_SUBJECTS)
+    
+    @pytest.mark.parametrize("name", sorted(EMAIL_SUBJECTS))
+    def test_renders_subject_text_and_layout(self, name):
+        rendered = email_templates.render(name, **SAMPLE_CONTEXTS[name])
+        
+        assert rendered.subject and "{{" not in rendered.subject
+        assert "Ana Silva" in rendered.text and "Ana Silva" in rendered.html
+        # Layout comum: estilos, cabeçalho e rodapé
+        assert rendered.html.lstrip().startswith("<!DOCTYPE html>")
+        assert 'class="footer"' in rendered.html and rendered.html.rstrip().endswith("</html>")
+    
+    def test_html_is_escaped_and_text_is_not(self):
+        rendered = email_templates.render(
+            "status_update", client_name="<script>x</script>", new_status="A & B", message=""
+        )
+        
+        assert "<script>" not in rendered.html and "&lt;script&gt;" in rendered.html
+        assert "<script>x</script>" in rendered.text
+        assert rendered.subject == "📋 Atualização do seu Processo - A & B"
+        print("✓ HTML escapado; texto e assunto sem escape")
+    
+    def test_optional_fields(self):
+        rendered = email_templates.render(
+            "credit_approved", client_name="Ana", bank_name="BCP", approved_amount="1 €",
+            interest_rate=None, monthly_payment="5 €"
+        )
+        
+        assert "Taxa de Juro" not in rendered.text and "Taxa de Juro" not in rendered.html
+        assert "Prestação Mensal: 5 €" in rendered.text
+        assert f"Equipa {COMPANY_NAME}".replace("&", "&amp;") in rendered.html
+    
+    def test_missing_variable_fails(self):
+        renderer = EmailTemplateRenderer(globals={"company_name": COMPANY_NAME})
+        with pytest.raises(Exception):
+            renderer.render("new_client", client_name="Ana")
+    
+    def test_render_many_uses_shared_context(self):
+        contexts = [{"client_name": f"Cliente {i}"} for i in range(3)]
+        rendered = email_templates.render_many("monthly_document_reminder", contexts, month_name="Maio", year=2026)
+        
+        assert [r.subject for r in rendered] == ["Documentação Mensal - Maio 2026"] * 3
+        assert all(f"Cliente {i}" in r.html for i, r in enumerate(rendered))
+        print("✓ Renderização em lote com contexto partilhado")
+
+
+class TestRenderBenchmark:
+    """Renderização em lote de todos os templates (templates já compilados)."""
+    
+    @pytest.mark.parametrize("name", sorted(EMAIL_SUBJECTS))
+    def test_batch_render(self, name):
+        email_templates.load()
+        field = PERSONALIZED_FIELD.get(name, "client_name")
+        contexts = [
+            {**SAMPLE_CONTEXTS[name], field: f"Cliente {i}"}
+            for i in range(BENCHMARK_EMAILS)
+        ]
+        
+        started = time.perf_counter()
+        rendered = email_templates.render_many(name, contexts)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        
+        assert len(rendered) == BENCHMARK_EMAILS
+        assert f"Cliente {BENCHMARK_EMAILS - 1}" in rendered[-1].html
+        per_email = elapsed_ms / BENCHMARK_EMAILS
+        assert per_email < BENCHMARK_MAX_MS_PER_EMAIL
+        print(f"✓ {name}: {BENCHMARK_EMAILS} emails em {elapsed_ms:.1f} ms ({per_email * 1000:.0f} µs/email)")
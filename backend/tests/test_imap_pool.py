@@ -0,0 +1,178 @@
+"""
+====================================================================
+TESTES DO POOL IMAP - CREDITOIMO
+====================================================================
+Sessões IMAP reutilizadas, pasta mantida seleccionada e leitura fora
+do event loop, contra o servidor IMAP local de substituição de
+conftest.py. O teste da sincronização das caixas requer MongoDB.
+====================================================================
+"""
+
+import asyncio
+import time
+
+import pytest
+import pytest_asyncio
+
+from services.email_service import EmailAccount, SyncCheckpoints, fetch_emails_from_account
+from services.email_sync import sync_all_mailboxes
+from services.imap_pool import imap_pools
+
+CLIENT = "cliente@test.pt"
+
+
+def local_account(server, name: str = "precision") -> EmailAccount:
+    return EmailAccount(
+        name=name, imap_server="127.0.0.1", imap_port=server.port,
+        smtp_server="127.0.0.1", smtp_port=0,
+        email="geral@precision.pt", password="secret", imap_ssl=False
+    )
+
+
+def fill_inbox(server, count: int, start: int = 0):
+    for i in range(start, start + count):
+        server.add_message("INBOX", CLIENT, "geral@precision.pt", f"Documentos {i}", f"Segue o documento {i}")
+
+
+def examines(server) -> int:
+    return len([c for c in server.commands if c.upper().startswith("EXAMINE")])
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def close_pools():
+    yield
+    await imap_pools.close()
+
+
+class TestIMAPPool:
+    """Reutilização de sessões e recuperação de ligações caídas."""
+    
+    @pytest.mark.asyncio
+    async def test_session_and_folder_are_reused(self, imap_server):
+        fill_inbox(imap_server, 3)
+        account = local_account(imap_server)
+        
+        for _ in range(5):
+            found = await fetch_emails_from_account(account, [CLIENT], checkpoints=SyncCheckpoints(account.name))
+            assert len(found) == 3
+        
+        # Um LOGIN e um EXAMINE para as cinco pesquisas
+        assert imap_server.logins == 1
+        assert examines(imap_server) == 1
+        assert imap_pools.get(account).stats["connections"] == 1
+        print("✓ 5 pesquisas numa só sessão IMAP, com a pasta já seleccionada")
+    
+    @pytest.mark.asyncio
+    async def test_new_mail_is_seen_without_reselecting(self, imap_server):
+        fill_inbox(imap_server, 2)
+        account = local_account(imap_server)
+        checkpoints = SyncCheckpoints(account.name, states={"INBOX": {"uidvalidity": 1, "last_uid": 2}})
+        assert await fetch_emails_from_account(account, [CLIENT], checkpoints=checkpoints) == []
+        
+        fill_inbox(imap_server, 1, start=2)
+        checkpoints = SyncCheckpoints(account.name, states={"INBOX": {"uidvalidity": 1, "last_uid": 2}})
+        found = await fetch_emails_from_account(account, [CLIENT], checkpoints=checkpoints)
+        
+        assert [em["subject"] for em in found] == ["Documentos 2"]
+        assert examines(imap_server) == 1
+    
+    @pytest.mark.asyncio
+    async def test_dropped_session_is_reopened(self, imap_server):
+        fill_inbox(imap_server, 2)
+        account = local_account(imap_server)
+        await fetch_emails_from_account(account, [CLIENT])
+        
+        imap_server.drop_sessions()
+        checkpoints = SyncCheckpoints(account.name)
+        found = await fetch_emails_from_account(account, [CLIENT], checkpoints=checkpoints)
+        
+        assert len(found) == 2 and not checkpoints.failed
+        assert imap_server.logins == 2
+        assert imap_pools.get(account).stats["reconnects"] == 1
+        print("✓ Ligação caída: sessão reaberta e pesquisa repetida")
+    
+    @pytest.mark.asyncio
+    async def test_slow_server_does_not_block_loop(self, imap_server):
+        fill_inbox(imap_server, 2)
+        imap_server.delay = 0.05
+        ticks = 0
+        
+        async def heartbeat():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+        
+        beat = asyncio.create_task(heartbeat())
+        found = await fetch_emails_from_account(local_account(imap_server), [CLIENT])
+        beat.cancel()
+        
+        assert len(found) == 2
+        assert ticks >= 10  # o event loop continuou a correr durante a leitura
+        print("✓ Leitura IMAP fora do event loop")
+    
+    @pytest.mark.asyncio
+    async def test_accounts_run_in_parallel(self, imap_server):
+        imap_server.delay = 0.05
+        accounts = [local_account(imap_server, name) for name in ("precision", "power")]
+        
+        def noop(mail):
+            return mail.noop()
+        
+        started = time.monotonic()
+        await imap_pools.get(local_account(imap_server, "solo")).run(noop)
+        single = time.monotonic() - started
+        
+        started = time.monotonic()
+        await asyncio.gather(*(imap_pools.get(account).run(noop) for account in accounts))
+        both = time.monotonic() - started
+        
+        # A segunda conta abre a sua sessão em paralelo com a primeira
+        assert both < single * 1.5
+        print(f"✓ Duas contas em paralelo: {both:.2f}s (uma conta: {single:.2f}s)")
+
+
+@pytest_asyncio.fixture
+async def pool_db():
+    """Base de dados de teste (salta se o MongoDB não estiver disponível)."""
+    from database import db
+    
+    try:
+        await asyncio.wait_for(db.command("ping"), timeout=2)
+    except Exception:
+        pytest.skip("MongoDB não disponível")
+    
+    process_id = "test-imap-pool"
+    await db.processes.insert_one({"id": process_id, "client_name": "Rita Pool", "client_email": CLIENT, "status": "fase_documental"})
+    
+    yield db, process_id
+    
+    await db.processes.delete_one({"id": process_id})
+    await db.emails.delete_many({"process_id": process_id})
+    await db.email_sync_state.delete_many({"scope": "mailbox"})
+
+
+class TestMailboxSyncConcurrency:
+    """Sincronização das caixas com as contas em paralelo (requer MongoDB)."""
+    
+    @pytest.mark.asyncio
+    async def test_mailboxes_are_read_concurrently(self, pool_db, imap_server, monkeypatch):
+        db, process_id = pool_db
+        fill_inbox(imap_server, 2)
+        imap_server.delay = 0.05
+        
+        monkeypatch.setattr("services.email_sync.get_email_accounts", lambda: [local_account(imap_server, "solo")])
+        started = time.monotonic()
+        await sync_all_mailboxes(database=db)
+        single = time.monotonic() - started
+        
+        accounts = [local_account(imap_server, name) for name in ("precision", "power")]
+        monkeypatch.setattr("services.email_sync.get_email_accounts", lambda: accounts)
+        started = time.monotonic()
+        result = await sync_all_mailboxes(database=db)
+        both = time.monotonic() - started
+        
+        assert result["accounts"]["precision"]["matched"] == 2
+        assert result["accounts"]["power"]["matched"] == 2
+        assert both < single * 1.5  # as duas caixas são lidas ao mesmo tempo
+        print(f"✓ Caixas de duas contas em paralelo: {both:.2f}s (uma conta: {single:.2f}s)")
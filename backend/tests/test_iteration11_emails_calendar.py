@@ -97,7 +97,7 @@ class TestEmailCRUD:
         )
         assert response.status_code == 200, f"Get emails failed: {response.text}"
         
-        emails = response.json()
+        emails = response.json()["emails"]
         assert isinstance(emails, list)
         print(f"PASS: Retrieved {len(emails)} emails for process")
     
@@ -111,7 +111,7 @@ class TestEmailCRUD:
         )
         assert response.status_code == 200
         
-        emails = response.json()
+        emails = response.json()["emails"]
         for email in emails:
             assert email["direction"] == "sent", "Filter by direction not working"
         print(f"PASS: Filtered emails by direction (sent): {len(emails)} emails")
@@ -281,7 +281,7 @@ class TestCleanup:
         )
         
         if response.status_code == 200:
-            emails = response.json()
+            emails = response.json()["emails"]
             deleted_count = 0
             for email in emails:
                 if email["subject"].startswith("TEST_"):
@@ -237,7 +237,7 @@ class TestEmailFilters:
             headers=self.headers
         )
         assert response.status_code == 200
-        emails = response.json()
+        emails = response.json()["emails"]
         assert isinstance(emails, list)
         print(f"PASS: All emails filter - {len(emails)} emails")
     
@@ -249,7 +249,7 @@ class TestEmailFilters:
             headers=self.headers
         )
         assert response.status_code == 200
-        emails = response.json()
+        emails = response.json()["emails"]
         
         for email in emails:
             assert email["direction"] == "sent", f"Expected sent, got {email['direction']}"
@@ -263,7 +263,7 @@ class TestEmailFilters:
             headers=self.headers
         )
         assert response.status_code == 200
-        emails = response.json()
+        emails = response.json()["emails"]
         
         for email in emails:
             assert email["direction"] == "received", f"Expected received, got {email['direction']}"
@@ -509,7 +509,7 @@ class TestCleanup:
         )
         
         if response.status_code == 200:
-            emails = response.json()
+            emails = response.json()["emails"]
             deleted_count = 0
             for email in emails:
                 if email["subject"].startswith("TEST_"):
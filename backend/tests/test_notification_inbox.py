@@ -0,0 +1,271 @@
+"""
+Testes da caixa de notificações com audiência pré-calculada
+(services/notification_inbox.py)
+"""
+import asyncio
+import uuid
+from datetime import datetime, timezone, timedelta
+
+import pytest
+import pytest_asyncio
+
+from services.notification_inbox import (
+    NotificationInbox,
+    InvalidCursorError,
+    build_audience,
+    viewer_audience,
+    process_participants,
+    encode_cursor,
+    decode_cursor,
+)
+
+
+class FakeDirectory:
+    """Directório fixo: um admin e um CEO."""
+    
+    users = [
+        {"id": "test-inbox-admin", "role": "admin", "is_active": True},
+        {"id": "test-inbox-ceo", "role": "ceo", "is_active": True},
+    ]
+    
+    async def get_users_by_roles(self, roles, active_only=True):
+        return [u for u in self.users if u["role"] in roles]
+
+
+ADMIN = {"id": "test-inbox-admin", "role": "admin"}
+CONSULTOR = {"id": "test-inbox-cons", "role": "consultor"}
+
+
+def make_notification(user_ids=(), roles=(), minutes_ago=0, read=False):
+    return {
+        "id": str(uuid.uuid4()),
+        "user_id": user_ids[0] if len(user_ids) == 1 and not roles else None,
+        "message": "Teste",
+        "type": "info",
+        "read": read,
+        "created_at": (datetime.now(timezone.utc) - timedelta(minutes=minutes_ago)).isoformat(),
+        "audience": build_audience(user_ids, roles),
+        "source": "test-inbox",
+    }
+
+
+@pytest_asyncio.fixture
+async def inbox():
+    """Caixa sobre a base de dados de teste (salta se o MongoDB não estiver disponível)."""
+    from database import db
+    
+    try:
+        await asyncio.wait_for(db.command("ping"), timeout=2)
+    except Exception:
+        pytest.skip("MongoDB não disponível")
+    
+    # Índice criado no arranque do servidor (server.py)
+    await db.notification_counters.create_index("user_id", unique=True)
+    
+    yield NotificationInbox(db, FakeDirectory())
+    
+    await db.notifications.delete_many({"source": "test-inbox"})
+    await db.notifications_archive.delete_many({"audience": {"$regex": "^user:test-inbox-"}})
+    await db.notification_counters.delete_many({"user_id": {"$regex": "^test-inbox-"}})
+
+
+class TestAudience:
+    """Construção da audiência e do cursor."""
+    
+    def test_build_audience_dedupes_tokens(self):
+        assert build_audience(["u1", None, "u1"], ["admin", "admin"]) == ["user:u1", "role:admin"]
+        assert viewer_audience(CONSULTOR) == ["user:test-inbox-cons", "role:consultor"]
+        print("✓ Audiência sem duplicados")
+    
+    def test_process_participants(self):
+        process = {"assigned_consultor_id": "c1", "consultor_id": "c1", "intermediario_id": "i1", "assigned_mediador_id": None}
+        assert process_participants(process) == ["c1", "i1"]
+        print("✓ Participantes do processo")
+    
+    def test_cursor_roundtrip(self):
+        notification = {"id": "n1", "created_at": "2026-01-01T10:00:00+00:00"}
+        assert decode_cursor(encode_cursor(notification)) == ("2026-01-01T10:00:00+00:00", "n1")
+        
+        with pytest.raises(InvalidCursorError):
+            decode_cursor("não-é-cursor")
+        print("✓ Cursor codificado e validado")
+
+
+class TestNotificationInbox:
+    """Listagem por audiência, paginação e contador de não lidas."""
+    
+    @pytest.mark.asyncio
+    async def test_visibility_follows_audience(self, inbox):
+        await inbox.insert([
+            make_notification([CONSULTOR["id"]]),
+            make_notification([ADMIN["id"]]),
+            make_notification(roles=["admin", "ceo"]),
+        ])
+        
+        consultor_page = await inbox.list_for_user(CONSULTOR)
+        admin_page = await inbox.list_for_user(ADMIN)
+        
+        assert len(consultor_page["notifications"]) == 1
+        assert len(admin_page["notifications"]) == 2
+        assert "audience" not in consultor_page["notifications"][0]
+        print("✓ Cada utilizador vê apenas a sua audiência")
+    
+    @pytest.mark.asyncio
+    async def test_keyset_pagination(self, inbox):
+        await inbox.insert([make_notification([CONSULTOR["id"]], minutes_ago=i) for i in range(5)])
+        
+        seen = []
+        cursor = None
+        while True:
+            page = await inbox.list_for_user(CONSULTOR, limit=2, cursor=cursor)
+            seen += [n["id"] for n in page["notifications"]]
+            cursor = page["next_cursor"]
+            if not cursor:
+                break
+        
+        assert len(seen) == 5 and len(set(seen)) == 5
+        print("✓ Paginação por cursor percorre todas as notificações")
+    
+    @pytest.mark.asyncio
+    async def test_unread_counter_is_maintained(self, inbox):
+        await inbox.insert([make_notification([CONSULTOR["id"]]), make_notification([CONSULTOR["id"]], read=True)])
+        
+        # Primeiro acesso calcula o contador
+        assert await inbox.unread_count(CONSULTOR) == 1
+        
+        first = make_notification([CONSULTOR["id"]])
+        await inbox.insert([first, make_notification(roles=["admin"])])
+        assert await inbox.unread_count(CONSULTOR) == 2
+        
+        assert await inbox.mark_read(first["id"], CONSULTOR)
+        assert await inbox.unread_count(CONSULTOR) == 1
+        
+        # Notificação de outro utilizador não é visível
+        other = make_notification([ADMIN["id"]])
+        await inbox.insert([other])
+        assert not await inbox.mark_read(other["id"], CONSULTOR)
+        
+        assert await inbox.mark_all_read(CONSULTOR) == 1
+        assert await inbox.unread_count(CONSULTOR) == 0
+        assert await inbox.unread_count(CONSULTOR) == await inbox.count_unread(CONSULTOR)
+        print("✓ Contador de não lidas acompanha escritas e leituras")
+    
+    @pytest.mark.asyncio
+    async def test_write_during_first_count_is_not_lost(self, inbox, monkeypatch):
+        await inbox.insert([make_notification([CONSULTOR["id"]])])
+        count_unread = inbox.count_unread
+        late = []
+        
+        async def count_then_insert(user):
+            unread = await count_unread(user)
+            if not late:
+                # Notificação criada entre a contagem e a gravação do contador
+                late.append(make_notification([CONSULTOR["id"]]))
+                await inbox.insert(late)
+            return unread
+        
+        monkeypatch.setattr(inbox, "count_unread", count_then_insert)
+        assert await inbox.unread_count(CONSULTOR) == 2
+        
+        await inbox.insert([make_notification([CONSULTOR["id"]])])
+        assert await inbox.unread_count(CONSULTOR) == await count_unread(CONSULTOR) == 3
+        print("✓ Escrita durante a primeira contagem não se perde")
+    
+    @pytest.mark.asyncio
+    async def test_role_audience_updates_every_member(self, inbox):
+        assert await inbox.unread_count(ADMIN) == await inbox.count_unread(ADMIN)
+        before = await inbox.unread_count(ADMIN)
+        
+        shared = make_notification(roles=["admin", "ceo"])
+        await inbox.insert([shared])
+        assert await inbox.unread_count(ADMIN) == before + 1
+        
+        await inbox.mark_read(shared["id"], {"id": "test-inbox-ceo", "role": "ceo"})
+        assert await inbox.unread_count(ADMIN) == before
+        print("✓ Notificações por role actualizam todos os membros")
+    
+    @pytest.mark.asyncio
+    async def test_duplicate_keys_are_ignored(self, inbox):
+        await inbox.db.notifications.create_index(
+            "dedupe_key", unique=True, partialFilterExpression={"dedupe_key": {"$exists": True}}
+        )
+        
+        def keyed(key):
+            return {**make_notification([CONSULTOR["id"]]), "dedupe_key": f"test-inbox:{key}"}
+        
+        assert await inbox.insert([keyed("a"), keyed("b")], ignore_duplicates=True) == 2
+        # Segunda execução da mesma tarefa: só a chave nova é guardada
+        assert await inbox.insert([keyed("a"), keyed("b"), keyed("c")], ignore_duplicates=True) == 1
+        
+        assert await inbox.unread_count(CONSULTOR) == 3
+        assert await inbox.unread_count(CONSULTOR) == await inbox.count_unread(CONSULTOR)
+        print("✓ Notificações repetidas ignoradas sem afectar o contador")
+
+
+class TestNotificationRetention:
+    """Passagem das notificações para o arquivo."""
+    
+    def test_compact_archive_document(self):
+        from services.notification_inbox import compact_for_archive
+        
+        now = datetime.now(timezone.utc)
+        notification = make_notification(["u1"])
+        notification.update(link=None, archive_at=now, user_id="u1")
+        
+        document = compact_for_archive(notification, now)
+        
+        assert document["_id"] == notification["id"]
+        assert document["archived_at"] == now
+        assert "link" not in document and "archive_at" not in document and "user_id" not in document
+        print("✓ Documento de arquivo compacto")
+    
+    @pytest.mark.asyncio
+    async def test_expired_notifications_move_to_archive(self, inbox):
+        unread = make_notification([CONSULTOR["id"]])
+        await inbox.insert([unread, make_notification([CONSULTOR["id"]])])
+        assert await inbox.unread_count(CONSULTOR) == 2
+        
+        # Forçar a expiração da janela quente de uma das notificações
+        await inbox.db.notifications.update_one(
+            {"id": unread["id"]},
+            {"$set": {"archive_at": datetime.now(timezone.utc) - timedelta(minutes=1)}}
+        )
+        
+        assert await inbox.archive_expired(batch_size=1, pause=0) >= 1
+        
+        page = await inbox.list_for_user(CONSULTOR)
+        archive = await inbox.list_archive_for_user(CONSULTOR)
+        
+        assert unread["id"] not in [n["id"] for n in page["notifications"]]
+        assert [n["id"] for n in archive["notifications"]] == [unread["id"]]
+        assert await inbox.unread_count(CONSULTOR) == 1
+        print("✓ Notificações expiradas arquivadas e contador actualizado")
+    
+    @pytest.mark.asyncio
+    async def test_archive_recounts_drifted_counter(self, inbox):
+        expired = make_notification([CONSULTOR["id"]])
+        await inbox.insert([expired, make_notification([CONSULTOR["id"]])])
+        await inbox.db.notifications.update_one(
+            {"id": expired["id"]},
+            {"$set": {"archive_at": datetime.now(timezone.utc) - timedelta(minutes=1)}}
+        )
+        # Contador desviado (p.ex. notificação removida pelo TTL sem passar pelo arquivo)
+        await inbox.unread_count(CONSULTOR)
+        await inbox.db.notification_counters.update_one({"user_id": CONSULTOR["id"]}, {"$inc": {"unread": 5}})
+        
+        assert await inbox.archive_expired(pause=0) >= 1
+        
+        assert await inbox.unread_count(CONSULTOR) == await inbox.count_unread(CONSULTOR) == 1
+        print("✓ Contador recalculado após o arquivo")
+    
+    @pytest.mark.asyncio
+    async def test_reading_brings_archive_date_forward(self, inbox):
+        notification = make_notification([CONSULTOR["id"]])
+        await inbox.insert([notification])
+        
+        before = await inbox.db.notifications.find_one({"id": notification["id"]})
+        await inbox.mark_read(notification["id"], CONSULTOR)
+        after = await inbox.db.notifications.find_one({"id": notification["id"]})
+        
+        assert after["archive_at"] < before["archive_at"]
+        print("✓ Notificações lidas saem mais cedo da colecção quente")
@@ -0,0 +1,361 @@
+"""
+====================================================================
+TESTES DO MOTOR DE ENVIO WEB PUSH - CREDITOIMO
+====================================================================
+Testes do envio assíncrono de push notifications (cifra ECE,
+assinatura VAPID e concorrência) e da fila persistente (retry,
+backoff e dead-letter), usando um serviço push local de substituição.
+Os testes da fila requerem MongoDB (MONGO_URL).
+====================================================================
+"""
+
+import asyncio
+import base64
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timezone, timedelta
+
+import httpx
+import pytest
+import pytest_asyncio
+from aiohttp import web
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).strip(b"=").decode()
+
+
+def make_subscription(endpoint: str) -> dict:
+    """Criar uma subscrição com chaves válidas (como as geradas pelo browser)."""
+    receiver = ec.generate_private_key(ec.SECP256R1())
+    p256dh = receiver.public_key().public_bytes(
+        serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint
+    )
+    return {"endpoint": endpoint, "keys": {"p256dh": _b64(p256dh), "auth": _b64(os.urandom(16))}}
+
+
+@pytest.fixture
+def vapid_key(monkeypatch):
+    """Configurar uma chave VAPID privada de teste."""
+    from services import push_notifications
+    
+    key = ec.generate_private_key(ec.SECP256R1())
+    raw = key.private_numbers().private_value.to_bytes(32, "big")
+    monkeypatch.setattr(push_notifications, "VAPID_PRIVATE_KEY", _b64(raw))
+    monkeypatch.setattr(push_notifications, "VAPID_PUBLIC_KEY", "test")
+    return raw
+
+
+@pytest_asyncio.fixture
+async def push_service():
+    """
+    Serviço push local de substituição.
+    
+    O comportamento é escolhido pelo último segmento do endpoint:
+    ok (201), gone (410), throttled (429 + Retry-After) e down (503).
+    """
+    received = []
+    responses = {
+        "ok": lambda: web.Response(status=201),
+        "gone": lambda: web.Response(status=410),
+        "throttled": lambda: web.Response(status=429, headers={"Retry-After": "30"}),
+        "down": lambda: web.Response(status=503),
+    }
+    
+    async def handler(request: web.Request):
+        received.append({"path": request.path, "headers": dict(request.headers), "body": await request.read()})
+        return responses[request.match_info["behaviour"]]()
+    
+    app = web.Application()
+    app.router.add_post("/push/{sub_id}/{behaviour}", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    
+    yield {"url": f"http://127.0.0.1:{port}/push", "received": received}
+    
+    await runner.cleanup()
+
+
+@pytest_asyncio.fixture
+async def push_db():
+    """Base de dados de teste (salta se o MongoDB não estiver disponível)."""
+    from database import db
+    
+    try:
+        await asyncio.wait_for(db.command("ping"), timeout=2)
+    except Exception:
+        pytest.skip("MongoDB não disponível")
+    
+    yield db
+    
+    await db.push_queue.delete_many({"user_id": {"$regex": "^test-push-"}})
+    await db.push_dead_letters.delete_many({"user_id": {"$regex": "^test-push-"}})
+    await db.push_subscriptions.delete_many({"user_id": {"$regex": "^test-push-"}})
+
+
+class TestWebPushSender:
+    """Testes para o WebPushSender."""
+    
+    @pytest.mark.asyncio
+    async def test_request_is_encrypted_and_signed(self, vapid_key):
+        """O pedido leva payload cifrado aes128gcm, TTL e Authorization VAPID."""
+        from services.push_notifications import WebPushSender
+        
+        captured = []
+        
+        def handler(request: httpx.Request):
+            captured.append(request)
+            return httpx.Response(201)
+        
+        sender = WebPushSender(transport=httpx.MockTransport(handler))
+        result = await sender.send(make_subscription("https://push.example.com/sub/1"), '{"title": "x"}', ttl=60)
+        await sender.close()
+        
+        assert result["success"] and result["status_code"] == 201
+        assert result["latency_ms"] >= 0
+        request = captured[0]
+        assert request.headers["content-encoding"] == "aes128gcm"
+        assert request.headers["ttl"] == "60"
+        assert request.headers["authorization"].startswith("vapid t=")
+        assert b'"title"' not in request.content
+    
+    @pytest.mark.asyncio
+    async def test_sends_run_concurrently(self, vapid_key):
+        """Envios para várias subscrições não são serializados."""
+        from services.push_notifications import WebPushSender
+        
+        async def handler(request: httpx.Request):
+            await asyncio.sleep(0.2)
+            return httpx.Response(201)
+        
+        sender = WebPushSender(max_concurrency=50, transport=httpx.MockTransport(handler))
+        subscriptions = [make_subscription(f"https://push.example.com/sub/{i}") for i in range(20)]
+        
+        started = time.perf_counter()
+        results = await sender.send_many(subscriptions, "{}")
+        elapsed = time.perf_counter() - started
+        await sender.close()
+        
+        assert all(r["success"] for r in results)
+        assert elapsed < 1.0
+    
+    @pytest.mark.asyncio
+    async def test_errors_are_reported_per_endpoint(self, vapid_key):
+        """Falhas HTTP e chaves inválidas não interrompem os restantes envios."""
+        from services.push_notifications import WebPushSender
+        
+        def handler(request: httpx.Request):
+            return httpx.Response(410 if request.url.path.endswith("gone") else 201)
+        
+        sender = WebPushSender(transport=httpx.MockTransport(handler))
+        results = await sender.send_many([
+            make_subscription("https://push.example.com/ok"),
+            make_subscription("https://push.example.com/gone"),
+            {"endpoint": "https://push.example.com/bad", "keys": {"p256dh": "x", "auth": "y"}},
+        ], "{}")
+        await sender.close()
+        
+        assert [r["status_code"] for r in results] == [201, 410, None]
+        assert results[2]["error"]
+    
+    @pytest.mark.asyncio
+    async def test_local_push_service_reports_retry_after(self, vapid_key, push_service):
+        """O resultado expõe Retry-After devolvido pelo serviço push."""
+        from services.push_notifications import WebPushSender
+        
+        sender = WebPushSender()
+        result = await sender.send(make_subscription(f"{push_service['url']}/1/throttled"), "{}")
+        await sender.close()
+        
+        assert result["status_code"] == 429
+        assert result["retry_after"] == "30"
+        assert push_service["received"][0]["headers"]["Content-Encoding"] == "aes128gcm"
+
+
+class TestRetryPolicy:
+    """Testes para o cálculo de backoff e Retry-After."""
+    
+    def test_parse_retry_after(self):
+        from services.push_queue import parse_retry_after
+        
+        now = datetime(2026, 1, 1, 12, 0, 0, tzinfo=timezone.utc)
+        assert parse_retry_after("120", now) == 120
+        assert parse_retry_after("Thu, 01 Jan 2026 12:01:00 GMT", now) == 60
+        assert parse_retry_after(None, now) is None
+        assert parse_retry_after("amanhã", now) is None
+    
+    def test_backoff_grows_and_respects_retry_after(self):
+        from services.push_queue import compute_retry_delay, PUSH_RETRY_BASE_SECONDS, PUSH_RETRY_MAX_SECONDS
+        
+        assert PUSH_RETRY_BASE_SECONDS / 2 <= compute_retry_delay(1) <= PUSH_RETRY_BASE_SECONDS
+        assert compute_retry_delay(4) >= PUSH_RETRY_BASE_SECONDS * 4
+        assert compute_retry_delay(50) <= PUSH_RETRY_MAX_SECONDS
+        assert compute_retry_delay(1, retry_after=300) == 300
+
+
+class TestPushQueueWorker:
+    """Ciclo do worker da fila (sem MongoDB)."""
+    
+    @pytest.mark.asyncio
+    async def test_wake_during_drain_is_not_lost(self, monkeypatch):
+        from services.push_queue import PushQueueWorker
+        
+        worker = PushQueueWorker(sender=object(), poll_interval=30)
+        drains = []
+        
+        async def drain():
+            drains.append(time.monotonic())
+            if len(drains) == 1:
+                worker.wake()  # entrega enfileirada durante a drenagem
+            return 0
+        
+        monkeypatch.setattr(worker, "drain", drain)
+        worker.start()
+        try:
+            for _ in range(100):
+                if len(drains) >= 2:
+                    break
+                await asyncio.sleep(0.02)
+        finally:
+            await worker.stop()
+        
+        assert len(drains) >= 2, "wake() durante a drenagem perdido até ao próximo poll"
+        print("✓ wake() durante a drenagem provoca nova drenagem")
+
+
+class TestPushQueue:
+    """Testes da fila persistente contra o serviço push local (requer MongoDB)."""
+    
+    async def _enqueue(self, push_db, push_service, behaviour: str, ttl: int = 3600) -> tuple:
+        from services.push_queue import enqueue_push_deliveries
+        
+        user_id = f"test-push-{uuid.uuid4()}"
+        subscription = make_subscription(f"{push_service['url']}/{uuid.uuid4()}/{behaviour}")
+        await push_db.push_subscriptions.insert_one({**subscription, "user_id": user_id, "is_active": True})
+        await enqueue_push_deliveries(user_id, [subscription], '{"title": "x"}', ttl=ttl)
+        return user_id, subscription["endpoint"]
+    
+    @pytest.mark.asyncio
+    async def test_delivery_outcomes(self, vapid_key, push_service, push_db):
+        """Sucesso remove da fila; 410 vai para dead-letter e desactiva a subscrição; 429 reagenda."""
+        from services.push_queue import PushQueueWorker
+        
+        ok_user, _ = await self._enqueue(push_db, push_service, "ok")
+        gone_user, gone_endpoint = await self._enqueue(push_db, push_service, "gone")
+        throttled_user, _ = await self._enqueue(push_db, push_service, "throttled")
+        
+        started = datetime.now(timezone.utc)
+        worker = PushQueueWorker()
+        stats = await worker.drain()
+        
+        assert stats["sent"] >= 1 and stats["retried"] >= 1 and stats["dead"] >= 1
+        assert await push_db.push_queue.count_documents({"user_id": ok_user}) == 0
+        
+        dead = await push_db.push_dead_letters.find_one({"user_id": gone_user})
+        assert dead["reason"] == "subscription_gone"
+        subscription = await push_db.push_subscriptions.find_one({"endpoint": gone_endpoint})
+        assert subscription["is_active"] is False
+        
+        retry = await push_db.push_queue.find_one({"user_id": throttled_user})
+        assert retry["status"] == "pending" and retry["attempts"] == 1
+        next_attempt = retry["next_attempt_at"].replace(tzinfo=timezone.utc)
+        assert next_attempt >= started + timedelta(seconds=30)
+        
+        # Latência guardada no resultado da entrega e resumida pelo worker
+        assert retry["last_latency_ms"] >= 0 and dead["last_latency_ms"] >= 0
+        latency = worker.latency_summary()
+        assert latency["samples"] >= 3 and latency["avg"] <= latency["max"] and latency["p95"] <= latency["max"]
+    
+    @pytest.mark.asyncio
+    async def test_expired_lease_does_not_delete_reclaimed_job(self, push_db):
+        """Um worker cujo lease expirou não apaga a entrega reservada por outro."""
+        from services.push_queue import PushQueueWorker, enqueue_push_deliveries
+        
+        user_id = f"test-push-{uuid.uuid4()}"
+        await enqueue_push_deliveries(user_id, [make_subscription(f"https://push.test/{uuid.uuid4()}")], '{"title": "x"}')
+        
+        class SlowSender:
+            async def send(self, job, payload, ttl=None):
+                # Entretanto o lease expirou e outro worker reservou a entrega
+                await push_db.push_queue.update_one({"id": job["id"]}, {"$set": {"lease_token": "outro-worker"}})
+                return {"success": True, "status_code": 201}
+        
+        stats = await PushQueueWorker(sender=SlowSender()).drain_once()
+        
+        assert stats["sent"] >= 1
+        job = await push_db.push_queue.find_one({"user_id": user_id})
+        assert job is not None and job["lease_token"] == "outro-worker"
+    
+    @pytest.mark.asyncio
+    async def test_ttl_expiry_dead_letters(self, vapid_key, push_service, push_db):
+        """Uma falha temporária cujo retry ultrapassaria o TTL vai para dead-letter."""
+        from services.push_queue import PushQueueWorker
+        
+        user_id, _ = await self._enqueue(push_db, push_service, "down", ttl=1)
+        await PushQueueWorker().drain()
+        
+        assert await push_db.push_queue.count_documents({"user_id": user_id}) == 0
+        dead = await push_db.push_dead_letters.find_one({"user_id": user_id})
+        assert dead["reason"] == "ttl_expired"
+        assert dead["last_status_code"] == 503
+
+
+class TestPushCaches:
+    """Testes para as caches de headers VAPID e de subscrições."""
+    
+    def test_vapid_headers_cached_per_origin(self, vapid_key, monkeypatch):
+        """O JWT VAPID é assinado uma vez por origem e renovado perto de expirar."""
+        from services import push_notifications
+        
+        monkeypatch.setattr(push_notifications, "_vapid_headers_cache", {})
+        signer = push_notifications._get_vapid_signer(push_notifications.VAPID_PRIVATE_KEY)
+        calls = []
+        original_sign = signer.sign
+        monkeypatch.setattr(signer, "sign", lambda claims: calls.append(claims["aud"]) or original_sign(claims))
+        
+        first = push_notifications._get_vapid_headers("https://fcm.googleapis.com/fcm/send/a")
+        second = push_notifications._get_vapid_headers("https://fcm.googleapis.com/fcm/send/b")
+        push_notifications._get_vapid_headers("https://updates.push.services.mozilla.com/wpush/v2/c")
+        assert first is second
+        assert calls == ["https://fcm.googleapis.com", "https://updates.push.services.mozilla.com"]
+        
+        # Perto de expirar: volta a assinar
+        audience = "https://fcm.googleapis.com"
+        headers, _ = push_notifications._vapid_headers_cache[audience]
+        push_notifications._vapid_headers_cache[audience] = (headers, time.time() + 60)
+        push_notifications._get_vapid_headers("https://fcm.googleapis.com/fcm/send/a")
+        assert calls[-1] == audience and len(calls) == 3
+    
+    @pytest.mark.asyncio
+    async def test_subscription_cache_and_invalidation(self, push_db):
+        """Subscrições são lidas da cache até serem invalidadas."""
+        from services.push_notifications import (
+            get_user_push_subscriptions, prefetch_push_subscriptions, invalidate_push_subscriptions
+        )
+        
+        user_id = f"test-push-{uuid.uuid4()}"
+        other_user = f"test-push-{uuid.uuid4()}"
+        await push_db.push_subscriptions.insert_one({
+            **make_subscription("https://push.example.com/cache/1"), "user_id": user_id, "is_active": True
+        })
+        
+        await prefetch_push_subscriptions([user_id, other_user])
+        assert len(await get_user_push_subscriptions(user_id)) == 1
+        assert await get_user_push_subscriptions(other_user) == []
+        
+        await push_db.push_subscriptions.insert_one({
+            **make_subscription("https://push.example.com/cache/2"), "user_id": user_id, "is_active": True
+        })
+        assert len(await get_user_push_subscriptions(user_id)) == 1
+        
+        invalidate_push_subscriptions(endpoints=["https://push.example.com/cache/1"])
+        assert len(await get_user_push_subscriptions(user_id)) == 2
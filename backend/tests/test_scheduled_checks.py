@@ -0,0 +1,184 @@
+"""
+Testes das verificações agendadas com filtros de data no servidor
+(services/scheduled_tasks.py e services/date_fields.py)
+"""
+import asyncio
+from datetime import datetime, timezone, timedelta
+
+import pytest
+import pytest_asyncio
+
+from services.date_fields import to_utc_datetime, backfill_date_fields
+from services.notification_inbox import NotificationInbox
+import services.scheduled_tasks as scheduled_tasks_module
+from services.scheduled_tasks import ScheduledTasksService
+
+
+class FakeDirectory:
+    """Directório vazio (as verificações testadas não usam roles)."""
+    
+    async def get_users_by_roles(self, roles, active_only=True):
+        return []
+
+
+def day(offset: int) -> str:
+    """Data (YYYY-MM-DD) a `offset` dias de hoje."""
+    return (datetime.now(timezone.utc) + timedelta(days=offset)).strftime("%Y-%m-%d")
+
+
+@pytest_asyncio.fixture
+async def service():
+    """Serviço sobre a base de dados de teste (salta se o MongoDB não estiver disponível)."""
+    from database import db
+    
+    try:
+        await asyncio.wait_for(db.command("ping"), timeout=2)
+    except Exception:
+        pytest.skip("MongoDB não disponível")
+    
+    tasks_service = ScheduledTasksService()
+    tasks_service.db = db
+    tasks_service.notification_inbox = NotificationInbox(db, FakeDirectory())
+    
+    yield tasks_service
+    
+    await db.processes.delete_many({"id": {"$regex": "^test-checks-"}})
+    await db.tasks.delete_many({"id": {"$regex": "^test-checks-"}})
+    await db.notifications.delete_many({"user_id": {"$regex": "^test-checks-"}})
+    await db.notification_counters.delete_many({"user_id": {"$regex": "^test-checks-"}})
+    await db.email_outbox.delete_many({"idempotency_key": {"$regex": "^monthly_reminder:test-checks-"}})
+
+
+async def notified(db, notification_type):
+    """IDs (processo ou tarefa) notificados aos utilizadores de teste."""
+    notifications = await db.notifications.find(
+        {"user_id": {"$regex": "^test-checks-"}, "type": notification_type},
+        {"_id": 0, "process_id": 1, "dedupe_key": 1}
+    ).to_list(None)
+    return notifications
+
+
+class TestDateFields:
+    """Conversão das datas em texto para datas BSON."""
+    
+    def test_to_utc_datetime(self):
+        assert to_utc_datetime("2026-03-01") == datetime(2026, 3, 1, tzinfo=timezone.utc)
+        assert to_utc_datetime("2026-03-01T10:00:00Z") == datetime(2026, 3, 1, 10, tzinfo=timezone.utc)
+        assert to_utc_datetime("2026-03-01T10:00:00+01:00") == datetime(2026, 3, 1, 9, tzinfo=timezone.utc)
+        assert to_utc_datetime(datetime(2026, 3, 1)) == datetime(2026, 3, 1, tzinfo=timezone.utc)
+        
+        for invalid in [None, "", "amanhã", 20260301]:
+            assert to_utc_datetime(invalid) is None
+        print("✓ Datas convertidas para UTC")
+
+
+class TestScheduledChecks:
+    """Só os registos dentro da janela de alerta são lidos e notificados."""
+    
+    @pytest.mark.asyncio
+    async def test_legacy_dates_are_backfilled(self, service):
+        await service.db.tasks.insert_one({"id": "test-checks-legacy", "due_date": "2026-03-01T10:00:00Z", "completed": False})
+        await service.db.processes.insert_one({
+            "id": "test-checks-legacy",
+            "credit_data": {"bank_approval_date": "2026-03-01"},
+            "documents": [{"name": "CC", "expiry_date": "2026-04-01"}, {"name": "Sem data"}]
+        })
+        
+        await backfill_date_fields(service.db)
+        
+        task = await service.db.tasks.find_one({"id": "test-checks-legacy"})
+        process = await service.db.processes.find_one({"id": "test-checks-legacy"})
+        assert to_utc_datetime(task["due_at"]) == datetime(2026, 3, 1, 10, tzinfo=timezone.utc)
+        assert to_utc_datetime(process["credit_data"]["bank_approval_at"]) == datetime(2026, 3, 1, tzinfo=timezone.utc)
+        assert to_utc_datetime(process["documents"][0]["expiry_at"]) == datetime(2026, 4, 1, tzinfo=timezone.utc)
+        assert process["documents"][1]["expiry_at"] is None
+        print("✓ Datas antigas migradas para BSON")
+    
+    @pytest.mark.asyncio
+    async def test_expiring_documents_window(self, service):
+        await service.db.processes.insert_one({
+            "id": "test-checks-docs",
+            "consultor_id": "test-checks-consultor",
+            "documents": [
+                {"id": "soon", "name": "CC", "expiry_at": to_utc_datetime(day(3))},
+                {"id": "later", "name": "IRS", "expiry_at": to_utc_datetime(day(30))},
+                {"id": "past", "name": "Recibo", "expiry_at": to_utc_datetime(day(-3))},
+            ]
+        })
+        
+        await service.check_expiring_documents()
+        
+        keys = [n["dedupe_key"] for n in await notified(service.db, "document_expiry")]
+        assert len(keys) == 1 and "test-checks-docs/soon" in keys[0]
+        print("✓ Apenas documentos a expirar na janela de 7 dias")
+    
+    @pytest.mark.asyncio
+    async def test_pre_approval_window(self, service):
+        def process(process_id, approval_offset):
+            approval = day(approval_offset)
+            return {
+                "id": process_id,
+                "consultor_id": "test-checks-consultor",
+                "credit_data": {"bank_approval_date": approval, "bank_approval_at": to_utc_datetime(approval)}
+            }
+        
+        await service.db.processes.insert_many([
+            process("test-checks-expiring", -80),  # faltam 10 dias
+            process("test-checks-recent", -10),    # faltam 80 dias
+            process("test-checks-expired", -95),   # já expirou
+        ])
+        
+        await service.check_pre_approval_countdown()
+        
+        notifications = await notified(service.db, "pre_approval_countdown")
+        assert [n["process_id"] for n in notifications] == ["test-checks-expiring"]
+        assert notifications[0]["dedupe_key"].endswith("/15")
+        print("✓ Apenas pré-aprovações dentro dos patamares de alerta")
+    
+    @pytest.mark.asyncio
+    async def test_tasks_due_window(self, service):
+        def task(task_id, due_offset):
+            return {
+                "id": task_id,
+                "title": task_id,
+                "assigned_to": ["test-checks-user"],
+                "completed": False,
+                "due_date": day(due_offset),
+                "due_at": to_utc_datetime(day(due_offset)),
+            }
+        
+        await service.db.tasks.insert_many([
+            task("test-checks-overdue", -2),
+            task("test-checks-tomorrow", 1),
+            task("test-checks-next-week", 7),
+            {**task("test-checks-done", 0), "completed": True},
+        ])
+        
+        await service.check_tasks_due_soon()
+        
+        types = {n["dedupe_key"].split(":")[1]: n["dedupe_key"].split(":")[0]
+                 for n in await notified(service.db, {"$regex": "^task_"})}
+        assert types == {"test-checks-overdue": "task_overdue", "test-checks-tomorrow": "task_due_tomorrow"}
+        print("✓ Apenas tarefas em atraso ou a vencer em 3 dias")
+    
+    @pytest.mark.asyncio
+    async def test_monthly_reminder_emails_go_to_outbox_once(self, service, monkeypatch):
+        monkeypatch.setattr(scheduled_tasks_module, "is_smtp_configured", lambda: True)
+        await service.db.email_outbox.create_index("idempotency_key", unique=True)
+        recipients = [
+            {"to": f"cliente{i}@test.pt", "client_name": f"Cliente {i}", "process_id": f"test-checks-monthly-{i}"}
+            for i in range(3)
+        ]
+        
+        assert await service.queue_monthly_reminder_emails(recipients, "Março", 2026, "2026-03") == 3
+        # Nova execução no mesmo mês (retoma, troca de líder): nenhum email repetido
+        assert await service.queue_monthly_reminder_emails(recipients, "Março", 2026, "2026-03") == 0
+        
+        jobs = await service.db.email_outbox.find(
+            {"idempotency_key": {"$regex": "^monthly_reminder:test-checks-"}}, {"_id": 0}
+        ).to_list(None)
+        assert sorted(job["idempotency_key"] for job in jobs) == [
+            f"monthly_reminder:test-checks-monthly-{i}:2026-03" for i in range(3)
+        ]
+        assert all(job["status"] == "pending" and "Março" in job["subject"] + job["body"] for job in jobs)
+        print("✓ Lembrete mensal: um email por processo e mês, pelo outbox")
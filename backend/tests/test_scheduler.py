@@ -0,0 +1,163 @@
+"""
+Testes do agendador de tarefas (services/scheduler.py)
+"""
+import asyncio
+from datetime import datetime, timezone, timedelta
+
+import pytest
+import pytest_asyncio
+
+from services.scheduler import CronSchedule, IntervalSchedule, JobScheduler, LeaderLease
+
+
+def utc(*args):
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+@pytest_asyncio.fixture
+async def scheduler_db():
+    """Base de dados de teste (salta se o MongoDB não estiver disponível)."""
+    from database import db
+    
+    try:
+        await asyncio.wait_for(db.command("ping"), timeout=2)
+    except Exception:
+        pytest.skip("MongoDB não disponível")
+    
+    yield db
+    
+    await db.scheduler_leases.delete_many({"_id": {"$regex": "^test-"}})
+    await db.scheduler_jobs.delete_many({"_id": {"$regex": "^test-"}})
+    await db.scheduler_runs.delete_many({"scheduler": {"$regex": "^test-"}})
+
+
+class TestSchedules:
+    """Cálculo da próxima execução."""
+    
+    def test_daily_cron_in_local_timezone(self):
+        schedule = CronSchedule("0 8 * * *", tz="Europe/Lisbon")
+        
+        # Verão (UTC+1): 08:00 em Lisboa = 07:00 UTC
+        assert schedule.next_after(utc(2026, 7, 1, 6, 0)) == utc(2026, 7, 1, 7, 0)
+        assert schedule.next_after(utc(2026, 7, 1, 7, 0)) == utc(2026, 7, 2, 7, 0)
+        # Inverno (UTC+0)
+        assert schedule.next_after(utc(2026, 12, 1, 9, 0)) == utc(2026, 12, 2, 8, 0)
+        print("✓ Cron diário no fuso configurado")
+    
+    def test_steps_lists_and_weekdays(self):
+        every_quarter = CronSchedule("*/15 * * * *", tz="UTC")
+        assert every_quarter.next_after(utc(2026, 1, 1, 10, 7)) == utc(2026, 1, 1, 10, 15)
+        
+        weekdays = CronSchedule("0 9 * * 1-5", tz="UTC")
+        # 2026-01-03 é sábado
+        assert weekdays.next_after(utc(2026, 1, 3, 12, 0)) == utc(2026, 1, 5, 9, 0)
+        
+        monthly = CronSchedule("0 9 1 * *", tz="UTC")
+        assert monthly.next_after(utc(2026, 1, 31, 12, 0)) == utc(2026, 2, 1, 9, 0)
+        
+        twice = CronSchedule("0 8,14 * * *", tz="UTC")
+        assert twice.next_after(utc(2026, 1, 1, 9, 0)) == utc(2026, 1, 1, 14, 0)
+        print("✓ Passos, listas e dias da semana")
+    
+    def test_invalid_expressions(self):
+        for expression in ["* * * *", "61 * * * *", "0 8 * * 9", "5-1 * * * *"]:
+            with pytest.raises(ValueError):
+                CronSchedule(expression)
+        print("✓ Expressões inválidas rejeitadas")
+    
+    def test_interval(self):
+        assert IntervalSchedule(90).next_after(utc(2026, 1, 1)) == utc(2026, 1, 1, 0, 1, 30)
+        
+        scheduler = JobScheduler(database=None, name="test")
+        with pytest.raises(ValueError):
+            scheduler.add_job("x", lambda: None)
+        print("✓ Intervalo fixo")
+
+
+class TestLeaderLease:
+    """Lease de líder partilhado entre réplicas."""
+    
+    @pytest.mark.asyncio
+    async def test_only_one_owner(self, scheduler_db):
+        first = LeaderLease(scheduler_db, "test-lease", ttl_seconds=60, owner="a")
+        second = LeaderLease(scheduler_db, "test-lease", ttl_seconds=60, owner="b")
+        
+        assert await first.acquire()
+        assert not await second.acquire()
+        assert await first.acquire()  # renovação
+        
+        await first.release()
+        assert await second.acquire()
+        print("✓ Apenas uma réplica detém o lease")
+    
+    @pytest.mark.asyncio
+    async def test_expired_lease_can_be_taken(self, scheduler_db):
+        first = LeaderLease(scheduler_db, "test-expired", ttl_seconds=60, owner="a")
+        second = LeaderLease(scheduler_db, "test-expired", ttl_seconds=60, owner="b")
+        assert await first.acquire()
+        
+        await scheduler_db.scheduler_leases.update_one(
+            {"_id": "test-expired"},
+            {"$set": {"expires_at": datetime.now(timezone.utc) - timedelta(seconds=1)}}
+        )
+        
+        assert await second.acquire()
+        assert not await first.acquire()
+        print("✓ Lease expirado passa para outra réplica")
+
+
+class TestJobScheduler:
+    """Execução, histórico e recuperação de execuções perdidas."""
+    
+    @pytest.mark.asyncio
+    async def test_run_is_recorded(self, scheduler_db):
+        scheduler = JobScheduler(scheduler_db, name="test-history")
+        
+        async def ok():
+            return 3
+        
+        async def fails():
+            raise RuntimeError("falhou")
+        
+        await scheduler.run_job(scheduler.add_job("ok", ok, every=60))
+        await scheduler.run_job(scheduler.add_job("fails", fails, every=60))
+        
+        runs = await scheduler_db.scheduler_runs.find({"scheduler": "test-history"}).to_list(None)
+        by_job = {run["job"]: run for run in runs}
+        assert by_job["ok"]["status"] == "success" and by_job["ok"]["result"] == 3
+        assert by_job["fails"]["status"] == "error" and "falhou" in by_job["fails"]["error"]
+        assert all(run["duration_ms"] >= 0 for run in runs)
+        
+        status = {s["job"]: s for s in await scheduler.get_status()}
+        assert status["fails"]["last_status"] == "error"
+        print("✓ Execuções registadas com estado e duração")
+    
+    @pytest.mark.asyncio
+    async def test_missed_run_is_caught_up_once(self, scheduler_db):
+        runs = []
+        
+        async def job():
+            runs.append(datetime.now(timezone.utc))
+        
+        scheduler = JobScheduler(scheduler_db, name="test-catchup", lease_seconds=3)
+        scheduler.add_job("daily", job, cron="0 8 * * *")
+        
+        # Execução em atraso (daemon esteve parado)
+        await scheduler_db.scheduler_jobs.update_one(
+            {"_id": "test-catchup:daily"},
+            {"$set": {"job": "daily", "next_run_at": datetime.now(timezone.utc) - timedelta(days=3)}},
+            upsert=True
+        )
+        
+        scheduler.start()
+        for _ in range(50):
+            if runs:
+                break
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(0.2)
+        await scheduler.stop()
+        
+        assert len(runs) == 1
+        state = await scheduler_db.scheduler_jobs.find_one({"_id": "test-catchup:daily"})
+        assert state["next_run_at"].replace(tzinfo=timezone.utc) > datetime.now(timezone.utc)
+        print("✓ Execução perdida recuperada uma única vez")
@@ -0,0 +1,154 @@
+"""
+====================================================================
+TESTES DO POOL SMTP - CREDITOIMO
+====================================================================
+Envio com ligações reutilizadas, contra o servidor SMTP local de
+substituição de conftest.py (a correr no mesmo event loop: só funciona
+se o envio não bloquear o loop).
+====================================================================
+"""
+
+from email.mime.text import MIMEText
+
+import asyncio
+import time
+
+import pytest
+
+from services import email as email_service
+from services.smtp_pool import SMTPPool
+
+
+def make_message(to: str, subject: str = "Documentação Mensal") -> MIMEText:
+    message = MIMEText("Olá", "plain", "utf-8")
+    message["Subject"] = subject
+    message["To"] = to
+    return message
+
+
+def make_pool(server, **kwargs) -> SMTPPool:
+    return SMTPPool("127.0.0.1", server.port, "sistema@test.pt", "secret", use_ssl=False, **kwargs)
+
+
+class TestSMTPPool:
+    """Reutilização de sessões, limites e resultado por mensagem."""
+    
+    @pytest.mark.asyncio
+    async def test_sessions_are_reused(self, smtp_server):
+        async with make_pool(smtp_server, size=2) as pool:
+            results = await pool.send_many([make_message(f"cliente{i}@test.pt") for i in range(20)])
+        
+        assert all(r["ok"] for r in results)
+        assert len(smtp_server.messages) == 20
+        assert smtp_server.sessions <= 2 and len(smtp_server.logins) == smtp_server.sessions
+        assert smtp_server.logins[0] == "sistema@test.pt"
+        assert b"From: sistema@test.pt" in smtp_server.messages[0]["data"]
+        print(f"✓ 20 emails em {smtp_server.sessions} sessões SMTP")
+    
+    @pytest.mark.asyncio
+    async def test_per_message_results(self, smtp_server):
+        async with make_pool(smtp_server, size=1) as pool:
+            results = await pool.send_many([
+                make_message("a@test.pt"),
+                make_message("reject@test.pt"),
+                make_message("b@test.pt"),
+            ])
+        
+        assert [r["ok"] for r in results] == [True, False, True]
+        assert results[1]["to"] == "reject@test.pt" and results[1]["error"]
+        assert results[1]["code"] == 550 and results[0]["code"] is None
+        # A recusa de um destinatário não invalida a sessão
+        assert smtp_server.sessions == 1
+        print("✓ Resultado por mensagem, sessão mantida após recusa")
+    
+    @pytest.mark.asyncio
+    async def test_session_message_limit(self, smtp_server):
+        async with make_pool(smtp_server, size=1, messages_per_connection=3) as pool:
+            results = await pool.send_many([make_message(f"c{i}@test.pt") for i in range(7)])
+        
+        assert all(r["ok"] for r in results)
+        assert smtp_server.sessions == 3
+        print("✓ Sessão renovada após o limite de mensagens")
+    
+    @pytest.mark.asyncio
+    async def test_dropped_session_is_reopened(self, smtp_server):
+        smtp_server.drop_after = 2
+        async with make_pool(smtp_server, size=1) as pool:
+            results = await pool.send_many([make_message(f"d{i}@test.pt") for i in range(5)])
+        
+        assert all(r["ok"] for r in results)
+        assert len(smtp_server.messages) == 5 and smtp_server.sessions == 3
+        print("✓ Ligação fechada pelo servidor reaberta automaticamente")
+    
+    @pytest.mark.asyncio
+    async def test_queue_wait_does_not_count_towards_timeout(self, smtp_server):
+        # 10 mensagens em 2 ligações a 0,3s cada: as últimas esperam ~1,2s pela vez
+        smtp_server.delay = 0.3
+        async with make_pool(smtp_server, size=2, send_timeout=1) as pool:
+            results = await pool.send_many([make_message(f"e{i}@test.pt") for i in range(10)])
+        
+        assert all(r["ok"] for r in results)
+        assert len(smtp_server.messages) == 10
+        print("✓ Tempo máximo conta só a partir do início de cada envio")
+    
+    @pytest.mark.asyncio
+    async def test_slow_connect_timeout_is_retryable_and_not_sent(self, smtp_server):
+        smtp_server.connect_delay = 0.6
+        async with make_pool(smtp_server, size=1, send_timeout=0.2) as pool:
+            result = await pool.send(make_message("f@test.pt"))
+            # A thread acaba de ligar depois do tempo máximo e desiste do envio
+            await asyncio.sleep(1)
+        
+        assert result["ok"] is False and result["unconfirmed"] is False
+        assert smtp_server.sessions == 1 and smtp_server.messages == []
+        print("✓ Ligação lenta: envio abandonado antes do sendmail, sem duplicado no retry")
+
+
+@pytest.fixture
+def email_transport(smtp_server, monkeypatch):
+    """Envio imediato (deliver_email) apontado para o servidor local."""
+    transport = make_pool(smtp_server, size=2, send_timeout=0.5)
+    monkeypatch.setattr(email_service, "smtp_transport", transport)
+    monkeypatch.setattr(email_service, "SMTP_SERVER", "127.0.0.1")
+    monkeypatch.setattr(email_service, "SMTP_EMAIL", "sistema@test.pt")
+    monkeypatch.setattr(email_service, "SMTP_PASSWORD", "secret")
+    return transport
+
+
+class TestEmailTransport:
+    """deliver_email sobre o pool partilhado."""
+    
+    @pytest.mark.asyncio
+    async def test_notifications_share_sessions(self, smtp_server, email_transport):
+        for i in range(3):
+            result = await email_service.deliver_email(f"staff{i}@test.pt", "Novo Prazo", "Texto", "<p>Texto</p>")
+            assert result["ok"]
+        await email_transport.close()
+        
+        assert len(smtp_server.messages) == 3
+        assert smtp_server.sessions == 1 and len(smtp_server.logins) == 1
+        assert smtp_server.messages[0]["to"] == ["staff0@test.pt"]
+        print("✓ Notificações por email reutilizam a sessão SMTP")
+    
+    @pytest.mark.asyncio
+    async def test_slow_server_times_out_without_blocking(self, smtp_server, email_transport):
+        smtp_server.delay = 2
+        ticks = 0
+        
+        async def heartbeat():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.05)
+        
+        beat = asyncio.create_task(heartbeat())
+        started = time.monotonic()
+        result = await email_service.deliver_email("lento@test.pt", "Assunto", "Texto")
+        elapsed = time.monotonic() - started
+        beat.cancel()
+        
+        assert result["ok"] is False and result["code"] is None
+        assert result["unconfirmed"] is True  # a mensagem já tinha seguido para o servidor
+        assert elapsed < 1.5
+        assert ticks >= 5  # o event loop continuou a correr durante o envio
+        print("✓ Servidor lento: tempo máximo respeitado sem bloquear o loop")
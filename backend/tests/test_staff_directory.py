@@ -0,0 +1,120 @@
+"""
+Testes do directório de utilizadores em cache (services/staff_directory.py)
+"""
+import pytest
+
+from services.staff_directory import StaffDirectory
+
+
+class FakeCursor:
+    def __init__(self, documents):
+        self.documents = documents
+    
+    async def to_list(self, length):
+        return self.documents
+
+
+class FakeUsersCollection:
+    """Colecção `users` mínima que conta as queries feitas."""
+    
+    def __init__(self, users):
+        self.users = {user["id"]: dict(user) for user in users}
+        self.queries = 0
+    
+    @staticmethod
+    def _project(user, projection):
+        return {k: v for k, v in user.items() if projection.get(k)}
+    
+    def find(self, query, projection):
+        self.queries += 1
+        return FakeCursor([self._project(u, projection) for u in self.users.values()])
+    
+    async def find_one(self, query, projection):
+        self.queries += 1
+        user = self.users.get(query["id"])
+        return self._project(user, projection) if user else None
+
+
+class FakeDatabase:
+    def __init__(self, users):
+        self.users = FakeUsersCollection(users)
+
+
+def make_users():
+    return [
+        {"id": "u-admin", "email": "admin@test.pt", "name": "Admin", "role": "admin", "is_active": True, "password": "x"},
+        {"id": "u-ceo", "email": "ceo@test.pt", "name": "CEO", "role": "ceo"},
+        {"id": "u-dir", "email": "dir@test.pt", "name": "Diretor", "role": "diretor", "is_active": False},
+        {"id": "u-cons", "email": "cons@test.pt", "name": "Consultor", "role": "consultor", "is_active": True},
+    ]
+
+
+class TestStaffDirectory:
+    """Resolução de destinatários a partir da cache."""
+    
+    @pytest.mark.asyncio
+    async def test_lookups_use_a_single_query(self):
+        database = FakeDatabase(make_users())
+        directory = StaffDirectory(database)
+        
+        staff = await directory.get_users_by_roles(["admin", "ceo", "diretor"])
+        assert {u["id"] for u in staff} == {"u-admin", "u-ceo"}
+        
+        users = await directory.get_users(["u-cons", "u-admin", "u-cons", "missing"])
+        assert [u["email"] for u in users] == ["cons@test.pt", "admin@test.pt"]
+        
+        assert (await directory.get_user("u-ceo"))["name"] == "CEO"
+        assert "password" not in await directory.get_user("u-admin")
+        assert database.users.queries == 1
+        print("✓ Um único carregamento serve todas as consultas")
+    
+    @pytest.mark.asyncio
+    async def test_inactive_users_are_filtered_on_request(self):
+        directory = StaffDirectory(FakeDatabase(make_users()))
+        
+        active = await directory.get_users_by_roles(["diretor"])
+        everyone = await directory.get_users_by_roles(["diretor"], active_only=False)
+        
+        assert active == []
+        assert [u["id"] for u in everyone] == ["u-dir"]
+        print("✓ Utilizadores desactivados excluídos por omissão")
+    
+    @pytest.mark.asyncio
+    async def test_refresh_and_remove_after_writes(self):
+        database = FakeDatabase(make_users())
+        directory = StaffDirectory(database)
+        await directory.get_all_users()
+        
+        # Mudança de role
+        database.users.users["u-cons"]["role"] = "admin"
+        await directory.refresh_user("u-cons")
+        admins = await directory.get_users_by_roles(["admin"])
+        assert {u["id"] for u in admins} == {"u-admin", "u-cons"}
+        assert await directory.get_users_by_roles(["consultor"]) == []
+        
+        # Novo utilizador
+        database.users.users["u-new"] = {"id": "u-new", "email": "new@test.pt", "name": "Novo", "role": "ceo"}
+        await directory.refresh_user("u-new")
+        assert {u["id"] for u in await directory.get_users_by_roles(["ceo"])} == {"u-ceo", "u-new"}
+        
+        # Eliminação
+        directory.remove_user("u-admin")
+        assert await directory.get_user("u-admin") is None
+        assert database.users.queries == 3
+        print("✓ Escritas de utilizadores reflectidas sem recarregar")
+    
+    @pytest.mark.asyncio
+    async def test_reload_after_ttl_or_invalidate(self):
+        database = FakeDatabase(make_users())
+        directory = StaffDirectory(database, ttl_seconds=0)
+        
+        await directory.get_all_users()
+        await directory.get_all_users()
+        assert database.users.queries == 2
+        
+        directory = StaffDirectory(database)
+        await directory.get_all_users()
+        directory.invalidate()
+        await directory.get_all_users()
+        assert database.users.queries == 4
+        print("✓ Recarregamento após expiração ou invalidação")
@@ -10,6 +10,7 @@ import pytest
 import asyncio
 from httpx import AsyncClient
 from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketState
 import os
 
 # Import app
@@ -86,6 +87,148 @@ class TestWebSocketManager:
         assert manager.is_user_connected("non_existent_user") == False
 
 
+class FakeWebSocket:
+    """WebSocket em memória para testes do gestor de conexões."""
+    
+    def __init__(self, fail_send: bool = False):
+        self.accepted = False
+        self.closed_code = None
+        self.sent = []
+        self.fail_send = fail_send
+        self.application_state = WebSocketState.CONNECTING
+    
+    async def accept(self):
+        self.accepted = True
+        self.application_state = WebSocketState.CONNECTED
+    
+    async def close(self, code: int = 1000, reason: str = ""):
+        self.closed_code = code
+        self.application_state = WebSocketState.DISCONNECTED
+    
+    async def send_json(self, message):
+        if self.fail_send:
+            raise RuntimeError("conexão morta")
+        self.sent.append(message)
+
+
+class TestConnectionManagerHeartbeat:
+    """Testes para heartbeat, limites e índices do gestor de conexões."""
+    
+    @pytest.mark.asyncio
+    async def test_role_index_and_broadcast_to_roles(self):
+        """Broadcast por papel usa o índice interno (sem users_data externo)."""
+        from services.websocket_manager import ConnectionManager
+        
+        manager = ConnectionManager()
+        admin_ws, consultor_ws = FakeWebSocket(), FakeWebSocket()
+        await manager.connect(admin_ws, "u1", "admin")
+        await manager.connect(consultor_ws, "u2", "consultor")
+        
+        assert manager.get_connected_users_by_role(["admin", "ceo"]) == ["u1"]
+        await manager.broadcast_to_roles({"type": "x"}, ["admin"])
+        assert admin_ws.sent == [{"type": "x"}]
+        assert consultor_ws.sent == []
+        
+        manager.disconnect(admin_ws)
+        assert manager.role_index == {"consultor": {"u2"}}
+    
+    @pytest.mark.asyncio
+    async def test_heartbeat_reaps_silent_connections(self):
+        """Conexões sem actividade durante N heartbeats são removidas."""
+        from services.websocket_manager import ConnectionManager, WS_CLOSE_HEARTBEAT_TIMEOUT
+        
+        manager = ConnectionManager(max_missed_beats=2)
+        silent, active = FakeWebSocket(), FakeWebSocket()
+        await manager.connect(silent, "u1")
+        await manager.connect(active, "u2")
+        
+        for _ in range(2):
+            assert await manager.run_heartbeat() == 0
+            manager.touch(active)
+        
+        assert await manager.run_heartbeat() == 1
+        assert silent.closed_code == WS_CLOSE_HEARTBEAT_TIMEOUT
+        assert manager.get_connected_users() == ["u2"]
+        assert manager.get_total_connections() == 1
+    
+    @pytest.mark.asyncio
+    async def test_heartbeat_reaps_failed_sends(self):
+        """Conexões cujo envio do ping falha são removidas imediatamente."""
+        from services.websocket_manager import ConnectionManager
+        
+        manager = ConnectionManager()
+        await manager.connect(FakeWebSocket(fail_send=True), "u1")
+        
+        assert await manager.run_heartbeat() == 1
+        assert manager.get_total_connections() == 0
+    
+    @pytest.mark.asyncio
+    async def test_connection_limits(self):
+        """Limite por utilizador fecha a mais antiga; limite por worker recusa."""
+        from services.websocket_manager import ConnectionManager, WS_CLOSE_USER_LIMIT
+        
+        manager = ConnectionManager(max_connections_per_user=2, max_connections_per_worker=3)
+        first, second, third = FakeWebSocket(), FakeWebSocket(), FakeWebSocket()
+        for ws in (first, second, third):
+            assert await manager.connect(ws, "u1")
+        
+        assert first.closed_code == WS_CLOSE_USER_LIMIT
+        assert manager.active_connections["u1"] == {second, third}
+        
+        assert await manager.connect(FakeWebSocket(), "u2")
+        rejected = FakeWebSocket()
+        assert not await manager.connect(rejected, "u3")
+        assert not rejected.accepted
+        assert manager.get_total_connections() == 3
+
+
+class ScriptedWebSocket(FakeWebSocket):
+    """WebSocket que recebe as mensagens indicadas e depois é fechado pelo servidor."""
+    
+    def __init__(self, manager, messages):
+        super().__init__()
+        self.manager = manager
+        self.messages = list(messages)
+        self.receives = 0
+    
+    async def receive_json(self):
+        self.receives += 1
+        if self.application_state != WebSocketState.CONNECTED:
+            # Comportamento do Starlette depois de close() do lado do servidor
+            raise RuntimeError('WebSocket is not connected. Need to call "accept" first.')
+        if self.messages:
+            return self.messages.pop(0)
+        # Heartbeat expirado: o gestor fecha a conexão
+        await self.manager._close(self, 4000, "Heartbeat expirado")
+        return {"type": "ping"}
+
+
+class TestWebSocketEndpoint:
+    """Loop de recepção do endpoint /ws/notifications."""
+    
+    @pytest.mark.asyncio
+    async def test_server_side_close_ends_receive_loop(self, monkeypatch):
+        """Conexão fechada pelo servidor termina o loop e limpa o gestor."""
+        from routes import websocket as ws_routes
+        from services.websocket_manager import ConnectionManager
+        
+        manager = ConnectionManager()
+        
+        async def fake_verify(token):
+            return {"id": "u1", "name": "Ana", "role": "consultor"}
+        
+        monkeypatch.setattr(ws_routes, "manager", manager)
+        monkeypatch.setattr(ws_routes, "verify_websocket_token", fake_verify)
+        
+        websocket = ScriptedWebSocket(manager, [{"type": "ping"}])
+        await asyncio.wait_for(ws_routes.websocket_notifications(websocket, "token"), timeout=2)
+        
+        assert websocket.closed_code == 4000
+        assert websocket.receives == 3
+        assert manager.get_total_connections() == 0
+        print("✓ Fecho do lado do servidor termina o loop de recepção")
+
+
 class TestWSEventTypes:
     """Testes para tipos de eventos WebSocket."""
     
@@ -149,7 +292,87 @@ class TestRealtimeNotifications:
         from services.realtime_notifications import notify_process_update
         
         assert callable(notify_process_update)
-
+    
+    
+    @pytest.mark.asyncio
+    async def test_coalescer_batches_within_window(self):
+        """Notificações do mesmo utilizador na mesma janela são entregues juntas."""
+        from services.realtime_notifications import NotificationCoalescer
+        
+        delivered = []
+        
+        async def deliver(user_id, notifications):
+            delivered.append((user_id, [n["id"] for n in notifications]))
+        
+        coalescer = NotificationCoalescer(20, deliver)
+        for notification_id in ("a", "b", "c"):
+            await coalescer.add("u1", {"id": notification_id})
+        await coalescer.add("u2", {"id": "d"})
+        assert delivered == []
+        
+        await asyncio.sleep(0.06)
+        assert sorted(delivered) == [("u1", ["a", "b", "c"]), ("u2", ["d"])]
+    
+    @pytest.mark.asyncio
+    async def test_coalescer_disabled_and_flush_all(self):
+        """Janela 0 entrega de imediato; flush_all entrega o que está pendente."""
+        from services.realtime_notifications import NotificationCoalescer
+        
+        delivered = []
+        
+        async def deliver(user_id, notifications):
+            delivered.append(len(notifications))
+        
+        await NotificationCoalescer(0, deliver).add("u1", {"id": "a"})
+        assert delivered == [1]
+        
+        coalescer = NotificationCoalescer(10_000, deliver)
+        await coalescer.add("u1", {"id": "b"})
+        await coalescer.add("u1", {"id": "c"})
+        await coalescer.flush_all()
+        assert delivered == [1, 2]
+    
+    @pytest.mark.asyncio
+    async def test_coalescer_add_many(self):
+        """Um lote multi-destinatário é repartido por utilizador."""
+        from services.realtime_notifications import NotificationCoalescer
+        
+        delivered = []
+        
+        async def deliver(user_id, notifications):
+            delivered.append((user_id, len(notifications)))
+        
+        notifications = [{"id": str(i), "user_id": f"u{i % 3}"} for i in range(6)]
+        await NotificationCoalescer(0, deliver).add_many(notifications[:3])
+        assert sorted(delivered) == [("u0", 1), ("u1", 1), ("u2", 1)]
+        
+        delivered.clear()
+        coalescer = NotificationCoalescer(10_000, deliver)
+        await coalescer.add_many(notifications)
+        await coalescer.flush_all()
+        assert sorted(delivered) == [("u0", 2), ("u1", 2), ("u2", 2)]
+    
+    @pytest.mark.asyncio
+    async def test_bulk_notification_without_recipients(self):
+        """Sem destinatários não há escrita nem entrega."""
+        from services.realtime_notifications import send_bulk_realtime_notification
+        
+        assert await send_bulk_realtime_notification([None, ""], "t", "m") == []
+    
+    def test_push_summary(self):
+        """A push agrupada resume os títulos e mantém o link comum."""
+        from services.realtime_notifications import _build_push_summary
+        
+        notifications = [
+            {"title": f"T{i}", "message": "m", "link": "/process/p1", "process_id": "p1"}
+            for i in range(6)
+        ]
+        summary = _build_push_summary(notifications)
+        
+        assert summary["title"] == "6 novas notificações"
+        assert summary["body"].splitlines() == ["• T0", "• T1", "• T2", "• T3", "… e mais 2"]
+        assert summary["url"] == "/process/p1"
+        assert summary["data"] == {"process_ids": ["p1"]}
 
 # Testes de integração (requerem servidor a correr)
 class TestWebSocketIntegration:
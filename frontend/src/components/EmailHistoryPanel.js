@@ -45,6 +45,8 @@ const EmailHistoryPanel = ({
   maxHeight = "400px"
 }) => {
   const [emails, setEmails] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [loadingMore, setLoadingMore] = useState(false);
   const [stats, setStats] = useState({ total: 0, sent: 0, received: 0 });
   const [loading, setLoading] = useState(true);
   const [syncing, setSyncing] = useState(false);
@@ -129,7 +131,8 @@ const EmailHistoryPanel = ({
         getProcessEmails(processId, filter === "all" ? null : filter),
         getEmailStats(processId)
       ]);
-      setEmails(emailsRes.data);
+      setEmails(emailsRes.data.emails);
+      setNextCursor(emailsRes.data.next_cursor);
       setStats(statsRes.data);
     } catch (error) {
       console.error("Erro ao carregar emails:", error);
@@ -138,6 +141,19 @@ const EmailHistoryPanel = ({
     }
   };
 
+  const handleLoadMore = async () => {
+    try {
+      setLoadingMore(true);
+      const response = await getProcessEmails(processId, filter === "all" ? null : filter, nextCursor);
+      setEmails(prev => [...prev, ...response.data.emails]);
+      setNextCursor(response.data.next_cursor);
+    } catch (error) {
+      console.error("Erro ao carregar mais emails:", error);
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
   const handleSyncEmails = async () => {
     if (!clientEmail) {
       toast.error("Cliente não tem email definido");
@@ -388,6 +404,17 @@ const EmailHistoryPanel = ({
                     </div>
                   </div>
                 ))}
+                {nextCursor && (
+                  <Button
+                    variant="ghost"
+                    size="sm"
+                    className="w-full text-xs"
+                    onClick={handleLoadMore}
+                    disabled={loadingMore}
+                  >
+                    {loadingMore ? "A carregar..." : "Carregar mais emails"}
+                  </Button>
+                )}
               </div>
             </ScrollArea>
           )}
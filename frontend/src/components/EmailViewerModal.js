@@ -12,6 +12,7 @@ import {
 } from "lucide-react";
 import { format, parseISO } from "date-fns";
 import { pt } from "date-fns/locale";
+import { getEmail } from "../services/api";
 
 const EmailViewerModal = ({ 
   isOpen, 
@@ -22,6 +23,8 @@ const EmailViewerModal = ({
 }) => {
   const [currentEmail, setCurrentEmail] = useState(null);
   const [currentIndex, setCurrentIndex] = useState(0);
+  // Corpos já carregados (a listagem só traz o resumo de cada email)
+  const [bodies, setBodies] = useState({});
 
   useEffect(() => {
     if (selectedEmailId && emails.length > 0) {
@@ -33,6 +36,20 @@ const EmailViewerModal = ({
     }
   }, [selectedEmailId, emails]);
 
+  useEffect(() => {
+    if (!isOpen || !currentEmail || bodies[currentEmail.id]) return;
+    const emailId = currentEmail.id;
+    getEmail(emailId)
+      .then(response => {
+        const { body, body_html } = response.data;
+        setBodies(prev => ({ ...prev, [emailId]: { body, body_html } }));
+      })
+      .catch(error => {
+        console.error("Erro ao carregar email:", error);
+        setBodies(prev => ({ ...prev, [emailId]: { body: currentEmail.preview || "" } }));
+      });
+  }, [isOpen, currentEmail, bodies]);
+
   const handleSelectEmail = (email, index) => {
     setCurrentEmail(email);
     setCurrentIndex(index);
@@ -57,6 +74,8 @@ const EmailViewerModal = ({
 
   if (!currentEmail) return null;
 
+  const currentBody = bodies[currentEmail.id];
+
   return (
     <Dialog open={isOpen} onOpenChange={onClose}>
       <DialogContent className="max-w-6xl h-[85vh] p-0 gap-0 overflow-hidden">
@@ -206,14 +225,16 @@ const EmailViewerModal = ({
             {/* Corpo do email - com scroll visível */}
             <div className="flex-1 overflow-y-auto p-4 scrollbar-thin scrollbar-thumb-muted-foreground/30 scrollbar-track-transparent hover:scrollbar-thumb-muted-foreground/50">
               <div className="prose prose-sm max-w-none dark:prose-invert">
-                {currentEmail.body_html ? (
+                {!currentBody ? (
+                  <p className="text-sm text-muted-foreground">A carregar...</p>
+                ) : currentBody.body_html ? (
                   <div 
-                    dangerouslySetInnerHTML={{ __html: currentEmail.body_html }}
+                    dangerouslySetInnerHTML={{ __html: currentBody.body_html }}
                     className="email-content"
                   />
                 ) : (
                   <pre className="whitespace-pre-wrap font-sans text-sm">
-                    {currentEmail.body}
+                    {currentBody.body}
                   </pre>
                 )}
               </div>
@@ -11,7 +11,7 @@ import {
 } from "./ui/dropdown-menu";
 import { ScrollArea } from "./ui/scroll-area";
 import { Bell, BellRing, UserPlus, Clock, FileText, Calendar, AlertTriangle, CheckCircle, Volume2, VolumeX, ArrowRight } from "lucide-react";
-import { getNotifications, markNotificationRead } from "../services/api";
+import { getNotifications, getUnreadNotificationsCount, markNotificationRead, markAllNotificationsRead } from "../services/api";
 import { toast } from "sonner";
 
 const notificationIcons = {
@@ -131,12 +131,24 @@ const NotificationsDropdown = () => {
     }
   }, [navigate, playNotificationSound]);
 
+  // Poll only the unread counter; reload the list when it changes
+  const pollUnreadCount = useCallback(async () => {
+    try {
+      const res = await getUnreadNotificationsCount();
+      if ((res.data.unread || 0) !== previousUnreadCount.current) {
+        fetchNotifications();
+      }
+    } catch (error) {
+      console.error("Erro ao obter contagem de notificações:", error);
+    }
+  }, [fetchNotifications]);
+
   useEffect(() => {
     fetchNotifications();
     // Fast polling for real-time notifications (10 seconds)
-    const interval = setInterval(fetchNotifications, POLLING_INTERVAL);
+    const interval = setInterval(pollUnreadCount, POLLING_INTERVAL);
     return () => clearInterval(interval);
-  }, [fetchNotifications]);
+  }, [fetchNotifications, pollUnreadCount]);
 
   const handleNotificationClick = async (notification) => {
     try {
@@ -147,6 +159,7 @@ const NotificationsDropdown = () => {
           prev.map(n => n.id === notification.id ? { ...n, read: true } : n)
         );
         setUnreadCount(prev => Math.max(0, prev - 1));
+        previousUnreadCount.current = Math.max(0, previousUnreadCount.current - 1);
       }
       
       // Navigate to process if exists
@@ -162,10 +175,10 @@ const NotificationsDropdown = () => {
 
   const markAllAsRead = async () => {
     try {
-      const unreadNotifications = notifications.filter(n => !n.read);
-      await Promise.all(unreadNotifications.map(n => markNotificationRead(n.id)));
+      await markAllNotificationsRead();
       setNotifications(prev => prev.map(n => ({ ...n, read: true })));
       setUnreadCount(0);
+      previousUnreadCount.current = 0;
       toast.success("Todas as notificações marcadas como lidas");
     } catch (error) {
       toast.error("Erro ao marcar notificações");
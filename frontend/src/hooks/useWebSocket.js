@@ -19,6 +19,7 @@ import { useAuth } from '../contexts/AuthContext';
 export const WSEventType = {
   // Notificações
   NEW_NOTIFICATION: 'new_notification',
+  NOTIFICATION_BATCH: 'notification_batch',
   NOTIFICATION_READ: 'notification_read',
   ALL_NOTIFICATIONS_READ: 'all_notifications_read',
   
@@ -127,6 +128,15 @@ export function useWebSocket(options = {}) {
       
       const { type, data: payload } = data;
       
+      // Lote de notificações agrupadas pelo servidor: tratar cada uma individualmente
+      if (type === WSEventType.NOTIFICATION_BATCH) {
+        (payload?.notifications || []).forEach((notification) => {
+          eventHandlersRef.current[WSEventType.NEW_NOTIFICATION]?.forEach(handler => handler(notification, data));
+          onNotification?.(notification);
+        });
+        return;
+      }
+      
       // Chamar handler registado para este tipo de evento
       if (eventHandlersRef.current[type]) {
         eventHandlersRef.current[type].forEach(handler => handler(payload, data));
@@ -156,6 +166,10 @@ export function useWebSocket(options = {}) {
           break;
         
         case WSEventType.HEARTBEAT:
+          // Ping do servidor: responder para não ser considerado inactivo
+          if (payload?.status === 'ping' && wsRef.current?.readyState === WebSocket.OPEN) {
+            wsRef.current.send(JSON.stringify({ type: 'pong' }));
+          }
           // Pong recebido, conexão está activa
           break;
         
@@ -94,6 +94,10 @@ export const getNotifications = (unreadOnly = false) =>
   axios.get(`${API_URL}/alerts/notifications`, { params: { unread_only: unreadOnly } });
 export const markNotificationRead = (id) => 
   axios.put(`${API_URL}/alerts/notifications/${id}/read`);
+export const getUnreadNotificationsCount = () => 
+  axios.get(`${API_URL}/alerts/notifications/unread-count`);
+export const markAllNotificationsRead = () => 
+  axios.put(`${API_URL}/alerts/notifications/read-all`);
 export const getProcessAlerts = (processId) => 
   axios.get(`${API_URL}/processes/${processId}/alerts`);
 export const getAlertsByProcess = (processId) => 
@@ -124,8 +128,9 @@ export const reopenTask = (id) => axios.put(`${API_URL}/tasks/${id}/reopen`);
 export const deleteTask = (id) => axios.delete(`${API_URL}/tasks/${id}`);
 
 // Emails
-export const getProcessEmails = (processId, direction = null) => 
-  axios.get(`${API_URL}/emails/process/${processId}`, { params: { direction } });
+export const getProcessEmails = (processId, direction = null, cursor = null) => 
+  axios.get(`${API_URL}/emails/process/${processId}`, { params: { direction, cursor } });
+export const getEmail = (id) => axios.get(`${API_URL}/emails/${id}`);
 export const getEmailStats = (processId) => axios.get(`${API_URL}/emails/stats/${processId}`);
 export const createEmail = (data) => axios.post(`${API_URL}/emails`, data);
 export const updateEmail = (id, data) => axios.put(`${API_URL}/emails/${id}`, data);